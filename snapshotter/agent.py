@@ -0,0 +1,368 @@
+"""A small helper agent for running filesystem operations on remote hosts.
+
+Instead of spawning a new ssh process for every ls, mv, rm or ln that
+snapshotter needs to run on a remote destination, the agent is started once
+over a single ssh session and then answers requests through a compact
+JSON-lines protocol on its stdin and stdout.
+
+Each request is one line of JSON like {"op": "rename", "src": ..., "dest": ...}
+and each response is one line of JSON, either {"ok": true, "result": ...} or
+{"ok": false, "error": "No such file or directory", "errno": 2}.
+
+The source code of this module is itself sent to the remote host and executed
+there, so it must only import from the standard library and must work with
+whatever Python the remote host has. It only knows the basic filesystem
+operations. The other operations, like verifying or comparing snapshots, are
+in their own modules (see MODULE_OPS), which are sent to the agent the first
+time that one of their operations is called.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import atexit
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import types
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+PROTOCOL_VERSION = 1
+
+
+# Server side.
+
+def _op_hello():
+    return {"version": PROTOCOL_VERSION}
+
+
+def _op_list(path):
+    """Return [name, is_dir] pairs for each entry in the directory path."""
+    return [[name, os.path.isdir(os.path.join(path, name))]
+            for name in os.listdir(path)]
+
+
+def _op_stat(path):
+    stat = os.lstat(path)
+    return {
+        "mode": stat.st_mode,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "nlink": stat.st_nlink,
+        "ino": stat.st_ino,
+        "dev": stat.st_dev,
+        "uid": stat.st_uid,
+        "gid": stat.st_gid,
+    }
+
+
+def _op_rename(src, dest):
+    os.rename(src, dest)
+
+
+def _op_symlink(target, path):
+    os.symlink(target, path)
+
+
+def _op_unlink(path, missing_ok=False):
+    try:
+        os.unlink(path)
+    except OSError as err:
+        if not (missing_ok and err.errno == 2):
+            raise
+
+
+def _op_rmtree(path):
+    # Like `rm -r -f`: it isn't an error if path doesn't exist.
+    if os.path.lexists(path):
+        shutil.rmtree(path)
+
+
+def _op_statvfs(path):
+    stat = os.statvfs(path)
+    return dict((field, getattr(stat, field)) for field in (
+        "f_bsize", "f_frsize", "f_blocks", "f_bfree", "f_bavail",
+        "f_files", "f_ffree", "f_favail"))
+
+
+def _op_mkdir(path):
+    # Like `mkdir -p`.
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def _op_reap(path):
+    """Start deleting path in a detached `rm -r -f` process.
+
+    The process is in its own session so it carries on after the agent and
+    the ssh connection have gone. Returns its process ID.
+
+    """
+    devnull = open(os.devnull, "r+b")
+    process = subprocess.Popen(
+        ["rm", "-r", "-f", path], stdin=devnull, stdout=devnull,
+        stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+    devnull.close()
+    return process.pid
+
+
+def _op_load(name, source):
+    """Run the source code of the module snapshotter.name and add its OPS.
+
+    The module is registered as part of a stand-in snapshotter package, so
+    that modules that are loaded later can import it.
+
+    """
+    package = sys.modules.get("snapshotter")
+    if package is None:
+        package = sys.modules["snapshotter"] = types.ModuleType(
+            str("snapshotter"))
+        package.__path__ = []
+    module = types.ModuleType(str("snapshotter." + name))
+    sys.modules[module.__name__] = module
+    setattr(package, str(name), module)
+    exec(compile(source, "snapshotter/" + name + ".py", "exec"),
+         module.__dict__)
+    _OPS.update(module.OPS)
+
+
+_OPS = {
+    "hello": _op_hello,
+    "list": _op_list,
+    "stat": _op_stat,
+    "rename": _op_rename,
+    "symlink": _op_symlink,
+    "unlink": _op_unlink,
+    "rmtree": _op_rmtree,
+    "statvfs": _op_statvfs,
+    "mkdir": _op_mkdir,
+    "reap": _op_reap,
+    "load": _op_load,
+}
+
+
+def _handle(request):
+    """Run a single request dict and return the response dict."""
+    try:
+        function = _OPS[request.pop("op")]
+    except KeyError:
+        return {"ok": False, "error": "Unknown operation", "errno": None}
+    try:
+        return {"ok": True, "result": function(**request)}
+    except EnvironmentError as err:
+        return {"ok": False, "error": err.strerror or str(err),
+                "errno": err.errno}
+    except (TypeError, ValueError) as err:
+        return {"ok": False, "error": str(err), "errno": None}
+
+
+def serve(stdin=None, stdout=None):
+    """Answer JSON-lines requests from stdin until it's closed."""
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    while True:
+        line = stdin.readline()
+        if not line:
+            return
+        if not line.strip():
+            continue
+        stdout.write(json.dumps(_handle(json.loads(line))) + "\n")
+        stdout.flush()
+
+
+# Client side.
+
+# The bootstrap program that's passed to `python -c` on the remote host.
+# It reads the agent's source code from stdin and runs it, after which the
+# agent reads requests from the same stdin.
+_BOOTSTRAP = (
+    "import sys;"
+    "exec(compile(sys.stdin.read(%d),'snapshotter-agent','exec'),"
+    "{'__name__':'__main__'})")
+
+
+#: The modules of the operations that the agent only has once they've been
+#: sent to it, by operation. Each of those modules has an OPS dict of its
+#: operations and, like this one, only imports from the standard library.
+MODULE_OPS = {
+    "sql": "database",
+    "scan": "diskusage",
+    "reclaimable": "diskusage",
+    "hash": "integrity",
+    "verify": "integrity",
+    "lock": "locking",
+    "unlock": "locking",
+    "reflink_seed": "reflinks",
+    "diff": "treediff",
+}
+
+#: The modules of MODULE_OPS that the others import.
+_MODULE_IMPORTS = {
+    "treediff": ["integrity"],
+}
+
+
+def _source(name="agent"):
+    """Return the source code of the module snapshotter.name, as bytes."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        name + ".py")
+    with open(path, "rb") as file_:
+        return file_.read()
+
+
+def bootstrap_command(python=None):
+    """Return the argv to start an agent with a local Python interpreter."""
+    return [python or sys.executable, "-c", _BOOTSTRAP % len(_source())]
+
+
+def remote_command():
+    """Return the command to start an agent over ssh, as a list.
+
+    The command is a single shell string because ssh passes it to the remote
+    user's shell. It prefers python3 and falls back to python.
+
+    """
+    bootstrap = quote(_BOOTSTRAP % len(_source()))
+    return ["command -v python3 >/dev/null 2>&1 "
+            "&& exec python3 -c {b} || exec python -c {b}".format(b=bootstrap)]
+
+
+class AgentUnavailableError(Exception):
+
+    """Raised if the agent couldn't be started or has stopped responding."""
+
+    pass
+
+
+class RemoteError(Exception):
+
+    """Raised when an operation fails on the remote host."""
+
+    def __init__(self, op, message, errno=None):
+        super(RemoteError, self).__init__(message)
+        self.op = op
+        self.message = message
+        self.errno = errno
+
+
+class Agent(object):
+
+    """A connection to a running agent process."""
+
+    def __init__(self, command):
+        self.command = command
+        self._lock = threading.Lock()
+        self._loaded = set()
+        self._loading = threading.Lock()
+        self._process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self._process.stdin.write(_source())
+            self._process.stdin.flush()
+        except EnvironmentError as err:
+            raise AgentUnavailableError(err)
+        self.version = self.call("hello")["version"]
+
+    def call(self, op, **kwargs):
+        """Run op on the agent with the given arguments and return its result.
+
+        The module of the operation (see MODULE_OPS) is sent to the agent
+        first, if it hasn't been already.
+
+        :raises RemoteError: if the operation fails on the remote host
+        :raises AgentUnavailableError: if the agent has gone away
+
+        """
+        if op in MODULE_OPS:
+            self._load(MODULE_OPS[op])
+        return self._call(op, **kwargs)
+
+    def _load(self, name):
+        """Send the module name, and the modules it imports, to the agent."""
+        with self._loading:
+            for module in _MODULE_IMPORTS.get(name, []) + [name]:
+                if module not in self._loaded:
+                    self._call("load", name=module,
+                               source=_source(module).decode("utf-8"))
+                    self._loaded.add(module)
+
+    def _call(self, op, **kwargs):
+        request = dict(kwargs, op=op)
+        with self._lock:
+            try:
+                self._process.stdin.write(
+                    (json.dumps(request) + "\n").encode("utf-8"))
+                self._process.stdin.flush()
+                line = self._process.stdout.readline()
+            except EnvironmentError as err:
+                raise AgentUnavailableError(err)
+        if not line:
+            raise AgentUnavailableError(
+                "The agent exited with status {status}".format(
+                    status=self._process.poll()))
+        response = json.loads(line.decode("utf-8"))
+        if not response["ok"]:
+            raise RemoteError(op, response["error"], response["errno"])
+        return response.get("result")
+
+    def close(self):
+        """Stop the agent by closing its stdin and wait for it to exit."""
+        with self._lock:
+            try:
+                self._process.stdin.close()
+            except EnvironmentError:
+                pass
+            self._process.wait()
+
+
+_agents = {}
+_agents_lock = threading.Lock()
+
+
+def connect(key, command):
+    """Return a running agent for key, starting it with command if needed.
+
+    Returns None if the agent can't be started (for example because the
+    remote host has no Python) so that callers can fall back to running
+    separate commands over ssh. A failure is remembered, so we only try to
+    start an agent once per key.
+
+    """
+    with _agents_lock:
+        if key not in _agents:
+            try:
+                _agents[key] = Agent(command)
+            except (AgentUnavailableError, EnvironmentError, ValueError):
+                _agents[key] = None
+        return _agents[key]
+
+
+def connected(key):
+    """Return True if connect() has already been called for key."""
+    with _agents_lock:
+        return key in _agents
+
+
+def close_all():
+    """Stop all the agents started by connect()."""
+    with _agents_lock:
+        for agent in _agents.values():
+            if agent is not None:
+                agent.close()
+        _agents.clear()
+
+
+atexit.register(close_all)
+
+
+if __name__ == "__main__":
+    serve()
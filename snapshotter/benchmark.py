@@ -0,0 +1,482 @@
+"""End-to-end benchmarks of snapshotter on synthetic source trees.
+
+Run with:
+
+    python -m snapshotter.benchmark [--scenarios cycles,list,prune,remote]
+        [--files N] [--sizes SIZES] [--depth D] [--churn F] [--runs R]
+        [--snapshots S] [--seed SEED] [--dir DIR] [--output FILE]
+
+and compare the results of two runs (for example of two versions) with:
+
+    python -m snapshotter.benchmark --compare OLD.json NEW.json
+
+The scenarios are:
+
+cycles
+    For each of --engines, a full snapshot of a generated source tree and
+    then --runs incremental snapshots, each after changing --churn of its
+    files.
+
+list
+    Listing a destination with --snapshots snapshots, with _ls_snapshots()
+    and with _list_snapshots() (which first builds the catalog, then reads
+    it).
+
+prune
+    Thinning --snapshots hourly snapshots with a retention policy, and
+    deleting the removed snapshots in the background.
+
+remote
+    The cycles scenario with rsync to localhost:DIR, through a stand-in for
+    ssh that runs the commands on this host, so that rsync's remote protocol
+    and the helper agent are measured without the network.
+
+The trees are generated from --seed, so that runs with the same options
+copy the same files. The results are printed and, with --output, written as
+JSON along with the options and the Python, platform and snapshotter
+versions.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import stat as stat_module
+import subprocess
+import sys
+import tempfile
+import time
+
+from snapshotter import agent
+from snapshotter import retention
+from snapshotter import snapshotter
+
+
+SCENARIOS = ["cycles", "list", "prune", "remote"]
+
+#: The default file size distribution: 60% of files of 1 KiB, 35% of
+#: 16 KiB and 5% of 256 KiB.
+SIZES = "1k:60,16k:35,256k:5"
+
+_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+#: The retention policy of the prune scenario.
+PRUNE_POLICY = "daily=7,weekly=4,monthly=*"
+
+#: A stand-in for ssh that runs `ssh HOST COMMAND...` on this host.
+SSH_STAND_IN = """#!/bin/sh
+shift
+exec sh -c "$*"
+"""
+
+
+def parse_sizes(text_):
+    """Parse a size distribution like "4k:70,64k:25,4m:5".
+
+    Returns a list of (bytes, weight) pairs. Sizes can have a k, m or g
+    suffix (powers of 1024).
+
+    :raises ValueError: if the distribution is invalid
+
+    """
+    sizes = []
+    for part in text_.split(","):
+        try:
+            size, weight = part.strip().lower().split(":")
+            unit = size[-1] if size[-1:] in _UNITS else ""
+            sizes.append((int(size[:len(size) - len(unit)]) * _UNITS[unit],
+                          float(weight)))
+        except (ValueError, IndexError):
+            raise ValueError("invalid size distribution: " + text_)
+    if not sizes or any(s < 0 or w <= 0 for s, w in sizes):
+        raise ValueError("invalid size distribution: " + text_)
+    return sizes
+
+
+class SyntheticTree(object):
+
+    """A reproducible source tree of random files.
+
+    The files are spread over directories up to depth levels deep, with
+    fanout subdirectories per directory, and their sizes are drawn from
+    sizes (see parse_sizes()). The same arguments always generate the same
+    tree, and the same sequence of churn() calls the same changes.
+
+    """
+
+    def __init__(self, root, files, sizes=SIZES, depth=3, fanout=10,
+                 seed=0):
+        self.root = root
+        self.files = files
+        self.sizes = parse_sizes(sizes) if isinstance(
+            sizes, type("")) else sizes
+        self.depth = depth
+        self.fanout = fanout
+        self.random = random.Random(seed)
+        self.paths = []
+        self._created = 0
+        # File contents are slices of one random block, which is much
+        # quicker than generating random bytes for every file.
+        length = min(max([1024 ** 2] + [s for s, _ in self.sizes]),
+                     16 * 1024 ** 2)
+        self._block = bytes(bytearray(
+            self.random.getrandbits(8) for _ in range(4096))) * (
+                length // 4096 + 1)
+
+    def _size(self):
+        point = self.random.uniform(0, sum(w for _, w in self.sizes))
+        for size, weight in self.sizes:
+            point -= weight
+            if point <= 0:
+                return size
+        return self.sizes[-1][0]
+
+    def _directory(self):
+        levels = self.random.randint(0, self.depth)
+        return os.path.join(*(["."] + [
+            "d%02d" % self.random.randrange(self.fanout)
+            for _ in range(levels)]))
+
+    def _write(self, relative, size):
+        path = os.path.join(self.root, relative)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        offset = self.random.randrange(4096)
+        with open(path, "wb") as file_:
+            while size > 0:
+                chunk = self._block[offset:offset + size]
+                file_.write(chunk)
+                size -= len(chunk)
+                offset = 0
+
+    def _new_file(self):
+        relative = os.path.normpath(os.path.join(
+            self._directory(), "f%07d" % self._created))
+        self._created += 1
+        self._write(relative, self._size())
+        self.paths.append(relative)
+
+    def create(self):
+        """Generate the tree. Returns the total bytes of its files."""
+        os.makedirs(self.root)
+        for _ in range(self.files):
+            self._new_file()
+        return self.size()
+
+    def size(self):
+        return sum(os.lstat(os.path.join(self.root, p)).st_size
+                   for p in self.paths)
+
+    def churn(self, fraction):
+        """Change about fraction of the files, like a day's work would.
+
+        A tenth of the changed files are deleted and as many new ones
+        created, the rest are appended to. Returns the number of files
+        changed and created.
+
+        """
+        count = min(len(self.paths), int(round(len(self.paths) * fraction)))
+        changed = self.random.sample(self.paths, count)
+        deleted = changed[:count // 10]
+        for relative in deleted:
+            os.unlink(os.path.join(self.root, relative))
+            self.paths.remove(relative)
+        for relative in changed[count // 10:]:
+            with open(os.path.join(self.root, relative), "ab") as file_:
+                file_.write(self._block[:self.random.randint(1, 4096)])
+        for _ in deleted:
+            self._new_file()
+        return count + len(deleted)
+
+
+def _timed(function, *args, **kwargs):
+    started = time.time()
+    function(*args, **kwargs)
+    return time.time() - started
+
+
+def _snapshot_name(when):
+    return when.strftime("%Y-%m-%dT%H_%M_%S") + ".snapshot"
+
+
+def make_snapshots(dest, count, files=0):
+    """Create count hourly snapshot directories in dest.
+
+    Each one has files small files, most of them hard links shared with the
+    other snapshots as rsync's --link-dest would make them.
+
+    """
+    shared = os.path.join(dest, "shared")
+    os.makedirs(shared)
+    for number in range(files):
+        with open(os.path.join(shared, "f%05d" % number), "wb") as file_:
+            file_.write(b"shared")
+    start = datetime.datetime(2015, 1, 1)
+    for number in range(count):
+        snapshot_ = os.path.join(dest, _snapshot_name(
+            start + datetime.timedelta(hours=number)))
+        os.mkdir(snapshot_)
+        for name in sorted(os.listdir(shared))[:max(0, files - 1)]:
+            os.link(os.path.join(shared, name), os.path.join(snapshot_, name))
+        if files:
+            with open(os.path.join(snapshot_, "unique"), "wb") as file_:
+                file_.write(b"unique")
+    shutil.rmtree(shared)
+
+
+def cycles(work, options, engines, dest_prefix=""):
+    """Time a full snapshot and options.runs incremental ones per engine.
+
+    Returns {engine: {"full": seconds, "incremental": [seconds...],
+    "incremental_mean": seconds, "bytes": the source's size}}.
+
+    """
+    results = {}
+    for engine in engines:
+        source = os.path.join(work, "source")
+        dest = os.path.join(work, "dest-" + engine)
+        if os.path.exists(source):
+            shutil.rmtree(source)
+        os.mkdir(dest)
+        # The same tree and changes for each engine.
+        tree = SyntheticTree(source, options.files, options.sizes,
+                             options.depth, options.fanout, options.seed)
+        size = tree.create()
+        full = _timed(snapshotter.snapshot, source, dest_prefix + dest,
+                      engine=engine)
+        incremental = []
+        for _ in range(options.runs):
+            tree.churn(options.churn)
+            # Snapshot names only go down to the second.
+            time.sleep(1)
+            incremental.append(_timed(snapshotter.snapshot, source,
+                                      dest_prefix + dest, engine=engine))
+        results[engine] = {
+            "full": full,
+            "incremental": incremental,
+            "incremental_mean": (sum(incremental) / len(incremental)
+                                 if incremental else None),
+            "bytes": size,
+        }
+        snapshotter._reaper.wait()
+        shutil.rmtree(dest)
+    return results
+
+
+def list_snapshots(work, options):
+    """Time listing a destination with options.snapshots snapshots."""
+    dest = os.path.join(work, "list")
+    os.mkdir(dest)
+    make_snapshots(dest, options.snapshots)
+    return {
+        "snapshots": options.snapshots,
+        "ls_snapshots": _timed(snapshotter._ls_snapshots, dest),
+        "list_snapshots_cold": _timed(snapshotter._list_snapshots, dest),
+        "list_snapshots_warm": _timed(snapshotter._list_snapshots, dest),
+    }
+
+
+def prune(work, options):
+    """Time thinning options.snapshots snapshots with PRUNE_POLICY."""
+    dest = os.path.join(work, "prune")
+    os.mkdir(dest)
+    make_snapshots(dest, options.snapshots, files=10)
+    # Build the catalog first, as a long-used destination would have one.
+    snapshotter._list_snapshots(dest)
+    started = time.time()
+    removed = snapshotter._apply_retention(
+        dest, retention.parse_policy(PRUNE_POLICY))
+    thinned = time.time() - started
+    snapshotter._reaper.wait()
+    return {
+        "snapshots": options.snapshots,
+        "removed": len(removed),
+        "thin": thinned,
+        "deleted": time.time() - started,
+    }
+
+
+def remote(work, options):
+    """The cycles scenario with rsync to localhost through a fake ssh."""
+    bin_ = os.path.join(work, "bin")
+    os.mkdir(bin_)
+    ssh = os.path.join(bin_, "ssh")
+    with io.open(ssh, "w") as file_:
+        file_.write(SSH_STAND_IN)
+    os.chmod(ssh, os.stat(ssh).st_mode | stat_module.S_IXUSR)
+    path = os.environ.get("PATH", "")
+    os.environ["PATH"] = bin_ + os.pathsep + path
+    try:
+        return cycles(work, options, ["rsync"], dest_prefix="localhost:")
+    finally:
+        agent.close_all()
+        os.environ["PATH"] = path
+
+
+def _version():
+    """Return {"version": ..., "commit": ...} of this snapshotter."""
+    version = commit = None
+    try:
+        from importlib import metadata
+        version = metadata.version("snapshotter")
+    except Exception:
+        pass
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (EnvironmentError, subprocess.CalledProcessError):
+        pass
+    return {"version": version, "commit": commit}
+
+
+def run(options):
+    """Run the scenarios in options.scenarios, return the results dict."""
+    results = {}
+    work = tempfile.mkdtemp(dir=options.dir)
+    try:
+        for scenario in options.scenarios:
+            directory = os.path.join(work, scenario)
+            os.mkdir(directory)
+            if scenario == "cycles":
+                results[scenario] = cycles(directory, options,
+                                           options.engines)
+            elif scenario == "list":
+                results[scenario] = list_snapshots(directory, options)
+            elif scenario == "prune":
+                results[scenario] = prune(directory, options)
+            elif scenario == "remote":
+                results[scenario] = remote(directory, options)
+            shutil.rmtree(directory)
+    finally:
+        shutil.rmtree(work)
+    return {
+        "snapshotter": _version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": datetime.datetime.now().isoformat(),
+        "options": dict((key, value) for key, value in vars(options).items()
+                        if key not in ("output", "compare", "dir")),
+        "results": results,
+    }
+
+
+def timings(results):
+    """Return {"scenario.key...": seconds} for the timings in results."""
+    flat = {}
+
+    def walk(prefix, value):
+        if isinstance(value, dict):
+            for key, child in value.items():
+                walk(prefix + [key], child)
+        elif isinstance(value, float):
+            flat[".".join(prefix)] = value
+    walk([], results["results"])
+    return flat
+
+
+def compare(old, new, threshold=0.1):
+    """Return (lines, regressions) comparing two results dicts.
+
+    A timing is a regression if it's more than threshold (a fraction)
+    slower in new than in old.
+
+    """
+    old_timings, new_timings = timings(old), timings(new)
+    lines = ["{name:45} {old:>9} {new:>9} {change:>8}".format(
+        name="timing", old="old", new="new", change="change")]
+    regressions = []
+    for name in sorted(set(old_timings) & set(new_timings)):
+        before, after = old_timings[name], new_timings[name]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  slower"
+        lines.append(
+            "{name:45} {old:8.3f}s {new:8.3f}s {change:+7.1%}{flag}".format(
+                name=name, old=before, new=after, change=change, flag=flag))
+    return lines, regressions
+
+
+def _scenarios(text_):
+    scenarios = text_.split(",")
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            "unknown scenarios: " + ", ".join(sorted(unknown)))
+    return scenarios
+
+
+def _sizes(text_):
+    try:
+        parse_sizes(text_)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(err)
+    return text_
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m snapshotter.benchmark")
+    parser.add_argument("--scenarios", type=_scenarios,
+                        default=["cycles", "list", "prune"],
+                        help="comma-separated, from: " + ",".join(SCENARIOS))
+    parser.add_argument("--engines", type=lambda s: s.split(","),
+                        default=["rsync", "native"])
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--sizes", type=_sizes, default=SIZES,
+                        help="file size distribution as SIZE:WEIGHT pairs "
+                             "(default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=10)
+    parser.add_argument("--churn", type=float, default=0.01,
+                        help="fraction of files changed before each "
+                             "incremental snapshot")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="incremental snapshots per engine")
+    parser.add_argument("--snapshots", type=int, default=2000,
+                        help="snapshots for the list and prune scenarios")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", help="where to create the test trees")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results to FILE as JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two JSON results files instead")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="with --compare, exit with status 1 if any "
+                             "timing is more than this fraction slower")
+    options = parser.parse_args(args)
+
+    if options.compare:
+        with io.open(options.compare[0]) as file_:
+            old = json.load(file_)
+        with io.open(options.compare[1]) as file_:
+            new = json.load(file_)
+        lines, regressions = compare(old, new, options.threshold)
+        print("\n".join(lines))
+        if regressions:
+            sys.exit(1)
+        return
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(options)
+    for name, seconds in sorted(timings(results).items()):
+        print("{name:45} {seconds:8.3f}s".format(name=name, seconds=seconds))
+    if options.output:
+        with io.open(options.output, "w") as file_:
+            # On Python 2 json.dumps() returns bytes, which a text file
+            # doesn't take, but adding the newline makes it text.
+            file_.write(json.dumps(results, indent=2, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    main()
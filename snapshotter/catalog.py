@@ -0,0 +1,219 @@
+"""A catalog of the snapshots in a destination directory.
+
+The catalog is a small SQLite database, catalog.sqlite in the destination
+directory, with one row for each snapshot: its name, its timestamp, how long
+it took, how many bytes rsync transferred, how many files it contains and its
+status ("complete" or "deleted"). Finding the snapshots in a destination is
+then a single query instead of a listing of the whole directory.
+
+The catalog is only a cache of the directory listing: it's created from the
+listing when it doesn't exist yet, and `snapshotter reindex DEST` rebuilds it
+from the listing at any time.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import os
+
+from snapshotter import agent
+from snapshotter import database
+from snapshotter import progress
+
+
+FILENAME = "catalog.sqlite"
+
+COMPLETE = "complete"
+DELETED = "deleted"
+
+#: A snapshot's row in the catalog. duration, bytes and files are None for
+#: snapshots that were added by reindex().
+Entry = collections.namedtuple(
+    "Entry", ["name", "timestamp", "duration", "bytes", "files", "status"])
+
+_SCHEMA = [
+    ["CREATE TABLE IF NOT EXISTS snapshots ("
+     "name TEXT PRIMARY KEY, timestamp TEXT NOT NULL, duration REAL, "
+     "bytes INTEGER, files INTEGER, status TEXT NOT NULL)", []],
+    ["CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+     []],
+]
+
+
+def path_for(snapshots_root):
+    """Return the catalog path for the given destination directory."""
+    return os.path.join(snapshots_root, FILENAME)
+
+
+def timestamp(name):
+    """Return the ISO 8601 timestamp of the given snapshot name.
+
+    For example "2015-03-05T16_23_12.snapshot" -> "2015-03-05T16:23:12".
+
+    """
+    if name.endswith(".snapshot"):
+        name = name[:-len(".snapshot")]
+    return name.replace("_", ":")
+
+
+class CatalogError(Exception):
+
+    """Raised if the catalog can't be read or written."""
+
+    pass
+
+
+class Catalog(object):
+
+    """The catalog of a local or remote destination directory.
+
+    Statements are run by the given execute function, which has the same
+    signature as database.sql() and defaults to it. For a remote destination
+    pass a function that runs the agent's "sql" operation instead.
+
+    The methods that write to the catalog do nothing if it doesn't exist, so
+    that it's only ever created (from the directory listing) by reindex().
+
+    """
+
+    def __init__(self, path, execute=None):
+        self.path = path
+        self._execute = execute or database.sql
+
+    def _run(self, statements, create=False):
+        """Run statements in one transaction, return the rows of each one.
+
+        Returns None if create is False and the catalog doesn't exist.
+
+        """
+        try:
+            result = self._execute(self.path, _SCHEMA + statements,
+                                   create=create)
+        except (EnvironmentError, agent.RemoteError,
+                agent.AgentUnavailableError) as err:
+            raise CatalogError("{path}: {err}".format(path=self.path,
+                                                      err=err))
+        if result is None:
+            return None
+        return result[len(_SCHEMA):]
+
+    def snapshots(self):
+        """Return the sorted names of the complete snapshots.
+
+        Returns None if the catalog doesn't exist or was never indexed.
+
+        """
+        result = self._run([
+            ["SELECT value FROM meta WHERE key = 'indexed'", []],
+            ["SELECT name FROM snapshots WHERE status = ? ORDER BY name",
+             [COMPLETE]],
+        ])
+        if result is None or not result[0]:
+            return None
+        return [name for name, in result[1]]
+
+    def entries(self):
+        """Return an Entry for every snapshot in the catalog, oldest first."""
+        result = self._run([
+            ["SELECT name, timestamp, duration, bytes, files, status "
+             "FROM snapshots ORDER BY name", []],
+        ])
+        if result is None:
+            return []
+        return [Entry(*row) for row in result[0]]
+
+    def add(self, name, duration=None, bytes_=None, files=None):
+        """Record a new complete snapshot."""
+        self._run([
+            ["INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?)",
+             [name, timestamp(name), duration, bytes_, files, COMPLETE]],
+        ])
+
+    def remove(self, names):
+        """Record that the snapshots with the given names have been deleted."""
+        self._run([["UPDATE snapshots SET status = ? WHERE name = ?",
+                    [DELETED, name]] for name in names])
+
+    def reindex(self, names):
+        """Rebuild the catalog from the given snapshot names.
+
+        Snapshots that aren't in names are marked as deleted, and the
+        statistics of snapshots that are already in the catalog are kept.
+        The catalog is created if it doesn't exist.
+
+        """
+        statements = [["UPDATE snapshots SET status = ?", [DELETED]]]
+        for name in names:
+            statements.append([
+                "INSERT OR IGNORE INTO snapshots (name, timestamp, status) "
+                "VALUES (?, ?, ?)", [name, timestamp(name), COMPLETE]])
+            statements.append([
+                "UPDATE snapshots SET status = ? WHERE name = ?",
+                [COMPLETE, name]])
+        statements.append([
+            "INSERT OR REPLACE INTO meta VALUES ('indexed', ?)", ["1"]])
+        self._run(statements, create=True)
+
+
+class Recorder(object):
+
+    """A consumer that collects a new snapshot's statistics for the catalog.
+
+    rsync must be run with --stats. The totals are added up over all the
+    rsyncs that copy into the snapshot (with --jobs, or when rsync is run
+    again after running out of space). Rsyncs that run at the same time
+    must each be given their own consumer from fork().
+
+    """
+
+    def __init__(self):
+        self._runs = []
+
+    def __call__(self, line):
+        if line.flags is not None:
+            return
+        if line.text.startswith("Number of files:"):
+            # The start of the --stats output of another rsync.
+            self._runs.append(progress.Stats())
+        if self._runs:
+            self._runs[-1](line)
+
+    def fork(self):
+        """Return a consumer for the output of one of several rsyncs.
+
+        Its --stats are added to this recorder's totals.
+
+        """
+        stats = progress.Stats()
+        self._runs.append(stats)
+        return stats
+
+    def _finished_runs(self):
+        return [run for run in self._runs if run.totals]
+
+    def total(self, key):
+        """Return the total of the given --stats key, or None if unknown."""
+        runs = self._finished_runs()
+        if not runs:
+            return None
+        return sum(run.totals.get(key, 0) for run in runs)
+
+    def totals(self):
+        """Return {--stats key: total} over all the rsyncs."""
+        totals = {}
+        for run in self._finished_runs():
+            for key, value in run.totals.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    @property
+    def bytes(self):
+        """The number of bytes transferred, or None if unknown."""
+        return self.total("Total transferred file size")
+
+    @property
+    def files(self):
+        """The number of files in the snapshot, or None if unknown."""
+        return self.total("Number of files")
@@ -0,0 +1,264 @@
+"""A content-hash index for finding renamed and moved files across snapshots.
+
+rsync's --link-dest and --fuzzy only find an unchanged file if it's at the
+same path (or, for --fuzzy, in the same directory) as in the previous
+snapshot, so renaming a big directory makes the next snapshot copy and store
+all of it again. The content index, content-index.sqlite in the destination
+directory, maps the SHA-256 and size of each file that rsync has created or
+updated to its path in the snapshot it was created in and its inode number.
+
+After each run the files that rsync newly created are looked up in the index
+and, if the same content is still in an earlier snapshot, replaced with a
+hard link to it (see dedup()). For remote sources, seed() can hard-link the
+files into incomplete.snapshot before the transfer, so that rsync doesn't
+transfer them at all.
+
+A file is only linked to if it's still the file that was indexed (it has the
+same inode number) and it has the same size, modification time, permissions
+and owner as the new file, so that linking doesn't change either of them.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import logging
+import os
+import sqlite3
+import stat as stat_module
+from multiprocessing.pool import ThreadPool
+
+from snapshotter import integrity
+from snapshotter import itemize
+from snapshotter import pack
+
+
+FILENAME = "content-index.sqlite"
+
+#: Files smaller than this aren't worth hashing and linking.
+MIN_SIZE = 64 * 1024
+
+#: A file's hash and the metadata that must match to link to another file.
+#: mtime is in nanoseconds, see integrity.mtime_ns().
+Fingerprint = collections.namedtuple(
+    "Fingerprint", ["hash", "size", "mtime", "mode", "uid", "gid"])
+
+
+def path_for(snapshots_root):
+    """Return the content index path for the given destination directory."""
+    return os.path.join(snapshots_root, FILENAME)
+
+
+def _log():
+    return logging.getLogger("snapshotter")
+
+
+def fingerprint(path):
+    """Return the Fingerprint of the file at path.
+
+    Returns None if it isn't a regular file of at least MIN_SIZE bytes.
+
+    """
+    stat = os.lstat(path)
+    if not stat_module.S_ISREG(stat.st_mode) or stat.st_size < MIN_SIZE:
+        return None
+    return Fingerprint(integrity.file_hash(path), stat.st_size,
+                       integrity.mtime_ns(stat), stat.st_mode, stat.st_uid,
+                       stat.st_gid)
+
+
+class ContentIndex(object):
+
+    """The content index of a local destination directory."""
+
+    def __init__(self, snapshots_root):
+        self.snapshots_root = snapshots_root
+        self.path = path_for(snapshots_root)
+        self._connection = sqlite3.connect(self.path, timeout=60,
+                                           check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (hash TEXT NOT NULL, "
+            "size INTEGER NOT NULL, snapshot TEXT NOT NULL, "
+            "path TEXT NOT NULL, inode INTEGER NOT NULL, "
+            "PRIMARY KEY (hash, size))")
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute(
+            "SELECT count(*) FROM files").fetchone()[0]
+
+    def add(self, entries):
+        """Record (hash, size, snapshot, path, inode) entries, newest wins."""
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", entries)
+
+    def find(self, fingerprint_):
+        """Return the path of an existing file to link to, or None.
+
+        The file is looked for at its indexed path in latest.snapshot first,
+        because files that haven't changed since they were indexed are still
+        there, and then in the snapshot it was indexed in, unless that has
+        been packed since.
+
+        """
+        row = self._connection.execute(
+            "SELECT snapshot, path, inode FROM files WHERE hash = ? AND "
+            "size = ?", (fingerprint_.hash, fingerprint_.size)).fetchone()
+        if row is None:
+            return None
+        snapshot, path, inode = row
+        for snapshot_ in ("latest.snapshot", snapshot):
+            snapshot_path = os.path.join(self.snapshots_root, snapshot_)
+            if pack.is_packed(snapshot_path):
+                continue
+            candidate = os.path.join(snapshot_path, path)
+            try:
+                stat = os.lstat(candidate)
+            except OSError:
+                continue
+            if stat.st_ino == inode and (
+                    stat.st_size, integrity.mtime_ns(stat), stat.st_mode,
+                    stat.st_uid, stat.st_gid) == tuple(fingerprint_[1:]):
+                return candidate
+        return None
+
+
+def _link(target, path):
+    """Replace the file at path, or create it, as a hard link to target."""
+    tmp = path + ".snapshotter-link"
+    os.link(target, tmp)
+    os.rename(tmp, path)
+
+
+def _hash_all(paths, threads):
+    """Return [(path, Fingerprint or None)] for paths, hashed in parallel."""
+    def hash_one(path):
+        try:
+            return path, fingerprint(path)
+        except EnvironmentError:
+            return path, None
+
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(hash_one, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def dedup(index, incomplete, snapshot, changes, threads=4, batch=1000):
+    """Link new files in incomplete to existing copies and index them.
+
+    changes is an iterable of (flags, path) pairs of the files that rsync
+    changed, as yielded by manifest.read(). Newly created files whose
+    content is found in the index are replaced with hard links to the
+    existing file, then all the created and updated files are added to the
+    index as being in snapshot (the name incomplete will be renamed to).
+
+    Returns (files, bytes) linked.
+
+    """
+    linked = [0, 0]
+    pending = []
+
+    def flush():
+        entries = []
+        for (path, created), (full, fingerprint_) in zip(
+                pending, _hash_all([os.path.join(incomplete, p)
+                                    for p, _ in pending], threads)):
+            if fingerprint_ is None:
+                continue
+            target = index.find(fingerprint_) if created else None
+            if target is not None:
+                try:
+                    _link(target, full)
+                except OSError as err:
+                    _log().warning("Linking {path} failed: {err}".format(
+                        path=full, err=err))
+                else:
+                    _log().debug("Linked {path} to {target}".format(
+                        path=full, target=target))
+                    linked[0] += 1
+                    linked[1] += fingerprint_.size
+            entries.append((fingerprint_.hash, fingerprint_.size, snapshot,
+                            path, os.lstat(full).st_ino))
+        index.add(entries)
+        del pending[:]
+
+    for flags, path in changes:
+        if flags.startswith("*") or flags[1] != "f":
+            continue
+        change = itemize.change_type(flags)
+        if change not in (itemize.CREATED, itemize.UPDATED):
+            continue
+        pending.append((path, change == itemize.CREATED))
+        if len(pending) >= batch:
+            flush()
+    flush()
+    return tuple(linked)
+
+
+def seed(index, incomplete, fingerprints):
+    """Link the files that are about to be transferred to existing copies.
+
+    fingerprints is a list of (path, Fingerprint) pairs of files in the
+    source, relative to the root of the snapshot. Each file whose content is
+    found in the index is hard-linked into incomplete at its path, so that
+    rsync finds it already up to date.
+
+    Returns (files, bytes) linked.
+
+    """
+    linked_files, linked_bytes = 0, 0
+    for path, fingerprint_ in fingerprints:
+        target = index.find(fingerprint_)
+        if target is None:
+            continue
+        full = os.path.join(incomplete, path)
+        try:
+            if not os.path.isdir(os.path.dirname(full)):
+                os.makedirs(os.path.dirname(full))
+            if not os.path.lexists(full):
+                os.link(target, full)
+        except OSError as err:
+            _log().warning("Linking {path} failed: {err}".format(path=full,
+                                                                 err=err))
+            continue
+        linked_files += 1
+        linked_bytes += fingerprint_.size
+    return linked_files, linked_bytes
+
+
+def build(index, snapshot_dir, snapshot, threads=4, batch=1000):
+    """Index all the files in the existing snapshot directory snapshot_dir.
+
+    snapshot is the name to index them under. Returns the number of files
+    indexed.
+
+    """
+    count = [0]
+    pending = []
+
+    def flush():
+        entries = []
+        for full, fingerprint_ in _hash_all(pending, threads):
+            if fingerprint_ is None:
+                continue
+            entries.append((fingerprint_.hash, fingerprint_.size, snapshot,
+                            os.path.relpath(full, snapshot_dir),
+                            os.lstat(full).st_ino))
+        index.add(entries)
+        count[0] += len(entries)
+        del pending[:]
+
+    for root, _, files in os.walk(snapshot_dir):
+        for name in files:
+            pending.append(os.path.join(root, name))
+            if len(pending) >= batch:
+                flush()
+    flush()
+    return count[0]
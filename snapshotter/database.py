@@ -0,0 +1,49 @@
+"""Running SQL statements on SQLite databases, locally or on remote hosts.
+
+The catalog (see catalog.Catalog) of a remote destination lives on the
+remote host, and its statements are run there with sql() by the helper
+agent (see agent.MODULE_OPS), so this module may only use the standard
+library.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+
+
+def sql(path, statements, create=True):
+    """Run [sql, params] statements on the SQLite database at path.
+
+    The statements are run in a single transaction, which is rolled back if
+    any of them fails. Returns a list of the rows that each statement
+    returned, or None if create is False and the database doesn't exist.
+
+    SQLite errors, and the remote Python having no sqlite3 module, are raised
+    as EnvironmentErrors so that they're returned to the client.
+
+    """
+    if not create and not os.path.exists(path):
+        return None
+    try:
+        import sqlite3
+    except ImportError as err:
+        raise EnvironmentError(None, str(err))
+    try:
+        connection = sqlite3.connect(path, timeout=60)
+        try:
+            with connection:
+                return [[list(row) for row in
+                         connection.execute(statement, params).fetchall()]
+                        for statement, params in statements]
+        finally:
+            connection.close()
+    except sqlite3.Error as err:
+        raise EnvironmentError(None, str(err))
+
+
+#: The operations that this module adds to the agent.
+OPS = {
+    "sql": sql,
+}
@@ -0,0 +1,398 @@
+"""Deduplicating identical files across snapshots and destinations.
+
+Hard links only ever point from a snapshot to earlier snapshots of the same
+source, so when many similar sources (say 50 near-identical servers) are
+backed up into sibling destinations on the same volume, each copy of an
+identical file is stored once per source. dedup() finds the files in all the
+snapshots under a root directory that are identical, in contents and in
+metadata, and replaces the duplicates with hard links to one of them.
+
+Only files with the same device, size, modification time, permissions and
+owner are compared, so that linking them changes neither their contents nor
+their metadata: files in snapshots share their metadata with every other
+link. Candidates are confirmed with a hash of their first PARTIAL_SIZE bytes
+and then with a hash of their whole contents.
+
+The state of the pass is kept in an index, dedup-index.sqlite in the root
+directory, of the inodes seen so far (and their hashes, once they've been
+needed). Snapshots are never changed once they've been made, so each
+snapshot is only scanned once and later runs only look at the inodes of new
+snapshots.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import errno
+import hashlib
+import logging
+import os
+import sqlite3
+import stat as stat_module
+from multiprocessing.pool import ThreadPool
+
+from snapshotter import integrity
+
+
+FILENAME = "dedup-index.sqlite"
+
+#: Files smaller than this aren't worth linking.
+MIN_SIZE = 4096
+
+#: The number of bytes that are hashed to rule out most candidates cheaply.
+PARTIAL_SIZE = 64 * 1024
+
+#: The snapshot directories that dedup() doesn't touch.
+SKIPPED = ("latest.snapshot", "incomplete.snapshot")
+
+#: The outcome of a dedup() run: the number of new snapshots scanned, the
+#: number of files in them, the number of files replaced with hard links,
+#: and the number of inodes and bytes on disk that that freed.
+Result = collections.namedtuple(
+    "Result", ["snapshots", "files", "linked", "inodes", "bytes"])
+
+
+class _Inode(object):
+
+    """A file being considered for deduplication, with all its paths."""
+
+    def __init__(self, device, inode, metadata, paths, nlink=1, blocks=0,
+                 partial=None, hash_=None, indexed=False):
+        self.device = device
+        self.inode = inode
+        #: (size, mtime in ns, mode, uid, gid): what must match to link.
+        self.metadata = metadata
+        #: Paths relative to the root directory.
+        self.paths = paths
+        self.nlink = nlink
+        self.blocks = blocks
+        self.partial = partial
+        self.hash = hash_
+        #: True if the inode was already in the index before this run.
+        self.indexed = indexed
+
+    @property
+    def key(self):
+        return self.device, self.inode
+
+
+def _log():
+    return logging.getLogger("snapshotter")
+
+
+def _mtime_ns(stat):
+    mtime_ns = getattr(stat, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(round(stat.st_mtime * 10 ** 9))
+    return mtime_ns
+
+
+def _metadata(stat):
+    return (stat.st_size, _mtime_ns(stat), stat.st_mode, stat.st_uid,
+            stat.st_gid)
+
+
+def find_snapshots(root):
+    """Return the paths, relative to root, of the snapshots under root.
+
+    Those are the *.snapshot directories in root and in its subdirectories
+    (each a destination directory), except latest.snapshot and
+    incomplete.snapshot. Trash directories aren't searched.
+
+    """
+    snapshots = []
+    for directory, dirs, _ in os.walk(root):
+        for name in list(dirs):
+            full = os.path.join(directory, name)
+            if name.endswith(".snapshot"):
+                dirs.remove(name)
+                if name not in SKIPPED and not os.path.islink(full):
+                    snapshots.append(os.path.relpath(full, root))
+            elif name == "trash":
+                dirs.remove(name)
+    return sorted(snapshots)
+
+
+def _scan(root, snapshot, min_size):
+    """Return [(path, stat)] of the regular files in the snapshot."""
+    files = []
+    top = os.path.join(root, snapshot)
+    device = os.lstat(top).st_dev
+    for directory, dirs, names in os.walk(top):
+        for name in list(dirs):
+            try:
+                if os.lstat(os.path.join(directory, name)).st_dev != device:
+                    dirs.remove(name)
+            except OSError:
+                dirs.remove(name)
+        for name in names:
+            full = os.path.join(directory, name)
+            try:
+                stat = os.lstat(full)
+            except OSError:
+                continue
+            if stat_module.S_ISREG(stat.st_mode) and stat.st_size >= min_size:
+                files.append((os.path.relpath(full, root), stat))
+    return files
+
+
+def partial_hash(path, size=PARTIAL_SIZE):
+    """Return the hex SHA-256 of the first size bytes of the file at path."""
+    with open(path, "rb") as file_:
+        return hashlib.sha256(file_.read(size)).hexdigest()
+
+
+class Index(object):
+
+    """The dedup index of the snapshots under a root directory."""
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, FILENAME)
+        self._connection = sqlite3.connect(self.path, timeout=60)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS inodes (device INTEGER NOT NULL, "
+                "inode INTEGER NOT NULL, size INTEGER NOT NULL, "
+                "mtime INTEGER NOT NULL, mode INTEGER NOT NULL, "
+                "uid INTEGER NOT NULL, gid INTEGER NOT NULL, partial TEXT, "
+                "hash TEXT, path TEXT NOT NULL, PRIMARY KEY (device, inode))")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS inodes_by_metadata ON inodes "
+                "(size, mtime, mode, uid, gid, device)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots "
+                "(path TEXT PRIMARY KEY)")
+
+    def close(self):
+        self._connection.close()
+
+    def snapshots(self):
+        """Return the set of snapshots that have already been scanned."""
+        return set(path for path, in self._connection.execute(
+            "SELECT path FROM snapshots"))
+
+    def forget_snapshots(self, snapshots):
+        """Forget the given snapshots, which no longer exist."""
+        with self._connection:
+            for snapshot in snapshots:
+                self._connection.execute(
+                    "DELETE FROM snapshots WHERE path = ?", (snapshot,))
+                self._connection.execute(
+                    "DELETE FROM inodes WHERE substr(path, 1, ?) = ?",
+                    (len(snapshot) + 1, snapshot + os.sep))
+
+    def add_snapshots(self, snapshots):
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO snapshots VALUES (?)",
+                [(snapshot,) for snapshot in snapshots])
+
+    def contains(self, device, inode):
+        return self._connection.execute(
+            "SELECT 1 FROM inodes WHERE device = ? AND inode = ?",
+            (device, inode)).fetchone() is not None
+
+    def matching(self, device, metadata):
+        """Return the indexed _Inodes with the given device and metadata."""
+        rows = self._connection.execute(
+            "SELECT inode, partial, hash, path FROM inodes WHERE size = ? AND "
+            "mtime = ? AND mode = ? AND uid = ? AND gid = ? AND device = ?",
+            tuple(metadata) + (device,)).fetchall()
+        return [_Inode(device, inode, metadata, [path], partial=partial,
+                       hash_=hash_, indexed=True)
+                for inode, partial, hash_, path in rows]
+
+    def add(self, inodes):
+        """Add or update the given _Inodes."""
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO inodes VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(inode.device, inode.inode) + tuple(inode.metadata) +
+                 (inode.partial, inode.hash, inode.paths[0])
+                 for inode in inodes])
+
+    def remove(self, inodes):
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM inodes WHERE device = ? AND inode = ?",
+                [inode.key for inode in inodes])
+
+
+def _still_there(root, inode):
+    """Return True if inode's first path still is that file, unchanged."""
+    try:
+        stat = os.lstat(os.path.join(root, inode.paths[0]))
+    except OSError:
+        return False
+    return ((stat.st_dev, stat.st_ino) == inode.key and
+            _metadata(stat) == tuple(inode.metadata))
+
+
+def _link(target, path):
+    """Replace the file at path with a hard link to target."""
+    tmp = path + ".snapshotter-dedup"
+    os.link(target, tmp)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+def _hash_all(root, inodes, attribute, function, pool):
+    """Set attribute of each of inodes to function(its first path).
+
+    Inodes that can't be read get None.
+
+    """
+    def hash_one(inode):
+        try:
+            return function(os.path.join(root, inode.paths[0]))
+        except EnvironmentError as err:
+            _log().warning("Reading {path} failed: {err}".format(
+                path=inode.paths[0], err=err))
+            return None
+
+    for inode, value in zip(inodes, pool.map(hash_one, inodes)):
+        setattr(inode, attribute, value)
+
+
+def _groups(inodes, attribute):
+    """Group inodes by attribute, returning the groups of 2 or more."""
+    groups = collections.OrderedDict()
+    for inode in inodes:
+        value = getattr(inode, attribute)
+        if value is not None:
+            groups.setdefault(value, []).append(inode)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def dedup(root, threads=8, min_size=MIN_SIZE, dry_run=False):
+    """Replace identical files in the snapshots under root with hard links.
+
+    The snapshots that haven't been scanned before are scanned with the
+    given number of threads, and each of their files is compared with the
+    other new files and with the files in the index that have the same
+    metadata. Of each set of identical files, the one that was indexed
+    first is kept and the others are replaced with hard links to it.
+
+    If dry_run is True nothing is linked and the index isn't updated, but
+    the result is what would have been done.
+
+    Returns a Result.
+
+    """
+    index = Index(root)
+    pool = ThreadPool(max(1, threads))
+    try:
+        snapshots = find_snapshots(root)
+        scanned = index.snapshots()
+        if not dry_run:
+            index.forget_snapshots(sorted(scanned - set(snapshots)))
+        new = [snapshot for snapshot in snapshots if snapshot not in scanned]
+        _log().info("Scanning {count} new snapshots".format(count=len(new)))
+
+        inodes = collections.OrderedDict()
+        files = 0
+        for snapshot, entries in zip(new, pool.map(
+                lambda snapshot: _scan(root, snapshot, min_size), new)):
+            for path, stat in entries:
+                files += 1
+                key = (stat.st_dev, stat.st_ino)
+                if key in inodes:
+                    inodes[key].paths.append(path)
+                elif not index.contains(*key):
+                    inodes[key] = _Inode(
+                        stat.st_dev, stat.st_ino, _metadata(stat), [path],
+                        stat.st_nlink, getattr(stat, "st_blocks", 0))
+
+        by_metadata = collections.OrderedDict()
+        for inode in inodes.values():
+            by_metadata.setdefault((inode.device, inode.metadata),
+                                   []).append(inode)
+        candidates, stale = [], []
+        for (device, metadata), group in by_metadata.items():
+            for indexed in index.matching(device, metadata):
+                if _still_there(root, indexed):
+                    group.insert(0, indexed)
+                else:
+                    stale.append(indexed)
+            if len(group) > 1:
+                candidates.append(group)
+
+        _hash_all(root, [inode for group in candidates for inode in group
+                         if inode.partial is None],
+                  "partial", partial_hash, pool)
+        same_start = [subgroup for group in candidates
+                      for subgroup in _groups(group, "partial")]
+        _hash_all(root, [inode for group in same_start for inode in group
+                         if inode.hash is None],
+                  "hash", integrity.file_hash, pool)
+
+        linked, freed, freed_bytes = 0, [], 0
+        changed_snapshots = set()
+        for group in same_start:
+            for identical in _groups(group, "hash"):
+                target = identical[0]
+                for duplicate in identical[1:]:
+                    replaced = 0
+                    for path in duplicate.paths:
+                        if dry_run:
+                            replaced += 1
+                            continue
+                        try:
+                            _link(os.path.join(root, target.paths[0]),
+                                  os.path.join(root, path))
+                        except OSError as err:
+                            if err.errno == errno.EMLINK:
+                                # target has as many links as the filesystem
+                                # allows: link the rest to this copy.
+                                target = duplicate
+                                break
+                            _log().warning(
+                                "Linking {path} failed: {err}".format(
+                                    path=path, err=err))
+                            continue
+                        replaced += 1
+                        changed_snapshots.add(_snapshot_of(path))
+                    linked += replaced
+                    if replaced == len(duplicate.paths) == duplicate.nlink:
+                        freed.append(duplicate)
+                        freed_bytes += duplicate.blocks * 512
+
+        if not dry_run:
+            freed_keys = set(inode.key for inode in freed)
+            index.remove(stale)
+            index.add([inode for inode in inodes.values()
+                       if inode.key not in freed_keys] +
+                      [inode for group in candidates for inode in group
+                       if inode.indexed])
+            index.add_snapshots(new)
+            _forget_du_cache(root, changed_snapshots)
+        return Result(len(new), files, linked, len(freed), freed_bytes)
+    finally:
+        pool.close()
+        pool.join()
+        index.close()
+
+
+def _snapshot_of(path):
+    """Return the snapshot (relative to root) that the path is in."""
+    parts = path.split(os.sep)
+    for i, part in enumerate(parts):
+        if part.endswith(".snapshot"):
+            return os.sep.join(parts[:i + 1])
+    return parts[0]
+
+
+def _forget_du_cache(root, snapshots):
+    """Remove the `snapshotter du` caches of the given changed snapshots."""
+    for snapshot in snapshots:
+        cache = os.path.join(root, os.path.dirname(snapshot), "du-cache",
+                             os.path.basename(snapshot))
+        if os.path.exists(cache):
+            os.unlink(cache)
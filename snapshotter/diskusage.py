@@ -0,0 +1,226 @@
+"""Measuring the disk usage of source trees and of snapshots.
+
+usage() estimates the size of a tree, for balancing the shards of --jobs,
+and reclaimable() works out how much space deleting each snapshot would
+free, for `snapshotter du` and --prune-by-space. For remote paths both are
+run on the remote host by the helper agent, which is why only the standard
+library is imported here.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import os
+import stat as stat_module
+import struct
+from multiprocessing.pool import ThreadPool
+
+
+def usage(path, device=None, limit=None):
+    """Return (bytes, count) for all the files in the tree at path.
+
+    Subdirectories on a different device than device (default: the device
+    that path is on) aren't descended into, like rsync's --one-file-system.
+
+    If a limit is given, the tree is read breadth first only until that many
+    files have been counted, and the rest is estimated: each directory that
+    wasn't read is taken to hold as much as the average directory that was.
+
+    """
+    if device is None:
+        device = os.lstat(path).st_dev
+    total_bytes, count, read = 0, 0, 0
+    directories = collections.deque([path])
+    while directories and (limit is None or count < limit):
+        directory = directories.popleft()
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        read += 1
+        for name in names:
+            full = os.path.join(directory, name)
+            try:
+                stat = os.lstat(full)
+            except OSError:
+                # The file vanished while we were scanning.
+                continue
+            total_bytes += stat.st_size
+            count += 1
+            if stat_module.S_ISDIR(stat.st_mode) and stat.st_dev == device:
+                directories.append(full)
+    if directories and read:
+        total_bytes += total_bytes * len(directories) // read
+        count += count * len(directories) // read
+    return total_bytes, count
+
+
+# The records of an inode table file: inode number, number of links in the
+# snapshot, bytes, and the inode's total number of links (st_nlink) when it
+# was scanned. The file starts with _MAGIC and the snapshot's unshared bytes.
+_MAGIC = b"snapdu2\n"
+_INODE = struct.Struct(">QIQI")
+_UNSHARED = struct.Struct(">Q")
+
+
+def _disk_usage(stat):
+    """Return the bytes on disk of the file with the given stat result."""
+    if hasattr(stat, "st_blocks"):
+        return stat.st_blocks * 512
+    return stat.st_size
+
+
+def inode_table(path):
+    """Return (unshared, table) for the tree at path.
+
+    unshared is the bytes on disk of the directories, which always belong to
+    this tree alone. table maps the inode number of every other file to
+    [links, bytes, nlink]: the number of its links that are in this tree,
+    its bytes on disk and its total number of links.
+
+    Like usage() this doesn't cross filesystem boundaries.
+
+    """
+    device = os.lstat(path).st_dev
+    unshared = _disk_usage(os.lstat(path))
+    table = {}
+    for root, dirs, files in os.walk(path):
+        subdirs = set(dirs)
+        for name in dirs + files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if stat.st_dev != device:
+                if name in subdirs:
+                    dirs.remove(name)
+                continue
+            if name in subdirs:
+                unshared += _disk_usage(stat)
+                continue
+            entry = table.get(stat.st_ino)
+            if entry is None:
+                table[stat.st_ino] = [1, _disk_usage(stat), stat.st_nlink]
+            else:
+                entry[0] += 1
+    return unshared, table
+
+
+def _write_inode_table(path, unshared, table):
+    """Write an inode table to the file path, atomically."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as file_:
+        file_.write(_MAGIC + _UNSHARED.pack(unshared))
+        for inode, (links, bytes_, nlink) in table.items():
+            file_.write(_INODE.pack(inode, links, bytes_, nlink))
+    os.rename(tmp, path)
+
+
+def _read_inode_table(path):
+    """Return the (unshared, table) written to path by _write_inode_table().
+
+    Returns None if the file was written in an older format.
+
+    """
+    with open(path, "rb") as file_:
+        data = file_.read()
+    if not data.startswith(_MAGIC):
+        return None
+    unshared, = _UNSHARED.unpack_from(data, len(_MAGIC))
+    table = {}
+    for offset in range(len(_MAGIC) + _UNSHARED.size, len(data),
+                        _INODE.size):
+        inode, links, bytes_, nlink = _INODE.unpack_from(data, offset)
+        table[inode] = [links, bytes_, nlink]
+    return unshared, table
+
+
+def reclaimable(snapshots_root, names, cache="du-cache", threads=8):
+    """Return {name: bytes} of the space that deleting each snapshot frees.
+
+    Those are the bytes of the files whose links are all in that one
+    snapshot: the links in the snapshot must be all of the file's st_nlink
+    links, and none of the other snapshots (or incomplete.snapshot, if
+    there is one) may link to it. Links from anywhere else, like the trash,
+    other destinations (see dedup) or hard links made since a snapshot was
+    scanned, count against the snapshot.
+
+    The snapshots are scanned in parallel, with the given number of threads,
+    and each snapshot's inode table is kept in the cache directory (relative
+    to snapshots_root) so that it's only ever scanned once. Tables of
+    snapshots that aren't in names are removed from the cache. As the link
+    counts in older tables can be out of date, the highest count of each
+    inode in any table is used. incomplete.snapshot is always scanned.
+
+    """
+    cache = os.path.join(snapshots_root, cache)
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+    for name in os.listdir(cache):
+        if name not in names:
+            os.unlink(os.path.join(cache, name))
+
+    def load(name):
+        path = os.path.join(cache, name)
+        if os.path.exists(path):
+            cached = _read_inode_table(path)
+            if cached is not None:
+                return cached
+        unshared, table = inode_table(os.path.join(snapshots_root, name))
+        _write_inode_table(path, unshared, table)
+        return unshared, table
+
+    def scan_incomplete():
+        incomplete = os.path.join(snapshots_root, "incomplete.snapshot")
+        if not os.path.isdir(incomplete) or os.path.islink(incomplete):
+            return 0, {}
+        return inode_table(incomplete)
+
+    pool = ThreadPool(max(1, min(threads, len(names) + 1)))
+    try:
+        incomplete = pool.apply_async(scan_incomplete)
+        tables = pool.map(load, names)
+        incomplete = incomplete.get()
+    finally:
+        pool.close()
+        pool.join()
+
+    links = {}
+    nlinks = {}
+    for _, table in tables + [incomplete]:
+        for inode, (count, _, nlink) in table.items():
+            links[inode] = links.get(inode, 0) + count
+            nlinks[inode] = max(nlinks.get(inode, 0), nlink)
+    result = {}
+    for name, (unshared, table) in zip(names, tables):
+        result[name] = unshared + sum(
+            bytes_ for inode, (count, bytes_, _) in table.items()
+            if links[inode] == count == nlinks[inode])
+    return result
+
+
+def subdirectory_usage(path, limit=None):
+    """Return [name, bytes, count] for each subdirectory of path.
+
+    Only subdirectories on the same device as path are included. See usage()
+    for the limit.
+
+    """
+    device = os.lstat(path).st_dev
+    result = []
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        stat = os.lstat(full)
+        if stat.st_dev == device and os.path.isdir(full) and (
+                not os.path.islink(full)):
+            result.append([name] + list(usage(full, device, limit)))
+    return result
+
+
+#: The operations that this module adds to the agent.
+OPS = {
+    "scan": subdirectory_usage,
+    "reclaimable": reclaimable,
+}
@@ -0,0 +1,518 @@
+"""An in-process copying engine for local-to-local snapshots.
+
+When the source and destination are both local, rsync's separate sender and
+receiver processes each use a single core and pass every file through a
+pipe. copy_tree() does what snapshotter's rsync command does (see _rsync())
+in process instead: it walks the source with several threads, hard-links the
+files that are the same as in latest.snapshot (or another link dest), and
+copies the rest with copy_file_range() or sendfile(), so that the kernel
+copies the data without it passing through Python.
+
+It keeps rsync's --archive semantics: permissions, modification times,
+symlinks (as symlinks), special files and, when running as root, owners and
+devices. Like --one-file-system it doesn't descend into other filesystems
+(their mount point directories are copied empty), and like --delete it
+removes anything in the destination that isn't in the source. Sparse files
+are kept sparse. rsync's other options, for example --exclude, aren't
+supported, except for what restoring a snapshot needs: not deleting,
+comparing contents (like --checksum) and preserving hard links.
+
+The changes are passed to the consumers as itemize.Line objects in the same
+format as rsync's --itemize-changes output, followed by the same --stats
+lines that rsync prints, so that manifests, catalogs and progress reports
+work as with rsync.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import errno
+import os
+import shutil
+import stat as stat_module
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from snapshotter import itemize
+
+
+def _log_lines(lines, consumers, lock):
+    parsed = [itemize.parse(line) for line in lines]
+    with lock:
+        for line in parsed:
+            for consumer in consumers:
+                consumer(line)
+
+
+def _same_file(stat, other):
+    """Return True if rsync would consider the two files unchanged.
+
+    That is if they have the same size, modification time (whole seconds),
+    permissions and owner, so a hard link to other preserves stat's
+    attributes.
+
+    """
+    return (stat_module.S_ISREG(other.st_mode) and
+            other.st_size == stat.st_size and
+            int(other.st_mtime) == int(stat.st_mtime) and
+            other.st_mode == stat.st_mode and
+            other.st_uid == stat.st_uid and other.st_gid == stat.st_gid)
+
+
+def _same_contents(path, other):
+    """Return True if the two files have the same contents."""
+    with open(path, "rb") as file_:
+        with open(other, "rb") as other_file:
+            while True:
+                data = file_.read(1024 * 1024)
+                if data != other_file.read(1024 * 1024):
+                    return False
+                if not data:
+                    return True
+
+
+def _changes(stat, basis):
+    """Return the itemize flags for copying a file that differs from basis."""
+    if basis is None or not stat_module.S_ISREG(basis.st_mode):
+        return ">f+++++++++"
+    return ">f." + "".join([
+        "s" if basis.st_size != stat.st_size else ".",
+        "t" if int(basis.st_mtime) != int(stat.st_mtime) else ".",
+        "p" if basis.st_mode != stat.st_mode else ".",
+        "o" if basis.st_uid != stat.st_uid else ".",
+        "g" if basis.st_gid != stat.st_gid else ".",
+        "...",
+    ])
+
+
+def _copy_range(source, target, offset, length):
+    """Copy length bytes at offset in the file source to target's offset.
+
+    Uses copy_file_range() where available (which can share the data on
+    filesystems with reflinks), else sendfile(), else plain reads and writes.
+    Stops early if source is shorter.
+
+    """
+    end = offset + length
+    copied = offset
+    for function in ("copy_file_range", "sendfile"):
+        if not hasattr(os, function):
+            continue
+        os.lseek(target.fileno(), copied, os.SEEK_SET)
+        try:
+            while copied < end:
+                if function == "copy_file_range":
+                    count = os.copy_file_range(
+                        source.fileno(), target.fileno(), end - copied,
+                        copied, copied)
+                else:
+                    count = os.sendfile(target.fileno(), source.fileno(),
+                                        copied, end - copied)
+                if count == 0:
+                    # The file shrank while it was being copied.
+                    break
+                copied += count
+            return
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                 errno.EOPNOTSUPP):
+                raise
+    source.seek(copied)
+    target.seek(copied)
+    while copied < end:
+        data = source.read(min(1024 * 1024, end - copied))
+        if not data:
+            break
+        target.write(data)
+        copied += len(data)
+
+
+def _data_extents(source, size):
+    """Yield (offset, length) of the parts of the file that aren't holes."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(source.fileno(), offset, os.SEEK_DATA)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # Nothing but a hole from offset to the end.
+                return
+            raise
+        end = min(size, os.lseek(source.fileno(), start, os.SEEK_HOLE))
+        if start >= end:
+            return
+        yield start, end - start
+        offset = end
+
+
+def copy_file(src, dest, size, sparse=False):
+    """Copy the contents of the file src to a new file dest.
+
+    Uses copy_file_range() where available, see _copy_range(). If sparse is
+    True only the parts of src that aren't holes are copied, so that dest is
+    as sparse as src, where the filesystem can say where the holes are.
+
+    """
+    with open(src, "rb") as source:
+        with open(dest, "wb") as target:
+            if sparse and hasattr(os, "SEEK_DATA"):
+                try:
+                    extents = list(_data_extents(source, size))
+                except OSError as err:
+                    if err.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                else:
+                    for offset, length in extents:
+                        _copy_range(source, target, offset, length)
+                    target.truncate(size)
+                    return
+            _copy_range(source, target, 0, size)
+
+
+def _is_sparse(stat):
+    """Return True if the file has holes: fewer blocks than its size."""
+    return getattr(stat, "st_blocks", None) is not None and (
+        stat.st_blocks * 512 < stat.st_size)
+
+
+def _set_attributes(path, stat, symlink=False):
+    """Give path the permissions, owner and times in stat, like rsync -a."""
+    if os.geteuid() == 0:
+        os.lchown(path, stat.st_uid, stat.st_gid)
+    if symlink:
+        # Python 2 can't set the times of a symlink itself.
+        if os.utime in getattr(os, "supports_follow_symlinks", ()):
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns),
+                     follow_symlinks=False)
+        return
+    os.chmod(path, stat_module.S_IMODE(stat.st_mode))
+    if hasattr(stat, "st_mtime_ns"):
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    else:
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+class Totals(object):
+
+    """The totals that copy_tree() reports as rsync's --stats would."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.directories = 0
+        self.links = 0
+        self.created = 0
+        self.transferred = 0
+        self.size = 0
+        self.transferred_size = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def stats_lines(self):
+        """Return the totals as rsync --stats output lines."""
+        return [
+            "Number of files: {total} (reg: {files}, dir: {dirs}, "
+            "link: {links})".format(
+                total=self.files + self.directories + self.links,
+                files=self.files, dirs=self.directories, links=self.links),
+            "Number of created files: {n}".format(n=self.created),
+            "Number of regular files transferred: {n}".format(
+                n=self.transferred),
+            "Total file size: {n} bytes".format(n=self.size),
+            "Total transferred file size: {n} bytes".format(
+                n=self.transferred_size),
+        ]
+
+
+class _Copier(object):
+
+    def __init__(self, source, dest, link_dests, consumers, lock,
+                 delete=True, compare_contents=False, hard_links=False):
+        self.source = source
+        self.dest = dest
+        self.link_dests = link_dests
+        self.consumers = consumers
+        self.lock = lock
+        self.delete = delete
+        self.compare_contents = compare_contents
+        self.hard_links = hard_links
+        self.device = os.lstat(source).st_dev
+        self.totals = Totals()
+        # (relative path, stat) of each directory, to set their attributes
+        # once their contents have been copied.
+        self.directories = []
+        # The first path copied of each inode with several links, and the
+        # (relative path, first path) of the others, to link at the end.
+        self.inodes = {}
+        self.links = []
+        self.inodes_lock = threading.Lock()
+
+    def _basis(self, relative, stat):
+        """Return (path, stat) of the file to link to or compare with.
+
+        That's the first file in the link dests that's the same as stat, or
+        else the first one that exists (with path None), or (None, None).
+
+        """
+        first = None
+        for link_dest in self.link_dests:
+            path = os.path.join(link_dest, relative)
+            try:
+                basis = os.lstat(path)
+            except OSError:
+                continue
+            if _same_file(stat, basis):
+                return path, basis
+            first = first or basis
+        return None, first
+
+    def _previous_link(self, relative):
+        """Return the symlink's target in the latest snapshot, or None."""
+        if not self.link_dests:
+            return None
+        try:
+            return os.readlink(os.path.join(self.link_dests[0], relative))
+        except OSError:
+            return None
+
+    def copy_directory(self, relative):
+        """Copy the entries of one directory, return its subdirectories."""
+        source = os.path.join(self.source, relative)
+        dest = os.path.join(self.dest, relative)
+        lines = []
+        subdirectories = []
+        try:
+            names = os.listdir(source)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                # Vanished since it was listed, like rsync's exit status 24.
+                return []
+            raise
+        for name in sorted(set(os.listdir(dest)) - set(names)
+                           if self.delete else ()):
+            _remove(os.path.join(dest, name))
+            lines.append("*deleting   " + os.path.join(relative, name))
+        for name in names:
+            child = os.path.join(relative, name)
+            try:
+                stat = os.lstat(os.path.join(self.source, child))
+                if self.copy_entry(child, stat, lines):
+                    subdirectories.append(child)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+        _log_lines(lines, self.consumers, self.lock)
+        return subdirectories
+
+    def copy_entry(self, relative, stat, lines):
+        """Copy one entry, return True if it's a directory to descend into."""
+        target = os.path.join(self.dest, relative)
+        try:
+            existing = os.lstat(target)
+        except OSError:
+            existing = None
+        if existing is not None and stat_module.S_IFMT(
+                existing.st_mode) != stat_module.S_IFMT(stat.st_mode):
+            _remove(target)
+            existing = None
+
+        mode = stat.st_mode
+        if stat_module.S_ISDIR(mode):
+            self.totals.add(directories=1)
+            if existing is None:
+                os.mkdir(target, 0o700)
+                if self._basis(relative, stat)[1] is None:
+                    # New since the previous snapshot.
+                    lines.append("cd+++++++++ " + relative + "/")
+            self.directories.append((relative, stat))
+            # Like --one-file-system, copy mount points but not their
+            # contents.
+            return stat.st_dev == self.device
+        if stat_module.S_ISREG(mode):
+            self.copy_regular_file(relative, stat, existing, lines)
+        elif stat_module.S_ISLNK(mode):
+            self.totals.add(links=1)
+            link = os.readlink(os.path.join(self.source, relative))
+            if existing is not None:
+                if os.readlink(target) == link:
+                    return False
+                os.unlink(target)
+            os.symlink(link, target)
+            _set_attributes(target, stat, symlink=True)
+            if self._previous_link(relative) != link:
+                lines.append("cL+++++++++ {path} -> {link}".format(
+                    path=relative, link=link))
+        elif existing is None:
+            try:
+                os.mknod(target, mode, stat.st_rdev)
+            except OSError as err:
+                if err.errno != errno.EPERM:
+                    raise
+                # Devices can only be created by root.
+                return False
+            _set_attributes(target, stat)
+            flag = "D" if stat_module.S_ISCHR(mode) or stat_module.S_ISBLK(
+                mode) else "S"
+            lines.append("c" + flag + "+++++++++ " + relative)
+        return False
+
+    def _first_link(self, relative, stat):
+        """Return the path that relative should be a hard link to, or None.
+
+        That's the first path seen of the same inode, if hard links are
+        being preserved.
+
+        """
+        if not self.hard_links or stat.st_nlink < 2:
+            return None
+        with self.inodes_lock:
+            first = self.inodes.setdefault((stat.st_dev, stat.st_ino),
+                                           relative)
+            if first == relative:
+                return None
+            self.links.append((relative, first))
+            return first
+
+    def copy_regular_file(self, relative, stat, existing, lines):
+        self.totals.add(files=1, size=stat.st_size)
+        if self._first_link(relative, stat) is not None:
+            # Linked by finish(), once the first path has been copied.
+            return
+        target = os.path.join(self.dest, relative)
+        if existing is not None and _same_file(stat, existing) and (
+                not self.compare_contents or _same_contents(
+                    os.path.join(self.source, relative), target)):
+            return
+        basis_path, basis = self._basis(relative, stat)
+        if basis_path is not None:
+            if existing is not None:
+                os.unlink(target)
+            try:
+                os.link(basis_path, target)
+                return
+            except OSError as err:
+                if err.errno != errno.EMLINK:
+                    raise
+                # Too many links to the file already, copy it instead.
+        if basis is None:
+            # Like rsync, report the change against the file being replaced.
+            basis = existing
+        tmp = os.path.join(os.path.dirname(target),
+                           "." + os.path.basename(target) + ".snapshotter")
+        copy_file(os.path.join(self.source, relative), tmp, stat.st_size,
+                  sparse=_is_sparse(stat))
+        _set_attributes(tmp, stat)
+        os.rename(tmp, target)
+        self.totals.add(transferred=1, transferred_size=stat.st_size,
+                        created=1 if basis is None else 0)
+        lines.append(_changes(stat, basis) + " " + relative)
+
+    def link(self):
+        """Make the hard links found by _first_link()."""
+        lines = []
+        for relative, first in sorted(self.links):
+            target = os.path.join(self.dest, relative)
+            first_target = os.path.join(self.dest, first)
+            try:
+                existing = os.lstat(target)
+            except OSError:
+                existing = None
+            if existing is not None:
+                if os.path.samestat(existing, os.lstat(first_target)):
+                    continue
+                _remove(target)
+            os.link(first_target, target)
+            lines.append("hf+++++++++ {path} => {first}".format(
+                path=relative, first=first))
+        _log_lines(lines, self.consumers, self.lock)
+
+    def finish(self):
+        """Make the hard links, then set the directories' attributes.
+
+        The directories' attributes are set deepest first.
+
+        """
+        self.link()
+        for relative, stat in sorted(self.directories,
+                                     key=lambda item: item[0].count(os.sep),
+                                     reverse=True):
+            _set_attributes(os.path.join(self.dest, relative), stat)
+        _set_attributes(self.dest, os.lstat(self.source))
+
+
+def copy_tree(source, dest, link_dests=(), consumers=(), threads=8,
+              delete=True, compare_contents=False, hard_links=False):
+    """Make dest a snapshot of the local directory source.
+
+    Files that are the same as in one of the link_dests directories (tried
+    in order) are hard-linked to it, like with rsync's --link-dest. dest is
+    created if it doesn't exist, and anything already in it that isn't in
+    source is removed (unless delete is False), so an interrupted
+    copy_tree() can be run again.
+
+    Files already in dest with the same size, modification time,
+    permissions and owner as in source are left alone; with
+    compare_contents their contents must also be the same. If hard_links is
+    True, files that are hard links to each other in source are hard links
+    in dest too, like with rsync's --hard-links.
+
+    Returns a Totals. The consumers get the changes and --stats lines from
+    one thread at a time.
+
+    :raises OSError: if copying fails, for example with ENOSPC
+
+    """
+    if not os.path.isdir(dest):
+        os.mkdir(dest, 0o700)
+    lock = threading.Lock()
+    copier = _Copier(source, dest, list(link_dests), list(consumers), lock,
+                     delete, compare_contents, hard_links)
+    pending = queue.Queue()
+    errors = []
+    pending.put("")
+
+    def work():
+        while True:
+            relative = pending.get()
+            if relative is None:
+                pending.task_done()
+                return
+            try:
+                if not errors:
+                    for subdirectory in copier.copy_directory(relative):
+                        pending.put(subdirectory)
+            except (OSError, IOError) as err:
+                errors.append(err)
+            finally:
+                pending.task_done()
+
+    workers = [threading.Thread(target=work) for _ in range(max(1, threads))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    pending.join()
+    for _ in workers:
+        pending.put(None)
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        raise errors[0]
+    copier.finish()
+    _log_lines(copier.totals.stats_lines(), consumers, lock)
+    return copier.totals
@@ -0,0 +1,297 @@
+"""Hashing the files of snapshots, and verifying them against their hashes.
+
+file_hash() is used to detect renamed files (see contentindex), to find
+duplicates (see dedup) and to compare snapshots (see treediff), and verify()
+keeps a ledger of the hashes of the files of a destination's snapshots to
+detect corruption. For remote destinations the helper agent does the
+hashing on the remote host, where only the standard library can be relied
+on.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import os
+import stat as stat_module
+import time
+from multiprocessing.pool import ThreadPool
+
+
+def file_hash(path, block_size=1024 * 1024, drop_cache=False):
+    """Return the hex SHA-256 of the contents of the file at path.
+
+    If drop_cache is True the kernel is told that the file will be read
+    sequentially and that its pages won't be needed again afterwards, so
+    that hashing lots of files doesn't evict everything else from the page
+    cache.
+
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file_:
+        advise = drop_cache and hasattr(os, "posix_fadvise")
+        if advise:
+            os.posix_fadvise(file_.fileno(), 0, 0,
+                             os.POSIX_FADV_SEQUENTIAL)
+        try:
+            while True:
+                block = file_.read(block_size)
+                if not block:
+                    return digest.hexdigest()
+                digest.update(block)
+        finally:
+            if advise:
+                os.posix_fadvise(file_.fileno(), 0, 0,
+                                 os.POSIX_FADV_DONTNEED)
+
+
+def mtime_ns(stat):
+    """Return the modification time of the os.stat() result in nanoseconds.
+
+    Pythons before 3.3 only have the float st_mtime.
+
+    """
+    mtime_ns = getattr(stat, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(round(stat.st_mtime * 10 ** 9))
+    return mtime_ns
+
+
+def hash_files(root, paths, min_size=0):
+    """Return [path, hash, size, mtime, mode, uid, gid] for files in root.
+
+    paths are relative to root and mtime is in nanoseconds. Files that are
+    smaller than min_size, that aren't regular files or that vanished are
+    left out.
+
+    """
+    result = []
+    for path in paths:
+        full = os.path.join(root, path)
+        try:
+            stat = os.lstat(full)
+            if not stat_module.S_ISREG(stat.st_mode) or (
+                    stat.st_size < min_size):
+                continue
+            result.append([path, file_hash(full), stat.st_size,
+                           mtime_ns(stat), stat.st_mode, stat.st_uid,
+                           stat.st_gid])
+        except EnvironmentError:
+            continue
+    return result
+
+
+#: The verification ledger in the destination directory, see verify().
+LEDGER_FILENAME = "verify-ledger.sqlite"
+
+_LEDGER_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS inodes (device INTEGER NOT NULL, "
+    "inode INTEGER NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, "
+    "hash TEXT NOT NULL, snapshot TEXT NOT NULL, path TEXT NOT NULL, "
+    "verified REAL NOT NULL, PRIMARY KEY (device, inode))",
+    "CREATE TABLE IF NOT EXISTS pass (started REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS done (snapshot TEXT PRIMARY KEY)",
+    "CREATE TABLE IF NOT EXISTS problems (device INTEGER NOT NULL, "
+    "inode INTEGER NOT NULL, snapshot TEXT NOT NULL, path TEXT NOT NULL, "
+    "problem TEXT NOT NULL, PRIMARY KEY (device, inode))",
+]
+
+#: The statuses of the files in verify()'s result.
+CORRUPT = "corrupt"
+UNREADABLE = "unreadable"
+
+
+def _snapshot_files(snapshot_dir):
+    """Yield (relative path, full path, stat) of the files in snapshot_dir.
+
+    The files are yielded in a stable order, and this doesn't cross
+    filesystem boundaries.
+
+    """
+    device = os.lstat(snapshot_dir).st_dev
+    for root, dirs, files in os.walk(snapshot_dir):
+        dirs.sort()
+        for name in list(dirs):
+            try:
+                if os.lstat(os.path.join(root, name)).st_dev != device:
+                    dirs.remove(name)
+            except OSError:
+                dirs.remove(name)
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            try:
+                stat = os.lstat(full)
+            except OSError:
+                continue
+            if stat_module.S_ISREG(stat.st_mode):
+                yield os.path.relpath(full, snapshot_dir), full, stat
+
+
+def _hash_for_verify(full):
+    """Return (hash, None) of the file full, or (None, error message)."""
+    try:
+        return file_hash(full, 8 * 1024 * 1024, drop_cache=True), None
+    except EnvironmentError as err:
+        return None, err.strerror or str(err)
+
+
+def verify(snapshots_root, names, max_seconds=None, max_bytes=None,
+           threads=4, batch_bytes=256 * 1024 * 1024):
+    """Hash the files of the snapshots names and check them against a ledger.
+
+    The ledger, LEDGER_FILENAME in snapshots_root, holds the SHA-256, size
+    and modification time of every file (inode) in the snapshots. A file
+    whose contents no longer match its hash although its size and
+    modification time haven't changed is reported as CORRUPT; one that
+    can't be read is reported as UNREADABLE. A file that isn't in the ledger
+    yet is added to it.
+
+    Each inode is hashed only once per pass, however many snapshots link to
+    it, and files are hashed in parallel by the given number of threads,
+    batch_bytes at a time, with large sequential reads. (mmap isn't used
+    because reading a damaged file through it kills the process with
+    SIGBUS.)
+
+    A pass through all the snapshots can be spread over several calls: each
+    call stops once it has spent max_seconds or hashed max_bytes, and the
+    next one carries on from where it stopped, skipping the snapshots and
+    inodes that have already been verified in this pass. When a pass is
+    finished, the entries of inodes that are no longer in any snapshot are
+    removed from the ledger and the next call starts a new pass.
+
+    Returns a dict with the files and bytes hashed, the number of new
+    files, the [snapshot, path, status] of the CORRUPT and UNREADABLE files
+    found in this call, the number of snapshots remaining in this pass and
+    whether the pass is finished.
+
+    """
+    try:
+        import sqlite3
+    except ImportError as err:
+        raise EnvironmentError(None, str(err))
+    started = time.time()
+    connection = sqlite3.connect(
+        os.path.join(snapshots_root, LEDGER_FILENAME), timeout=60)
+    pool = ThreadPool(max(1, threads))
+    result = {"files": 0, "bytes": 0, "new": 0, "problems": [],
+              "remaining": 0, "finished": False}
+    try:
+        with connection:
+            for statement in _LEDGER_SCHEMA:
+                connection.execute(statement)
+            row = connection.execute("SELECT started FROM pass").fetchone()
+            if row is None:
+                connection.execute("INSERT INTO pass VALUES (?)", (started,))
+                pass_started = started
+            else:
+                pass_started = row[0]
+        done = set(name for name, in connection.execute(
+            "SELECT snapshot FROM done"))
+        seen = set()
+        pending = []
+
+        def over_budget(pending_bytes=0):
+            return ((max_seconds is not None and
+                     time.time() - started >= max_seconds) or
+                    (max_bytes is not None and
+                     result["bytes"] + pending_bytes >= max_bytes))
+
+        def flush():
+            hashes = pool.map(_hash_for_verify,
+                              [full for _, _, full, _ in pending])
+            rows, problems = [], []
+            for (name, path, _, stat), (hash_, error) in zip(pending,
+                                                             hashes):
+                key = (stat.st_dev, stat.st_ino)
+                if error is not None:
+                    problems.append(key + (name, path, UNREADABLE))
+                    continue
+                result["files"] += 1
+                result["bytes"] += stat.st_size
+                known = connection.execute(
+                    "SELECT size, mtime, hash FROM inodes WHERE device = ? "
+                    "AND inode = ?", key).fetchone()
+                if known is None:
+                    result["new"] += 1
+                elif known[2] != hash_ and tuple(known[:2]) == (
+                        stat.st_size, int(stat.st_mtime)):
+                    problems.append(key + (name, path, CORRUPT))
+                    continue
+                rows.append(key + (stat.st_size, int(stat.st_mtime), hash_,
+                                   name, path, time.time()))
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO inodes VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                connection.executemany(
+                    "INSERT OR REPLACE INTO problems VALUES (?, ?, ?, ?, ?)",
+                    problems)
+            result["problems"].extend(
+                [name, path, problem]
+                for _, _, name, path, problem in problems)
+            del pending[:]
+
+        stopped = False
+        for name in names:
+            if name in done:
+                continue
+            if over_budget():
+                break
+            pending_bytes = 0
+            for path, full, stat in _snapshot_files(
+                    os.path.join(snapshots_root, name)):
+                key = (stat.st_dev, stat.st_ino)
+                if key in seen:
+                    continue
+                seen.add(key)
+                row = connection.execute(
+                    "SELECT verified FROM inodes WHERE device = ? AND "
+                    "inode = ?", key).fetchone()
+                if row is not None and row[0] >= pass_started:
+                    continue
+                # Always hash at least one file, however big it is.
+                if (pending or result["files"]) and over_budget(
+                        pending_bytes + stat.st_size):
+                    stopped = True
+                    break
+                pending.append((name, path, full, stat))
+                pending_bytes += stat.st_size
+                if pending_bytes >= batch_bytes:
+                    flush()
+                    pending_bytes = 0
+            flush()
+            if stopped:
+                break
+            with connection:
+                connection.execute("INSERT OR IGNORE INTO done VALUES (?)",
+                                   (name,))
+            done.add(name)
+
+        result["remaining"] = len([name for name in names
+                                   if name not in done])
+        if not result["remaining"]:
+            result["finished"] = True
+            with connection:
+                connection.execute(
+                    "DELETE FROM inodes WHERE verified < ? AND NOT EXISTS "
+                    "(SELECT 1 FROM problems WHERE problems.device = "
+                    "inodes.device AND problems.inode = inodes.inode)",
+                    (pass_started,))
+                connection.execute("DELETE FROM pass")
+                connection.execute("DELETE FROM done")
+                connection.execute("DELETE FROM problems")
+    except sqlite3.Error as err:
+        raise EnvironmentError(None, str(err))
+    finally:
+        pool.close()
+        pool.join()
+        connection.close()
+    return result
+
+
+#: The operations that this module adds to the agent.
+OPS = {
+    "hash": hash_files,
+    "verify": verify,
+}
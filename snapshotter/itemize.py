@@ -0,0 +1,87 @@
+"""Parsing of the lines that rsync outputs while it runs.
+
+With --itemize-changes rsync prints one line per changed file, for example:
+
+    >f+++++++++ Documents/new_file.txt
+    >f.st...... Documents/changed_file.txt
+    cd+++++++++ Documents/new_directory/
+    cL+++++++++ Documents/a_symlink -> target
+    hf+++++++++ Documents/a_hard_link => Documents/new_file.txt
+    *deleting   Documents/deleted_file.txt
+
+See the --itemize-changes section of `man rsync` for what the flags mean.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import re
+
+
+#: A line of rsync output. flags and path are None for lines that aren't
+#: itemized changes (errors, progress or --stats output).
+Line = collections.namedtuple("Line", ["text", "flags", "path"])
+
+
+_ITEMIZED = re.compile(r"^([<>ch.][fdLDS][^ ]{7,9}) (.+)$")
+_DELETING = re.compile(r"^\*deleting +(.+)$")
+
+
+CREATED = "created"
+UPDATED = "updated"
+DELETED = "deleted"
+HARDLINKED = "hardlinked"
+UNCHANGED = "unchanged"
+
+
+def parse(text):
+    """Parse one line of rsync output and return it as a Line."""
+    match = _ITEMIZED.match(text)
+    if match:
+        flags, path = match.groups()
+        if flags[1] == "L":
+            path = path.split(" -> ", 1)[0]
+        elif flags[0] == "h":
+            path = path.split(" => ", 1)[0]
+        return Line(text, flags, path)
+    match = _DELETING.match(text)
+    if match:
+        return Line(text, "*deleting", match.group(1))
+    return Line(text, None, None)
+
+
+def change_type(flags):
+    """Return the type of change described by the given itemize flags.
+
+    Returns one of CREATED, UPDATED, DELETED, HARDLINKED or UNCHANGED.
+
+    """
+    if flags.startswith("*"):
+        return DELETED
+    if flags[0] == "h":
+        return HARDLINKED
+    if flags[2:].strip("+") == "":
+        return CREATED
+    if flags[0] in "<>c":
+        return UPDATED
+    return UNCHANGED
+
+
+class Counter(object):
+
+    """A consumer that counts itemized changes by type."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def __call__(self, line):
+        if line.flags is not None:
+            self.counts[change_type(line.flags)] += 1
+
+    def summary(self):
+        """Return a one-line human-readable summary of the counts."""
+        return ", ".join("{count} {type}".format(count=self.counts[type_],
+                                                  type=type_)
+                         for type_ in (CREATED, UPDATED, DELETED, HARDLINKED))
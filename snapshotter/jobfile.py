@@ -0,0 +1,320 @@
+"""Running the snapshots of many sources from a job file.
+
+`snapshotter run JOBFILE` reads a list of jobs, each one a source, a
+destination and the options for its snapshot, from a TOML file like:
+
+    [limits]
+    jobs = 4            # snapshots running at once in all
+    per_host = 2        # snapshots reading from the same source host
+    per_device = 1      # snapshots writing to the same destination device
+
+    [defaults]          # options for every job that doesn't set its own
+    keep = "daily=7,weekly=4"
+
+    [[job]]
+    name = "documents"
+    source = "fred@laptop:Documents"
+    dest = "/media/backup/Documents"
+    rsync_args = ["--exclude", "*.tmp"]
+    keep = "hourly=24,daily=30"
+
+and runs them with a Scheduler, which starts the jobs that have taken the
+longest recently first (so that a long job doesn't start last and keep the
+whole run going) as long as none of the limits would be exceeded.
+
+The options are the same as snapshotter's command-line options, without the
+leading -- and with - replaced by _ (see OPTIONS).
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import io
+import threading
+import time
+
+try:
+    import tomllib as _toml
+except ImportError:
+    try:
+        import tomli as _toml
+    except ImportError:
+        _toml = None
+
+from snapshotter import retention
+
+
+def _policy(value):
+    return retention.parse_policy(value)
+
+
+def _string_list(value):
+    if not isinstance(value, list) or not all(
+            isinstance(item, type("")) for item in value):
+        raise ValueError("must be a list of strings")
+    return value
+
+
+def _typed(type_):
+    def convert(value):
+        if not isinstance(value, type_) or (
+                type_ is int and isinstance(value, bool)):
+            raise ValueError("must be a " + type_.__name__)
+        return value
+    return convert
+
+
+def _number(value):
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        raise ValueError("must be a number")
+    return float(value)
+
+
+def _choice(*choices):
+    def convert(value):
+        if value not in choices:
+            raise ValueError("must be one of " + ", ".join(choices))
+        return value
+    return convert
+
+
+#: The options that a job can have: {name in the job file: (snapshot()
+#: argument, function that checks and converts the value)}.
+OPTIONS = {
+    "rsync_args": ("extra_args", _string_list),
+    "min_snapshots": ("min_snapshots", _typed(int)),
+    "max_snapshots": ("max_snapshots", _typed(int)),
+    "jobs": ("jobs", _typed(int)),
+    "plan_space": ("plan_space", _typed(bool)),
+    "lazy_delete": ("lazy_delete", _typed(bool)),
+    "prune_by_space": ("prune_by_space", _typed(bool)),
+    "keep": ("keep", _policy),
+    "link_dests": ("link_dest_count", _typed(int)),
+    "link_dest_history": ("link_dest_history", _policy),
+    "detect_renames": ("detect_renames", _typed(bool)),
+    "journal": ("journal_dir", _typed(type(""))),
+    "engine": ("engine", _choice("rsync", "native")),
+    "reflink": ("reflink", _typed(bool)),
+    "progress_file": ("progress_file", _typed(type(""))),
+    "if_locked": ("if_locked", _choice("wait", "exit", "coalesce")),
+    "report_file": ("report_file", _typed(type(""))),
+    "metrics_textfile": ("metrics_textfile", _typed(type(""))),
+    "throttle": ("throttle_target", _number),
+    "throttle_cgroup": ("throttle_cgroup", _typed(type(""))),
+}
+
+#: The limits and their defaults: 1 job at a time, and no limit per host or
+#: device beyond that.
+LIMITS = {"jobs": 1, "per_host": None, "per_device": None}
+
+#: A job from a job file. options are the keyword arguments for snapshot().
+Job = collections.namedtuple("Job", ["name", "source", "dest", "options"])
+
+#: The outcome of running a job. status is "ok" or "failed", snapshot is
+#: what the job returned and error the exception it raised, if any.
+Result = collections.namedtuple(
+    "Result", ["name", "status", "duration", "snapshot", "error"])
+
+OK = "ok"
+FAILED = "failed"
+
+
+class JobFileError(Exception):
+
+    """Raised if a job file can't be read or is invalid."""
+
+    pass
+
+
+def _options(table, where):
+    options = {}
+    for key, value in table.items():
+        if key not in OPTIONS:
+            raise JobFileError("{where}: unknown option {key}".format(
+                where=where, key=key))
+        argument, convert = OPTIONS[key]
+        try:
+            options[argument] = convert(value)
+        except ValueError as err:
+            raise JobFileError("{where}: {key} {err}".format(
+                where=where, key=key, err=err))
+    return options
+
+
+def parse(text_):
+    """Return (jobs, limits) from the contents of a job file.
+
+    jobs is a list of Jobs in the order they're in the file, and limits a
+    dict with the keys of LIMITS.
+
+    :raises JobFileError: if the job file is invalid
+
+    """
+    if _toml is None:
+        raise JobFileError("Reading job files needs Python 3.11 or tomli")
+    try:
+        document = _toml.loads(text_)
+    except ValueError as err:
+        raise JobFileError(err)
+
+    unknown = set(document) - set(["limits", "defaults", "job"])
+    if unknown:
+        raise JobFileError("unknown section " + ", ".join(sorted(unknown)))
+
+    limits = dict(LIMITS)
+    for key, value in document.get("limits", {}).items():
+        if key not in LIMITS:
+            raise JobFileError("limits: unknown limit " + key)
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise JobFileError(
+                "limits: {key} must be a positive integer".format(key=key))
+        limits[key] = value
+
+    defaults = _options(document.get("defaults", {}), "defaults")
+    jobs = []
+    names = set()
+    for number, table in enumerate(document.get("job", []), 1):
+        table = dict(table)
+        where = "job {number}".format(number=number)
+        try:
+            source = table.pop("source")
+            dest = table.pop("dest")
+        except KeyError as err:
+            raise JobFileError("{where}: {key} is missing".format(
+                where=where, key=err.args[0]))
+        name = table.pop("name", dest)
+        if name in names:
+            raise JobFileError("{where}: there's already a job named "
+                               "{name}".format(where=where, name=name))
+        names.add(name)
+        options = dict(defaults)
+        options.update(_options(table, name))
+        jobs.append(Job(name, source, dest, options))
+    if not jobs:
+        raise JobFileError("there are no jobs")
+    return jobs, limits
+
+
+def load(path):
+    """Return (jobs, limits) from the job file at path, see parse().
+
+    :raises JobFileError: if the job file can't be read or is invalid
+
+    """
+    try:
+        with io.open(path, encoding="utf-8") as file_:
+            return parse(file_.read())
+    except (EnvironmentError, UnicodeDecodeError) as err:
+        raise JobFileError("{path}: {err}".format(path=path, err=err))
+
+
+class Scheduler(object):
+
+    """Runs jobs concurrently within the global, host and device limits.
+
+    host and device are functions that return the source host and the
+    destination device of a job (any hashable values), and runtime one that
+    returns how long it's expected to take, or None if that isn't known.
+    Jobs are started longest first, with the unknown ones before all the
+    others, and a job is skipped over while starting it would exceed a
+    limit. run_job(job) is called in a thread of its own for each job.
+
+    """
+
+    def __init__(self, jobs, run_job, host, device, runtime, limits=None):
+        self.jobs = list(jobs)
+        self.run_job = run_job
+        self.host = host
+        self.device = device
+        self.limits = dict(LIMITS)
+        self.limits.update(limits or {})
+        expected = dict((job.name, runtime(job)) for job in self.jobs)
+        # sorted() is stable, so equal jobs run in the job file's order.
+        self.order = sorted(
+            self.jobs, key=lambda job: (expected[job.name] is not None,
+                                        -(expected[job.name] or 0)))
+
+    def _run_one(self, job):
+        started = time.time()
+        try:
+            snapshot_ = self.run_job(job)
+        except Exception as err:
+            return Result(job.name, FAILED, time.time() - started, None, err)
+        return Result(job.name, OK, time.time() - started, snapshot_, None)
+
+    def run(self):
+        """Run all the jobs, return their Results in the job file's order."""
+        condition = threading.Condition()
+        pending = list(self.order)
+        running = []
+        hosts = collections.Counter()
+        devices = collections.Counter()
+        results = {}
+        keys = dict((job.name, (self.host(job), self.device(job)))
+                    for job in self.jobs)
+
+        def can_start(job):
+            host, device = keys[job.name]
+            per_host = self.limits["per_host"]
+            per_device = self.limits["per_device"]
+            return ((per_host is None or hosts[host] < per_host) and
+                    (per_device is None or devices[device] < per_device))
+
+        def work(job):
+            result = self._run_one(job)
+            with condition:
+                results[job.name] = result
+                running.remove(job)
+                hosts[keys[job.name][0]] -= 1
+                devices[keys[job.name][1]] -= 1
+                condition.notify()
+
+        threads = []
+        with condition:
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= self.limits["jobs"]:
+                        break
+                    if not can_start(job):
+                        continue
+                    pending.remove(job)
+                    running.append(job)
+                    hosts[keys[job.name][0]] += 1
+                    devices[keys[job.name][1]] += 1
+                    thread = threading.Thread(target=work, args=(job,),
+                                              name=job.name)
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                if pending or running:
+                    condition.wait()
+        for thread in threads:
+            thread.join()
+        return [results[job.name] for job in self.jobs]
+
+
+def summary(results):
+    """Return the lines of a report of the given Results."""
+    width = max([len("job")] + [len(result.name) for result in results])
+    lines = ["{name:{width}}  {status:6}  {duration:>9}  {detail}".format(
+        name="job", width=width, status="status", duration="duration",
+        detail="snapshot or error")]
+    for result in results:
+        if result.status == OK:
+            detail = result.snapshot or ""
+        else:
+            # Only the last line of, for example, rsync's error output.
+            message = ("{0}".format(result.error).strip().splitlines() or
+                       [""])[-1]
+            detail = "{type}: {message}".format(
+                type=type(result.error).__name__, message=message)
+        lines.append(
+            "{name:{width}}  {status:6}  {duration:8.1f}s  {detail}".format(
+                name=result.name, width=width, status=result.status,
+                duration=result.duration, detail=detail))
+    failed = len([r for r in results if r.status == FAILED])
+    lines.append("{total} jobs, {ok} ok, {failed} failed".format(
+        total=len(results), ok=len(results) - failed, failed=failed))
+    return lines
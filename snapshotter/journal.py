@@ -0,0 +1,587 @@
+"""A journal of the files that changed in a source directory since a snapshot.
+
+Even when only a few files have changed rsync has to stat every file in the
+source and in latest.snapshot to find them. With `snapshotter watch SRC
+JOURNAL` running, a Watcher records the path of every file and directory
+that's created, changed, moved or deleted in SRC into the JOURNAL directory
+using inotify. `snapshotter --journal JOURNAL SRC DEST` then copies the
+unchanged files by hard-linking latest.snapshot into the new snapshot in
+process (see link_tree()) and runs rsync with --files-from on only the paths
+in the journal.
+
+The journal is a directory containing:
+
+- journal: the segment that the watcher is appending records to
+- segment-N: segments that a snapshot has taken from the watcher (see
+  Journal.rotate()) but that haven't been committed yet, oldest first
+- base: the name of the snapshot that the segments are changes since
+- lock and watcher.lock: locks held while writing a segment and while a
+  watcher is running
+- flush-TOKEN: a request, while a snapshot is rotating the journal, for the
+  watcher to write the changes it has seen but not recorded yet
+
+The journal can only be trusted if the watcher has been running all the time
+since the base snapshot was made. Journal.read() returns None, meaning that
+rsync has to scan the whole source after all, if the watcher isn't running,
+if it was (re)started since (it writes a start record when it starts), or if
+it lost events (it writes an overflow record).
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+import select
+import shutil
+import stat as stat_module
+import struct
+import sys
+import threading
+import time
+import uuid
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+_DIRTY = b"D"
+_START = b"S"
+_OVERFLOW = b"O"
+_FLUSHED = b"F"
+
+_FLUSH_PREFIX = "flush-"
+
+#: How many seconds Journal.rotate() waits for the watcher to record the
+#: changes that it's holding before writing them out (see Watcher.poll()).
+FLUSH_TIMEOUT = 10
+
+
+def _log():
+    return logging.getLogger("snapshotter")
+
+
+def _encode(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding(), "surrogateescape")
+
+
+def _decode(path):
+    if str is bytes:
+        # Python 2: keep paths as bytes, like os.listdir() does.
+        return path
+    return path.decode(sys.getfilesystemencoding(), "surrogateescape")
+
+
+class Journal(object):
+
+    """A journal directory, see the module docstring."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._current = os.path.join(directory, "journal")
+
+    def _locked(self, name, blocking=True):
+        """Return an open file holding an exclusive lock on the lock file.
+
+        Returns None if blocking is False and the lock is already held.
+
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        file_ = open(os.path.join(self.directory, name), "a")
+        try:
+            fcntl.flock(file_.fileno(), fcntl.LOCK_EX | (
+                0 if blocking else fcntl.LOCK_NB))
+        except IOError as err:
+            file_.close()
+            if err.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return file_
+
+    def _append(self, records):
+        """Durably append the given records to the current segment."""
+        lock = self._locked("lock")
+        try:
+            with open(self._current, "ab") as file_:
+                file_.write(b"".join(records))
+                file_.flush()
+                os.fsync(file_.fileno())
+        finally:
+            lock.close()
+
+    def start(self):
+        """Record that a watcher has started, and return its lock file.
+
+        The watcher must keep the returned file open while it runs.
+
+        """
+        alive = self._locked("watcher.lock", blocking=False)
+        if alive is None:
+            raise EnvironmentError(
+                "A watcher is already running for {path}".format(
+                    path=self.directory))
+        self._append([_START + uuid.uuid4().hex.encode("ascii") + b"\0"])
+        return alive
+
+    def record(self, paths, flushed=()):
+        """Record that the given paths (relative to the source) changed.
+
+        flushed are the tokens of the flush requests (see rotate()) that were
+        made before the last of the changes that the watcher has seen.
+
+        """
+        records = [_DIRTY + _encode(path) + b"\0" for path in paths]
+        records.extend(_FLUSHED + _encode(token) + b"\0"
+                       for token in flushed)
+        if records:
+            self._append(records)
+
+    def overflow(self):
+        """Record that changes were lost, so the journal can't be used."""
+        self._append([_OVERFLOW + b"\0"])
+
+    def watching(self):
+        """Return True if a watcher is running for this journal."""
+        lock = self._locked("watcher.lock", blocking=False)
+        if lock is None:
+            return True
+        lock.close()
+        return False
+
+    def segments(self):
+        """Return the paths of the rotated segments, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        numbers = sorted(int(name[len("segment-"):])
+                         for name in os.listdir(self.directory)
+                         if name.startswith("segment-"))
+        return [os.path.join(self.directory, "segment-%d" % number)
+                for number in numbers]
+
+    def _flush(self, timeout):
+        """Have the watcher record all the changes it has seen so far.
+
+        The watcher watches the journal directory for flush requests, and
+        as inotify queues events in order, it has read the events of all the
+        changes made before the request when it sees the request. Returns
+        False if it didn't answer within timeout seconds.
+
+        """
+        token = uuid.uuid4().hex
+        try:
+            offset = os.path.getsize(self._current)
+        except OSError:
+            offset = 0
+        answer = _FLUSHED + token.encode("ascii") + b"\0"
+        request = os.path.join(self.directory, _FLUSH_PREFIX + token)
+        deadline = time.time() + timeout
+        open(request, "w").close()
+        try:
+            while True:
+                try:
+                    with open(self._current, "rb") as file_:
+                        file_.seek(offset)
+                        if answer in file_.read():
+                            return True
+                except IOError:
+                    pass
+                if time.time() >= deadline:
+                    return False
+                time.sleep(0.01)
+        finally:
+            os.unlink(request)
+
+    def rotate(self, timeout=None):
+        """Take the current segment from the watcher and return all segments.
+
+        The watcher starts a new segment with its next record, so the
+        returned segments don't change any more. Returns the paths of all
+        the segments that haven't been committed yet, oldest first.
+
+        If timeout is given and a watcher is running, the changes that it
+        has seen but is still holding are written into the current segment
+        first. If it doesn't do that within timeout seconds an overflow is
+        recorded instead, so that the segments aren't trusted.
+
+        """
+        if (timeout is not None and self.watching() and
+                not self._flush(timeout)):
+            _log().info("The watcher didn't record its changes in time")
+            self.overflow()
+        lock = self._locked("lock")
+        try:
+            segments = self.segments()
+            if os.path.exists(self._current):
+                number = len(segments) and int(
+                    segments[-1].rsplit("-", 1)[1]) + 1
+                segment = os.path.join(self.directory,
+                                       "segment-%d" % number)
+                os.rename(self._current, segment)
+                segments.append(segment)
+            return segments
+        finally:
+            lock.close()
+
+    def read(self, segments):
+        """Return the set of paths that changed in the given segments.
+
+        Returns None if the segments aren't a complete record of the changes
+        since base(): if they contain a start or overflow record, or if
+        no watcher is running.
+
+        """
+        if not self.watching():
+            _log().info("No watcher is running for the journal")
+            return None
+        paths = set()
+        for segment in segments:
+            with open(segment, "rb") as file_:
+                records = file_.read().split(b"\0")
+            # The last record is either empty or was cut short by a crash.
+            for record in records[:-1]:
+                if record[:1] == _DIRTY:
+                    paths.add(_decode(record[1:]))
+                elif record[:1] == _START:
+                    _log().info("The watcher was restarted")
+                    return None
+                elif record[:1] == _OVERFLOW:
+                    _log().info("The watcher lost events")
+                    return None
+        return paths
+
+    def base(self):
+        """Return the name of the snapshot the segments are changes since."""
+        try:
+            with open(os.path.join(self.directory, "base")) as file_:
+                return file_.read().strip() or None
+        except IOError:
+            return None
+
+    def commit(self, segments, base):
+        """Delete the given segments once base contains their changes."""
+        path = os.path.join(self.directory, "base")
+        with open(path + ".tmp", "w") as file_:
+            file_.write(base + "\n")
+            file_.flush()
+            os.fsync(file_.fileno())
+        os.rename(path + ".tmp", path)
+        for segment in segments:
+            os.unlink(segment)
+
+
+def _scandir(path):
+    """Yield (name, stat) for each entry in the directory path."""
+    for name in os.listdir(path):
+        yield name, os.lstat(os.path.join(path, name))
+
+
+def link_tree(src, dest, skip=(), threads=8):
+    """Make dest a copy of the directory tree src, hard-linking its files.
+
+    Like `cp -a -l` but several directories are done at once. Files and
+    symlinks whose paths (relative to src) are in skip aren't copied;
+    directories are always copied. Entries that already exist in dest are
+    left alone, so an interrupted link_tree() can be run again. Directories
+    get their permissions, owner and times from src once they're filled.
+
+    """
+    skip = set(skip)
+    directories = []
+    lock = threading.Lock()
+    pending = queue.Queue()
+    errors = []
+    pending.put("")
+
+    def copy(relative):
+        source = os.path.join(src, relative)
+        target = os.path.join(dest, relative)
+        if not os.path.isdir(target):
+            os.mkdir(target)
+        for name, stat in _scandir(source):
+            child = os.path.join(relative, name)
+            if stat_module.S_ISDIR(stat.st_mode):
+                with lock:
+                    directories.append((child, stat))
+                pending.put(child)
+            elif child in skip or os.path.lexists(
+                    os.path.join(dest, child)):
+                continue
+            elif stat_module.S_ISLNK(stat.st_mode):
+                os.symlink(os.readlink(os.path.join(src, child)),
+                           os.path.join(dest, child))
+            else:
+                try:
+                    os.link(os.path.join(src, child),
+                            os.path.join(dest, child))
+                except OSError as err:
+                    if err.errno != errno.EMLINK:
+                        raise
+                    # Too many links to the file already.
+                    shutil.copy2(os.path.join(src, child),
+                                 os.path.join(dest, child))
+
+    def work():
+        while True:
+            relative = pending.get()
+            if relative is None:
+                pending.task_done()
+                return
+            try:
+                copy(relative)
+            except OSError as err:
+                errors.append(err)
+            finally:
+                pending.task_done()
+
+    workers = [threading.Thread(target=work) for _ in range(max(1, threads))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    pending.join()
+    for _ in workers:
+        pending.put(None)
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        raise errors[0]
+    directories.append(("", os.stat(src)))
+    for relative, stat in directories:
+        target = os.path.join(dest, relative)
+        os.chmod(target, stat_module.S_IMODE(stat.st_mode))
+        if os.geteuid() == 0:
+            os.chown(target, stat.st_uid, stat.st_gid)
+        os.utime(target, (stat.st_atime, stat.st_mtime))
+
+
+def prune(source, dest, paths):
+    """Remove the given paths from dest if they've been deleted from source.
+
+    A path is also removed if it's a different type of file in source
+    (for example a file that replaced a directory), so that rsync can
+    create it again. Returns the removed paths.
+
+    """
+    removed = []
+    for path in sorted(paths):
+        target = os.path.join(dest, path)
+        try:
+            existing = os.lstat(target)
+        except OSError:
+            continue
+        try:
+            current = os.lstat(os.path.join(source, path))
+        except OSError:
+            current = None
+        if current is not None and stat_module.S_IFMT(
+                current.st_mode) == stat_module.S_IFMT(existing.st_mode):
+            continue
+        if stat_module.S_ISDIR(existing.st_mode):
+            shutil.rmtree(target)
+        else:
+            os.unlink(target)
+        removed.append(path)
+    return removed
+
+
+# inotify(7) constants.
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_EXCL_UNLINK = 0x4000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+               IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+               IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+#: Events that also change the modification time of the parent directory.
+_ENTRY_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT = struct.Struct("iIII")
+
+
+class WatcherError(Exception):
+
+    """Raised if the source directory can't be watched."""
+
+    pass
+
+
+class Watcher(object):
+
+    """Records the changes in a source directory into a Journal.
+
+    Every directory in the source is watched with inotify, so the watcher
+    needs one inotify watch per directory (see
+    /proc/sys/fs/inotify/max_user_watches). If a directory can't be watched
+    or the kernel's event queue overflows an overflow record is written, so
+    that snapshots go back to scanning the whole source until the watcher is
+    restarted.
+
+    """
+
+    def __init__(self, root, journal, interval=1.0):
+        self.root = root
+        self.journal = journal
+        self.interval = interval
+        library = ctypes.util.find_library("c")
+        if library is None or not sys.platform.startswith("linux"):
+            raise WatcherError("Watching needs inotify (Linux)")
+        self._libc = ctypes.CDLL(library, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise WatcherError("inotify_init1: " + os.strerror(
+                ctypes.get_errno()))
+        self._paths = {}
+        self._dirty = set()
+        self._flushes = []
+        self._overflowed = False
+        try:
+            self._alive = journal.start()
+        except EnvironmentError as err:
+            os.close(self._fd)
+            raise WatcherError(str(err))
+        # Journal.rotate() asks for the changes by creating files here.
+        self._requests = self._libc.inotify_add_watch(
+            self._fd, _encode(journal.directory), IN_CREATE | IN_ONLYDIR)
+        if self._requests < 0:
+            error = ctypes.get_errno()
+            self.close()
+            raise WatcherError("{path}: {error}".format(
+                path=journal.directory, error=os.strerror(error)))
+        self._add_tree("")
+
+    def close(self):
+        os.close(self._fd)
+        self._alive.close()
+
+    def _overflow(self, reason):
+        if not self._overflowed:
+            _log().warning("Changes were lost, the next snapshot will scan "
+                           "the whole source: {reason}".format(reason=reason))
+            self._overflowed = True
+            self.journal.overflow()
+
+    def _add_tree(self, relative, record=False):
+        """Watch the directory relative and every directory below it.
+
+        If record is True also record everything in it as changed, because
+        it's new.
+
+        """
+        for directory, names, files in os.walk(
+                os.path.join(self.root, relative)):
+            path = os.path.relpath(directory, self.root)
+            path = "" if path == os.curdir else path
+            wd = self._libc.inotify_add_watch(
+                self._fd, _encode(directory), _WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    # Deleted again already.
+                    continue
+                self._overflow("{path}: {error}".format(
+                    path=directory, error=os.strerror(error)))
+                continue
+            self._paths[wd] = path
+            if record:
+                self._dirty.update(os.path.join(path, name)
+                                   for name in names + files)
+
+    def _remove_tree(self, relative):
+        """Stop watching the directory relative and the ones below it."""
+        prefix = relative + os.sep
+        for wd, path in list(self._paths.items()):
+            if path == relative or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._paths[wd]
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self._overflow("the inotify event queue overflowed")
+            return
+        if wd == self._requests:
+            if mask & IN_CREATE and name.startswith(_FLUSH_PREFIX):
+                self._flushes.append(name[len(_FLUSH_PREFIX):])
+            return
+        if mask & IN_IGNORED:
+            self._paths.pop(wd, None)
+            return
+        directory = self._paths.get(wd)
+        if directory is None:
+            return
+        if not name:
+            # An event on the watched directory itself.
+            self._dirty.add(directory or os.curdir)
+            return
+        path = os.path.join(directory, name)
+        self._dirty.add(path)
+        if mask & _ENTRY_EVENTS:
+            self._dirty.add(directory or os.curdir)
+        if mask & IN_ISDIR:
+            if mask & IN_MOVED_FROM:
+                self._remove_tree(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path, record=True)
+
+    def poll(self, timeout=None):
+        """Read events for timeout seconds and record the changed paths.
+
+        timeout defaults to the watcher's interval. The changed paths are
+        appended to the journal in one write at the end, or as soon as a
+        snapshot asks for them (see Journal.rotate()).
+
+        """
+        deadline = time.time() + (self.interval if timeout is None
+                                  else timeout)
+        while True:
+            wait = deadline - time.time()
+            if wait <= 0 or not select.select([self._fd], [], [], wait)[0]:
+                break
+            data = os.read(self._fd, 65536)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                self._handle(wd, mask, _decode(name))
+            if self._flushes:
+                break
+        if self._dirty or self._flushes:
+            self.journal.record(sorted(self._dirty), self._flushes)
+            self._dirty.clear()
+            del self._flushes[:]
+
+    def run(self):
+        """Record changes until interrupted."""
+        _log().info("Watching {count} directories in {root}".format(
+            count=len(self._paths), root=self.root))
+        while True:
+            self.poll()
+
+
+def files_from(paths):
+    """Return the given paths as the contents of an rsync --from0 list."""
+    return b"".join(_encode(path) + b"\0" for path in paths)
@@ -0,0 +1,115 @@
+"""Locking destination directories against concurrent snapshots.
+
+The lock of a remote destination is taken and held on the remote host by the
+helper agent, see lock(). No imports outside the standard library.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import threading
+import time
+
+
+#: The lock file in a destination directory, and the file that invocations
+#: that found it locked leave their catch-up requests in.
+LOCK_FILENAME = "snapshotter.lock"
+REQUESTS_FILENAME = "snapshotter.lock.requests"
+
+#: {destination directory: open lock file} of the locks held by this process.
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _describe_process():
+    import socket
+    return "pid {pid} on {host} since {time}".format(
+        pid=os.getpid(), host=socket.gethostname(),
+        time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def _requests_file(snapshots_root):
+    """Return the requests file opened and exclusively locked.
+
+    Holding this lock while taking or releasing the main lock makes
+    registering a request and releasing the main lock atomic with respect to
+    each other, so that a request is never left behind unseen.
+
+    """
+    import fcntl
+    file_ = open(os.path.join(snapshots_root, REQUESTS_FILENAME), "a+")
+    fcntl.flock(file_.fileno(), fcntl.LOCK_EX)
+    return file_
+
+
+def lock(snapshots_root, register=False):
+    """Try to take the lock on the destination directory snapshots_root.
+
+    Returns [locked, holder]. If the lock is held by another process (or
+    another thread of this one) locked is False, holder describes that
+    process and, if register is True, a request for it to make one more
+    snapshot when it finishes has been left for it (see unlock()).
+
+    The lock is an flock() on the lock file, which the kernel releases when
+    the process holding it dies, so a lock is never left behind by a crashed
+    snapshotter. The remote agent exits, releasing its locks, when its ssh
+    connection is closed.
+
+    """
+    import fcntl
+    requests = _requests_file(snapshots_root)
+    try:
+        file_ = open(os.path.join(snapshots_root, LOCK_FILENAME), "a+")
+        try:
+            fcntl.flock(file_.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except EnvironmentError:
+            file_.seek(0)
+            holder = file_.read().strip()
+            file_.close()
+            if register:
+                requests.write(_describe_process() + "\n")
+                requests.flush()
+            return [False, holder]
+        file_.truncate(0)
+        file_.write(_describe_process() + "\n")
+        file_.flush()
+        with _locks_lock:
+            _locks[snapshots_root] = file_
+        return [True, None]
+    finally:
+        requests.close()
+
+
+def unlock(snapshots_root, catch_up=True):
+    """Release the lock on snapshots_root, unless a catch-up is requested.
+
+    If catch_up is True and other invocations registered requests while the
+    lock was held, the requests are cleared, the lock is kept and True is
+    returned: the caller should make one more snapshot and call unlock()
+    again. Otherwise the lock is released and False is returned.
+
+    """
+    requests = _requests_file(snapshots_root)
+    try:
+        if catch_up:
+            requests.seek(0)
+            if requests.read().strip():
+                requests.truncate(0)
+                return True
+        with _locks_lock:
+            file_ = _locks.pop(snapshots_root, None)
+        if file_ is not None:
+            # Closing the file releases the flock().
+            file_.close()
+        return False
+    finally:
+        requests.close()
+
+
+#: The operations that this module adds to the agent.
+OPS = {
+    "lock": lock,
+    "unlock": unlock,
+}
@@ -0,0 +1,151 @@
+"""Compact binary manifests of the changes rsync made in each snapshot.
+
+A manifest is written next to each snapshot as YYYY-MM-DDTHH_MM_SS.manifest.
+It's built while rsync runs from its --itemize-changes output, so finding out
+what changed in a snapshot is a file read instead of a walk of two trees.
+
+A manifest file is one or more segments (one for each time rsync was run
+into the same incomplete.snapshot directory). Each segment starts with MAGIC
+and is followed by records of two types:
+
+* A prefix record interns a directory path so it's stored only once:
+  b"P" + prefix id (uint32) + length (uint16) + the UTF-8 directory path.
+
+* An entry record is one itemized change:
+  b"E" + the itemize flags (FLAGS_WIDTH bytes, space-padded) +
+  prefix id (uint32) + length (uint16) + the UTF-8 name within the prefix.
+  Directory names end with a /.
+
+All integers are big-endian. Prefix ids are only valid within their segment.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import struct
+
+
+MAGIC = b"SNAPMAN1"
+FLAGS_WIDTH = 11
+
+_HEADER = struct.Struct(">IH")
+
+
+def path_for(snapshot):
+    """Return the manifest path for the given snapshot directory path."""
+    if snapshot.endswith(".snapshot"):
+        snapshot = snapshot[:-len(".snapshot")]
+    return snapshot + ".manifest"
+
+
+class Writer(object):
+
+    """A consumer that writes the itemized lines it's given to a manifest.
+
+    The file isn't created until the first itemized change is written, and
+    new segments are appended to an existing file (when resuming an
+    interrupted snapshot).
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._prefixes = {}
+
+    def __call__(self, line):
+        if line.flags is not None:
+            self.add(line.flags, line.path)
+
+    def add(self, flags, path):
+        """Add one changed path with its itemize flags to the manifest."""
+        if self._file is None:
+            self._file = open(self.path, "ab")
+            self._file.write(MAGIC)
+
+        directory, _, name = path.rstrip("/").rpartition("/")
+        if path.endswith("/"):
+            name += "/"
+
+        prefix_id = self._prefixes.get(directory)
+        if prefix_id is None:
+            prefix_id = self._prefixes[directory] = len(self._prefixes)
+            encoded = directory.encode("utf-8")
+            self._file.write(
+                b"P" + _HEADER.pack(prefix_id, len(encoded)) + encoded)
+
+        encoded = name.encode("utf-8")
+        self._file.write(
+            b"E" + flags.ljust(FLAGS_WIDTH)[:FLAGS_WIDTH].encode("ascii") +
+            _HEADER.pack(prefix_id, len(encoded)) + encoded)
+
+    def close(self):
+        """Close the manifest file. Returns True if anything was written."""
+        if self._file is None:
+            return False
+        self._file.close()
+        self._file = None
+        self._prefixes = {}
+        return True
+
+
+class CorruptManifestError(Exception):
+
+    """Raised when reading a manifest file that isn't valid."""
+
+    pass
+
+
+def _read_exact(file_, size, path):
+    data = file_.read(size)
+    if len(data) != size:
+        raise CorruptManifestError(path)
+    return data
+
+
+def read(path):
+    """Yield (flags, path) pairs for each change in the given manifest file.
+
+    The file is read incrementally, so this works for manifests of any size.
+
+    """
+    with open(path, "rb") as file_:
+        prefixes = None
+        while True:
+            record_type = file_.read(1)
+            if not record_type:
+                return
+            if record_type == MAGIC[:1]:
+                if _read_exact(file_, len(MAGIC) - 1, path) != MAGIC[1:]:
+                    raise CorruptManifestError(path)
+                prefixes = {}
+                continue
+            if prefixes is None:
+                raise CorruptManifestError(path)
+            if record_type == b"E":
+                flags = _read_exact(
+                    file_, FLAGS_WIDTH, path).decode("ascii").rstrip()
+            elif record_type != b"P":
+                raise CorruptManifestError(path)
+            id_, length = _HEADER.unpack(
+                _read_exact(file_, _HEADER.size, path))
+            value = _read_exact(file_, length, path).decode("utf-8")
+            if record_type == b"P":
+                prefixes[id_] = value
+            elif id_ not in prefixes:
+                raise CorruptManifestError(path)
+            elif prefixes[id_]:
+                yield flags, prefixes[id_] + "/" + value
+            else:
+                yield flags, value
+
+
+def changes(path):
+    """Return a dict mapping each changed path to its itemize flags.
+
+    If a path was itemized more than once (because rsync was run more than
+    once for the snapshot) the last change wins.
+
+    """
+    return dict((path_, flags) for flags, path_ in read(path))
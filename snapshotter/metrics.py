@@ -0,0 +1,221 @@
+"""Per-phase timings and counters of snapshotter runs.
+
+snapshot() records a Report of each run: how long each of its phases took
+(listing snapshots, pruning, the transfer, moving incomplete.snapshot, ...),
+counters like the number of subprocesses, ssh connections and prune
+iterations, and the totals from rsync's --stats output. The report is
+returned by snapshot() and can be written as JSON and as a Prometheus
+node-exporter textfile.
+
+The report being recorded is per thread (see recording()), so that
+concurrent snapshots, for example of a job file, each get their own. Code
+that starts threads of its own has to pass the report on to them.
+
+Phases can nest: the time spent listing snapshots while pruning counts
+towards both phases. For development, each finished phase is logged at debug
+level by the snapshotter.metrics logger and passed to the functions in
+hooks.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import contextlib
+import functools
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+
+#: The statuses of a Report.
+COMPLETE = "complete"
+COALESCED = "coalesced"
+FAILED = "failed"
+
+#: Functions called with (phase name, seconds) each time a phase finishes.
+hooks = []
+
+_current = threading.local()
+
+
+class Report(object):
+
+    """The timings, counters and rsync totals of one snapshotter run."""
+
+    def __init__(self, source=None, dest=None):
+        self.source = source
+        self.dest = dest
+        self.snapshot = None
+        self.status = None
+        self.started = time.time()
+        self.duration = None
+        #: {phase: [seconds, times entered]}, in the order they started.
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+        #: rsync's --stats totals, see catalog.Recorder.totals().
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent in the with block to the phase name."""
+        with self._lock:
+            self.phases.setdefault(name, [0.0, 0])
+        started = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - started
+            with self._lock:
+                self.phases[name][0] += seconds
+                self.phases[name][1] += 1
+            logging.getLogger("snapshotter.metrics").debug(
+                "{name}: {seconds:.3f}s".format(name=name, seconds=seconds))
+            for hook in hooks:
+                hook(name, seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def finish(self, status):
+        """Record the run's outcome, one of COMPLETE, COALESCED or FAILED."""
+        self.status = status
+        self.duration = time.time() - self.started
+
+    def as_dict(self):
+        return {
+            "source": self.source,
+            "dest": self.dest,
+            "snapshot": self.snapshot,
+            "status": self.status,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                     time.localtime(self.started)),
+            "duration": self.duration,
+            "phases": collections.OrderedDict(
+                (name, {"seconds": seconds, "count": count})
+                for name, (seconds, count) in self.phases.items()),
+            "counters": dict(self.counters),
+            "rsync": self.stats,
+        }
+
+    def write_json(self, path):
+        """Write the report to the file path as JSON."""
+        _write_atomically(path, json.dumps(self.as_dict(), indent=2,
+                                           sort_keys=True) + "\n")
+
+    def write_textfile(self, path):
+        """Write the report to path in Prometheus's text format.
+
+        The file is replaced atomically, as node-exporter's textfile
+        collector requires. Every metric has a dest label, but each
+        destination needs a file of its own.
+
+        """
+        _write_atomically(path, "".join(textfile_lines(self)))
+
+
+def _write_atomically(path, text_):
+    tmp = path + ".tmp"
+    with io.open(tmp, "w", encoding="utf-8") as file_:
+        file_.write(text_)
+    os.rename(tmp, path)
+
+
+def _label(value):
+    return "{0}".format(value).replace("\\", "\\\\").replace(
+        "\"", "\\\"").replace("\n", "\\n")
+
+
+def _metric_name(text_):
+    return re.sub("[^a-z0-9]+", "_", text_.lower()).strip("_")
+
+
+def textfile_lines(report):
+    """Return the lines of report in Prometheus's text exposition format."""
+    dest = 'dest="{dest}"'.format(dest=_label(report.dest))
+    lines = []
+
+    def metric(name, help_, samples, type_="gauge"):
+        lines.append("# HELP snapshotter_{name} {help}\n".format(
+            name=name, help=help_))
+        lines.append("# TYPE snapshotter_{name} {type}\n".format(
+            name=name, type=type_))
+        for labels, value in samples:
+            lines.append("snapshotter_{name}{{{labels}}} {value}\n".format(
+                name=name, labels=",".join([dest] + labels), value=value))
+
+    metric("last_run_timestamp_seconds", "When the last run started.",
+           [([], report.started)])
+    metric("last_run_duration_seconds", "How long the last run took.",
+           [([], report.duration or 0)])
+    metric("last_run_success", "1 if the last run succeeded, else 0.",
+           [([], 0 if report.status == FAILED else 1)])
+    metric("phase_duration_seconds", "Time spent in each phase of the run.",
+           [(['phase="{0}"'.format(_label(name))], seconds)
+            for name, (seconds, _) in report.phases.items()])
+    for name, value in sorted(report.counters.items()):
+        metric(_metric_name(name), "The run's {0} count.".format(name),
+               [([], value)])
+    for key, value in sorted(report.stats.items()):
+        metric("rsync_" + _metric_name(key), "rsync --stats: " + key,
+               [([], value)])
+    return lines
+
+
+def current():
+    """Return the Report being recorded in this thread, or None."""
+    return getattr(_current, "report", None)
+
+
+@contextlib.contextmanager
+def recording(report):
+    """Record the phases and counts in the with block into report."""
+    previous = current()
+    _current.report = report
+    try:
+        yield report
+    finally:
+        _current.report = previous
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the with block as the phase name of the current report, if any."""
+    report = current()
+    if report is None:
+        yield
+    else:
+        with report.phase(name):
+            yield
+
+
+def timed(name):
+    """Decorate a function to time each call as the phase name."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """Add n to the counter name of the current report, if any."""
+    report = current()
+    if report is not None:
+        report.count(name, n)
+
+
+def set_stats(totals):
+    """Record rsync's --stats totals in the current report, if any."""
+    report = current()
+    if report is not None:
+        report.stats = dict(totals)
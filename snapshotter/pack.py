@@ -0,0 +1,353 @@
+"""Packing old snapshots into compressed, indexed archives.
+
+A snapshot is a tree of directories and hard links, so a destination with
+a year of hourly snapshots holds hundreds of millions of directory entries,
+and everything that walks them (fsck, listing, deleting) gets slow. pack()
+converts a snapshot into a packed snapshot: a directory with the same name
+that holds only a few files, so it's still listed, catalogued and removed by
+retention like any other snapshot.
+
+A packed snapshot contains an index, INDEX_FILENAME, and data segments. The
+index is a SQLite database with a row for every file, directory, symlink and
+special file of the snapshot: its metadata and, for regular files, the
+segment, offset and length of its zlib-compressed contents. So a single file
+can be restored by reading only its own bytes, see PackedSnapshot.
+
+The contents of the files that were hard-linked to the previous packed
+snapshot (same inode, size and modification time, as rsync would judge) are
+not stored again: their rows point into the previous snapshot's segments,
+which are hard-linked into the new packed snapshot. Every packed snapshot
+therefore holds all the segments it needs and can be deleted on its own.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import os
+import shutil
+import sqlite3
+import stat as stat_module
+import zlib
+
+
+INDEX_FILENAME = "packed-snapshot.sqlite"
+
+#: The suffix of data segment files, which are named after the snapshot
+#: that wrote them.
+SEGMENT_SUFFIX = ".data"
+
+#: How much of a file is read, compressed or decompressed at a time.
+CHUNK_SIZE = 1024 * 1024
+
+#: The types of entries in the index.
+FILE, DIRECTORY, SYMLINK, SPECIAL = "f", "d", "l", "s"
+
+#: The outcome of a pack() run: the number of entries in the snapshot, the
+#: total size of its files, the compressed bytes written to its segment and
+#: the bytes of files whose data was taken from the previous snapshot.
+Result = collections.namedtuple(
+    "Result", ["entries", "bytes", "written", "reused"])
+
+_COLUMNS = ("path", "type", "mode", "uid", "gid", "mtime", "size", "rdev",
+            "target", "inode", "segment", "offset", "length")
+
+#: A row of the index.
+Entry = collections.namedtuple("Entry", _COLUMNS)
+
+#: Whether os.utime() takes times in nanoseconds and follow_symlinks, which
+#: it doesn't before Python 3.3.
+_UTIME_NS = hasattr(os, "supports_follow_symlinks")
+
+
+def _mtime_ns(stat):
+    mtime_ns = getattr(stat, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(round(stat.st_mtime * 10 ** 9))
+    return mtime_ns
+
+
+def is_packed(path):
+    """Return True if the snapshot directory path is a packed snapshot."""
+    return os.path.isfile(os.path.join(path, INDEX_FILENAME))
+
+
+def _walk(top):
+    """Yield (path relative to top, lstat) for everything under top.
+
+    Parents come before their children.
+
+    """
+    for directory, dirs, names in os.walk(top):
+        for name in sorted(dirs) + sorted(names):
+            full = os.path.join(directory, name)
+            yield os.path.relpath(full, top), os.lstat(full)
+
+
+def _compress(path, segment):
+    """Append the compressed contents of path to segment.
+
+    Returns the number of bytes written.
+
+    """
+    compressor = zlib.compressobj()
+    written = 0
+    with open(path, "rb") as file_:
+        while True:
+            chunk = file_.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            data = compressor.compress(chunk)
+            segment.write(data)
+            written += len(data)
+    data = compressor.flush()
+    segment.write(data)
+    return written + len(data)
+
+
+def _create_index(path):
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute(
+            "CREATE TABLE entries (path TEXT PRIMARY KEY, type TEXT NOT NULL, "
+            "mode INTEGER NOT NULL, uid INTEGER NOT NULL, "
+            "gid INTEGER NOT NULL, mtime INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, rdev INTEGER, target TEXT, "
+            "inode INTEGER, segment TEXT, offset INTEGER, length INTEGER)")
+        connection.execute("CREATE INDEX entries_by_inode ON entries (inode)")
+    return connection
+
+
+def pack(snapshot, output, previous=None):
+    """Pack the snapshot directory snapshot into the new directory output.
+
+    previous is the path of the packed snapshot that was made from the
+    snapshot before this one, or None. The contents of the files that are
+    the same inodes as files of previous (and have the same size and
+    modification time) are taken from previous rather than stored again.
+    Returns a Result.
+
+    """
+    name = os.path.basename(snapshot.rstrip(os.sep))
+    os.mkdir(output)
+    previous = PackedSnapshot(previous) if previous else None
+    connection = _create_index(os.path.join(output, INDEX_FILENAME))
+    segment_name = name + SEGMENT_SUFFIX
+    packed = {}
+    linked = set()
+    entries = total = reused = 0
+    try:
+        with open(os.path.join(output, segment_name), "wb") as segment:
+            for path, stat in _walk(snapshot):
+                mode = stat.st_mode
+                row = dict(path=path, mode=stat_module.S_IMODE(mode),
+                           uid=stat.st_uid, gid=stat.st_gid,
+                           mtime=_mtime_ns(stat), size=0, rdev=None,
+                           target=None, inode=None, segment=None,
+                           offset=None, length=None)
+                if stat_module.S_ISDIR(mode):
+                    row["type"] = DIRECTORY
+                elif stat_module.S_ISLNK(mode):
+                    row.update(type=SYMLINK, target=os.readlink(
+                        os.path.join(snapshot, path)))
+                elif stat_module.S_ISREG(mode):
+                    row.update(type=FILE, size=stat.st_size,
+                               inode=stat.st_ino)
+                    total += stat.st_size
+                    location = packed.get(stat.st_ino)
+                    if location is None and previous is not None:
+                        location = previous.location_of(
+                            stat.st_ino, stat.st_size, row["mtime"])
+                        if location is not None:
+                            reused += stat.st_size
+                            if location[0] not in linked:
+                                os.link(previous.segment_path(location[0]),
+                                        os.path.join(output, location[0]))
+                                linked.add(location[0])
+                    if location is None:
+                        offset = segment.tell()
+                        length = _compress(os.path.join(snapshot, path),
+                                           segment)
+                        location = (segment_name, offset, length)
+                    packed[stat.st_ino] = location
+                    row.update(zip(("segment", "offset", "length"),
+                                   location))
+                else:
+                    row.update(type=SPECIAL, rdev=stat.st_rdev,
+                               mode=mode)
+                connection.execute(
+                    "INSERT INTO entries VALUES ({0})".format(
+                        ", ".join("?" * len(_COLUMNS))),
+                    tuple(row[column] for column in _COLUMNS))
+                entries += 1
+            segment.flush()
+            os.fsync(segment.fileno())
+        connection.commit()
+        written = os.path.getsize(os.path.join(output, segment_name))
+    finally:
+        connection.close()
+        if previous is not None:
+            previous.close()
+    return Result(entries, total, written, reused)
+
+
+class PackedSnapshot(object):
+
+    """Reads the files of a packed snapshot, see pack()."""
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(
+            os.path.join(path, INDEX_FILENAME))
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _select(self, where="", parameters=()):
+        return [Entry(*row) for row in self._connection.execute(
+            "SELECT {columns} FROM entries {where} ORDER BY path".format(
+                columns=", ".join(_COLUMNS), where=where), parameters)]
+
+    def entries(self, paths=None):
+        """Return the Entries of the snapshot, sorted by path.
+
+        If paths are given only the entries of those paths, and of everything
+        under the directories among them, are returned.
+
+        """
+        paths = [os.path.normpath(path).strip(os.sep) for path in paths or ()]
+        if not paths or "." in paths:
+            return self._select()
+        entries = {}
+        for path in paths:
+            # Everything in between "path/" and "path0" starts with "path/".
+            for entry in self._select(
+                    "WHERE path = ? OR (path > ? AND path < ?)",
+                    (path, path + os.sep, path + chr(ord(os.sep) + 1))):
+                entries[entry.path] = entry
+        return [entries[path] for path in sorted(entries)]
+
+    def lookup(self, path):
+        """Return the Entry of path, or None if it isn't in the snapshot."""
+        entries = self._select("WHERE path = ?",
+                               (os.path.normpath(path).strip(os.sep),))
+        return entries[0] if entries else None
+
+    def location_of(self, inode, size, mtime):
+        """Return (segment, offset, length) of the data of a file, or None.
+
+        The file is the one that was the given inode, with the given size and
+        modification time (in nanoseconds), when the snapshot was packed.
+
+        """
+        return self._connection.execute(
+            "SELECT segment, offset, length FROM entries WHERE inode = ? AND "
+            "type = ? AND size = ? AND mtime = ?",
+            (inode, FILE, size, mtime)).fetchone()
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, segment)
+
+    def read_chunks(self, entry):
+        """Yield the contents of the file entry, a chunk at a time.
+
+        Only the compressed bytes of this file are read from its segment.
+
+        """
+        decompressor = zlib.decompressobj()
+        with open(self.segment_path(entry.segment), "rb") as segment:
+            segment.seek(entry.offset)
+            remaining = entry.length
+            while remaining:
+                chunk = segment.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError("{0} is truncated".format(entry.segment))
+                remaining -= len(chunk)
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def read(self, path):
+        """Return the contents of the file path.
+
+        :raises KeyError: if path isn't a file of the snapshot
+
+        """
+        entry = self.lookup(path)
+        if entry is None or entry.type != FILE:
+            raise KeyError(path)
+        return b"".join(self.read_chunks(entry))
+
+    def extract(self, target, paths=None):
+        """Restore the snapshot, or the given paths of it, under target.
+
+        Files keep their permissions and modification times (and owners, if
+        this process runs as root), and files that were hard links to each
+        other are hard links again. Returns the number of entries restored.
+
+        """
+        entries = self.entries(paths)
+        inodes = {}
+        directories = []
+        for entry in entries:
+            path = os.path.join(target, entry.path)
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if entry.type == DIRECTORY:
+                if not os.path.isdir(path):
+                    os.mkdir(path)
+                directories.append((path, entry))
+                continue
+            if os.path.lexists(path):
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            if entry.type == SYMLINK:
+                os.symlink(entry.target, path)
+            elif entry.type == SPECIAL:
+                os.mknod(path, entry.mode, entry.rdev)
+            elif entry.inode in inodes:
+                os.link(inodes[entry.inode], path)
+                continue
+            else:
+                with open(path, "wb") as file_:
+                    for data in self.read_chunks(entry):
+                        file_.write(data)
+                inodes[entry.inode] = path
+            _set_attributes(path, entry)
+        # Set the directories' times last, as creating their contents
+        # changed them, and deepest first.
+        for path, entry in reversed(directories):
+            _set_attributes(path, entry)
+        return len(entries)
+
+
+def _set_attributes(path, entry):
+    """Give path the permissions, owner and times of entry, like rsync -a."""
+    symlink = entry.type == SYMLINK
+    if os.geteuid() == 0:
+        os.lchown(path, entry.uid, entry.gid)
+    if symlink:
+        # Python 2 can't set the times of a symlink itself.
+        if _UTIME_NS and os.utime in os.supports_follow_symlinks:
+            os.utime(path, ns=(entry.mtime, entry.mtime),
+                     follow_symlinks=False)
+        return
+    os.chmod(path, stat_module.S_IMODE(entry.mode))
+    if _UTIME_NS:
+        os.utime(path, ns=(entry.mtime, entry.mtime))
+    else:
+        mtime = entry.mtime / 10.0 ** 9
+        os.utime(path, (mtime, mtime))
@@ -0,0 +1,240 @@
+"""Live progress and throughput telemetry for rsync transfers.
+
+In progress mode rsync is run with --info=progress2 and --stats, and the
+Monitor consumer parses its output as it's streamed. Every interval seconds
+it reports the transfer rate in bytes/s and files/s, how many files have been
+checked and transferred, and an estimate of the time remaining. Reports go to
+the logger and, optionally, to a JSON-lines file that monitoring can tail.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import logging
+import re
+import threading
+import time
+
+
+#: The extra rsync arguments that progress mode needs.
+RSYNC_ARGS = ["--info=progress2", "--stats"]
+
+
+_UNITS = {"": 1, "K": 1000, "M": 1000 ** 2, "G": 1000 ** 3, "T": 1000 ** 4,
+          "P": 1000 ** 5}
+
+_SIZE = re.compile(r"^([\d.,]+)([KMGTP]?)", re.IGNORECASE)
+
+# For example: "    1,234,567  12%   10.50MB/s    0:01:23 (xfr#5, to-chk=100/200)"
+_PROGRESS2 = re.compile(
+    r"^\s*(?P<bytes>[\d.,]+[KMGTP]?)\s+(?P<percent>\d+)%\s+"
+    r"(?P<rate>[\d.,]+[KMGTP]?B/s)\s+(?P<time>\d+:\d\d:\d\d)"
+    r"(?:\s+\(xfr#(?P<xfr>\d+), (?:ir|to)-chk=(?P<to_check>\d+)/"
+    r"(?P<total>\d+)\))?", re.IGNORECASE)
+
+# For example: "Total transferred file size: 1.23M bytes" or
+# "Number of files: 1,234 (reg: 1,000, dir: 234)"
+_STATS = re.compile(r"^(?P<key>[A-Z][A-Za-z ]+): (?P<value>[\d.,]+[KMGTP]?)"
+                    r"(?: bytes)?(?: \((?P<breakdown>.*)\))?")
+
+
+def parse_size(text):
+    """Return the number in the given rsync output as an int.
+
+    Understands both the digit separators that rsync uses by default and the
+    K, M, G, T and P suffixes (units of 1000) that --human-readable adds.
+
+    """
+    match = _SIZE.match(text.strip())
+    if not match:
+        raise ValueError(text)
+    number, unit = match.groups()
+    if unit:
+        return int(float(number.replace(",", ".")) * _UNITS[unit.upper()])
+    return int(number.replace(",", "").replace(".", ""))
+
+
+class Stats(object):
+
+    """A consumer that collects the totals from rsync's --stats output.
+
+    After rsync has finished self.totals is a dict like
+    {"Number of files": 1234, "Number of files (dir)": 234,
+    "Total transferred file size": 1230000, ...}.
+
+    """
+
+    def __init__(self):
+        self.totals = {}
+
+    def __call__(self, line):
+        if line.flags is not None:
+            return
+        match = _STATS.match(line.text)
+        if not match:
+            return
+        key = match.group("key")
+        try:
+            self.totals[key] = parse_size(match.group("value"))
+            for part in (match.group("breakdown") or "").split(", "):
+                if ": " in part:
+                    name, value = part.split(": ", 1)
+                    self.totals["%s (%s)" % (key, name)] = parse_size(value)
+        except ValueError:
+            pass
+
+
+def _format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Progress(Stats):
+
+    """A consumer that keeps track of one rsync's --info=progress2 output."""
+
+    def __init__(self):
+        super(Progress, self).__init__()
+        self.bytes = 0
+        self.percent = 0
+        self.files_transferred = 0
+        self.files_checked = 0
+        self.files_total = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, line):
+        super(Progress, self).__call__(line)
+        if line.flags is not None:
+            return
+        match = _PROGRESS2.match(line.text)
+        if not match:
+            return
+        with self._lock:
+            self.bytes = parse_size(match.group("bytes"))
+            self.percent = int(match.group("percent"))
+            if match.group("xfr"):
+                self.files_transferred = int(match.group("xfr"))
+                self.files_total = int(match.group("total"))
+                self.files_checked = (
+                    self.files_total - int(match.group("to_check")))
+
+    def state(self):
+        """Return (bytes, percent, files transferred, checked and total)."""
+        with self._lock:
+            return (self.bytes, self.percent, self.files_transferred,
+                    self.files_checked, self.files_total)
+
+
+class Monitor(Progress):
+
+    """A consumer that reports rsync's progress every interval seconds.
+
+    Call start() before running rsync and stop() afterwards. Reports are
+    made from a background thread so that they keep coming even if rsync
+    stalls and stops writing output (in which case the rates drop to 0).
+
+    The output of rsyncs that run at the same time must each go to their own
+    consumer from fork(), as their progress lines would overwrite each
+    other's. The reports add up the progress of all of them.
+
+    """
+
+    def __init__(self, interval=10, path=None, clock=time.time):
+        super(Monitor, self).__init__()
+        self.interval = interval
+        self.path = path
+        self.clock = clock
+        self._forks = []
+        self._stopped = threading.Event()
+        self._thread = None
+        self._last = None
+
+    def fork(self):
+        """Return a Progress for the output of one of several rsyncs."""
+        progress = Progress()
+        with self._lock:
+            self._forks.append(progress)
+        return progress
+
+    def report(self):
+        """Return a dict describing the progress since the last report."""
+        now = self.clock()
+        with self._lock:
+            forks = list(self._forks)
+        states = [self.state()] + [fork.state() for fork in forks]
+        bytes_, _, transferred, checked, total = [
+            sum(values) for values in zip(*states)]
+        # Each rsync's percentage is of its own total bytes.
+        total_bytes = sum(state[0] * 100.0 / state[1] for state in states
+                          if state[1])
+        current = (now, bytes_, checked)
+        report = {
+            "time": now,
+            "bytes": bytes_,
+            "percent": int(round(bytes_ * 100.0 / total_bytes))
+            if total_bytes else 0,
+            "files_checked": checked,
+            "files_total": total,
+            "files_transferred": transferred,
+            "bytes_per_second": 0.0,
+            "files_per_second": 0.0,
+            "eta_seconds": None,
+        }
+        if self._last is not None and now > self._last[0]:
+            elapsed = now - self._last[0]
+            report["bytes_per_second"] = (current[1] - self._last[1]) / elapsed
+            report["files_per_second"] = (current[2] - self._last[2]) / elapsed
+        self._last = current
+        if report["bytes_per_second"] > 0 and 0 < report["percent"] < 100:
+            total_bytes = report["bytes"] * 100.0 / report["percent"]
+            report["eta_seconds"] = (
+                (total_bytes - report["bytes"]) / report["bytes_per_second"])
+        return report
+
+    def emit(self, report=None):
+        """Send a report to the logger and the progress file."""
+        report = report or self.report()
+        logging.getLogger("snapshotter.progress").info(
+            "{bytes} bytes ({percent}%) at {rate:.0f} bytes/s, "
+            "{files_rate:.1f} files/s, {checked}/{total} files checked, "
+            "{transferred} transferred, ETA {eta}".format(
+                bytes=report["bytes"], percent=report["percent"],
+                rate=report["bytes_per_second"],
+                files_rate=report["files_per_second"],
+                checked=report["files_checked"], total=report["files_total"],
+                transferred=report["files_transferred"],
+                eta=_format_duration(report["eta_seconds"])))
+        self._write(report)
+
+    def _write(self, record):
+        if self.path:
+            with open(self.path, "a") as file_:
+                file_.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            self.emit()
+
+    def start(self):
+        """Start reporting progress every interval seconds."""
+        self._last = (self.clock(), 0, 0)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop reporting, and write a final record with rsync's --stats."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        totals = dict(self.totals)
+        for fork in self._forks:
+            for key, value in fork.totals.items():
+                totals[key] = totals.get(key, 0) + value
+        self._write({"time": self.clock(), "stats": totals})
@@ -0,0 +1,146 @@
+"""Deleting large directory trees in the background.
+
+Deleting an old snapshot with `rm -r -f` can take a long time, because every
+one of its (hard-linked) files has to be unlinked. Instead, snapshotter
+renames the snapshot into a trash directory, which is instant, and then a
+Reaper deletes it concurrently with whatever snapshotter does next.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import logging
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def _scandir(path):
+    """Yield (name, is_dir) for each entry in the directory path."""
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(path):
+            yield entry.name, entry.is_dir(follow_symlinks=False)
+    else:
+        for name in os.listdir(path):
+            full = os.path.join(path, name)
+            yield name, os.path.isdir(full) and not os.path.islink(full)
+
+
+def remove_tree(path, threads=8, pace=None):
+    """Delete the directory tree at path using several threads.
+
+    The threads unlink the files in different directories at the same time,
+    then the (by then empty) directories are removed deepest-first. Like
+    `rm -r -f` it isn't an error if path doesn't exist.
+
+    If a pace function is given, each thread calls it after each directory,
+    so that it can slow the deletion down (see throttle.Throttle.pace()).
+
+    """
+    if not os.path.lexists(path):
+        return
+    if not os.path.isdir(path) or os.path.islink(path):
+        os.unlink(path)
+        return
+
+    directories = [path]
+    lock = threading.Lock()
+    pending = queue.Queue()
+    errors = []
+    pending.put(path)
+
+    def work():
+        while True:
+            directory = pending.get()
+            if directory is None:
+                pending.task_done()
+                return
+            try:
+                for name, is_dir in _scandir(directory):
+                    full = os.path.join(directory, name)
+                    if is_dir:
+                        with lock:
+                            directories.append(full)
+                        pending.put(full)
+                    else:
+                        os.unlink(full)
+            except OSError as err:
+                errors.append(err)
+            finally:
+                pending.task_done()
+            if pace is not None:
+                pace()
+
+    workers = [threading.Thread(target=work) for _ in range(max(1, threads))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    pending.join()
+    for _ in workers:
+        pending.put(None)
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        raise errors[0]
+    for directory in sorted(directories, key=lambda d: d.count(os.sep),
+                            reverse=True):
+        os.rmdir(directory)
+
+
+class Reaper(object):
+
+    """Deletes directory trees in background threads.
+
+    reap() returns immediately. Call wait() when the space is actually
+    needed, for example before checking the free space on the disk again.
+
+    """
+
+    def __init__(self, threads=8):
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._running = {}
+
+    def reap(self, path, pace=None):
+        """Start deleting the directory tree at path in the background.
+
+        Does nothing if path is already being deleted. See remove_tree() for
+        pace.
+
+        """
+        def run():
+            try:
+                remove_tree(path, self.threads, pace)
+                logging.getLogger("snapshotter").info(
+                    "Finished deleting {path}".format(path=path))
+            except OSError as err:
+                logging.getLogger("snapshotter").error(
+                    "Deleting {path} failed: {err}".format(path=path,
+                                                           err=err))
+
+        with self._lock:
+            self._running = dict(
+                (p, t) for p, t in self._running.items() if t.is_alive())
+            if path in self._running:
+                return
+            thread = self._running[path] = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+
+    def pending(self):
+        """Return True if any trees are still being deleted."""
+        with self._lock:
+            return any(t.is_alive() for t in self._running.values())
+
+    def wait(self):
+        """Wait until all the trees passed to reap() have been deleted."""
+        with self._lock:
+            running = list(self._running.values())
+        for thread in running:
+            thread.join()
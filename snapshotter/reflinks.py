@@ -0,0 +1,123 @@
+"""Starting snapshots as copy-on-write clones of the latest one (--reflink).
+
+On filesystems with reflinks, like XFS and btrfs, reflink_seed() fills
+incomplete.snapshot with clones of the latest snapshot's files, which share
+their data until rsync changes them. The helper agent runs it on the remote
+host for remote destinations (standard library only).
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import stat as stat_module
+import time
+from multiprocessing.pool import ThreadPool
+
+
+#: The FICLONE ioctl from linux/fs.h, which makes a file share all of
+#: another file's data until either of them is written to (a "reflink").
+FICLONE = 0x40049409
+
+
+def _set_attributes(path, stat):
+    """Give path the permissions, times and (as root) owner in stat."""
+    if os.geteuid() == 0:
+        os.lchown(path, stat.st_uid, stat.st_gid)
+    os.chmod(path, stat_module.S_IMODE(stat.st_mode))
+    os.utime(path, (stat.st_atime, stat.st_mtime))
+
+
+def clone_file(src, dest):
+    """Make the new file dest a reflink of the file src.
+
+    :raises EnvironmentError: if the filesystem can't clone files
+
+    """
+    import fcntl
+    with open(src, "rb") as source:
+        with open(dest, "wb") as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    _set_attributes(dest, os.lstat(src))
+
+
+def supports_reflink(path):
+    """Return True if files in the directory path can be reflinked."""
+    probe = os.path.join(path, ".snapshotter-reflink-%d" % os.getpid())
+    try:
+        with open(probe, "wb") as file_:
+            file_.write(b"probe")
+        clone_file(probe, probe + ".clone")
+        return True
+    except EnvironmentError:
+        return False
+    finally:
+        for name in (probe, probe + ".clone"):
+            if os.path.lexists(name):
+                os.unlink(name)
+
+
+def clone_tree(src, dest, threads=8):
+    """Make dest a copy of the directory tree src, reflinking its files.
+
+    Symlinks are copied as symlinks and special files are skipped. The files
+    of each directory are cloned by a pool of threads.
+
+    """
+    directories = []
+    pool = ThreadPool(max(1, threads))
+    try:
+        for root, dirs, files in os.walk(src):
+            relative = os.path.relpath(root, src)
+            target = dest if relative == os.curdir else os.path.join(
+                dest, relative)
+            os.mkdir(target)
+            directories.append((target, os.lstat(root)))
+            regular = []
+            for name in files + [d for d in dirs
+                                 if os.path.islink(os.path.join(root, d))]:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(target, name))
+                elif os.path.isfile(path):
+                    regular.append((path, os.path.join(target, name)))
+            pool.map(lambda pair: clone_file(*pair), regular)
+    finally:
+        pool.close()
+        pool.join()
+    for path, stat in reversed(directories):
+        _set_attributes(path, stat)
+
+
+def reflink_seed(snapshots_root, trash, threads=8):
+    """Fill incomplete.snapshot with reflinks of latest.snapshot's files.
+
+    Returns [seeded, stale]. seeded is False, and nothing is done, if there's
+    no latest.snapshot or the filesystem can't reflink files.
+
+    rsync updates the files of a seeded incomplete.snapshot in place, so an
+    incomplete.snapshot left by an earlier run (whose files may be hard links
+    into other snapshots) is first moved into the trash directory. stale is
+    the path it was moved to, for the caller to delete, or None.
+
+    """
+    latest = os.path.join(snapshots_root, "latest.snapshot")
+    incomplete = os.path.join(snapshots_root, "incomplete.snapshot")
+    if not os.path.isdir(latest) or not supports_reflink(snapshots_root):
+        return [False, None]
+    stale = None
+    if os.path.lexists(incomplete):
+        if not os.path.isdir(trash):
+            os.makedirs(trash)
+        stale = os.path.join(trash, "incomplete-%d.snapshot" % (
+            time.time() * 1000))
+        os.rename(incomplete, stale)
+    clone_tree(latest + os.sep, incomplete, threads)
+    return [True, stale]
+
+
+#: The operations that this module adds to the agent.
+OPS = {
+    "reflink_seed": reflink_seed,
+}
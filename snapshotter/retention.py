@@ -0,0 +1,99 @@
+"""Generational retention policies for thinning out old snapshots.
+
+A policy says how many hourly, daily, weekly, monthly and yearly snapshots to
+keep, for example "hourly=24,daily=30,weekly=52,monthly=*" keeps the last
+snapshot of each of the last 24 hours that have snapshots, of each of the last
+30 days, of each of the last 52 weeks and of every month. A snapshot is kept if
+any of the rules keeps it.
+
+The times come from the YYYY-MM-DDTHH_MM_SS.snapshot names, so thinning is a
+single pass over the list of snapshots without touching the filesystem.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import datetime
+import os
+
+
+INF = float("inf")
+
+#: The periods that a policy can use, shortest first, each with a function
+#: that returns the period that a datetime is in.
+PERIODS = [
+    ("hourly", lambda time: (time.date(), time.hour)),
+    ("daily", lambda time: time.date()),
+    ("weekly", lambda time: time.isocalendar()[:2]),
+    ("monthly", lambda time: (time.year, time.month)),
+    ("yearly", lambda time: time.year),
+]
+
+
+def parse_policy(text):
+    """Parse a policy like "hourly=24,daily=30,monthly=*".
+
+    Returns a list of (period, count) pairs in the order of PERIODS, where
+    count is INF for "*".
+
+    :raises ValueError: if text isn't a valid policy
+
+    """
+    counts = {}
+    for part in text.split(","):
+        period, _, count = part.strip().partition("=")
+        if period not in dict(PERIODS):
+            raise ValueError(
+                "Unknown retention period: {period}".format(period=period))
+        if count == "*":
+            counts[period] = INF
+        else:
+            try:
+                counts[period] = int(count)
+            except ValueError:
+                raise ValueError(
+                    "Invalid number of {period} snapshots: {count}".format(
+                        period=period, count=count))
+            if counts[period] < 0:
+                raise ValueError(
+                    "Invalid number of {period} snapshots: {count}".format(
+                        period=period, count=count))
+    return [(period, counts[period]) for period, _ in PERIODS
+            if period in counts]
+
+
+def time_of(snapshot):
+    """Return the datetime of the given YYYY-MM-DDTHH_MM_SS.snapshot path."""
+    return datetime.datetime.strptime(os.path.basename(snapshot)[:19],
+                                      "%Y-%m-%dT%H_%M_%S")
+
+
+def thin(snapshots, policy, min_snapshots=1):
+    """Split the given snapshots into the ones to keep and the ones to remove.
+
+    snapshots must be sorted oldest-first, as returned by _ls_snapshots().
+    Going from the newest snapshot to the oldest, each rule of the policy
+    keeps the newest snapshot of each period until it has kept count of
+    them. The newest min_snapshots snapshots are always kept.
+
+    Returns (keep, remove), both sorted oldest-first.
+
+    """
+    keys = dict(PERIODS)
+    last = {}
+    kept = dict((period, 0) for period, _ in policy)
+    keep, remove = [], []
+    for index, snapshot in enumerate(reversed(snapshots)):
+        time = time_of(snapshot)
+        keeping = index < min_snapshots
+        for period, count in policy:
+            key = keys[period](time)
+            if key != last.get(period) and kept[period] < count:
+                kept[period] += 1
+                keeping = True
+            last[period] = key
+        (keep if keeping else remove).append(snapshot)
+    keep.reverse()
+    remove.reverse()
+    return keep, remove
@@ -0,0 +1,84 @@
+"""Splitting a source directory into balanced shards for parallel transfer.
+
+The top-level subdirectories of the source are scanned for their total size
+and number of files, and then assigned to shards so that each shard has
+roughly the same amount of work. Only the first SCAN_LIMIT files of each
+subdirectory are looked at and the rest is extrapolated, as the balance only
+needs to be rough and a full scan would take about as long as rsync's own.
+Each shard's subdirectories are transferred by their own rsync processes,
+concurrently with the other shards.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import os
+from multiprocessing.pool import ThreadPool
+
+from snapshotter import diskusage
+
+
+#: How many bytes of transfer one file's per-file overhead (stat calls,
+#: protocol round trips, directory entries) is worth when balancing shards.
+PER_FILE_COST = 64 * 1024
+
+
+#: How many files of each top-level subdirectory to look at when scanning.
+SCAN_LIMIT = 10000
+
+
+#: A top-level subdirectory of the source, with its size and number of files.
+Subtree = collections.namedtuple("Subtree", ["name", "bytes", "count"])
+
+
+def scan(path, threads=4, limit=SCAN_LIMIT):
+    """Return a Subtree for each top-level subdirectory of the local path.
+
+    Subdirectories that are symlinks or on a different device to path (mount
+    points) aren't returned. The subdirectories are scanned in parallel, each
+    up to limit files (None for all of them), see diskusage.usage().
+
+    """
+    device = os.lstat(path).st_dev
+    names = []
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        if (os.path.isdir(full) and not os.path.islink(full) and
+                os.lstat(full).st_dev == device):
+            names.append(name)
+
+    pool = ThreadPool(max(1, threads))
+    try:
+        usages = pool.map(
+            lambda name: diskusage.usage(os.path.join(path, name), device,
+                                         limit),
+            names)
+    finally:
+        pool.close()
+        pool.join()
+    return [Subtree(name, bytes_, count)
+            for name, (bytes_, count) in zip(names, usages)]
+
+
+def weight(subtree):
+    """Return the estimated transfer cost of the given subtree."""
+    return subtree.bytes + subtree.count * PER_FILE_COST
+
+
+def plan(subtrees, jobs):
+    """Split subtrees into at most jobs lists of roughly equal weight.
+
+    Returns a list of lists of subtree names. Uses the longest processing
+    time first heuristic: the heaviest remaining subtree always goes to the
+    lightest shard so far.
+
+    """
+    shards = [[] for _ in range(max(1, jobs))]
+    loads = [0] * len(shards)
+    for subtree in sorted(subtrees, key=weight, reverse=True):
+        lightest = loads.index(min(loads))
+        shards[lightest].append(subtree.name)
+        loads[lightest] += weight(subtree)
+    return [shard for shard in shards if shard]
@@ -8,16 +8,45 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 from __future__ import print_function
 
+import collections
 import datetime
+import errno
+import json
 import sys
+import time
 import os
 import subprocess
+import tempfile
 import argparse
 import re
 import logging
+import signal
+import threading
+from multiprocessing.pool import ThreadPool
 
 
 from snapshotter import PY2, PY3, STDOUT_ENCODING
+from snapshotter import agent
+from snapshotter import catalog
+from snapshotter import contentindex
+from snapshotter import dedup
+from snapshotter import diskusage
+from snapshotter import engine
+from snapshotter import integrity
+from snapshotter import itemize
+from snapshotter import jobfile
+from snapshotter import journal
+from snapshotter import locking
+from snapshotter import manifest
+from snapshotter import metrics
+from snapshotter import pack
+from snapshotter import progress
+from snapshotter import reflinks
+from snapshotter import shards
+from snapshotter import reaper
+from snapshotter import retention
+from snapshotter import throttle
+from snapshotter import treediff
 
 
 if PY2:
@@ -29,6 +58,40 @@ elif PY3:
 INF = float("inf")
 
 
+#: The number of lines of a streamed command's output to keep for error
+#: reporting.
+TAIL_LINES = 100
+
+
+#: The factor by which to overestimate the space needed for a new snapshot.
+SPACE_MARGIN = 1.05
+
+#: The typical size of a filesystem block, for estimating space.
+BLOCK_SIZE = 4096
+
+
+#: The most --link-dest args that rsync accepts.
+MAX_LINK_DESTS = 20
+
+#: The number of snapshots that a retention policy removes at once.
+RETENTION_BATCH = 100
+
+
+#: What snapshot() does if another snapshotter is making a snapshot in the
+#: same destination: wait for it to finish, exit, or ask it to make one more
+#: snapshot when it finishes and exit.
+WAIT = "wait"
+EXIT = "exit"
+COALESCE = "coalesce"
+
+#: How often to check whether a locked destination has been unlocked.
+LOCK_POLL = 5
+
+
+#: Deletes old snapshots from local destinations in the background.
+_reaper = reaper.Reaper()
+
+
 def _info(message):
     logging.getLogger("snapshotter").info(message)
 
@@ -54,12 +117,18 @@ class NoSuchCommandError(Exception):
         self.command = command
 
 
-def _run(command, debug=False):
+def _run(command, debug=False, consumers=None, throttle_=None):
     """Run the given command as a subprocess and return its output.
 
     This redirects the subprocess's stderr to stdout so the returned string
     should contain everything written to stdout and stderr together.
 
+    If a list of consumers is given the output is streamed instead: each line
+    is passed to each of the consumer callables as it's read, only the last
+    TAIL_LINES lines are kept (for error.output if the command fails) and
+    None is returned. The process of a streamed command is throttled by the
+    given throttle.Throttle, if any, while it runs.
+
     :raises CalledProcessError: If running the command fails or the command
         exits with non-zero status. The command's stdout and stderr will be
         availabled as error.output, and its exit status as error.exit_value.
@@ -70,7 +139,12 @@ def _run(command, debug=False):
     _info(" ".join(command))
     if debug:
         return
+    metrics.count("subprocesses")
+    if command[0] == "ssh":
+        metrics.count("ssh_connections")
     try:
+        if consumers is not None:
+            return _stream(command, consumers, throttle_)
         return text(
             subprocess.check_output(command, stderr=subprocess.STDOUT),
             encoding=STDOUT_ENCODING)
@@ -86,6 +160,74 @@ def _run(command, debug=False):
             raise
 
 
+def _lines(file_):
+    """Yield the lines read from the given file object as text.
+
+    Both \\n and \\r end a line, because rsync uses \\r to redraw its
+    progress output in place.
+
+    """
+    pending = b""
+    while True:
+        chunk = os.read(file_.fileno(), 65536)
+        if not chunk:
+            break
+        lines = re.split(b"[\r\n]", pending + chunk)
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield text(line, encoding=STDOUT_ENCODING, errors="replace")
+    if pending:
+        yield text(pending, encoding=STDOUT_ENCODING, errors="replace")
+
+
+def _kill_process_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        # The processes have already exited.
+        pass
+
+
+def _stream(command, consumers, throttle_=None):
+    """Run command, passing each line of its output to each of consumers.
+
+    Only a bounded tail of the output is kept in memory, so this can be used
+    for commands that produce any amount of output. A throttled command is
+    run in a process group of its own, see throttle.Throttle.add().
+
+    """
+    tail = collections.deque(maxlen=TAIL_LINES)
+    kwargs = throttle.new_process_group() if throttle_ is not None else {}
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    if throttle_ is not None:
+        throttle_.add(process.pid)
+    try:
+        try:
+            for line in _lines(process.stdout):
+                tail.append(line)
+                for consumer in consumers:
+                    consumer(line)
+        except BaseException:
+            if throttle_ is not None:
+                # Its children aren't in our process group, so Ctrl-C
+                # didn't reach them.
+                _kill_process_group(process.pid)
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            process.stdout.close()
+        exit_value = process.wait()
+    finally:
+        if throttle_ is not None:
+            throttle_.remove(process.pid)
+    if exit_value != 0:
+        raise CalledProcessError(' '.join(command), '\n'.join(tail),
+                                 exit_value)
+
+
 class NoSpaceLeftOnDeviceError(Exception):
 
     """Exception that's raised if rsync fails with "No space left on device."""
@@ -93,9 +235,39 @@ class NoSpaceLeftOnDeviceError(Exception):
     pass
 
 
-def _rsync(source, dest, debug=False, extra_args=None):
+def _log_rsync_line(line):
+    """Log a line of rsync's output at debug level."""
+    logging.getLogger("snapshotter.rsync").debug(line.text)
+
+
+def _rsync(source, dest, debug=False, extra_args=None, consumers=None,
+           subdir=None, link_dests=None, files_from=None, reflink=False):
     """Run an rsync command as a subprocess.
 
+    rsync's output is streamed, not held in memory: each line is parsed into
+    an itemize.Line and passed to each of the given consumer callables as
+    rsync runs.
+
+    If a throttle.Throttle is applying to the calling thread (see
+    throttle.applying()) rsync is run at low priority and throttled by it.
+
+    If a subdir is given then only that top-level subdirectory of source is
+    copied, into the same subdirectory of incomplete.snapshot and with
+    --link-dest pointing to the same subdirectory of latest.snapshot.
+
+    link_dests is a list of the names of other snapshots for rsync to look
+    for unchanged files in (with more --link-dest args) if they aren't in
+    latest.snapshot, in the order to look in them.
+
+    If files_from is given then only the NUL-separated paths (relative to
+    source) in that file are copied, and nothing is deleted from
+    incomplete.snapshot, see _incremental_rsync().
+
+    If reflink is True then incomplete.snapshot already contains reflinks of
+    latest.snapshot's files (see _reflink_seed()), so instead of --link-dest
+    rsync is told to update the changed blocks of the files in place, so
+    that the unchanged blocks stay shared with latest.snapshot.
+
     :raises CalledProcessError: if rsync exits with a non-zero exit value
     :raises NoSuchCommandError: if rsync is not installed in the expected
         location
@@ -104,6 +276,8 @@ def _rsync(source, dest, debug=False, extra_args=None):
     # Make sure source ends with / because this affects how rsync behaves.
     if not source.endswith(os.sep):
         source += os.sep
+    if subdir is not None:
+        source += subdir + os.sep
 
     rsync_cmd = [
         "rsync",
@@ -117,11 +291,27 @@ def _rsync(source, dest, debug=False, extra_args=None):
         '--delete-excluded',  # Also delete excluded files from dest dirs.
         '--itemize-changes',  # Output a change-summary for all updates.
         # Make hard-links to the previous snapshot, if any.
-        '--link-dest=../latest.snapshot',
+        '--link-dest=' + _link_dest(subdir),
         '--human-readable',  # Output numbers in a human-readable format.
         '--fuzzy',  # Look for basis files for any missing destination files.
     ]
 
+    for name in link_dests or []:
+        rsync_cmd.append('--link-dest=' + _link_dest(subdir, name))
+
+    if files_from is not None:
+        rsync_cmd = [arg for arg in rsync_cmd
+                     if not arg.startswith('--delete')]
+        rsync_cmd.extend(['--files-from=' + files_from, '--from0'])
+
+    if reflink:
+        # --inplace can't be used with --partial-dir, and rsync only
+        # compares blocks (instead of copying whole files) between local
+        # directories with --no-whole-file.
+        rsync_cmd = [arg for arg in rsync_cmd
+                     if not arg.startswith(('--link-dest', '--partial'))]
+        rsync_cmd.extend(['--inplace', '--no-whole-file'])
+
     rsync_cmd.extend(extra_args or [])
 
     if debug:
@@ -136,12 +326,38 @@ def _rsync(source, dest, debug=False, extra_args=None):
             dest += "%s@" % user
         dest += "%s:" % host
     dest += os.path.join(snapshots_root, "incomplete.snapshot")
+    if subdir is not None:
+        dest = os.path.join(dest, subdir)
     rsync_cmd.append(dest)
 
+    controller = throttle.current()
+    if controller is not None:
+        rsync_cmd = controller.command(rsync_cmd)
+
+    metrics.count("rsync_runs")
+    if host is not None or _is_remote(source):
+        # rsync runs ssh itself.
+        metrics.count("ssh_connections")
+
+    no_space_errors = []
+    counter = itemize.Counter()
+    consumers = [_log_rsync_line, counter] + list(consumers or [])
+
+    def consume(text_):
+        line = itemize.parse(text_)
+        if "No space left on device (28)" in text_:
+            # Remember this in case it has scrolled out of err.output.
+            no_space_errors.append(text_)
+        for consumer in consumers:
+            consumer(line)
+
     try:
-        _run(rsync_cmd)
+        _run(rsync_cmd, consumers=[consume], throttle_=controller)
+        _info("rsync: " + counter.summary())
     except CalledProcessError as err:
-        if err.exit_value == 11 and "No space left on device (28)" in err.output:
+        if err.exit_value == 11 and (
+                no_space_errors or
+                "No space left on device (28)" in err.output):
             raise NoSpaceLeftOnDeviceError(err.output)
         elif err.exit_value ==  24:
             # Partial transfer due to vanished source files.
@@ -150,6 +366,258 @@ def _rsync(source, dest, debug=False, extra_args=None):
             raise
 
 
+def _link_dest(subdir=None, snapshot="latest.snapshot"):
+    """Return the --link-dest path for the given subdir of the snapshot.
+
+    rsync interprets a relative --link-dest path relative to the destination
+    directory.
+
+    """
+    if subdir is None:
+        return os.path.join("..", snapshot)
+    return os.path.join("..", "..", snapshot, subdir)
+
+
+def _link_dest_candidates(snapshots, count=1, history=None):
+    """Return the names of the snapshots to pass to _rsync() as link_dests.
+
+    These are the count most recent snapshots (including the newest one,
+    which latest.snapshot already points to and which isn't returned) and
+    then the snapshots that the history retention policy keeps (see
+    retention.thin()), newest first. rsync takes at most MAX_LINK_DESTS
+    --link-dest args.
+
+    """
+    newest_first = [os.path.basename(s) for s in reversed(snapshots)]
+    candidates = newest_first[1:count]
+    if history:
+        keep, _ = retention.thin(newest_first[::-1], history, min_snapshots=0)
+        candidates.extend(name for name in reversed(keep)
+                          if name not in candidates and
+                          name != newest_first[0])
+    return candidates[:MAX_LINK_DESTS - 1]
+
+
+def _choose_link_dests(dest, count=1, history=None, debug=False):
+    """Return the _link_dest_candidates() of dest that aren't packed.
+
+    Packed snapshots have no files for rsync to link to.
+
+    """
+    user, host, snapshots_root = _parse_path(dest)
+    return [name for name in _link_dest_candidates(
+        _list_snapshots(dest, debug), count, history)
+        if not _is_packed(os.path.join(snapshots_root, name), user, host)]
+
+
+def _report_link_dests(link_dests, recorder, baseline):
+    """Report what the extra --link-dest snapshots saved.
+
+    recorder is the catalog.Recorder of the real transfer and baseline the
+    progress.Stats of a dry run with latest.snapshot as the only --link-dest.
+    The bytes are those of the files that were transferred and stored in the
+    new snapshot instead of being hard-linked.
+
+    """
+    files_key = "Number of regular files transferred"
+    bytes_key = "Total transferred file size"
+    _info("With {count} more --link-dest snapshots: {files} files and "
+          "{bytes} bytes transferred and stored. With latest.snapshot only: "
+          "{baseline_files} files and {baseline_bytes} bytes".format(
+              count=len(link_dests), files=recorder.total(files_key),
+              bytes=recorder.total(bytes_key),
+              baseline_files=baseline.totals.get(files_key),
+              baseline_bytes=baseline.totals.get(bytes_key)))
+
+
+class _PrefixingConsumer(object):
+
+    """Pass lines from a subdir's rsync on to consumers with full paths.
+
+    A lock is held while passing each line on so that the consumers don't
+    have to be thread-safe.
+
+    """
+
+    def __init__(self, subdir, consumers, lock):
+        self.subdir = subdir
+        self.consumers = consumers
+        self.lock = lock
+
+    def __call__(self, line):
+        if line.path is not None:
+            line = line._replace(path=self.subdir + "/" + line.path)
+        with self.lock:
+            for consumer in self.consumers:
+                consumer(line)
+
+
+def _escape_rsync_pattern(name):
+    """Return a filter pattern for rsync that only matches name itself.
+
+    rsync only treats a backslash as an escape character in patterns that
+    contain wildcards, so names without any are returned unchanged.
+
+    """
+    if not re.search(r"[*?[]", name):
+        return name
+    return re.sub(r"([*?[\\])", r"\\\1", name)
+
+
+def _scan_source(source, jobs):
+    """Return a shards.Subtree for each top-level subdirectory of source.
+
+    Each subdirectory is only scanned up to shards.SCAN_LIMIT files.
+
+    """
+    user, host, path = _parse_path(source)
+    remote = _agent(user, host)
+    if remote is not None:
+        return [shards.Subtree(*entry)
+                for entry in _call_agent(remote, "scan", path=path,
+                                         limit=shards.SCAN_LIMIT)]
+    elif host:
+        return []
+    return shards.scan(path, threads=jobs)
+
+
+def _parallel_rsync(source, dest, jobs, debug=False, extra_args=None,
+                    consumers=None, link_dests=None, reflink=False):
+    """Copy source to dest by running up to jobs rsync processes at once.
+
+    The top-level subdirectories of source are split into jobs balanced
+    shards, and each shard's subdirectories are copied by their own rsyncs,
+    concurrently with the other shards. A final rsync then copies the
+    top-level files and deletes any top-level entries that are no longer in
+    source, without touching the subdirectories that have already been
+    copied.
+
+    The output of the concurrent rsyncs is interleaved line by line, so each
+    rsync's output goes to consumers of its own from the fork() method of
+    the consumers that have one (like catalog.Recorder), which keep state
+    from one line to the next.
+
+    Note that any exclude patterns anchored to the root of the transfer
+    (like --exclude=/foo/bar) won't match inside the sharded subdirectories.
+
+    :raises NoSpaceLeftOnDeviceError: if any of the rsyncs runs out of space
+    :raises CalledProcessError: if any of the rsyncs fails for another reason
+
+    """
+    plan = shards.plan(_scan_source(source, jobs), jobs)
+    if not plan:
+        return _rsync(source, dest, debug, extra_args, consumers=consumers,
+                      link_dests=link_dests, reflink=reflink)
+    _info("Copying {count} subdirectories in {shards} shards".format(
+        count=sum(len(shard) for shard in plan), shards=len(plan)))
+
+    user, host, snapshots_root = _parse_path(dest)
+    _mkdir(os.path.join(snapshots_root, "incomplete.snapshot"), user, host,
+           debug=debug)
+
+    lock = threading.Lock()
+    errors = []
+
+    report = metrics.current()
+    controller = throttle.current()
+
+    def run_shard(shard):
+        with metrics.recording(report), throttle.applying(controller):
+            for subdir in shard:
+                with lock:
+                    forks = [consumer.fork() if hasattr(consumer, "fork")
+                             else consumer for consumer in consumers or []]
+                try:
+                    _rsync(source, dest, debug, extra_args,
+                           consumers=[_PrefixingConsumer(subdir, forks,
+                                                         lock)],
+                           subdir=subdir, link_dests=link_dests,
+                           reflink=reflink)
+                except (NoSpaceLeftOnDeviceError, CalledProcessError) as err:
+                    errors.append(err)
+                    if isinstance(err, NoSpaceLeftOnDeviceError):
+                        return
+
+    pool = ThreadPool(len(plan))
+    try:
+        pool.map(run_shard, plan)
+    finally:
+        pool.close()
+        pool.join()
+
+    for err in errors:
+        if isinstance(err, NoSpaceLeftOnDeviceError):
+            raise err
+    if errors:
+        raise errors[0]
+
+    root_args = list(extra_args or [])
+    for subdir in sorted(sum(plan, [])):
+        # Don't copy the subdirectories again, and protect them from
+        # --delete-excluded.
+        pattern = _escape_rsync_pattern(subdir)
+        root_args.extend(
+            ["--exclude=/%s/" % pattern, "--filter=P /%s/" % pattern])
+    _rsync(source, dest, debug, root_args, consumers=consumers,
+           link_dests=link_dests, reflink=reflink)
+
+
+def _native_copy(source, dest, consumers=None, link_dests=None, threads=8):
+    """Copy local source into a new snapshot in local dest without rsync.
+
+    See engine.copy_tree(). Unchanged files are hard-linked against
+    latest.snapshot and then the link_dests snapshots, like _rsync() does.
+
+    :raises NoSpaceLeftOnDeviceError: if dest runs out of space
+    :raises CalledProcessError: if copying fails for any other reason
+
+    """
+    snapshots_root = _parse_path(dest)[2]
+    counter = itemize.Counter()
+    try:
+        engine.copy_tree(
+            _parse_path(source)[2],
+            os.path.join(snapshots_root, "incomplete.snapshot"),
+            link_dests=[os.path.join(snapshots_root, name) for name in
+                        ["latest.snapshot"] + list(link_dests or [])],
+            consumers=[_log_rsync_line, counter] + list(consumers or []),
+            threads=threads)
+    except (OSError, IOError) as err:
+        if err.errno == errno.ENOSPC:
+            raise NoSpaceLeftOnDeviceError(text(err))
+        raise CalledProcessError("native copy", text(err), 1)
+    _info("native: " + counter.summary())
+
+
+def _reflink_seed(snapshots_root, user=None, host=None):
+    """Fill incomplete.snapshot with reflinks of latest.snapshot's files.
+
+    See reflinks.reflink_seed(), which is run on the remote host for remote
+    destinations. Returns False if that can't be done (no latest.snapshot, a
+    filesystem without reflinks, or a remote host without the helper agent),
+    in which case rsync should use --link-dest as usual.
+
+    """
+    remote = _agent(user, host)
+    trash = _trash_dir(snapshots_root)
+    if remote is not None:
+        seeded, stale = _call_agent(remote, "reflink_seed",
+                                    snapshots_root=snapshots_root,
+                                    trash=trash)
+    elif host:
+        seeded, stale = False, None
+    else:
+        seeded, stale = reflinks.reflink_seed(snapshots_root, trash)
+    if stale:
+        _reap([stale], user, host)
+    if seeded:
+        _info("Cloned latest.snapshot into incomplete.snapshot")
+    else:
+        _info("Can't reflink files in {root}, using --link-dest".format(
+            root=snapshots_root))
+    return seeded
+
+
 def _wrap_in_ssh(command, user, host):
     """Return the given command with ssh prepended to run it remotely.
 
@@ -172,29 +640,163 @@ def _wrap_in_ssh(command, user, host):
     return ssh_command
 
 
+def _agent(user, host):
+    """Return the helper agent for the given remote host.
+
+    Returns None if host is None (a local path) or if the agent couldn't be
+    started on the remote host, in which case callers should fall back to
+    running each command over its own ssh connection.
+
+    """
+    if not host:
+        return None
+    if not agent.connected((user, host)):
+        metrics.count("ssh_connections")
+    return agent.connect(
+        (user, host), _wrap_in_ssh(agent.remote_command(), user, host))
+
+
+def _call_agent(remote, op, debug=False, **kwargs):
+    """Run an operation on the given helper agent and return its result.
+
+    :raises CalledProcessError: if the operation fails on the remote host
+
+    """
+    description = " ".join([op] + [text(v) for v in kwargs.values()])
+    _info("agent: " + description)
+    if debug:
+        return
+    metrics.count("agent_calls")
+    try:
+        return remote.call(op, **kwargs)
+    except agent.RemoteError as err:
+        raise CalledProcessError(description, err.message, err.errno or 1)
+    except agent.AgentUnavailableError as err:
+        raise CalledProcessError(description, text(err), 255)
+
+
+def _is_packed(path, user=None, host=None):
+    """Return True if the snapshot directory path on host is packed.
+
+    See pack.is_packed(). Remote snapshots are checked through the helper
+    agent, and taken not to be packed if it can't be started there.
+
+    """
+    if not host:
+        return pack.is_packed(path)
+    remote = _agent(user, host)
+    if remote is None:
+        return False
+    try:
+        remote.call("stat", path=os.path.join(path, pack.INDEX_FILENAME))
+    except agent.RemoteError:
+        return False
+    return True
+
+
+def _incomplete_manifest_path(snapshots_root, date, host=None):
+    """Return the path to write the manifest of a new snapshot to.
+
+    For local destinations this is incomplete.manifest next to the
+    incomplete.snapshot directory. Manifests for remote destinations are
+    written to a new local temporary directory and copied when the snapshot
+    is done, see _move_incomplete_dir().
+
+    """
+    if host:
+        # In a new directory, as several snapshots (see run_jobs()) can be
+        # made at once, even in the same second, and manifest.Writer only
+        # creates the file when there's something to write.
+        return os.path.join(tempfile.mkdtemp(prefix="snapshotter-"),
+                            date + ".manifest")
+    return os.path.join(snapshots_root, "incomplete.manifest")
+
+
+def _remove_temporary_manifest(manifest_path):
+    """Remove a manifest from _incomplete_manifest_path() for a remote dest.
+
+    Its temporary directory is removed as well.
+
+    """
+    if os.path.exists(manifest_path):
+        os.unlink(manifest_path)
+    os.rmdir(os.path.dirname(manifest_path))
+
+
 def _move_incomplete_dir(snapshots_root, date, user=None, host=None,
-                         debug=False):
+                         debug=False, manifest_path=None, recorder=None,
+                         duration=None):
     """Move the incomplete.snapshot dir to YYYY-MM-DDTHH_MM_SS.snapshot.
 
-    If snapshots_root is a remote path move the directory remotely
-    by running `ssh [user@]host mv ...`.
+    If snapshots_root is a remote path move the directory remotely, using the
+    helper agent or else by running `ssh [user@]host mv ...`.
+
+    If a manifest_path is given and the file exists then it's published as
+    YYYY-MM-DDTHH_MM_SS.manifest, but only once the snapshot itself has been
+    moved into place. For remote destinations the local temporary manifest
+    is removed either way.
+
+    The new snapshot is then added to the catalog, with the statistics
+    collected by the given catalog.Recorder and the given duration.
 
     """
     src = os.path.join(snapshots_root, "incomplete.snapshot")
     dest = os.path.join(snapshots_root, date + ".snapshot")
-    mv_cmd = _wrap_in_ssh(["mv", src, dest], user, host)
     _info("Moving incomplete.snapshot")
-    _run(mv_cmd, debug=debug)
+    try:
+        _mv(src, dest, user, host, debug=debug)
+
+        if manifest_path and not debug and os.path.exists(manifest_path):
+            published = manifest.path_for(dest)
+            if host:
+                remote_path = "%s:%s" % (host, published)
+                if user is not None:
+                    remote_path = "%s@%s" % (user, remote_path)
+                _run(["rsync", manifest_path, remote_path])
+            else:
+                os.rename(manifest_path, published)
+    finally:
+        if manifest_path and not debug and host:
+            _remove_temporary_manifest(manifest_path)
+
+    if not debug:
+        _update_catalog(
+            snapshots_root, user, host, "add", date + ".snapshot",
+            duration=duration,
+            bytes_=recorder.bytes if recorder is not None else None,
+            files=recorder.files if recorder is not None else None)
     return dest
 
 
+def _mv(src, dest, user=None, host=None, debug=False):
+    """Rename src to dest.
+
+    If the paths are remote rename them remotely, using the helper agent or
+    else by running `ssh [user@]host mv ...`.
+
+    """
+    remote = _agent(user, host)
+    if remote is not None:
+        _call_agent(remote, "rename", src=src, dest=dest, debug=debug)
+    else:
+        _run(_wrap_in_ssh(["mv", src, dest], user, host), debug=debug)
+
+
 def _rm(path, user=None, host=None, directory=False, debug=False):
     """Remove the given filesystem path.
 
-    If path is a remote path remove it remotely by running
-    `ssh [user@]host rm ...`.
+    If path is a remote path remove it remotely, using the helper agent or
+    else by running `ssh [user@]host rm ...`.
 
     """
+    remote = _agent(user, host)
+    if remote is not None:
+        if directory:
+            _call_agent(remote, "rmtree", path=path, debug=debug)
+        else:
+            _call_agent(remote, "unlink", path=path, missing_ok=True,
+                        debug=debug)
+        return
     command = ["rm", "-f", path]
     if directory:
         command.insert(1, "-r")
@@ -205,14 +807,170 @@ def _rm(path, user=None, host=None, directory=False, debug=False):
 def _ln(target, link_path, user=None, host=None, debug=False):
     """Create a symlink to the given target of the given link path.
 
-    If link_path is a remote path then create the symlink remotely by running
-    `ssh [user@]host ln -s ...`.
+    If link_path is a remote path then create the symlink remotely, using the
+    helper agent or else by running `ssh [user@]host ln -s ...`.
 
     """
+    remote = _agent(user, host)
+    if remote is not None:
+        _call_agent(remote, "symlink", target=target, path=link_path,
+                    debug=debug)
+        return
     command = _wrap_in_ssh(["ln", "-s", target, link_path], user, host)
     _run(command, debug=debug)
 
 
+def _trash_dir(snapshots_root):
+    """Return the path to the trash directory in snapshots_root."""
+    return os.path.join(snapshots_root, "trash")
+
+
+def _reap(paths, user=None, host=None, debug=False):
+    """Start deleting the given paths in the background.
+
+    Local paths are deleted by background threads in this process, which
+    are throttled by the throttle.Throttle applying to the calling thread,
+    if any. Remote paths are deleted by detached `rm -r -f` processes on
+    the remote host, started by the helper agent or else by a single `ssh
+    [user@]host nohup rm ...`.
+
+    """
+    for path in paths:
+        _info("Deleting {path} in the background".format(path=path))
+    if debug or not paths:
+        return
+    if not host:
+        controller = throttle.current()
+        for path in paths:
+            _reaper.reap(path, controller and controller.pace)
+        return
+    remote = _agent(user, host)
+    if remote is not None:
+        for path in paths:
+            _call_agent(remote, "reap", path=path)
+    else:
+        _run(_wrap_in_ssh(
+            ["nohup", "rm", "-r", "-f"] + list(paths) +
+            ["</dev/null", ">/dev/null", "2>&1", "&"], user, host))
+
+
+def _ls_trash(snapshots_root, user=None, host=None):
+    """Return the names of the entries in the trash directory."""
+    trash = _trash_dir(snapshots_root)
+    remote = _agent(user, host)
+    if remote is not None:
+        try:
+            return [name for name, _ in remote.call("list", path=trash)]
+        except agent.RemoteError:
+            return []
+    elif host:
+        output = _run(_wrap_in_ssh(["ls", "-A", trash, "2>/dev/null", "||",
+                                    "true"], user, host))
+        return [name for name in output.split("\n") if name]
+    elif os.path.isdir(trash):
+        return os.listdir(trash)
+    return []
+
+
+def _wait_for_reaping(snapshots_root, user=None, host=None, poll=1):
+    """Wait until the snapshots being deleted in the background are gone.
+
+    Only call this when the space is actually needed.
+
+    """
+    _info("Waiting for old snapshots to be deleted")
+    _reap_trash(snapshots_root, user, host)
+    _reaper.wait()
+    if host:
+        while _ls_trash(snapshots_root, user, host):
+            time.sleep(poll)
+
+
+def _reap_trash(snapshots_root, user=None, host=None, debug=False):
+    """Make sure everything in the trash is being deleted.
+
+    This resumes deleting anything left in the trash by an earlier run.
+
+    """
+    _reap([os.path.join(_trash_dir(snapshots_root), name)
+           for name in _ls_trash(snapshots_root, user, host)],
+          user, host, debug=debug)
+
+
+def _discard_snapshot(snapshot_, user=None, host=None, debug=False):
+    """Remove the given snapshot directory and its manifest.
+
+    See _discard_snapshots().
+
+    """
+    _discard_snapshots([snapshot_], user, host, debug=debug)
+
+
+def _discard_snapshots(snapshots, user=None, host=None, debug=False):
+    """Remove the given snapshot directories and their manifests.
+
+    The snapshots, which must all be in the same directory, are first removed
+    from the catalog and moved into the trash directory, which is instant,
+    and then deleted in the background (see _reap()). Each step is done for
+    all of the snapshots at once, in a single transaction or command where
+    possible.
+
+    """
+    if not snapshots:
+        return
+    metrics.count("prune_iterations")
+    metrics.count("snapshots_removed", len(snapshots))
+    snapshots_root = os.path.dirname(snapshots[0])
+    names = [os.path.basename(s) for s in snapshots]
+    if not debug:
+        _update_catalog(snapshots_root, user, host, "remove", names)
+    trash = _trash_dir(snapshots_root)
+    _mkdir(trash, user, host, debug=debug)
+    remote = _agent(user, host)
+    if remote is not None or not host or len(snapshots) == 1:
+        for snapshot_, name in zip(snapshots, names):
+            _mv(snapshot_, os.path.join(trash, name), user, host, debug=debug)
+    else:
+        _run(_wrap_in_ssh(["mv"] + list(snapshots) + [trash], user, host),
+             debug=debug)
+    _remove_manifests(snapshots, user, host, debug=debug)
+    _reap([os.path.join(trash, name) for name in names], user, host,
+          debug=debug)
+
+
+def _remove_manifests(snapshots, user=None, host=None, debug=False):
+    """Remove the manifest files of the given snapshots, if they have them."""
+    paths = [manifest.path_for(s) for s in snapshots]
+    remote = _agent(user, host)
+    if remote is not None:
+        for path in paths:
+            _call_agent(remote, "unlink", path=path, missing_ok=True,
+                        debug=debug)
+    elif host:
+        _run(_wrap_in_ssh(["rm", "-f"] + paths, user, host), debug=debug)
+    elif not debug:
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError as err:
+                if err.errno != 2:
+                    raise
+
+
+def _mkdir(path, user=None, host=None, debug=False):
+    """Create the given directory, and any missing parents.
+
+    If path is a remote path then create it remotely, using the helper agent
+    or else by running `ssh [user@]host mkdir -p ...`.
+
+    """
+    remote = _agent(user, host)
+    if remote is not None:
+        _call_agent(remote, "mkdir", path=path, debug=debug)
+        return
+    _run(_wrap_in_ssh(["mkdir", "-p", path], user, host), debug=debug)
+
+
 def _update_latest_symlink(date, snapshots_root, user=None, host=None,
                            debug=False):
     """Update the latest.snapshot symlink to point to the new snapshot.
@@ -309,13 +1067,21 @@ def _ls_snapshots(dest):
         # removing the user and host parts from it.
         user, host, dest = _parse_path(dest)
 
-        # FIXME: This will list files and directories, it should really list
-        # directories only (although the chances of files named like
-        # YYYY-MM-DDTHH_MM_SS.snapshot in the destination directory seems low.)
-        output = _run(_wrap_in_ssh(["ls", dest], user, host))
-        directories.extend([
-            d for d in output.split('\n') if d
-        ])
+        remote = _agent(user, host)
+        if remote is not None:
+            directories.extend([
+                name for name, is_dir in _call_agent(remote, "list", path=dest)
+                if is_dir
+            ])
+        else:
+            # FIXME: This will list files and directories, it should really
+            # list directories only (although the chances of files named like
+            # YYYY-MM-DDTHH_MM_SS.snapshot in the destination directory seems
+            # low.)
+            output = _run(_wrap_in_ssh(["ls", dest], user, host))
+            directories.extend([
+                d for d in output.split('\n') if d
+            ])
 
     else:
         for directory in os.listdir(dest):
@@ -328,6 +1094,77 @@ def _ls_snapshots(dest):
     return sorted(snapshots)
 
 
+def _catalog(snapshots_root, user=None, host=None):
+    """Return the catalog.Catalog of the given destination directory.
+
+    Returns None if the destination has no catalog: a local directory that
+    doesn't exist, or a remote one without the helper agent.
+
+    """
+    path = catalog.path_for(snapshots_root)
+    if not host:
+        if not os.path.isdir(snapshots_root):
+            return None
+        return catalog.Catalog(path)
+    remote = _agent(user, host)
+    if remote is None:
+        return None
+
+    def execute(path, statements, create=True):
+        return remote.call("sql", path=path, statements=statements,
+                           create=create)
+    return catalog.Catalog(path, execute)
+
+
+def _update_catalog(snapshots_root, user, host, method, *args, **kwargs):
+    """Call the given method of the destination's catalog, if it has one.
+
+    A catalog that can't be updated is reported but isn't an error, because
+    it can always be rebuilt with `snapshotter reindex`.
+
+    """
+    catalog_ = _catalog(snapshots_root, user, host)
+    if catalog_ is None:
+        return
+    try:
+        getattr(catalog_, method)(*args, **kwargs)
+    except catalog.CatalogError as err:
+        logging.getLogger("snapshotter").warning(
+            "Updating the catalog failed, run `snapshotter reindex` to "
+            "rebuild it: {err}".format(err=err))
+
+
+@metrics.timed("list_snapshots")
+def _list_snapshots(dest, debug=False):
+    """Return a sorted list of the snapshot directories in directory dest.
+
+    The snapshots are read from dest's catalog. If dest has no catalog yet
+    (or it can't be read) they're listed with _ls_snapshots() instead and,
+    unless debug is True, the catalog is created from the listing.
+
+    """
+    user, host, snapshots_root = _parse_path(dest)
+    catalog_ = _catalog(snapshots_root, user, host)
+    if catalog_ is None:
+        return _ls_snapshots(dest)
+    try:
+        names = catalog_.snapshots()
+    except catalog.CatalogError as err:
+        _info("Can't read the catalog: {err}".format(err=err))
+        return _ls_snapshots(dest)
+    if names is not None:
+        return [os.path.join(snapshots_root, name) for name in names]
+
+    snapshots = _ls_snapshots(dest)
+    if not debug:
+        _info("Creating the catalog")
+        try:
+            catalog_.reindex([os.path.basename(s) for s in snapshots])
+        except catalog.CatalogError as err:
+            _info("Can't create the catalog: {err}".format(err=err))
+    return snapshots
+
+
 class NoMoreSnapshotsToRemoveError(Exception):
 
     """Exception that's raised if there's no more snapshots to delete.
@@ -348,6 +1185,13 @@ class InconsistentArgumentsError(Exception):
     pass
 
 
+class DestinationLockedError(Exception):
+
+    """Raised if another snapshotter is making a snapshot in the same dest."""
+
+    pass
+
+
 def _remove_oldest_snapshot(dest, user=None, host=None, min_snapshots=3,
                             debug=False):
     """Remove the oldest snapshot directory from dest.
@@ -356,13 +1200,391 @@ def _remove_oldest_snapshot(dest, user=None, host=None, min_snapshots=3,
     less than or equal to min_snapshots.
 
     """
-    snapshots = _ls_snapshots(dest)
+    snapshots = _list_snapshots(dest, debug)
     if len(snapshots) <= min_snapshots:
         raise NoMoreSnapshotsToRemoveError
     else:
         oldest_snapshot = snapshots[0]
         _info("Removing oldest snapshot")
-        _rm(oldest_snapshot, user, host, directory=True, debug=debug)
+        _discard_snapshot(oldest_snapshot, user, host, debug=debug)
+
+
+def _reclaimable(snapshots, user=None, host=None):
+    """Return {snapshot: bytes} of the space deleting each snapshot frees.
+
+    The snapshots must all be in the same directory. See
+    diskusage.reclaimable(), which is run on the remote host for remote
+    snapshots. Returns None if that can't be done (a remote destination
+    without the helper agent).
+
+    """
+    if not snapshots:
+        return {}
+    snapshots_root = os.path.dirname(snapshots[0])
+    names = [os.path.basename(s) for s in snapshots]
+    remote = _agent(user, host)
+    if remote is not None:
+        result = _call_agent(remote, "reclaimable",
+                             snapshots_root=snapshots_root, names=names)
+    elif host:
+        return None
+    else:
+        result = diskusage.reclaimable(snapshots_root, names)
+    return dict((os.path.join(snapshots_root, name), bytes_)
+                for name, bytes_ in result.items())
+
+
+def _remove_most_reclaimable_snapshot(dest, user=None, host=None,
+                                      min_snapshots=3, debug=False):
+    """Remove the snapshot whose deletion frees the most space from dest.
+
+    The newest snapshot, which the next snapshot is hard-linked against, is
+    never removed. Falls back to removing the oldest snapshot if the space
+    can't be found out.
+
+    Raises NoMoreSnapshotsToRemoveError if the number of snapshots in dest is
+    less than or equal to min_snapshots.
+
+    """
+    snapshots = _list_snapshots(dest, debug)
+    if len(snapshots) <= max(min_snapshots, 1):
+        raise NoMoreSnapshotsToRemoveError
+    reclaimable = _reclaimable(snapshots, user, host)
+    if reclaimable is None:
+        return _remove_oldest_snapshot(dest, user, host,
+                                       min_snapshots=min_snapshots,
+                                       debug=debug)
+    # max() returns the oldest of the snapshots that free the most space.
+    snapshot_ = max(snapshots[:-1], key=lambda s: reclaimable[s])
+    _info("Removing {snapshot}, which frees {bytes} bytes".format(
+        snapshot=snapshot_, bytes=reclaimable[snapshot_]))
+    _discard_snapshot(snapshot_, user, host, debug=debug)
+
+
+def _remove_snapshot(dest, user=None, host=None, min_snapshots=3, debug=False,
+                     by_space=False):
+    """Remove a snapshot from dest to make space for a new one.
+
+    If by_space is True remove the snapshot that frees the most space (see
+    _remove_most_reclaimable_snapshot()), otherwise the oldest one.
+
+    """
+    if by_space:
+        _remove_most_reclaimable_snapshot(
+            dest, user, host, min_snapshots=min_snapshots, debug=debug)
+    else:
+        _remove_oldest_snapshot(dest, user, host, min_snapshots=min_snapshots,
+                                debug=debug)
+
+
+def _apply_retention(dest, policy, user=None, host=None, min_snapshots=3,
+                     debug=False):
+    """Remove the snapshots in dest that the retention policy doesn't keep.
+
+    See retention.thin(). The snapshots are removed RETENTION_BATCH at a time
+    (see _discard_snapshots()). In dry-run mode the snapshots that would be
+    removed are only reported.
+
+    Returns the list of snapshots that were (or would be) removed.
+
+    """
+    keep, remove = retention.thin(_list_snapshots(dest, debug), policy,
+                                  min_snapshots=max(min_snapshots, 1))
+    _info("The retention policy keeps {keep} snapshots and removes "
+          "{remove}".format(keep=len(keep), remove=len(remove)))
+    if debug:
+        for snapshot_ in remove:
+            _info("Would remove {snapshot}".format(snapshot=snapshot_))
+        return remove
+    for start in range(0, len(remove), RETENTION_BATCH):
+        _discard_snapshots(remove[start:start + RETENTION_BATCH], user, host)
+    return remove
+
+
+def _free_space(snapshots_root, user=None, host=None):
+    """Return (bytes, inodes) available on the filesystem of snapshots_root.
+
+    Either number may be INF if the filesystem doesn't limit it. Returns None
+    if the free space can't be found out (a remote destination without the
+    helper agent, or a local destination that doesn't exist yet).
+
+    """
+    remote = _agent(user, host)
+    if remote is not None:
+        stat = _call_agent(remote, "statvfs", path=snapshots_root)
+    elif host or not os.path.isdir(snapshots_root):
+        return None
+    else:
+        result = os.statvfs(snapshots_root)
+        stat = dict((field, getattr(result, field))
+                    for field in ("f_bavail", "f_frsize", "f_files",
+                                  "f_favail"))
+    inodes = stat["f_favail"] if stat["f_files"] else INF
+    return stat["f_bavail"] * stat["f_frsize"], inodes
+
+
+def _estimate_space(source, dest, extra_args=None):
+    """Return an estimate of the (bytes, inodes) a new snapshot will need.
+
+    This runs rsync with --dry-run --stats, so it only costs a scan of the
+    source and of latest.snapshot. The estimate allows a margin for the
+    blocks used by directories and partially-filled blocks. The stats are
+    asked for in plain digits, as --human-readable rounds them to three
+    significant figures.
+
+    """
+    stats = progress.Stats()
+    _rsync(source, dest, True,
+           list(extra_args or []) + ["--stats", "--no-human-readable"],
+           consumers=[stats])
+    totals = stats.totals
+    transferred_files = totals.get("Number of regular files transferred", 0)
+    directories = totals.get("Number of files (dir)", 0)
+    inodes = transferred_files + directories + totals.get(
+        "Number of files (link)", 0)
+    bytes_ = totals.get("Total transferred file size", 0)
+    bytes_ = int(bytes_ * SPACE_MARGIN) + inodes * BLOCK_SIZE
+    return bytes_, int(inodes * SPACE_MARGIN)
+
+
+def _plan_space(source, dest, user=None, host=None, min_snapshots=3,
+                extra_args=None, by_space=False):
+    """Remove old snapshots until there's enough space for the new one.
+
+    The space needed is estimated with _estimate_space() and compared with
+    the free space on the destination. Snapshots are removed oldest-first
+    (or, if by_space is True, those that free the most space first), leaving
+    at least min_snapshots, so that rsync can normally finish in a single pass
+    instead of running out of space and being restarted.
+
+    """
+    _, _, snapshots_root = _parse_path(dest)
+    needed_bytes, needed_inodes = _estimate_space(source, dest, extra_args)
+    _info("The new snapshot needs about {bytes} bytes and {inodes} "
+          "inodes".format(bytes=needed_bytes, inodes=needed_inodes))
+    while True:
+        free = _free_space(snapshots_root, user, host)
+        if free is None:
+            _info("Can't find out the free space on the destination")
+            return
+        free_bytes, free_inodes = free
+        if free_bytes >= needed_bytes and free_inodes >= needed_inodes:
+            return
+        if _reaper.pending() or _ls_trash(snapshots_root, user, host):
+            # Let the space from snapshots that are already being deleted be
+            # reclaimed before deleting any more.
+            _wait_for_reaping(snapshots_root, user, host)
+            continue
+        try:
+            _remove_snapshot(dest, user, host, min_snapshots=min_snapshots,
+                             by_space=by_space)
+        except NoMoreSnapshotsToRemoveError:
+            # The estimate may be too high, so try anyway.
+            _info("Not enough space for the new snapshot and no more "
+                  "snapshots to remove")
+            return
+
+
+def _content_index(snapshots_root):
+    """Return the contentindex.ContentIndex of a local destination directory.
+
+    A new index is built from the files in latest.snapshot, if there is one.
+
+    """
+    new = not os.path.exists(contentindex.path_for(snapshots_root))
+    index = contentindex.ContentIndex(snapshots_root)
+    latest = os.path.join(snapshots_root, "latest.snapshot")
+    if new and os.path.isdir(latest):
+        _info("Building the content index")
+        contentindex.build(index, latest,
+                           os.path.basename(os.path.realpath(latest)))
+    return index
+
+
+def _seed_renames(source, dest, index, extra_args=None):
+    """Hard-link files that a remote source renamed into incomplete.snapshot.
+
+    A dry run finds the files that rsync would create, the source host's
+    helper agent hashes them, and the ones whose content is already in the
+    index are linked into place before the real rsync so that they aren't
+    transferred. Does nothing if the source host has no helper agent.
+
+    """
+    user, host, source_root = _parse_path(source)
+    remote = _agent(user, host)
+    if remote is None:
+        return
+    created = []
+
+    def collect(line):
+        if (line.flags is not None and line.flags[1] == "f" and
+                itemize.change_type(line.flags) == itemize.CREATED):
+            created.append(line.path)
+    _rsync(source, dest, True, extra_args, consumers=[collect])
+    if not created:
+        return
+    _info("agent: hash {count} files".format(count=len(created)))
+    try:
+        rows = remote.call("hash", root=source_root, paths=created,
+                           min_size=contentindex.MIN_SIZE)
+    except (agent.RemoteError, agent.AgentUnavailableError) as err:
+        _info("Can't hash the new files: {err}".format(err=err))
+        return
+    files, bytes_ = contentindex.seed(
+        index, os.path.join(_parse_path(dest)[2], "incomplete.snapshot"),
+        [(row[0], contentindex.Fingerprint(*row[1:])) for row in rows])
+    _info("Linked {files} renamed files ({bytes} bytes) before the "
+          "transfer".format(files=files, bytes=bytes_))
+
+
+def _detect_renames(snapshots_root, date, index, manifest_path):
+    """Hard-link new files in incomplete.snapshot to existing copies.
+
+    The files that rsync created are read from the new snapshot's manifest,
+    see contentindex.dedup().
+
+    """
+    if not os.path.exists(manifest_path):
+        return
+    files, bytes_ = contentindex.dedup(
+        index, os.path.join(snapshots_root, "incomplete.snapshot"),
+        date + ".snapshot", manifest.read(manifest_path))
+    _info("Linked {files} renamed files ({bytes} bytes) to earlier "
+          "snapshots".format(files=files, bytes=bytes_))
+
+
+def _incremental_rsync(source, dest, changes, extra_args=None,
+                       consumers=None, link_dests=None, reflink=False):
+    """Copy only the given changed paths from source into a new snapshot.
+
+    Everything else is hard-linked from latest.snapshot in process (see
+    journal.link_tree()), changed paths that have been deleted from source
+    are removed again (and passed to the consumers as deletions), then rsync
+    copies the rest of the changed paths with --files-from. Source and dest
+    must both be local.
+
+    """
+    source_root = _parse_path(source)[2]
+    snapshots_root = _parse_path(dest)[2]
+    incomplete = os.path.join(snapshots_root, "incomplete.snapshot")
+    _info("Linking unchanged files from latest.snapshot")
+    journal.link_tree(os.path.join(snapshots_root, "latest.snapshot"),
+                      incomplete, skip=changes)
+    for path in journal.prune(source_root, incomplete, changes):
+        line = itemize.parse("*deleting   " + path)
+        for consumer in [_log_rsync_line] + list(consumers or []):
+            consumer(line)
+
+    paths = [path for path in sorted(changes)
+             if os.path.lexists(os.path.join(source_root, path))]
+    if not paths:
+        return
+    with tempfile.NamedTemporaryFile(prefix="snapshotter-", suffix=".files",
+                                     delete=False) as file_:
+        file_.write(journal.files_from(paths))
+    try:
+        _rsync(source, dest, extra_args=extra_args, consumers=consumers,
+               link_dests=link_dests, files_from=file_.name, reflink=reflink)
+    finally:
+        os.unlink(file_.name)
+
+
+def _journal_changes(journal_, segments, source, dest):
+    """Return the paths that changed in source since latest.snapshot.
+
+    The changes are read from the given segments of the journal. Returns
+    None if the whole source has to be scanned instead: if source or dest is
+    remote, if latest.snapshot isn't the snapshot the journal's changes are
+    since, or if the journal isn't complete (see journal.Journal.read()).
+
+    """
+    if _is_remote(source) or _is_remote(dest):
+        _info("--journal only works with local sources and destinations")
+        return None
+    latest = os.path.join(_parse_path(dest)[2], "latest.snapshot")
+    if not os.path.isdir(latest) or journal_.base() != os.path.basename(
+            os.path.realpath(latest)):
+        _info("The journal doesn't start at latest.snapshot")
+        return None
+    changes = journal_.read(segments)
+    if changes is not None:
+        _info("The journal has {count} changed paths".format(
+            count=len(changes)))
+    return changes
+
+
+def _call_lock(dest, op, **kwargs):
+    """Run locking.lock() or locking.unlock() for dest, locally or remotely.
+
+    Returns None, without doing anything, if dest can't be locked: it's a
+    local directory that doesn't exist yet, or a remote one without the
+    helper agent or that doesn't exist.
+
+    """
+    user, host, snapshots_root = _parse_path(dest)
+    if not host:
+        if not os.path.isdir(snapshots_root):
+            return None
+        return getattr(locking, op)(snapshots_root, **kwargs)
+    remote = _agent(user, host)
+    if remote is None:
+        return None
+    try:
+        return _call_agent(remote, op, snapshots_root=snapshots_root,
+                           **kwargs)
+    except CalledProcessError as err:
+        if err.exit_value == errno.ENOENT:
+            return None
+        raise
+
+
+def _lock(dest, if_locked=WAIT):
+    """Take the lock on dest, so that only one snapshotter writes to it.
+
+    Returns True once the lock has been taken, or False if dest can't be
+    locked (see _call_lock()), in which case the snapshot is made without
+    it. If another process holds the lock then with if_locked WAIT this
+    waits for it, with EXIT it raises DestinationLockedError and with
+    COALESCE it registers a request for the other process to make one more
+    snapshot when it has finished (see locking.unlock()) and returns None.
+
+    A process that dies releases its lock, see locking.lock().
+
+    """
+    waiting = False
+    while True:
+        result = _call_lock(dest, "lock", register=if_locked == COALESCE)
+        if result is None:
+            _info("Can't lock {dest}, making the snapshot without a "
+                  "lock".format(dest=dest))
+            return False
+        locked, holder = result
+        if locked:
+            return True
+        if if_locked == EXIT:
+            raise DestinationLockedError(
+                "{dest} is locked by another snapshotter ({holder})".format(
+                    dest=dest, holder=holder))
+        if if_locked == COALESCE:
+            _info("{dest} is locked by another snapshotter ({holder}), it "
+                  "will make another snapshot when it has finished".format(
+                      dest=dest, holder=holder))
+            return None
+        if not waiting:
+            _info("Waiting for another snapshotter ({holder}) to finish "
+                  "with {dest}".format(holder=holder, dest=dest))
+            waiting = True
+        time.sleep(LOCK_POLL)
+
+
+def _unlock(dest, catch_up=True):
+    """Release the lock on dest, unless a catch-up snapshot was requested.
+
+    Returns True if another snapshot should be made before unlocking again,
+    see locking.unlock().
+
+    """
+    return bool(_call_lock(dest, "unlock", catch_up=catch_up))
 
 
 def snapshot(source,
@@ -370,7 +1592,27 @@ def snapshot(source,
              debug=False,
              min_snapshots=3,
              max_snapshots=INF,
-             extra_args=None):
+             extra_args=None,
+             progress_interval=None,
+             progress_file=None,
+             jobs=1,
+             plan_space=False,
+             lazy_delete=False,
+             prune_by_space=False,
+             keep=None,
+             link_dest_count=1,
+             link_dest_history=None,
+             link_dest_report=False,
+             detect_renames=False,
+             journal_dir=None,
+             engine="rsync",
+             reflink=False,
+             if_locked=WAIT,
+             report_file=None,
+             metrics_textfile=None,
+             profile=None,
+             throttle_target=None,
+             throttle_cgroup=None):
     """Make a new snapshot of source in dest.
 
     Make a new snapshot means:
@@ -383,15 +1625,24 @@ def snapshot(source,
     3. Then if that succeeds update the latest.snapshot symlink to point to the
        newly-created snapshot.
 
+    A YYYY-MM-DDTHH_MM_SS.manifest file recording the changes that rsync made
+    is written next to each new snapshot (see the manifest module), and the
+    snapshot is added to the catalog in dest (see the catalog module).
+
+    Old snapshots are removed by moving them into a trash directory in dest
+    and deleting them in the background, see _discard_snapshot().
+
     Either source or dest can be a local path or a remote path
     (e.g. seanh@mydomain.org:Snapshots/Documents or just
     mydomain.org:Snapshots/Documents). Either can be a relative path and can
     contain ~ (which will be expanded to the path to the user's home
     directory).
 
-    If dest if a remote path then ssh will be used to run mv, rm and ln to
-    move the incomplete.snapshot directory and update the latest.snapshot
-    symlink remotely.
+    If dest if a remote path then a helper agent is started on the remote
+    host over a single ssh connection and used to move the
+    incomplete.snapshot directory and update the latest.snapshot symlink
+    remotely. If the agent can't be started ssh is used to run mv, rm and ln
+    instead.
 
     :param source: the path to the source directory to be backed up
     :type source: string
@@ -405,35 +1656,809 @@ def snapshot(source,
         incomplete.snapshot directory or update the latest.snapshot symlink
     :type debug: bool
 
+    :param progress_interval: if given, report rsync's transfer rate, files
+        checked and transferred and ETA every progress_interval seconds
+    :type progress_interval: number
+
+    :param progress_file: if given, also append the progress reports to this
+        file as JSON lines (implies a progress_interval of 10 if none is given)
+    :type progress_file: string
+
+    :param jobs: the number of rsync processes to run at once, see
+        _parallel_rsync()
+    :type jobs: int
+
+    :param plan_space: if True, estimate the space needed for the new
+        snapshot and remove old snapshots to make room for it before running
+        rsync, see _plan_space()
+    :type plan_space: bool
+
+    :param lazy_delete: if True, don't wait for local old snapshots to finish
+        being deleted before returning, only wait for them when their space is
+        needed. Anything still in the trash is deleted on the next run.
+    :type lazy_delete: bool
+
+    :param prune_by_space: if True, when old snapshots have to be removed to
+        make space remove the ones that free the most space first (see
+        _remove_most_reclaimable_snapshot()) instead of the oldest ones.
+        --max-snapshots still removes the oldest snapshots.
+    :type prune_by_space: bool
+
+    :param keep: a retention policy, as returned by retention.parse_policy().
+        If given, after making the new snapshot remove the old snapshots that
+        the policy doesn't keep (see _apply_retention())
+    :type keep: list
+
+    :param link_dest_count: the number of most recent snapshots for rsync to
+        hard-link unchanged files against, see _link_dest_candidates()
+    :type link_dest_count: int
+
+    :param link_dest_history: a retention policy choosing older snapshots for
+        rsync to also hard-link unchanged files against
+    :type link_dest_history: list
+
+    :param link_dest_report: if True and there are other snapshots to link
+        against than latest.snapshot, first do a dry run with latest.snapshot
+        only and report how much it would have transferred compared with
+        what was actually transferred, see _report_link_dests()
+    :type link_dest_report: bool
+
+    :param detect_renames: if True, hard-link files that were renamed or
+        moved since an earlier snapshot to their copies in it instead of
+        storing them again, using the content index in dest (see the
+        contentindex module). Only for local destinations.
+    :type detect_renames: bool
+
+    :param journal_dir: the directory of a journal that `snapshotter watch`
+        is recording the changes in source into. If the journal has all the
+        changes since latest.snapshot was made, only the changed paths are
+        copied with rsync and the rest are hard-linked from latest.snapshot
+        without scanning source, see _incremental_rsync(). Otherwise the
+        whole source is scanned as usual. Only for local sources and
+        destinations.
+    :type journal_dir: string
+
+    :param engine: "rsync", or "native" to copy in process with several
+        threads instead of running rsync (see _native_copy()), which only
+        works with local sources and destinations and no extra_args. With
+        native, jobs is the number of threads (default 8). Dry runs always
+        use rsync.
+    :type engine: string
+
+    :param reflink: if True and dest's filesystem supports reflinks (for
+        example XFS or btrfs), start the new snapshot as reflinks of
+        latest.snapshot's files and have rsync update the changed blocks in
+        place, instead of hard-linking the unchanged files, see
+        _reflink_seed(). Not used with the native engine.
+    :type reflink: bool
+
+    :param if_locked: what to do if another snapshotter is already making a
+        snapshot in dest: WAIT until it has finished, EXIT by raising
+        DestinationLockedError, or COALESCE: ask it to make one more
+        snapshot when it has finished, and return None. See _lock().
+    :type if_locked: string
+
+    :param report_file: if given, write the run's metrics.Report to this
+        file as JSON, whether it succeeds or fails
+    :type report_file: string
+
+    :param metrics_textfile: if given, also write the report to this file in
+        Prometheus's text format, for node-exporter's textfile collector
+    :type metrics_textfile: string
+
+    :param profile: if given, profile the run (the calling thread only) with
+        cProfile and write the stats to this file, see the pstats module
+    :type profile: string
+
+    :param throttle_target: if given, throttle rsync and the deletion of old
+        snapshots adaptively so that the pressure on this host (the
+        percentage of time that tasks are stalled waiting for I/O or CPU)
+        stays under this target, see throttle.Throttle
+    :type throttle_target: number
+
+    :param throttle_cgroup: a delegated cgroup v2 directory to throttle
+        rsync with cpu.max and io.max limits instead of pausing it, see
+        throttle.Throttle
+    :type throttle_cgroup: string
+
+    :returns: the run's metrics.Report, with timings of each of its phases,
+        counters and rsync's --stats totals. Its snapshot is the path of the
+        new snapshot, or None if the snapshot was left to another
+        snapshotter to make
+
     :raises CalledProcessError: if any of the commands fails or exits with a
         non-zero exit value
 
     :raises NoSuchCommandError: if any of the rsync, mv, ln or ssh commands
         aren't found at the expected location
 
+    :raises DestinationLockedError: if if_locked is EXIT and dest is locked
+
     """
+    report = metrics.Report(source, dest)
+    controller = None
+    if throttle_target is not None and not debug:
+        controller = throttle.Throttle(
+            throttle_target,
+            path=None if _is_remote(source) else _parse_path(source)[2],
+            cgroup=throttle_cgroup)
+        controller.start()
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with metrics.recording(report), throttle.applying(controller):
+            locked = False
+            if not debug:
+                with metrics.phase("lock"):
+                    locked = _lock(dest, if_locked)
+                if locked is None:
+                    report.finish(metrics.COALESCED)
+                    return report
+            try:
+                while True:
+                    report.snapshot = _snapshot(
+                        source, dest, debug, min_snapshots, max_snapshots,
+                        extra_args, progress_interval, progress_file, jobs,
+                        plan_space, lazy_delete, prune_by_space, keep,
+                        link_dest_count, link_dest_history, link_dest_report,
+                        detect_renames, journal_dir, engine, reflink)
+                    if not locked:
+                        break
+                    if not _unlock(dest):
+                        locked = False
+                        break
+                    _info("Making another snapshot that was requested while "
+                          "this one was being made")
+                    report.count("catch_up_snapshots")
+                    # Snapshot names only go down to the second.
+                    time.sleep(1)
+            finally:
+                if locked:
+                    try:
+                        _unlock(dest, catch_up=False)
+                    except CalledProcessError as err:
+                        logging.getLogger("snapshotter").warning(
+                            "Unlocking {dest} failed: {err}".format(
+                                dest=dest, err=err))
+        report.finish(metrics.COMPLETE)
+        return report
+    finally:
+        if report.status is None:
+            report.finish(metrics.FAILED)
+        if controller is not None:
+            controller.stop()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        _write_report(report, report_file, metrics_textfile)
+
+
+def _write_report(report, report_file=None, metrics_textfile=None):
+    """Write report to the given files, logging rather than raising errors."""
+    for path, method in ((report_file, report.write_json),
+                         (metrics_textfile, report.write_textfile)):
+        if not path:
+            continue
+        try:
+            method(path)
+        except EnvironmentError as err:
+            logging.getLogger("snapshotter").warning(
+                "Writing {path} failed: {err}".format(path=path, err=err))
+
+
+def _snapshot(source, dest, debug, min_snapshots, max_snapshots, extra_args,
+              progress_interval, progress_file, jobs, plan_space,
+              lazy_delete, prune_by_space, keep, link_dest_count,
+              link_dest_history, link_dest_report, detect_renames,
+              journal_dir, engine, reflink):
+    """Make a new snapshot of source in dest, see snapshot()."""
     date = _datetime()
+    started = time.time()
     user, host, snapshots_root = _parse_path(dest)
 
     if max_snapshots <= min_snapshots:
         raise InconsistentArgumentsError(
             "--max-snapshots must be greater than --min-snapshots")
 
-    while len(_ls_snapshots(dest)) >= max_snapshots:
-        _remove_oldest_snapshot(
-            dest, user, host, min_snapshots=min_snapshots - 1, debug=debug)
+    if engine == "native":
+        if _is_remote(source) or host:
+            raise InconsistentArgumentsError(
+                "--engine=native only works with local SRC and DEST")
+        if extra_args:
+            raise InconsistentArgumentsError(
+                "--engine=native doesn't support rsync options: " +
+                " ".join(extra_args))
 
-    while True:
-        try:
-            _rsync(source, dest, debug, extra_args)
-            break
-        except NoSpaceLeftOnDeviceError as err:
-            _info(err)
+    if not host:
+        # Resume deleting anything left in the trash by an earlier run. For
+        # remote destinations this waits until the space is needed, to save
+        # a round trip.
+        with metrics.phase("reap_trash"):
+            _reap_trash(snapshots_root, user, host, debug=debug)
+
+    with metrics.phase("prune"):
+        while len(_list_snapshots(dest, debug)) >= max_snapshots:
             _remove_oldest_snapshot(
-                dest, user, host, min_snapshots=min_snapshots, debug=debug)
-    snapshot_ = _move_incomplete_dir(snapshots_root, date, user, host, debug)
-    _update_latest_symlink(date, snapshots_root, user, host, debug)
+                dest, user, host, min_snapshots=min_snapshots - 1,
+                debug=debug)
+
+    if plan_space and not debug:
+        with metrics.phase("plan_space"):
+            _plan_space(source, dest, user, host,
+                        min_snapshots=min_snapshots, extra_args=extra_args,
+                        by_space=prune_by_space)
+
+    recorder = catalog.Recorder()
+    consumers = [recorder]
+
+    monitor = None
+    if progress_interval or progress_file:
+        monitor = progress.Monitor(progress_interval or 10, progress_file)
+        consumers.append(monitor)
+        extra_args = list(extra_args or []) + progress.RSYNC_ARGS
+        monitor.start()
+    if "--stats" not in (extra_args or []):
+        # For the statistics in the catalog.
+        extra_args = list(extra_args or []) + ["--stats"]
+
+    baseline = None
+    if link_dest_report and not debug and _choose_link_dests(
+            dest, link_dest_count, link_dest_history):
+        baseline = progress.Stats()
+        with metrics.phase("link_dest_report"):
+            _rsync(source, dest, True, extra_args, consumers=[baseline])
+
+    journal_ = segments = changes = None
+    if journal_dir and not debug:
+        with metrics.phase("journal"):
+            journal_ = journal.Journal(journal_dir)
+            segments = journal_.rotate(timeout=journal.FLUSH_TIMEOUT)
+            changes = _journal_changes(journal_, segments, source, dest)
+
+    index = None
+    if detect_renames and host:
+        _info("--detect-renames only works with local destinations")
+    elif detect_renames and not debug:
+        index = _content_index(snapshots_root)
+        if _is_remote(source):
+            with metrics.phase("detect_renames"):
+                _seed_renames(source, dest, index, extra_args)
+
+    seeded = False
+    if reflink and engine == "native":
+        _info("--reflink isn't used with --engine=native")
+    elif reflink and not debug:
+        with metrics.phase("reflink_seed"):
+            seeded = _reflink_seed(snapshots_root, user, host)
+
+    manifest_path = None
+    if not debug:
+        manifest_path = _incomplete_manifest_path(snapshots_root, date, host)
+        manifest_writer = manifest.Writer(manifest_path)
+        consumers.append(manifest_writer)
+
+    try:
+        while True:
+            link_dests = []
+            if link_dest_count > 1 or link_dest_history:
+                # Choose again each time, in case snapshots were removed.
+                link_dests = _choose_link_dests(
+                    dest, link_dest_count, link_dest_history, debug)
+            try:
+                with metrics.phase("transfer"):
+                    if changes is not None:
+                        _incremental_rsync(
+                            source, dest, changes, extra_args,
+                            consumers=consumers, link_dests=link_dests,
+                            reflink=seeded)
+                    elif engine == "native" and not debug:
+                        _native_copy(source, dest, consumers=consumers,
+                                     link_dests=link_dests,
+                                     threads=jobs if jobs > 1 else 8)
+                    elif jobs > 1:
+                        _parallel_rsync(source, dest, jobs, debug,
+                                        extra_args, consumers=consumers,
+                                        link_dests=link_dests,
+                                        reflink=seeded)
+                    else:
+                        _rsync(source, dest, debug, extra_args,
+                               consumers=consumers, link_dests=link_dests,
+                               reflink=seeded)
+                break
+            except NoSpaceLeftOnDeviceError as err:
+                _info(err)
+                metrics.count("no_space_retries")
+                with metrics.phase("prune"):
+                    _remove_snapshot(
+                        dest, user, host, min_snapshots=min_snapshots,
+                        debug=debug, by_space=prune_by_space)
+                    # Only now that the space is needed, wait for it.
+                    _wait_for_reaping(snapshots_root, user, host)
+            finally:
+                if not debug:
+                    manifest_writer.close()
+    except BaseException:
+        if host and manifest_path is not None:
+            # Remote snapshots aren't resumed from the temporary manifest.
+            _remove_temporary_manifest(manifest_path)
+        raise
+    finally:
+        if monitor is not None:
+            monitor.stop()
+    metrics.set_stats(recorder.totals())
+    if index is not None:
+        try:
+            with metrics.phase("detect_renames"):
+                _detect_renames(snapshots_root, date, index, manifest_path)
+        finally:
+            index.close()
+    with metrics.phase("move_incomplete"):
+        snapshot_ = _move_incomplete_dir(
+            snapshots_root, date, user, host, debug,
+            manifest_path=manifest_path, recorder=recorder,
+            duration=time.time() - started)
+    with metrics.phase("update_latest"):
+        _update_latest_symlink(date, snapshots_root, user, host, debug)
+    if journal_ is not None:
+        with metrics.phase("journal"):
+            journal_.commit(segments, os.path.basename(snapshot_))
     _info("Successfully completed snapshot: {path}".format(path=snapshot_))
+    if baseline is not None:
+        _report_link_dests(link_dests, recorder, baseline)
+    if keep:
+        with metrics.phase("retention"):
+            _apply_retention(dest, keep, user, host,
+                             min_snapshots=min_snapshots, debug=debug)
+    if not lazy_delete and _reaper.pending():
+        _info("Waiting for old snapshots to be deleted")
+        with metrics.phase("wait_for_deletes"):
+            _reaper.wait()
+    return snapshot_
+
+
+def reindex(dest):
+    """Rebuild the catalog of dest from a listing of its snapshots.
+
+    Returns the number of snapshots in the catalog.
+
+    :raises catalog.CatalogError: if dest can't have a catalog (a local
+        directory that doesn't exist, or a remote directory on a host where
+        the helper agent can't be started) or it can't be written
+
+    """
+    user, host, snapshots_root = _parse_path(dest)
+    catalog_ = _catalog(snapshots_root, user, host)
+    if catalog_ is None:
+        raise catalog.CatalogError(
+            "Can't create a catalog in {dest}".format(dest=dest))
+    snapshots = _ls_snapshots(dest)
+    catalog_.reindex([os.path.basename(s) for s in snapshots])
+    _info("Indexed {count} snapshots".format(count=len(snapshots)))
+    return len(snapshots)
+
+
+def du(dest):
+    """Return the space that deleting each snapshot in dest would free.
+
+    Returns a {snapshot: bytes} dict, see _reclaimable().
+
+    :raises CalledProcessError: if dest is remote and the helper agent can't
+        be started there
+
+    """
+    user, host, _ = _parse_path(dest)
+    snapshots = _list_snapshots(dest)
+    reclaimable = _reclaimable(snapshots, user, host)
+    if reclaimable is None:
+        raise CalledProcessError(
+            "du " + dest, "du needs Python on the remote host", 1)
+    return reclaimable
+
+
+def verify(dest, max_seconds=None, max_bytes=None, jobs=4):
+    """Check the files of the snapshots in dest against their stored hashes.
+
+    Verifying all the snapshots can be spread over several runs with the
+    max_seconds and max_bytes budgets, each run resuming where the last one
+    stopped. See integrity.verify(), which is run on the remote host for
+    remote destinations, for the details. Returns its result, whose
+    "problems" are the corrupt or unreadable files found.
+
+    :raises CalledProcessError: if dest is remote and the helper agent can't
+        be started there, or if the verification ledger can't be used
+
+    """
+    user, host, snapshots_root = _parse_path(dest)
+    kwargs = {
+        "snapshots_root": snapshots_root,
+        "names": [os.path.basename(s) for s in _list_snapshots(dest)],
+        "max_seconds": max_seconds,
+        "max_bytes": max_bytes,
+        "threads": jobs,
+    }
+    remote = _agent(user, host)
+    if remote is not None:
+        result = _call_agent(remote, "verify", **kwargs)
+    elif host:
+        raise CalledProcessError(
+            "verify " + dest, "verify needs Python on the remote host", 1)
+    else:
+        try:
+            result = integrity.verify(**kwargs)
+        except EnvironmentError as err:
+            raise CalledProcessError("verify " + dest, text(err), 1)
+    return result
+
+
+def deduplicate(root, jobs=8, min_size=dedup.MIN_SIZE, debug=False):
+    """Hard-link identical files in the snapshots of all the dests in root.
+
+    root is a local directory containing destination directories (or a
+    single destination directory). See dedup.dedup(). If debug is True
+    nothing is changed, but what would be done is reported. Returns the
+    dedup.Result.
+
+    :raises InconsistentArgumentsError: if root is a remote path
+
+    """
+    if _is_remote(root):
+        raise InconsistentArgumentsError(
+            "dedup only works with local directories")
+    return dedup.dedup(_parse_path(root)[2], threads=jobs,
+                       min_size=min_size, dry_run=debug)
+
+
+def pack_snapshots(dest, older_than, debug=False):
+    """Pack the snapshots in dest that are older than older_than seconds.
+
+    Each snapshot is packed into a pack.PackedSnapshot with the same name,
+    reusing the data of the packed snapshot before it, and the original
+    directory is then deleted in the background. The newest snapshot, which
+    new snapshots are hard-linked to, is never packed. If debug is True
+    nothing is changed, but what would be packed is reported. Returns the
+    paths of the snapshots packed.
+
+    :raises InconsistentArgumentsError: if dest is a remote path
+
+    """
+    if _is_remote(dest):
+        raise InconsistentArgumentsError(
+            "pack only works with local directories")
+    snapshots_root = _parse_path(dest)[2]
+    cutoff = (datetime.datetime.now() - datetime.timedelta(
+        seconds=older_than)).strftime("%Y-%m-%dT%H:%M:%S")
+    locked = not debug and _lock(dest)
+    packed = []
+    try:
+        previous = None
+        for snapshot_ in _list_snapshots(dest, debug)[:-1]:
+            name = os.path.basename(snapshot_)
+            if pack.is_packed(snapshot_):
+                previous = snapshot_
+                continue
+            if catalog.timestamp(name) >= cutoff:
+                break
+            _info("Packing {snapshot}".format(snapshot=snapshot_))
+            packed.append(snapshot_)
+            if debug:
+                continue
+            output = os.path.join(snapshots_root, "incomplete.pack")
+            reaper.remove_tree(output)
+            with metrics.phase("pack"):
+                result = pack.pack(snapshot_, output, previous)
+            _info("Packed {entries} entries ({bytes} bytes) into {written} "
+                  "bytes, reusing {reused} bytes".format(**result._asdict()))
+            trash = _trash_dir(snapshots_root)
+            _mkdir(trash)
+            _mv(snapshot_, os.path.join(trash, name))
+            _mv(output, snapshot_)
+            # The `snapshotter du` cache of the unpacked tree is stale now.
+            cache = os.path.join(snapshots_root, "du-cache", name)
+            if os.path.exists(cache):
+                os.unlink(cache)
+            _reap([os.path.join(trash, name)])
+            previous = snapshot_
+    finally:
+        if locked:
+            _unlock(dest, catch_up=False)
+    return packed
+
+
+def unpack(snapshot_, target, paths=None):
+    """Restore the packed snapshot snapshot_, or the given paths of it.
+
+    The files are written under the local directory target, see
+    pack.PackedSnapshot.extract(). Returns the number of entries restored.
+
+    :raises InconsistentArgumentsError: if snapshot_ is remote or isn't a
+        packed snapshot
+
+    """
+    if _is_remote(snapshot_) or not pack.is_packed(snapshot_):
+        raise InconsistentArgumentsError(
+            "{snapshot} isn't a local packed snapshot".format(
+                snapshot=snapshot_))
+    with pack.PackedSnapshot(snapshot_) as packed:
+        count = packed.extract(target, paths)
+    _info("Restored {count} entries into {target}".format(
+        count=count, target=target))
+    return count
+
+
+def _rsync_path(user, host, path):
+    """Return the rsync argument for the given path on the given host."""
+    if host is None:
+        return path
+    return "{user}{host}:{path}".format(
+        user=user + "@" if user else "", host=host, path=path)
+
+
+def restore(snapshot_, target, checksum=False, delete=False, jobs=8):
+    """Copy the snapshot snapshot_ back to target, copying only what differs.
+
+    Files in target with the same size, modification time, permissions and
+    owner as in the snapshot are left alone, unless checksum is True and
+    their contents differ. Everything else is copied with its metadata, like
+    rsync --archive, keeping hard links between files of the snapshot and
+    keeping sparse files sparse. Files in target that aren't in the snapshot
+    are only deleted if delete is True.
+
+    If both are local the files are copied by jobs threads, see
+    engine.copy_tree(), and if either of them is remote rsync does the
+    copying. A packed snapshot (see pack) is restored with unpack() instead,
+    which writes every entry again, so checksum and delete can't be used
+    with it. Returns the itemize.Counter of the changes made.
+
+    :raises InconsistentArgumentsError: if both snapshot_ and target are
+        remote, or snapshot_ is packed and target is remote or checksum or
+        delete is True
+    :raises CalledProcessError: if copying fails
+
+    """
+    user, host, snapshot_path = _parse_path(snapshot_)
+    target_user, target_host, target_path = _parse_path(target)
+    if host and target_host:
+        raise InconsistentArgumentsError(
+            "The snapshot and the target can't both be remote")
+    counter = itemize.Counter()
+    consumers = [_log_rsync_line, counter]
+    if not host and pack.is_packed(snapshot_path):
+        if target_host:
+            raise InconsistentArgumentsError(
+                "Packed snapshots can only be restored to local directories")
+        if checksum or delete:
+            raise InconsistentArgumentsError(
+                "--checksum and --delete can't be used with packed "
+                "snapshots, which are restored in full")
+        counter.counts[itemize.UPDATED] += unpack(snapshot_path, target_path)
+        _info("restore: " + counter.summary())
+        return counter
+    if not host and not target_host:
+        try:
+            with metrics.phase("restore"):
+                engine.copy_tree(
+                    snapshot_path, target_path, consumers=consumers,
+                    threads=jobs, delete=delete, compare_contents=checksum,
+                    hard_links=True)
+        except (OSError, IOError) as err:
+            raise CalledProcessError("restore", text(err), 1)
+        _info("restore: " + counter.summary())
+        return counter
+
+    rsync_cmd = ["rsync", "--archive", "--hard-links", "--sparse",
+                 "--itemize-changes", "--human-readable"]
+    if checksum:
+        rsync_cmd.append("--checksum")
+    if delete:
+        rsync_cmd.append("--delete")
+    rsync_cmd.extend([
+        _rsync_path(user, host, snapshot_path.rstrip(os.sep) + os.sep),
+        _rsync_path(target_user, target_host, target_path)])
+    metrics.count("rsync_runs")
+
+    def consume(text_):
+        line = itemize.parse(text_)
+        for consumer in consumers:
+            consumer(line)
+
+    with metrics.phase("restore"):
+        _run(rsync_cmd, consumers=[consume])
+    _info("rsync: " + counter.summary())
+    return counter
+
+
+def _find_snapshot(names, spec):
+    """Return the one of the snapshot names that spec refers to.
+
+    spec is "latest" (the newest snapshot), a snapshot's name or timestamp
+    ("2015-03-05T16_23_12.snapshot", "2015-03-05T16:23:12") or the start of
+    one ("2015-03-05T16") that matches only one snapshot.
+
+    :raises InconsistentArgumentsError: if spec matches no snapshot or
+        several
+
+    """
+    if spec in ("latest", "latest.snapshot") and names:
+        return names[-1]
+    if spec.endswith(".snapshot"):
+        spec = spec[:-len(".snapshot")]
+    spec = spec.replace(":", "_")
+    if spec + ".snapshot" in names:
+        return spec + ".snapshot"
+    matches = [name for name in names if name.startswith(spec)]
+    if len(matches) != 1:
+        raise InconsistentArgumentsError(
+            "{spec!r} matches {count} snapshots".format(
+                spec=spec, count=len(matches)))
+    return matches[0]
+
+
+def _resolve_snapshot(path, default_dest=os.curdir):
+    """Return (dest, name) of the snapshot that path refers to.
+
+    path is a snapshot in a destination directory, given as in
+    _find_snapshot() (for example /media/backup/latest), or just the part
+    after the directory, for a snapshot in default_dest.
+
+    """
+    dest, spec = os.path.split(path.rstrip(os.sep))
+    dest = dest or default_dest
+    names = [os.path.basename(s) for s in _list_snapshots(dest)]
+    return dest, _find_snapshot(names, spec)
+
+
+def diff(old, new, checksum=False, jobs=8):
+    """Return what changed between the snapshots old and new.
+
+    old and new are snapshots as taken by _resolve_snapshot(), new
+    defaulting to old's destination. Files that are the same inode in both
+    snapshots (hard links) are unchanged without being compared, see
+    treediff.diff(), which is run on the remote host for remote destinations.
+    Returns treediff.diff()'s result, with the paths of the two snapshots
+    added as "old" and "new".
+
+    :raises InconsistentArgumentsError: if a snapshot can't be found, the
+        snapshots are on different hosts or one of them is packed
+    :raises CalledProcessError: if the destination is remote and the helper
+        agent can't be started there
+
+    """
+    old_dest, old_name = _resolve_snapshot(old)
+    new_dest, new_name = _resolve_snapshot(new, old_dest)
+    user, host, old_root = _parse_path(old_dest)
+    new_user, new_host, new_root = _parse_path(new_dest)
+    if (user, host) != (new_user, new_host):
+        raise InconsistentArgumentsError(
+            "The snapshots to compare must be on the same host")
+    kwargs = {
+        "old": os.path.join(old_root, old_name),
+        "new": os.path.join(new_root, new_name),
+        "checksum": checksum,
+        "threads": jobs,
+    }
+    remote = _agent(user, host)
+    if host and remote is None:
+        raise CalledProcessError(
+            "diff " + old_dest, "diff needs Python on the remote host", 1)
+    if (_is_packed(kwargs["old"], user, host) or
+            _is_packed(kwargs["new"], user, host)):
+        raise InconsistentArgumentsError(
+            "Packed snapshots can't be compared, unpack them first")
+    if remote is not None:
+        result = _call_agent(remote, "diff", **kwargs)
+    else:
+        result = treediff.diff(**kwargs)
+    return dict(result, old=kwargs["old"], new=kwargs["new"])
+
+
+def watch(source, journal_dir):
+    """Record the changes in the local directory source into a journal.
+
+    Runs until interrupted, see journal.Watcher. Snapshots made with
+    --journal journal_dir then only copy the changed paths.
+
+    :raises journal.WatcherError: if source can't be watched
+
+    """
+    watcher = journal.Watcher(_parse_path(source)[2],
+                              journal.Journal(journal_dir))
+    try:
+        watcher.run()
+    finally:
+        watcher.close()
+
+
+def _dest_device(dest):
+    """Return a key for the device that dest is on, for the scheduler.
+
+    For local paths that's the device of dest or its closest existing
+    parent, and for remote ones the host, as it's the same host's disks.
+
+    """
+    _, host, snapshots_root = _parse_path(dest)
+    if host:
+        return host
+    path = snapshots_root
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+def _recent_runtime(dest, count=3):
+    """Return the mean duration of the latest count snapshots in dest.
+
+    The durations come from dest's catalog. Returns None if there aren't
+    any.
+
+    """
+    user, host, snapshots_root = _parse_path(dest)
+    catalog_ = _catalog(snapshots_root, user, host)
+    if catalog_ is None:
+        return None
+    try:
+        durations = [entry.duration for entry in catalog_.entries()
+                     if entry.duration is not None]
+    except catalog.CatalogError:
+        return None
+    if not durations:
+        return None
+    return sum(durations[-count:]) / len(durations[-count:])
+
+
+def run_jobs(job_file, debug=False):
+    """Make a snapshot for each job in job_file.
+
+    The jobs are run concurrently by a jobfile.Scheduler, within the limits
+    in the job file on the number of snapshots at once in all, per source
+    host and per destination device, longest first by their recent
+    durations in the catalog. A job that fails doesn't stop the others.
+
+    Returns the jobfile.Results in the job file's order, see
+    jobfile.summary().
+
+    :raises jobfile.JobFileError: if job_file can't be read or is invalid
+
+    """
+    jobs, limits = jobfile.load(job_file)
+
+    def run_job(job):
+        _info("Starting job {name}: {source} -> {dest}".format(
+            name=job.name, source=job.source, dest=job.dest))
+        try:
+            return snapshot(job.source, job.dest, debug=debug,
+                            **job.options).snapshot
+        except Exception as err:
+            logging.getLogger("snapshotter").error(
+                "Job {name} failed: {err}".format(name=job.name, err=err))
+            raise
+
+    scheduler = jobfile.Scheduler(
+        jobs, run_job,
+        host=lambda job: _parse_path(job.source)[1],
+        device=lambda job: _dest_device(job.dest),
+        runtime=lambda job: _recent_runtime(job.dest),
+        limits=limits)
+    return scheduler.run()
+
+
+class _ArgumentParser(argparse.ArgumentParser):
+
+    """An ArgumentParser that doesn't accept abbreviated long options.
+
+    Unknown options are passed on to rsync, so an rsync option like
+    --progress or --link-dest mustn't be taken for an abbreviation of one of
+    snapshotter's (--progress-interval, --link-dest-history). This is
+    allow_abbrev=False, which Python 2 doesn't have.
+
+    """
+
+    def _get_option_tuples(self, option_string):
+        if option_string.startswith("--"):
+            return []
+        return super(_ArgumentParser, self)._get_option_tuples(option_string)
 
 
 class CommandLineArgumentsError(Exception):
@@ -443,13 +2468,51 @@ class CommandLineArgumentsError(Exception):
     pass
 
 
-def _parse_cli(args=None):
-    """Parse the command-line arguments."""
-    args = args if args is not None else sys.argv[1:]
+def _retention_policy(text_):
+    """Parse the argument of --keep, see retention.parse_policy()."""
+    try:
+        return retention.parse_policy(text_)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(text(err))
+
+
+def _parse_size(text_):
+    """Parse a number of bytes with an optional K, M, G or T suffix."""
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$", text_,
+                     re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            "invalid size: {0!r}".format(text_))
+    return int(float(match.group(1)) *
+               1024 ** " kmgt".index(match.group(2).lower() or " "))
+
+
+def _parse_duration(text_):
+    """Parse a number of seconds with an optional s, m, h, d or w suffix."""
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$", text_,
+                     re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            "invalid duration: {0!r}".format(text_))
+    return float(match.group(1)) * {
+        "": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}[
+            match.group(2).lower()]
+
+
+def _text_arg(value):
+    """Return a command-line argument as text (on Python 2 it's bytes)."""
+    try:
+        return text(value, encoding=STDOUT_ENCODING)
+    except TypeError:
+        return value
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("SRC", help="the path to be backed up")
-    parser.add_argument("DEST", help="the directory to create snapshots in")
+
+def _add_snapshot_arguments(parser):
+    """Add the arguments of `snapshotter [snapshot] SRC DEST` to parser."""
+    parser.add_argument("source", metavar="SRC", type=_text_arg,
+                        help="the path to be backed up")
+    parser.add_argument("dest", metavar="DEST", type=_text_arg,
+                        help="the directory to create snapshots in")
     parser.add_argument(
         '-n', '--dry-run', dest='debug', action='store_true', default=False,
         help="Perform a trial-run with no changes made (pass the --dry-run "
@@ -464,9 +2527,339 @@ def _parse_cli(args=None):
         help="The maximum number of snapshots allowed for the backup "
              " (default: inf)",
         default=INF)
+    parser.add_argument(
+        '--progress-interval', type=float, dest='progress_interval',
+        metavar='SECONDS',
+        help="Report rsync's transfer rate, files checked and transferred and "
+             "estimated time remaining every SECONDS seconds")
+    parser.add_argument(
+        '--progress-file', dest='progress_file', metavar='PATH',
+        help="Also append the progress reports to PATH as JSON lines "
+             "(implies --progress-interval 10)")
+    parser.add_argument(
+        '--jobs', type=int, dest='jobs', default=1, metavar='N',
+        help="Split the source's top-level subdirectories into N balanced "
+             "shards and copy them with N concurrent rsyncs (default: 1)")
+    parser.add_argument(
+        '--plan-space', action='store_true', dest='plan_space', default=False,
+        help="Estimate the space needed with a dry run first and remove old "
+             "snapshots to make room before copying, instead of removing them "
+             "when rsync runs out of space")
+    parser.add_argument(
+        '--lazy-delete', action='store_true', dest='lazy_delete',
+        default=False,
+        help="Don't wait for old snapshots to finish being deleted before "
+             "exiting, only when their space is needed. Anything left in "
+             "DEST/trash is deleted on the next run")
+    parser.add_argument(
+        '--keep', type=_retention_policy, dest='keep', metavar='POLICY',
+        help="After making the snapshot, thin out old snapshots with a "
+             "retention policy like hourly=24,daily=30,weekly=52,monthly=* "
+             "(periods: hourly, daily, weekly, monthly, yearly; * keeps all)."
+             " With --dry-run the snapshots that would be removed are listed")
+    parser.add_argument(
+        '--link-dests', type=int, dest='link_dest_count', default=1,
+        metavar='N',
+        help="Hard-link unchanged files against the N most recent snapshots "
+             "instead of only the latest one, so that files that were "
+             "changed and changed back aren't stored again (default: 1)")
+    parser.add_argument(
+        '--link-dest-history', type=_retention_policy,
+        dest='link_dest_history', metavar='POLICY',
+        help="Also hard-link unchanged files against older snapshots chosen "
+             "by a retention policy like daily=7,weekly=4 (see --keep). At "
+             "most 20 snapshots are used in all")
+    parser.add_argument(
+        '--link-dest-report', action='store_true', dest='link_dest_report',
+        default=False,
+        help="Report how much was transferred compared with linking against "
+             "the latest snapshot only (costs an extra rsync dry run)")
+    parser.add_argument(
+        '--detect-renames', action='store_true', dest='detect_renames',
+        default=False,
+        help="Hard-link files that were renamed or moved since an earlier "
+             "snapshot instead of storing them again, using a content-hash "
+             "index in DEST (local destinations only)")
+    parser.add_argument(
+        '--engine', choices=['rsync', 'native'], dest='engine',
+        default='rsync',
+        help="Copy with rsync (the default), or natively in process with "
+             "several threads (local SRC and DEST only, no rsync options, "
+             "--jobs sets the number of threads)")
+    parser.add_argument(
+        '--reflink', action='store_true', dest='reflink', default=False,
+        help="On filesystems with reflinks (XFS, btrfs), start each snapshot "
+             "as a copy-on-write clone of the latest one and only store the "
+             "changed blocks of changed files, instead of hard-linking "
+             "unchanged files (falls back to hard links elsewhere)")
+    parser.add_argument(
+        '--journal', dest='journal_dir', metavar='DIR',
+        help="Only copy the files that `snapshotter watch SRC DIR` recorded "
+             "as changed, and hard-link the rest from the latest snapshot, "
+             "instead of scanning all of SRC (local SRC and DEST only)")
+    parser.add_argument(
+        '--report', dest='report_file', metavar='FILE',
+        help="Write a JSON report of the run to FILE: the time each phase "
+             "took, counters like the number of subprocesses and ssh "
+             "connections, and rsync's --stats totals")
+    parser.add_argument(
+        '--metrics-textfile', dest='metrics_textfile', metavar='FILE',
+        help="Also write the report to FILE in Prometheus's text format, for "
+             "node-exporter's textfile collector (FILE must end in .prom)")
+    parser.add_argument(
+        '--profile', dest='profile', metavar='FILE',
+        help="Profile the run with cProfile and write the stats to FILE (for "
+             "development)")
+    parser.add_argument(
+        '--throttle', type=float, dest='throttle_target', metavar='PERCENT',
+        help="Throttle rsync and the deletion of old snapshots adaptively to "
+             "keep the pressure on this host (the %% of time that tasks are "
+             "stalled waiting for I/O or CPU) under PERCENT")
+    parser.add_argument(
+        '--throttle-cgroup', dest='throttle_cgroup', metavar='DIR',
+        help="Throttle rsync with the cpu.max and io.max limits of the "
+             "delegated cgroup v2 directory DIR instead of pausing it")
+    parser.add_argument(
+        '--if-locked', choices=[WAIT, EXIT, COALESCE], dest='if_locked',
+        default=WAIT,
+        help="What to do if another snapshotter is making a snapshot in DEST:"
+             " wait for it to finish (the default), exit with an error, or "
+             "coalesce: exit and have it make one more snapshot when it has "
+             "finished")
+    parser.add_argument(
+        '--prune-by-space', action='store_true', dest='prune_by_space',
+        default=False,
+        help="When old snapshots have to be removed to make space, remove "
+             "the ones that free the most space (because of hard links) "
+             "first instead of the oldest ones")
+
+
+def _print_result(command, result, output_format="text", **kwargs):
+    """Print what main() ran: result, from command called with kwargs.
+
+    Only du, verify, diff and run print to stdout: the space each snapshot
+    holds, the files that failed verification, the changes (one JSON object
+    if output_format is "json") and the summary of the jobs. The other
+    commands, and the totals of verify, dedup and diff, are logged.
+
+    """
+    if command == "du":
+        for snapshot_ in sorted(result):
+            print("{bytes}\t{snapshot}".format(bytes=result[snapshot_],
+                                               snapshot=snapshot_))
+    elif command == "verify":
+        snapshots_root = _parse_path(kwargs["dest"])[2]
+        for snapshot_, path, problem in result["problems"]:
+            print("{problem}\t{path}".format(
+                problem=problem,
+                path=os.path.join(snapshots_root, snapshot_, path)))
+        _info("Verified {files} files ({bytes} bytes), {new} of them new; "
+              "{status}".format(
+                  files=result["files"], bytes=result["bytes"],
+                  new=result["new"],
+                  status="finished verifying all the snapshots"
+                  if result["finished"] else
+                  "{0} snapshots left to verify".format(result["remaining"])))
+    elif command == "dedup":
+        _info("Scanned {snapshots} new snapshots ({files} files), {verb} "
+              "{linked} files, freeing {inodes} inodes and {bytes} "
+              "bytes".format(
+                  verb="would have linked" if kwargs.get("debug") else
+                  "linked", **result._asdict()))
+    elif command == "diff":
+        if output_format == "json":
+            print(json.dumps({
+                "old": result["old"],
+                "new": result["new"],
+                "changes": [{"change": change, "path": path}
+                            for change, path in result["changes"]],
+                "shared": result["shared"],
+                "compared": result["compared"],
+            }, indent=2, sort_keys=True))
+        else:
+            for change, path in result["changes"]:
+                print("{change}\t{path}".format(change=change, path=path))
+        _info("{changes} changes between {old} and {new}; {shared} paths "
+              "unchanged (the same inodes), {compared} compared".format(
+                  changes=len(result["changes"]),
+                  old=os.path.basename(result["old"]),
+                  new=os.path.basename(result["new"]),
+                  shared=result["shared"], compared=result["compared"]))
+    elif command == "run":
+        for line in jobfile.summary(result):
+            print(line)
+
+
+#: The commands of `snapshotter COMMAND ...`, by name. Without a command,
+#: snapshotter makes a snapshot.
+_COMMANDS = {
+    "snapshot": snapshot,
+    "reindex": reindex,
+    "du": du,
+    "watch": watch,
+    "verify": verify,
+    "dedup": deduplicate,
+    "pack": pack_snapshots,
+    "unpack": unpack,
+    "restore": restore,
+    "diff": diff,
+    "run": run_jobs,
+}
+
+
+def _parse_cli(args=None):
+    """Parse the command-line arguments.
+
+    Returns the name of the command (see _COMMANDS) and a dict of the
+    keyword arguments to call it with.
+
+    `snapshotter SRC DEST` is short for `snapshotter snapshot SRC DEST`, so
+    the first argument is only taken as a command if it's the name of one.
+    To back up a directory that's named like a command, use the long form
+    or a path such as ./du.
+
+    """
+    args = list(args if args is not None else sys.argv[1:])
+
+    parser = _ArgumentParser(
+        prog="snapshotter",
+        description="Make incremental snapshot backups with rsync.",
+        epilog="`snapshotter SRC DEST` is short for `snapshotter snapshot SRC "
+               "DEST`. Run `snapshotter COMMAND --help` for the options of "
+               "a command.")
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+
+    _add_snapshot_arguments(subparsers.add_parser(
+        "snapshot", help="make a snapshot of SRC in DEST (the default)"))
+
+    for name, help_ in (
+            ("reindex", "rebuild the catalog of DEST"),
+            ("du", "print the space that deleting each snapshot in DEST "
+                   "would free")):
+        subparser = subparsers.add_parser(name, help=help_)
+        subparser.add_argument(
+            "dest", metavar="DEST", type=_text_arg,
+            help="the directory containing the snapshots")
+
+    subparser = subparsers.add_parser(
+        "watch", help="record the changes in SRC for --journal")
+    subparser.add_argument("source", metavar="SRC", type=_text_arg,
+                           help="the directory to watch")
+    subparser.add_argument("journal_dir", metavar="JOURNAL", type=_text_arg,
+                           help="the directory to record the changes in")
+
+    subparser = subparsers.add_parser(
+        "verify", help="check the snapshots in DEST for corruption")
+    subparser.add_argument("dest", metavar="DEST", type=_text_arg,
+                           help="the directory containing the snapshots")
+    subparser.add_argument(
+        '--max-time', type=_parse_duration, dest='max_seconds',
+        metavar='DURATION',
+        help="Stop after DURATION (for example 3600, 90m or 2h) and carry "
+             "on from there next time")
+    subparser.add_argument(
+        '--max-bytes', type=_parse_size, dest='max_bytes', metavar='SIZE',
+        help="Stop after reading SIZE bytes (for example 500G) and carry on "
+             "from there next time")
+    subparser.add_argument(
+        '--jobs', type=int, dest='jobs', default=4, metavar='N',
+        help="Hash N files at once (default: 4)")
+
+    subparser = subparsers.add_parser(
+        "dedup", help="hard-link identical files in the snapshots of all "
+                      "the destinations in ROOT")
+    subparser.add_argument(
+        "root", metavar="ROOT", type=_text_arg,
+        help="the directory containing the destination directories")
+    subparser.add_argument(
+        '-n', '--dry-run', dest='debug', action='store_true', default=False,
+        help="Report what would be linked without changing anything")
+    subparser.add_argument(
+        '--jobs', type=int, dest='jobs', default=8, metavar='N',
+        help="Scan and hash with N threads (default: 8)")
+    subparser.add_argument(
+        '--min-size', type=_parse_size, dest='min_size',
+        default=dedup.MIN_SIZE, metavar='SIZE',
+        help="Leave files smaller than SIZE alone (default: 4K)")
+
+    subparser = subparsers.add_parser(
+        "pack", help="pack the old snapshots in DEST into archives")
+    subparser.add_argument("dest", metavar="DEST", type=_text_arg,
+                           help="the directory containing the snapshots")
+    subparser.add_argument(
+        '--older-than', type=_parse_duration, dest='older_than',
+        required=True, metavar='DURATION',
+        help="Pack the snapshots older than DURATION (for example 30d or 12w)")
+    subparser.add_argument(
+        '-n', '--dry-run', dest='debug', action='store_true', default=False,
+        help="Report what would be packed without changing anything")
+
+    subparser = subparsers.add_parser(
+        "unpack", help="restore a packed snapshot")
+    subparser.add_argument("snapshot_", metavar="SNAPSHOT", type=_text_arg,
+                           help="the packed snapshot to restore")
+    subparser.add_argument("target", metavar="TARGET", type=_text_arg,
+                           help="the directory to restore the files into")
+    subparser.add_argument(
+        "paths", metavar="PATH", nargs="*", type=_text_arg,
+        help="the paths in the snapshot to restore (default: all of them)")
+
+    subparser = subparsers.add_parser(
+        "restore", help="copy a snapshot back to TARGET")
+    subparser.add_argument("snapshot_", metavar="SNAPSHOT", type=_text_arg,
+                           help="the snapshot to restore")
+    subparser.add_argument("target", metavar="TARGET", type=_text_arg,
+                           help="the directory to restore it into")
+    subparser.add_argument(
+        '-c', '--checksum', dest='checksum', action='store_true',
+        default=False,
+        help="Also compare the contents of files that have the same size "
+             "and modification time")
+    subparser.add_argument(
+        '--delete', dest='delete', action='store_true', default=False,
+        help="Delete the files in TARGET that aren't in the snapshot")
+    subparser.add_argument(
+        '--jobs', type=int, dest='jobs', default=8, metavar='N',
+        help="Copy with N threads, if both paths are local (default: 8)")
+
+    subparser = subparsers.add_parser(
+        "diff", help="print what changed between two snapshots")
+    subparser.add_argument(
+        "old", metavar="OLD", type=_text_arg,
+        help="the snapshot to compare from, for example "
+             "/media/backup/2015-03-05T16:23:12")
+    subparser.add_argument(
+        "new", metavar="NEW", type=_text_arg,
+        help="the snapshot to compare to, for example latest (in OLD's "
+             "directory) or /media/backup/latest")
+    subparser.add_argument(
+        '-c', '--checksum', dest='checksum', action='store_true',
+        default=False,
+        help="Also compare the contents of files that have the same size "
+             "and modification time but aren't hard links")
+    subparser.add_argument(
+        '--json', dest='output_format', action='store_const', const='json',
+        default='text', help="Print the changes as JSON")
+    subparser.add_argument(
+        '--jobs', type=int, dest='jobs', default=8, metavar='N',
+        help="Compare N directories at once (default: 8)")
+
+    subparser = subparsers.add_parser(
+        "run", help="make the snapshots of all the jobs in JOBFILE")
+    subparser.add_argument("job_file", metavar="JOBFILE", type=_text_arg,
+                           help="the TOML file listing the jobs")
+    subparser.add_argument(
+        '-n', '--dry-run', dest='debug', action='store_true', default=False,
+        help="Perform a trial-run of every job with no changes made")
+
+    if not args or (args[0] not in subparsers.choices and
+                    args[0] not in ("-h", "--help")):
+        args.insert(0, "snapshot")
 
     try:
-        args, extra_args = parser.parse_known_args(args)
+        namespace, extra_args = parser.parse_known_args(args)
+        if extra_args and namespace.command != "snapshot":
+            parser.error("unrecognized arguments: " + " ".join(extra_args))
     except SystemExit as err:
         if err.code == 0:
             # This happens when you pass -h or --help.
@@ -474,23 +2867,29 @@ def _parse_cli(args=None):
         else:
             raise CommandLineArgumentsError(err.code)
 
-    try:
-        src = text(args.SRC, encoding=STDOUT_ENCODING)
-        dest = text(args.DEST, encoding=STDOUT_ENCODING)
-    except TypeError:
-        src = args.SRC
-        dest = args.DEST
-
-    return (src,
-            dest,
-            args.debug,
-            args.min_snapshots,
-            args.max_snapshots,
-            extra_args)
+    kwargs = vars(namespace)
+    command = kwargs.pop("command")
+    if command == "snapshot":
+        # Anything that snapshotter doesn't know is passed on to rsync.
+        kwargs["extra_args"] = extra_args
+    return command, kwargs
 
 
 def main():
-    """Parse command-line args and pass them to snapshot().
+    """Parse command-line args and run the command, see _parse_cli().
+
+    Without a command that's snapshot(). `snapshotter reindex DEST` rebuilds
+    the catalog of DEST instead, `snapshotter du DEST` prints the space each
+    snapshot in DEST holds, `snapshotter watch SRC JOURNAL` records the
+    changes in SRC for --journal, `snapshotter run JOBFILE` makes the
+    snapshots of all the jobs in JOBFILE, `snapshotter verify DEST` checks
+    the snapshots in DEST for corruption, `snapshotter dedup ROOT`
+    hard-links identical files in the snapshots of all the destinations in
+    ROOT, `snapshotter pack DEST` packs the old snapshots in DEST into
+    archives, `snapshotter unpack SNAPSHOT TARGET` restores a packed
+    snapshot, `snapshotter restore SNAPSHOT TARGET` copies a snapshot back
+    to TARGET and `snapshotter diff OLD NEW` prints what changed between two
+    snapshots.
 
     Also turns any known exceptions raised into clean sys.exit()s with a
     non-zero exit status and an error message printed, instead of stack traces.
@@ -498,13 +2897,28 @@ def main():
     """
     logging.basicConfig(level=logging.INFO)
     try:
-        snapshot(*_parse_cli())
+        command, kwargs = _parse_cli()
+        output_format = kwargs.pop("output_format", "text")
+        result = _COMMANDS[command](**kwargs)
+        _print_result(command, result, output_format, **kwargs)
+        if command == "verify" and result["problems"]:
+            sys.exit("{count} corrupt or unreadable files found".format(
+                count=len(result["problems"])))
+        if command == "run":
+            failed = [r for r in result if r.status == jobfile.FAILED]
+            if failed:
+                sys.exit("{count} of {total} jobs failed".format(
+                    count=len(failed), total=len(result)))
     except CommandLineArgumentsError as err:
-        sys.exit(err.message)
+        # argparse has already printed the usage and the error.
+        sys.exit(err.args[0])
     except NoSuchCommandError as err:
         sys.exit("{message}: {command}".format(
-            message=err.message, command=err.command))
+            message=text(err), command=err.command))
     except CalledProcessError as err:
         sys.exit(err.output)
-    except InconsistentArgumentsError as err:
-        sys.exit(err.message)
+    except (InconsistentArgumentsError, DestinationLockedError) as err:
+        sys.exit(text(err))
+    except (catalog.CatalogError, journal.WatcherError,
+            jobfile.JobFileError) as err:
+        sys.exit(text(err))
@@ -0,0 +1,186 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import io
+import json
+import os
+import importlib
+import shutil
+import sys
+import tempfile
+
+import mock
+import nose.tools
+
+import snapshotter
+from snapshotter import agent
+
+
+def _serve(*requests):
+    """Run the agent's server loop on the given requests, return responses."""
+    stdin = io.StringIO("".join(json.dumps(r) + "\n" for r in requests))
+    stdout = io.StringIO()
+    agent.serve(stdin, stdout)
+    return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+
+class TestServe(object):
+
+    """Unit tests for the agent's request handling."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_list(self):
+        os.mkdir(os.path.join(self.directory, "a_dir"))
+        open(os.path.join(self.directory, "a_file"), "w").close()
+
+        response, = _serve({"op": "list", "path": self.directory})
+
+        assert response["ok"] is True
+        assert sorted(response["result"]) == [
+            ["a_dir", True], ["a_file", False]]
+
+    def test_rename_symlink_and_unlink(self):
+        src = os.path.join(self.directory, "incomplete.snapshot")
+        dest = os.path.join(self.directory, "new.snapshot")
+        link = os.path.join(self.directory, "latest.snapshot")
+        os.mkdir(src)
+
+        responses = _serve(
+            {"op": "rename", "src": src, "dest": dest},
+            {"op": "unlink", "path": link, "missing_ok": True},
+            {"op": "symlink", "target": "new.snapshot", "path": link},
+        )
+
+        assert [r["ok"] for r in responses] == [True, True, True]
+        assert os.path.isdir(dest)
+        assert os.readlink(link) == "new.snapshot"
+
+    def test_rmtree(self):
+        tree = os.path.join(self.directory, "old.snapshot")
+        os.makedirs(os.path.join(tree, "sub"))
+
+        responses = _serve({"op": "rmtree", "path": tree},
+                           {"op": "rmtree", "path": tree})
+
+        assert [r["ok"] for r in responses] == [True, True]
+        assert not os.path.exists(tree)
+
+    def test_mkdir(self):
+        subdir = os.path.join(self.directory, "a", "b")
+
+        responses = _serve({"op": "mkdir", "path": subdir},
+                           {"op": "mkdir", "path": subdir})
+
+        assert [r["ok"] for r in responses] == [True, True]
+        assert os.path.isdir(subdir)
+
+    @mock.patch.dict("snapshotter.agent._OPS")
+    @mock.patch.dict(sys.modules)
+    def test_load(self):
+        source = "OPS = {'double': lambda number: 2 * number}\n"
+
+        try:
+            responses = _serve({"op": "double", "number": 2},
+                               {"op": "load", "name": "doubling",
+                                "source": source},
+                               {"op": "double", "number": 2})
+        finally:
+            del snapshotter.doubling
+
+        assert responses[0]["ok"] is False
+        assert responses[1] == {"ok": True, "result": None}
+        assert responses[2] == {"ok": True, "result": 4}
+
+    def test_errors_are_returned_not_raised(self):
+        response, = _serve(
+            {"op": "stat", "path": os.path.join(self.directory, "missing")})
+
+        assert response["ok"] is False
+        assert response["errno"] == 2
+
+    def test_unknown_op(self):
+        response, = _serve({"op": "format_disk"})
+
+        assert response["ok"] is False
+
+    def test_module_ops(self):
+        """MODULE_OPS should name the module of each of their operations."""
+        for op, name in agent.MODULE_OPS.items():
+            module = importlib.import_module("snapshotter." + name)
+            assert op in module.OPS
+            assert op not in agent._OPS
+        for name in set(agent.MODULE_OPS.values()):
+            module = importlib.import_module("snapshotter." + name)
+            for op in module.OPS:
+                assert agent.MODULE_OPS[op] == name
+
+
+class TestAgent(object):
+
+    """Tests that start a real agent process on the local host."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.agent = agent.Agent(agent.bootstrap_command())
+
+    def teardown(self):
+        self.agent.close()
+        shutil.rmtree(self.directory)
+
+    def test_call(self):
+        os.mkdir(os.path.join(self.directory, "2016-03-20T13_19_25.snapshot"))
+
+        assert self.agent.call("list", path=self.directory) == [
+            ["2016-03-20T13_19_25.snapshot", True]]
+        assert self.agent.call("statvfs", path=self.directory)["f_bsize"] > 0
+
+    def test_modules_are_sent_when_first_needed(self):
+        os.makedirs(os.path.join(self.directory, "one", "sub"))
+        os.mkdir(os.path.join(self.directory, "two"))
+
+        assert sorted((name, count) for name, _, count in self.agent.call(
+            "scan", path=self.directory)) == [("one", 1), ("two", 0)]
+        # treediff needs integrity, which is sent along with it.
+        result = self.agent.call(
+            "diff", old=os.path.join(self.directory, "one"),
+            new=os.path.join(self.directory, "two"), checksum=True)
+        assert result["changes"] == [["deleted", "sub"]]
+        assert self.agent._loaded == set(
+            ["diskusage", "integrity", "treediff"])
+
+    def test_call_raises_RemoteError(self):
+        nose.tools.assert_raises(
+            agent.RemoteError, self.agent.call, "rename",
+            src=os.path.join(self.directory, "missing"),
+            dest=os.path.join(self.directory, "other"))
+
+
+class TestConnect(object):
+
+    """Tests for the connect() function."""
+
+    def teardown(self):
+        agent.close_all()
+
+    def test_it_reuses_agents(self):
+        first = agent.connect("key", agent.bootstrap_command())
+        second = agent.connect("key", agent.bootstrap_command())
+
+        assert first is not None
+        assert first is second
+
+    def test_remote_command(self):
+        """remote_command() should work when run by a shell, as ssh does."""
+        remote = agent.connect("key", ["sh", "-c"] + agent.remote_command())
+
+        assert remote is not None
+        assert remote.version == agent.PROTOCOL_VERSION
+
+    def test_it_returns_None_if_the_agent_cannot_start(self):
+        assert agent.connect("key", ["false"]) is None
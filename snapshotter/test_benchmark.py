@@ -0,0 +1,131 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+import nose.tools
+
+from snapshotter import benchmark
+
+
+def _contents(root):
+    """Return {relative path: bytes} of the files under root."""
+    contents = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            with open(path, "rb") as file_:
+                contents[os.path.relpath(path, root)] = file_.read()
+    return contents
+
+
+class TestParseSizes(object):
+
+    def test_it_parses_size_distributions(self):
+        assert benchmark.parse_sizes("4k:70, 64K:25,1m:5,100:1") == [
+            (4096, 70.0), (65536, 25.0), (1024 ** 2, 5.0), (100, 1.0)]
+
+    def test_invalid_size_distributions(self):
+        for text in ("", "4k", "4x:1", "4k:0", "k:1", "4k:a"):
+            nose.tools.assert_raises(ValueError, benchmark.parse_sizes, text)
+
+
+class TestSyntheticTree(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _tree(self, name, seed=0):
+        return benchmark.SyntheticTree(os.path.join(self.directory, name),
+                                       50, "100:1,5k:1", depth=2, fanout=3,
+                                       seed=seed)
+
+    def test_trees_are_reproducible(self):
+        first, second = self._tree("first"), self._tree("second")
+        other = self._tree("other", seed=1)
+        for tree in (first, second, other):
+            tree.create()
+            tree.churn(0.2)
+
+        contents = _contents(first.root)
+        assert len(contents) == 50
+        assert set(len(data) for data in contents.values()) - set(
+            [100, 5120]), "some files should have been appended to"
+        assert contents == _contents(second.root)
+        assert contents != _contents(other.root)
+
+    def test_churn(self):
+        tree = self._tree("tree")
+        tree.create()
+        before = _contents(tree.root)
+
+        assert tree.churn(0.2) == 11
+
+        after = _contents(tree.root)
+        assert len(after) == 50
+        assert len(set(before) - set(after)) == 1
+        assert len([path for path in before if path in after and
+                    before[path] != after[path]]) == 9
+
+
+class TestScenarios(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_make_snapshots(self):
+        benchmark.make_snapshots(self.directory, 3, files=4)
+
+        assert sorted(os.listdir(self.directory)) == [
+            "2015-01-01T00_00_00.snapshot", "2015-01-01T01_00_00.snapshot",
+            "2015-01-01T02_00_00.snapshot"]
+        snapshot_ = os.path.join(self.directory,
+                                 "2015-01-01T00_00_00.snapshot")
+        assert len(os.listdir(snapshot_)) == 4
+        assert os.stat(os.path.join(snapshot_, "f00000")).st_nlink == 3
+
+    @mock.patch("snapshotter.benchmark.time.sleep")
+    def test_it_writes_json_results(self, _):
+        output = os.path.join(self.directory, "results.json")
+
+        benchmark.main(["--scenarios", "cycles,list,prune", "--engines",
+                        "native", "--files", "20", "--runs", "1",
+                        "--snapshots", "50", "--dir", self.directory,
+                        "--output", output])
+
+        with open(output) as file_:
+            data = file_.read()
+        results = json.loads(data)
+        assert data.endswith("}\n")
+        assert results["options"]["files"] == 20
+        assert set(results["results"]) == set(["cycles", "list", "prune"])
+        assert len(results["results"]["cycles"]["native"][
+            "incremental"]) == 1
+        assert results["results"]["prune"]["removed"] > 0
+        assert os.listdir(self.directory) == ["results.json"]
+
+
+class TestCompare(object):
+
+    def test_compare(self):
+        old = {"results": {"list": {"ls_snapshots": 1.0, "snapshots": 10},
+                           "prune": {"thin": 2.0}}}
+        new = {"results": {"list": {"ls_snapshots": 1.5, "snapshots": 10},
+                           "prune": {"thin": 1.0}}}
+
+        lines, regressions = benchmark.compare(old, new)
+
+        assert regressions == ["list.ls_snapshots"]
+        assert len(lines) == 3
+        assert lines[1].endswith("slower")
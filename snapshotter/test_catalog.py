@@ -0,0 +1,102 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import nose.tools
+
+from snapshotter import catalog
+from snapshotter import itemize
+
+
+class TestCatalog(object):
+
+    """Tests for the Catalog class."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.catalog = catalog.Catalog(catalog.path_for(self.directory))
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_it_is_not_created_until_reindexed(self):
+        assert self.catalog.snapshots() is None
+        self.catalog.add("2015-03-05T16_23_12.snapshot")
+        self.catalog.remove(["2015-03-05T16_23_12.snapshot"])
+
+        assert os.listdir(self.directory) == []
+
+    def test_reindex(self):
+        self.catalog.reindex(["2015-03-05T16_24_15.snapshot",
+                              "2015-03-05T16_23_12.snapshot"])
+
+        assert self.catalog.snapshots() == [
+            "2015-03-05T16_23_12.snapshot", "2015-03-05T16_24_15.snapshot"]
+        assert self.catalog.entries()[0] == catalog.Entry(
+            "2015-03-05T16_23_12.snapshot", "2015-03-05T16:23:12", None, None,
+            None, catalog.COMPLETE)
+
+    def test_add_and_remove(self):
+        self.catalog.reindex(["2015-03-05T16_23_12.snapshot"])
+
+        self.catalog.add("2015-03-05T16_24_15.snapshot", duration=1.5,
+                         bytes_=1000, files=10)
+        self.catalog.remove(["2015-03-05T16_23_12.snapshot"])
+
+        assert self.catalog.snapshots() == ["2015-03-05T16_24_15.snapshot"]
+        old, new = self.catalog.entries()
+        assert old.status == catalog.DELETED
+        assert (new.duration, new.bytes, new.files) == (1.5, 1000, 10)
+
+    def test_reindex_keeps_statistics(self):
+        self.catalog.reindex([])
+        self.catalog.add("2015-03-05T16_23_12.snapshot", bytes_=1000)
+        self.catalog.add("2015-03-05T16_24_15.snapshot")
+
+        self.catalog.reindex(["2015-03-05T16_23_12.snapshot"])
+
+        assert self.catalog.snapshots() == ["2015-03-05T16_23_12.snapshot"]
+        assert self.catalog.entries()[0].bytes == 1000
+
+    def test_errors(self):
+        catalog_ = catalog.Catalog(os.path.join(self.directory, "missing",
+                                                catalog.FILENAME))
+
+        nose.tools.assert_raises(catalog.CatalogError, catalog_.reindex, [])
+
+
+class TestRecorder(object):
+
+    """Tests for the Recorder consumer."""
+
+    def test_it_adds_up_the_stats_of_each_rsync(self):
+        recorder = catalog.Recorder()
+        assert recorder.bytes is None
+        assert recorder.files is None
+
+        for text in (">f+++++++++ a/new_file",
+                     "Number of files: 100 (reg: 90, dir: 10)",
+                     "Total transferred file size: 1.50K bytes",
+                     "Number of files: 1,000",
+                     "Total transferred file size: 500 bytes"):
+            recorder(itemize.parse(text))
+
+        assert recorder.bytes == 2000
+        assert recorder.files == 1100
+
+    def test_forks_keep_the_stats_of_concurrent_rsyncs_apart(self):
+        recorder = catalog.Recorder()
+        first, second = recorder.fork(), recorder.fork()
+        assert recorder.files is None
+
+        first(itemize.parse("Number of files: 100"))
+        second(itemize.parse("Number of files: 1,000"))
+        first(itemize.parse("Total transferred file size: 1.50K bytes"))
+        second(itemize.parse("Total transferred file size: 500 bytes"))
+
+        assert recorder.bytes == 2000
+        assert recorder.files == 1100
@@ -0,0 +1,117 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+from snapshotter import contentindex
+from snapshotter import pack
+
+
+def _write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as file_:
+        file_.write(content)
+    os.utime(path, (1425572592, 1425572592))
+
+
+class TestContentIndex(object):
+
+    """Tests for the content index functions."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.old = os.path.join(self.directory, "2015-03-05T16_23_12.snapshot")
+        self.new = os.path.join(self.directory, "incomplete.snapshot")
+        self.content = b"x" * contentindex.MIN_SIZE
+        _write(os.path.join(self.old, "photos", "a.jpg"), self.content)
+        _write(os.path.join(self.old, "small.txt"), b"small")
+        os.symlink(os.path.basename(self.old),
+                   os.path.join(self.directory, "latest.snapshot"))
+        self.index = contentindex.ContentIndex(self.directory)
+
+    def teardown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_build_indexes_large_files_only(self):
+        count = contentindex.build(self.index, self.old,
+                                   os.path.basename(self.old))
+
+        assert count == 1
+        assert len(self.index) == 1
+
+    def test_dedup_links_renamed_files(self):
+        contentindex.build(self.index, self.old, os.path.basename(self.old))
+        _write(os.path.join(self.new, "pictures", "a.jpg"), self.content)
+        _write(os.path.join(self.new, "other.jpg"), b"y" * 70000)
+
+        linked = contentindex.dedup(
+            self.index, self.new, "2015-03-06T16_23_12.snapshot",
+            [(">f+++++++++", "pictures/a.jpg"),
+             (">f+++++++++", "other.jpg"),
+             ("cd+++++++++", "pictures")])
+
+        assert linked == (1, len(self.content))
+        assert os.path.samefile(os.path.join(self.new, "pictures", "a.jpg"),
+                                os.path.join(self.old, "photos", "a.jpg"))
+        assert not os.path.exists(
+            os.path.join(self.new, "pictures", "a.jpg.snapshotter-link"))
+        # The new file is indexed too.
+        assert len(self.index) == 2
+
+    def test_dedup_does_not_link_files_with_other_metadata(self):
+        contentindex.build(self.index, self.old, os.path.basename(self.old))
+        path = os.path.join(self.new, "a.jpg")
+        _write(path, self.content)
+        os.utime(path, (1425572000, 1425572000))
+
+        linked = contentindex.dedup(self.index, self.new, "new.snapshot",
+                                    [(">f+++++++++", "a.jpg")])
+
+        assert linked == (0, 0)
+        assert not os.path.samefile(
+            path, os.path.join(self.old, "photos", "a.jpg"))
+
+    def test_dedup_does_not_link_files_with_another_subsecond_mtime(self):
+        contentindex.build(self.index, self.old, os.path.basename(self.old))
+        path = os.path.join(self.new, "a.jpg")
+        _write(path, self.content)
+        os.utime(path, (1425572592.5, 1425572592.5))
+
+        linked = contentindex.dedup(self.index, self.new, "new.snapshot",
+                                    [(">f+++++++++", "a.jpg")])
+
+        assert linked == (0, 0)
+
+    def test_find_ignores_replaced_files(self):
+        contentindex.build(self.index, self.old, os.path.basename(self.old))
+        path = os.path.join(self.old, "photos", "a.jpg")
+        # Write the new file before the old one is gone so that it can't
+        # reuse its inode.
+        _write(path + ".new", self.content)
+        os.rename(path + ".new", path)
+
+        assert self.index.find(contentindex.fingerprint(path)) is None
+
+    def test_find_ignores_packed_snapshots(self):
+        contentindex.build(self.index, self.old, os.path.basename(self.old))
+        path = os.path.join(self.old, "photos", "a.jpg")
+        _write(os.path.join(self.old, pack.INDEX_FILENAME), b"")
+
+        assert self.index.find(contentindex.fingerprint(path)) is None
+
+    def test_seed(self):
+        contentindex.build(self.index, self.old, os.path.basename(self.old))
+        fingerprint = contentindex.fingerprint(
+            os.path.join(self.old, "photos", "a.jpg"))
+
+        linked = contentindex.seed(self.index, self.new,
+                                   [("moved/a.jpg", fingerprint)])
+
+        assert linked == (1, len(self.content))
+        assert os.path.samefile(os.path.join(self.new, "moved", "a.jpg"),
+                                os.path.join(self.old, "photos", "a.jpg"))
@@ -0,0 +1,36 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import nose.tools
+
+from snapshotter import database
+
+
+class TestSQL(object):
+
+    """Tests for running SQL statements."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sql(self):
+        path = os.path.join(self.directory, "test.sqlite")
+
+        assert database.sql(path, [], create=False) is None
+        assert database.sql(path, [
+            ["CREATE TABLE t (x INTEGER)", []],
+            ["INSERT INTO t VALUES (?)", [1]],
+            ["SELECT x FROM t", []]]) == [[], [], [[1]]]
+        nose.tools.assert_raises(EnvironmentError, database.sql, path, [
+            ["INSERT INTO t VALUES (?)", [2]],
+            ["SELECT nonsense", []]])
+        # The failed statement rolled back the whole transaction.
+        assert database.sql(path, [["SELECT x FROM t", []]]) == [[[1]]]
@@ -0,0 +1,149 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import errno
+import os
+import shutil
+import tempfile
+
+import mock
+
+from snapshotter import dedup
+
+
+SNAPSHOT = "2015-03-05T16_23_12.snapshot"
+
+
+class TestDedup(object):
+
+    """Tests for the dedup() function."""
+
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, path, data, mtime=1425572592):
+        full = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(full)):
+            os.makedirs(os.path.dirname(full))
+        with open(full, "wb") as file_:
+            file_.write(data)
+        os.utime(full, (mtime, mtime))
+        return full
+
+    def _inode(self, path):
+        return os.lstat(os.path.join(self.root, path)).st_ino
+
+    def test_find_snapshots(self):
+        for path in ("one/" + SNAPSHOT, "one/incomplete.snapshot",
+                     "one/trash/old.snapshot", "two/" + SNAPSHOT, SNAPSHOT):
+            os.makedirs(os.path.join(self.root, path, "a.snapshot"))
+        os.symlink(SNAPSHOT, os.path.join(self.root, "one",
+                                          "latest.snapshot"))
+
+        assert dedup.find_snapshots(self.root) == [
+            SNAPSHOT, os.path.join("one", SNAPSHOT),
+            os.path.join("two", SNAPSHOT)]
+
+    def test_it_links_identical_files(self):
+        data = os.urandom(100000)
+        for server in ("one", "two", "three"):
+            self._write(os.path.join(server, SNAPSHOT, "etc", "big"), data)
+        # Same contents, different modification time.
+        self._write(os.path.join("four", SNAPSHOT, "etc", "big"), data,
+                    mtime=1425572593)
+        # Same size and start, different end.
+        self._write(os.path.join("five", SNAPSHOT, "etc", "big"),
+                    data[:-1] + b"x")
+        os.makedirs(os.path.join(self.root, "two", "du-cache"))
+        open(os.path.join(self.root, "two", "du-cache", SNAPSHOT),
+             "w").close()
+
+        result = dedup.dedup(self.root, threads=2)
+
+        assert (result.snapshots, result.files, result.linked,
+                result.inodes) == (5, 5, 2, 2)
+        assert result.bytes >= 200000
+        inodes = set(self._inode(os.path.join(server, SNAPSHOT, "etc", "big"))
+                     for server in ("one", "two", "three"))
+        assert len(inodes) == 1
+        assert self._inode(os.path.join("four", SNAPSHOT, "etc",
+                                        "big")) not in inodes
+        assert self._inode(os.path.join("five", SNAPSHOT, "etc",
+                                        "big")) not in inodes
+        assert os.listdir(os.path.join(self.root, "two", "du-cache")) == []
+
+    def test_later_runs_only_scan_new_snapshots(self):
+        data = os.urandom(10000)
+        self._write(os.path.join("one", SNAPSHOT, "file"), data)
+        self._write(os.path.join("two", SNAPSHOT, "other"), os.urandom(10000))
+        dedup.dedup(self.root)
+
+        assert dedup.dedup(self.root).snapshots == 0
+
+        self._write(os.path.join("two", "2015-03-06T16_23_12.snapshot",
+                                 "file"), data)
+
+        result = dedup.dedup(self.root)
+
+        assert (result.snapshots, result.files, result.linked) == (1, 1, 1)
+        assert self._inode(os.path.join("one", SNAPSHOT, "file")) == (
+            self._inode(os.path.join("two", "2015-03-06T16_23_12.snapshot",
+                                     "file")))
+
+    def test_deleted_snapshots_are_forgotten(self):
+        self._write(os.path.join("one", SNAPSHOT, "file"), b"x" * 10000)
+        dedup.dedup(self.root)
+        shutil.rmtree(os.path.join(self.root, "one"))
+        self._write(os.path.join("two", SNAPSHOT, "file"), b"x" * 10000)
+
+        result = dedup.dedup(self.root)
+
+        assert (result.snapshots, result.linked) == (1, 0)
+        index = dedup.Index(self.root)
+        try:
+            assert index.snapshots() == set([os.path.join("two", SNAPSHOT)])
+        finally:
+            index.close()
+
+    def test_dry_run(self):
+        for server in ("one", "two"):
+            self._write(os.path.join(server, SNAPSHOT, "file"), b"x" * 10000)
+
+        result = dedup.dedup(self.root, dry_run=True)
+
+        assert (result.linked, result.inodes) == (1, 1)
+        assert self._inode(os.path.join("one", SNAPSHOT, "file")) != (
+            self._inode(os.path.join("two", SNAPSHOT, "file")))
+        assert dedup.dedup(self.root).linked == 1
+
+    def test_small_files_are_left_alone(self):
+        for server in ("one", "two"):
+            self._write(os.path.join(server, SNAPSHOT, "file"), b"x" * 100)
+
+        assert dedup.dedup(self.root).linked == 0
+        assert dedup.dedup(self.root, min_size=0).snapshots == 0
+
+    def test_too_many_links(self):
+        for server in ("one", "two", "three"):
+            self._write(os.path.join(server, SNAPSHOT, "file"), b"x" * 10000)
+        link = dedup._link
+        calls = []
+
+        def link_once(target, path):
+            calls.append(target)
+            if len(calls) == 1:
+                raise OSError(errno.EMLINK, "Too many links")
+            link(target, path)
+
+        with mock.patch("snapshotter.dedup._link", side_effect=link_once):
+            result = dedup.dedup(self.root)
+
+        # three couldn't be linked to one, so two is linked to three.
+        assert result.linked == 1
+        assert self._inode(os.path.join("two", SNAPSHOT, "file")) == (
+            self._inode(os.path.join("three", SNAPSHOT, "file")))
+        assert calls[1] == os.path.join(self.root, "three", SNAPSHOT, "file")
@@ -0,0 +1,86 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+from snapshotter import diskusage
+
+
+class TestDiskUsage(object):
+
+    """Tests for measuring the disk usage of snapshots."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_subdirectory_usage(self):
+        os.makedirs(os.path.join(self.directory, "a", "b"))
+        open(os.path.join(self.directory, "file"), "w").close()
+
+        (name, bytes_, count), = diskusage.subdirectory_usage(self.directory)
+
+        assert (name, count) == ("a", 1)
+        assert bytes_ >= 0
+
+    def test_reclaimable(self):
+        for name in ("one", "two", "three"):
+            os.mkdir(os.path.join(self.directory, name))
+        def write(path, size):
+            with open(os.path.join(self.directory, path), "wb") as file_:
+                file_.write(b"x" * size)
+        def link(src, dest):
+            os.link(os.path.join(self.directory, src),
+                    os.path.join(self.directory, dest))
+        # Shared by all the snapshots.
+        write("one/shared", 100000)
+        link("one/shared", "two/shared")
+        link("one/shared", "three/shared")
+        # Only in two, but linked twice.
+        write("two/big", 500000)
+        link("two/big", "two/big_again")
+        # Only in one.
+        write("one/small", 50000)
+        names = ["one", "two", "three"]
+
+        result = diskusage.reclaimable(self.directory, names)
+
+        assert result["two"] > result["one"] > result["three"]
+        assert result["two"] >= 500000
+        assert result["three"] < 100000
+
+        # The cached tables are reused, and two's table is removed.
+        result = diskusage.reclaimable(self.directory, ["one", "three"])
+        assert sorted(os.listdir(
+            os.path.join(self.directory, "du-cache"))) == ["one", "three"]
+        assert result["three"] < 100000
+        assert result["one"] >= 50000
+
+    def test_reclaimable_counts_links_elsewhere(self):
+        for name in ("one", "two", "incomplete.snapshot"):
+            os.mkdir(os.path.join(self.directory, name))
+        for name in ("kept", "new", "own"):
+            with open(os.path.join(self.directory, "one", name),
+                      "wb") as file_:
+                file_.write(b"x" * 100000)
+        # Linked outside the snapshots, e.g. from the trash.
+        os.link(os.path.join(self.directory, "one", "kept"),
+                os.path.join(self.directory, "elsewhere"))
+        os.link(os.path.join(self.directory, "one", "new"),
+                os.path.join(self.directory, "incomplete.snapshot", "new"))
+
+        result = diskusage.reclaimable(self.directory, ["one", "two"])
+
+        assert 100000 <= result["one"] < 200000
+        assert result["two"] < 100000
+
+        # The cached link counts may be out of date, but they only ever make
+        # the result too low, never too high.
+        os.unlink(os.path.join(self.directory, "elsewhere"))
+        result = diskusage.reclaimable(self.directory, ["one", "two"])
+        assert 100000 <= result["one"] < 200000
@@ -0,0 +1,173 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+from snapshotter import engine
+from snapshotter import progress
+
+
+def _write(path, content=b"", mtime=1425572592):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as file_:
+        file_.write(content)
+    os.utime(path, (mtime, mtime))
+
+
+class TestCopyTree(object):
+
+    """Tests for the copy_tree() function."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, "source")
+        self.latest = os.path.join(self.directory, "latest")
+        self.dest = os.path.join(self.directory, "dest")
+        _write(os.path.join(self.source, "dir", "unchanged"), b"same")
+        _write(os.path.join(self.source, "dir", "changed"), b"new content")
+        _write(os.path.join(self.source, "new"), b"new")
+        os.symlink("dir/changed", os.path.join(self.source, "link"))
+        os.mkfifo(os.path.join(self.source, "fifo"))
+        os.chmod(os.path.join(self.source, "dir", "unchanged"), 0o640)
+        os.chmod(os.path.join(self.source, "dir"), 0o750)
+        os.utime(os.path.join(self.source, "dir"), (1425572000, 1425572000))
+
+        shutil.copytree(os.path.join(self.source, "dir"),
+                        os.path.join(self.latest, "dir"), symlinks=True)
+        _write(os.path.join(self.latest, "dir", "changed"), b"old")
+        _write(os.path.join(self.latest, "deleted"), b"deleted")
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _copy(self):
+        lines = []
+        totals = engine.copy_tree(self.source, self.dest, [self.latest],
+                                  consumers=[lines.append], threads=4)
+        return totals, lines
+
+    def test_it_links_unchanged_files(self):
+        self._copy()
+
+        assert os.path.samefile(
+            os.path.join(self.dest, "dir", "unchanged"),
+            os.path.join(self.latest, "dir", "unchanged"))
+        assert not os.path.samefile(
+            os.path.join(self.dest, "dir", "changed"),
+            os.path.join(self.latest, "dir", "changed"))
+        with open(os.path.join(self.dest, "dir", "changed"), "rb") as file_:
+            assert file_.read() == b"new content"
+        assert not os.path.exists(os.path.join(self.dest, "deleted"))
+
+    def test_it_preserves_attributes(self):
+        self._copy()
+
+        for path in ("dir", "dir/changed", "new"):
+            source = os.lstat(os.path.join(self.source, path))
+            dest = os.lstat(os.path.join(self.dest, path))
+            assert dest.st_mode == source.st_mode
+            assert int(dest.st_mtime) == int(source.st_mtime)
+        assert os.readlink(os.path.join(self.dest, "link")) == "dir/changed"
+        assert os.path.exists(os.path.join(self.dest, "fifo"))
+
+    def test_it_reports_changes_and_stats(self):
+        totals, lines = self._copy()
+
+        changes = sorted((line.flags, line.path) for line in lines
+                         if line.flags is not None)
+        assert (">f+++++++++", "new") in changes
+        assert (">f.s.......", "dir/changed") in changes
+        assert ("cL+++++++++", "link") in changes
+        assert not [path for _, path in changes if "unchanged" in path]
+        stats = progress.Stats()
+        for line in lines:
+            stats(line)
+        assert stats.totals["Number of regular files transferred"] == 2
+        assert stats.totals["Total transferred file size"] == len(
+            b"new content") + len(b"new")
+        assert totals.files == 3
+
+    def test_it_resumes_and_deletes_extraneous_files(self):
+        _write(os.path.join(self.dest, "leftover", "file"))
+        _write(os.path.join(self.dest, "new"), b"new")
+
+        _, lines = self._copy()
+
+        assert not os.path.exists(os.path.join(self.dest, "leftover"))
+        assert [line.path for line in lines
+                if line.flags == "*deleting"] == ["leftover"]
+        assert not [line.path for line in lines if line.path == "new"]
+
+    def test_restore_options(self):
+        os.link(os.path.join(self.source, "new"),
+                os.path.join(self.source, "dir", "also_new"))
+        _write(os.path.join(self.dest, "extra"), b"keep me")
+        # Same size and modification time, different contents.
+        _write(os.path.join(self.dest, "dir", "unchanged"), b"diff")
+        os.chmod(os.path.join(self.dest, "dir", "unchanged"), 0o640)
+        lines = []
+
+        engine.copy_tree(self.source, self.dest, consumers=[lines.append],
+                         delete=False, compare_contents=True,
+                         hard_links=True)
+
+        assert os.path.exists(os.path.join(self.dest, "extra"))
+        with open(os.path.join(self.dest, "dir", "unchanged"), "rb") as file_:
+            assert file_.read() == b"same"
+        assert os.path.samefile(os.path.join(self.dest, "new"),
+                                os.path.join(self.dest, "dir", "also_new"))
+        assert [line.flags for line in lines
+                if line.path in ("new", "dir/also_new")] == [
+                    ">f+++++++++", "hf+++++++++"]
+
+        lines = []
+        engine.copy_tree(self.source, self.dest, consumers=[lines.append],
+                         delete=False, compare_contents=True,
+                         hard_links=True)
+
+        assert [line.text for line in lines if line.flags is not None] == []
+
+
+class TestCopyFile(object):
+
+    def test_copy_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            content = os.urandom(3 * 1024 * 1024 + 17)
+            _write(os.path.join(directory, "a"), content)
+
+            engine.copy_file(os.path.join(directory, "a"),
+                             os.path.join(directory, "b"), len(content))
+
+            with open(os.path.join(directory, "b"), "rb") as file_:
+                assert file_.read() == content
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sparse_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "sparse")
+            with open(path, "wb") as file_:
+                file_.write(b"start")
+                file_.seek(64 * 1024 * 1024)
+                file_.write(b"end")
+            size = os.path.getsize(path)
+
+            engine.copy_file(path, os.path.join(directory, "copy"), size,
+                             sparse=engine._is_sparse(os.stat(path)))
+
+            with open(os.path.join(directory, "copy"), "rb") as file_:
+                assert file_.read(5) == b"start"
+                file_.seek(-3, os.SEEK_END)
+                assert file_.read() == b"end"
+            copy = os.stat(os.path.join(directory, "copy"))
+            assert copy.st_size == size
+            assert copy.st_blocks * 512 <= os.stat(path).st_blocks * 512 + (
+                1024 * 1024)
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,120 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from snapshotter import integrity
+
+
+class TestHashFiles(object):
+
+    """Tests for the hash_files() function."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_it_hashes_regular_files_only(self):
+        path = os.path.join(self.directory, "a")
+        with open(path, "wb") as file_:
+            file_.write(b"abc")
+        os.utime(path, (1425572592.5, 1425572592.5))
+        os.mkdir(os.path.join(self.directory, "dir"))
+
+        rows = integrity.hash_files(self.directory, ["a", "dir", "missing"])
+
+        assert [row[:3] for row in rows] == [
+            ["a", integrity.file_hash(path), 3]]
+        # The modification time is in nanoseconds.
+        assert rows[0][3] // 10 ** 6 == 1425572592500
+
+
+class TestVerify(object):
+
+    """Tests for verifying snapshots against their stored hashes."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _snapshots(self):
+        """Make three snapshots that share most of their files."""
+        names = ["one", "two", "three"]
+        for name in names:
+            os.mkdir(os.path.join(self.directory, name))
+        for i in range(4):
+            path = os.path.join(self.directory, "one", "shared%d" % i)
+            with open(path, "wb") as file_:
+                file_.write(os.urandom(1000))
+            for name in ("two", "three"):
+                os.link(path, os.path.join(self.directory, name,
+                                           "shared%d" % i))
+        with open(os.path.join(self.directory, "three", "new"), "wb") as file_:
+            file_.write(b"new")
+        return names
+
+    def test_verify(self):
+        names = self._snapshots()
+
+        with mock.patch("snapshotter.integrity.file_hash",
+                        side_effect=integrity.file_hash) as mock_file_hash:
+            result = integrity.verify(self.directory, names, threads=2)
+
+        # Each inode is hashed once, however many snapshots link to it.
+        assert mock_file_hash.call_count == 5
+        assert (result["files"], result["bytes"], result["new"]) == (
+            5, 4003, 5)
+        assert result["problems"] == []
+        assert result["finished"]
+
+        # Corrupt a file without changing its size or modification time.
+        path = os.path.join(self.directory, "two", "shared2")
+        stat = os.stat(path)
+        with open(path, "r+b") as file_:
+            file_.write(b"x")
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+
+        result = integrity.verify(self.directory, names)
+
+        assert result["problems"] == [["one", "shared2", integrity.CORRUPT]]
+        assert result["new"] == 0
+
+    def test_verify_resumes_where_it_stopped(self):
+        names = self._snapshots()
+
+        result = integrity.verify(self.directory, names, max_bytes=2500)
+
+        assert (result["files"], result["remaining"]) == (2, 3)
+        assert not result["finished"]
+
+        # The rest of one, then only three's new file is left: two and
+        # three's shared files have already been verified in this pass.
+        result = integrity.verify(self.directory, names, max_bytes=2500)
+
+        assert (result["files"], result["bytes"]) == (3, 2003)
+        assert result["finished"]
+
+        # The next call starts a new pass.
+        result = integrity.verify(self.directory, names, max_bytes=2500)
+
+        assert (result["files"], result["new"]) == (2, 0)
+        assert not result["finished"]
+
+    def test_verify_reports_unreadable_files(self):
+        names = self._snapshots()
+
+        with mock.patch("snapshotter.integrity.file_hash",
+                        side_effect=IOError(5, "Input/output error")):
+            result = integrity.verify(self.directory, names)
+
+        assert ["three", "new", integrity.UNREADABLE] in result["problems"]
+        assert result["files"] == 0
@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+from snapshotter import itemize
+
+
+class TestParse(object):
+
+    """Unit tests for the parse() function."""
+
+    def test_new_file(self):
+        line = itemize.parse(">f+++++++++ Documents/new file.txt")
+
+        assert line.flags == ">f+++++++++"
+        assert line.path == "Documents/new file.txt"
+
+    def test_symlink(self):
+        line = itemize.parse("cL+++++++++ a_symlink -> target")
+
+        assert line.path == "a_symlink"
+
+    def test_hard_link(self):
+        line = itemize.parse("hf+++++++++ a_link => new_file.txt")
+
+        assert line.path == "a_link"
+
+    def test_deleting(self):
+        line = itemize.parse("*deleting   old/file.txt")
+
+        assert line.flags == "*deleting"
+        assert line.path == "old/file.txt"
+
+    def test_other_output(self):
+        line = itemize.parse("sent 1.23K bytes  received 35 bytes")
+
+        assert line == itemize.Line(
+            "sent 1.23K bytes  received 35 bytes", None, None)
+
+
+class TestChangeType(object):
+
+    """Unit tests for the change_type() function."""
+
+    def test_change_types(self):
+        assert itemize.change_type(">f+++++++++") == itemize.CREATED
+        assert itemize.change_type("cd+++++++++") == itemize.CREATED
+        assert itemize.change_type(">f.st......") == itemize.UPDATED
+        assert itemize.change_type(".d..t......") == itemize.UNCHANGED
+        assert itemize.change_type("hf+++++++++") == itemize.HARDLINKED
+        assert itemize.change_type("*deleting") == itemize.DELETED
+
+
+class TestCounter(object):
+
+    """Unit tests for the Counter consumer."""
+
+    def test_counter(self):
+        counter = itemize.Counter()
+
+        for text in (">f+++++++++ a", ">f.st...... b", "*deleting   c",
+                     "sent 1.23K bytes"):
+            counter(itemize.parse(text))
+
+        assert counter.summary() == "1 created, 1 updated, 1 deleted, " \
+                                    "0 hardlinked"
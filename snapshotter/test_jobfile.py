@@ -0,0 +1,182 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import nose.tools
+
+from snapshotter import jobfile
+from snapshotter import retention
+
+
+JOB_FILE = """
+[limits]
+jobs = 4
+per_host = 2
+
+[defaults]
+keep = "daily=7"
+min_snapshots = 2
+
+[[job]]
+name = "documents"
+source = "fred@laptop:Documents"
+dest = "/media/backup/Documents"
+rsync_args = ["--exclude", "*.tmp"]
+keep = "hourly=24,daily=30"
+
+[[job]]
+source = "/srv/www"
+dest = "/media/backup/www"
+engine = "native"
+throttle = 10
+"""
+
+
+def _job(name, source="/src", dest="/dest"):
+    return jobfile.Job(name, source, dest, {})
+
+
+class TestParse(object):
+
+    """Tests for the parse() and load() functions."""
+
+    def test_it_parses_job_files(self):
+        jobs, limits = jobfile.parse(JOB_FILE)
+
+        assert limits == {"jobs": 4, "per_host": 2, "per_device": None}
+        assert jobs == [
+            jobfile.Job("documents", "fred@laptop:Documents",
+                        "/media/backup/Documents",
+                        {"extra_args": ["--exclude", "*.tmp"],
+                         "keep": retention.parse_policy("hourly=24,daily=30"),
+                         "min_snapshots": 2}),
+            jobfile.Job("/media/backup/www", "/srv/www", "/media/backup/www",
+                        {"keep": retention.parse_policy("daily=7"),
+                         "min_snapshots": 2, "engine": "native",
+                         "throttle_target": 10.0}),
+        ]
+
+    def test_invalid_job_files(self):
+        for text in (
+                "",
+                "not toml",
+                "[[job]]\nsource = '/src'\n",
+                "[[job]]\nsource = '/a'\ndest = '/b'\nkeep = 'daily'\n",
+                "[[job]]\nsource = '/a'\ndest = '/b'\ncolour = 'red'\n",
+                "[[job]]\nsource = '/a'\ndest = '/b'\nengine = 'cp'\n",
+                "[[job]]\nsource = '/a'\ndest = '/b'\nreflink = 'yes'\n",
+                "[[job]]\nsource = '/a'\ndest = '/b'\nthrottle = true\n",
+                "[[job]]\nsource = '/a'\ndest = '/b'\n"
+                "[[job]]\nsource = '/c'\ndest = '/b'\n",
+                "[limits]\njobs = 0\n[[job]]\nsource = '/a'\ndest = '/b'\n",
+                "[jobs]\n[[job]]\nsource = '/a'\ndest = '/b'\n"):
+            nose.tools.assert_raises(jobfile.JobFileError, jobfile.parse,
+                                     text)
+
+    def test_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "jobs.toml")
+            with open(path, "w") as file_:
+                file_.write(JOB_FILE)
+
+            jobs, _ = jobfile.load(path)
+
+            assert [job.name for job in jobs] == ["documents",
+                                                  "/media/backup/www"]
+            nose.tools.assert_raises(jobfile.JobFileError, jobfile.load,
+                                     os.path.join(directory, "missing"))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestScheduler(object):
+
+    """Tests for the Scheduler class."""
+
+    def _run(self, jobs, runtimes=None, limits=None, fail=()):
+        """Run jobs with a recording run_job, return (results, log).
+
+        log is a list of ("start" or "end", job name) in the order that
+        they happened.
+
+        """
+        runtimes = runtimes or {}
+        log = []
+        lock = threading.Lock()
+
+        def run_job(job):
+            with lock:
+                log.append(("start", job.name))
+            time.sleep(0.02)
+            with lock:
+                log.append(("end", job.name))
+            if job.name in fail:
+                raise RuntimeError("rsync failed\nexit status 23")
+            return job.dest + "/snapshot"
+
+        scheduler = jobfile.Scheduler(
+            jobs, run_job, host=lambda job: job.source,
+            device=lambda job: job.dest,
+            runtime=lambda job: runtimes.get(job.name), limits=limits)
+        return scheduler.run(), log
+
+    def _max_concurrent(self, log, names=None):
+        running, most = 0, 0
+        for event, name in log:
+            if names is not None and name not in names:
+                continue
+            running += 1 if event == "start" else -1
+            most = max(most, running)
+        return most
+
+    def test_longest_jobs_start_first(self):
+        jobs = [_job("a"), _job("b"), _job("c"), _job("d")]
+
+        results, log = self._run(jobs, runtimes={"a": 10, "b": 300, "d": 60})
+
+        starts = [name for event, name in log if event == "start"]
+        assert starts == ["c", "b", "d", "a"]
+        # The results are in the job file's order.
+        assert [result.name for result in results] == ["a", "b", "c", "d"]
+        assert all(result.status == jobfile.OK for result in results)
+        assert results[0].snapshot == "/dest/snapshot"
+
+    def test_global_limit(self):
+        jobs = [_job(name, source=name, dest=name) for name in "abcdef"]
+
+        _, log = self._run(jobs, limits={"jobs": 3})
+
+        assert self._max_concurrent(log) == 3
+
+    def test_host_and_device_limits(self):
+        jobs = [_job("a1", "host-a", "disk-1"), _job("a2", "host-a", "disk-2"),
+                _job("a3", "host-a", "disk-3"), _job("b1", "host-b", "disk-1"),
+                _job("b2", "host-b", "disk-4")]
+
+        _, log = self._run(jobs, limits={"jobs": 5, "per_host": 2,
+                                         "per_device": 1})
+
+        assert self._max_concurrent(log, ["a1", "a2", "a3"]) == 2
+        assert self._max_concurrent(log, ["a1", "b1"]) == 1
+        # Jobs that can't start yet don't hold up the ones after them.
+        assert sorted(log[:3]) == [("start", "a1"), ("start", "a2"),
+                                   ("start", "b2")]
+
+    def test_failures_dont_stop_other_jobs(self):
+        jobs = [_job("a"), _job("b"), _job("c")]
+
+        results, _ = self._run(jobs, fail=["b"])
+
+        assert [result.status for result in results] == [
+            jobfile.OK, jobfile.FAILED, jobfile.OK]
+        assert isinstance(results[1].error, RuntimeError)
+        lines = jobfile.summary(results)
+        assert "RuntimeError: exit status 23" in lines[2]
+        assert lines[-1] == "3 jobs, 2 ok, 1 failed"
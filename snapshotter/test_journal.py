@@ -0,0 +1,204 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import nose.tools
+from nose.plugins.skip import SkipTest
+
+from snapshotter import journal
+
+
+def _write(path, content=b""):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as file_:
+        file_.write(content)
+
+
+class TestJournal(object):
+
+    """Tests for the Journal class."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = journal.Journal(os.path.join(self.directory, "j"))
+        self.alive = self.journal.start()
+
+    def teardown(self):
+        self.alive.close()
+        shutil.rmtree(self.directory)
+
+    def test_a_new_watcher_makes_the_journal_incomplete(self):
+        self.journal.record(["a"])
+
+        segments = self.journal.rotate()
+
+        assert len(segments) == 1
+        assert self.journal.read(segments) is None
+
+    def test_changes_after_a_rotation(self):
+        self.journal.commit(self.journal.rotate(), "1.snapshot")
+        self.journal.record(["a", "b/c"])
+        self.journal.record(["a"])
+
+        segments = self.journal.rotate()
+
+        assert self.journal.base() == "1.snapshot"
+        assert self.journal.read(segments) == set(["a", "b/c"])
+
+    def test_uncommitted_segments_are_read_again(self):
+        self.journal.commit(self.journal.rotate(), "1.snapshot")
+        self.journal.record(["a"])
+        self.journal.rotate()
+        self.journal.record(["b"])
+
+        segments = self.journal.rotate()
+
+        assert len(segments) == 2
+        assert self.journal.read(segments) == set(["a", "b"])
+        self.journal.commit(segments, "2.snapshot")
+        assert self.journal.rotate() == []
+        assert self.journal.read([]) == set()
+
+    def test_overflow(self):
+        self.journal.commit(self.journal.rotate(), "1.snapshot")
+        self.journal.record(["a"])
+        self.journal.overflow()
+
+        assert self.journal.read(self.journal.rotate()) is None
+
+    def test_it_is_incomplete_without_a_watcher(self):
+        self.journal.commit(self.journal.rotate(), "1.snapshot")
+        self.alive.close()
+
+        assert not self.journal.watching()
+        assert self.journal.read(self.journal.rotate()) is None
+
+    def test_only_one_watcher(self):
+        nose.tools.assert_raises(EnvironmentError, self.journal.start)
+
+
+class TestLinkTree(object):
+
+    """Tests for link_tree() and prune()."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.src = os.path.join(self.directory, "src")
+        self.dest = os.path.join(self.directory, "dest")
+        _write(os.path.join(self.src, "a", "b", "file"), b"b")
+        _write(os.path.join(self.src, "a", "changed"), b"c")
+        os.symlink("a/changed", os.path.join(self.src, "link"))
+        os.chmod(os.path.join(self.src, "a"), 0o700)
+        os.utime(os.path.join(self.src, "a"), (1425572592, 1425572592))
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_link_tree(self):
+        journal.link_tree(self.src, self.dest, skip=["a/changed"])
+
+        assert os.path.samefile(os.path.join(self.src, "a", "b", "file"),
+                                os.path.join(self.dest, "a", "b", "file"))
+        assert not os.path.exists(os.path.join(self.dest, "a", "changed"))
+        assert os.readlink(os.path.join(self.dest, "link")) == "a/changed"
+        stat = os.stat(os.path.join(self.dest, "a"))
+        assert stat.st_mode & 0o777 == 0o700
+        assert stat.st_mtime == 1425572592
+
+    def test_link_tree_again(self):
+        journal.link_tree(self.src, self.dest)
+        journal.link_tree(self.src, self.dest)
+
+        assert os.path.samefile(os.path.join(self.src, "a", "changed"),
+                                os.path.join(self.dest, "a", "changed"))
+
+    def test_prune(self):
+        journal.link_tree(self.src, self.dest)
+        source = os.path.join(self.directory, "source")
+        _write(os.path.join(source, "a", "changed"))
+        _write(os.path.join(source, "link"))
+
+        removed = journal.prune(source, self.dest,
+                                ["a/b", "a/changed", "link", "new"])
+
+        assert removed == ["a/b", "link"]
+        assert os.listdir(os.path.join(self.dest, "a")) == ["changed"]
+        assert not os.path.lexists(os.path.join(self.dest, "link"))
+
+
+class TestWatcher(object):
+
+    """Tests for the Watcher class."""
+
+    def setup(self):
+        if not sys.platform.startswith("linux"):
+            raise SkipTest("inotify is Linux only")
+        self.directory = tempfile.mkdtemp()
+        self.src = os.path.join(self.directory, "src")
+        _write(os.path.join(self.src, "a", "old"))
+        self.journal = journal.Journal(os.path.join(self.directory, "j"))
+        self.watcher = journal.Watcher(self.src, self.journal, interval=0.1)
+        self.journal.commit(self.journal.rotate(), "1.snapshot")
+
+    def teardown(self):
+        self.watcher.close()
+        shutil.rmtree(self.directory)
+
+    def test_it_records_changes(self):
+        _write(os.path.join(self.src, "a", "old"), b"changed")
+        os.makedirs(os.path.join(self.src, "new", "sub"))
+        _write(os.path.join(self.src, "new", "sub", "file"))
+        self.watcher.poll(0.5)
+
+        changes = self.journal.read(self.journal.rotate())
+
+        assert "a/old" in changes
+        assert "new" in changes
+        assert "new/sub/file" in changes
+        assert "." in changes
+
+    def test_it_follows_moved_directories(self):
+        os.rename(os.path.join(self.src, "a"), os.path.join(self.src, "b"))
+        self.watcher.poll(0.5)
+        self.journal.commit(self.journal.rotate(), "2.snapshot")
+
+        _write(os.path.join(self.src, "b", "new"))
+        self.watcher.poll(0.5)
+
+        assert self.journal.read(self.journal.rotate()) == set(
+            ["b", "b/new"])
+
+    def test_rotating_right_after_a_change(self):
+        stop = threading.Event()
+
+        def watch():
+            while not stop.is_set():
+                # Without the flush the change would be held for a second.
+                self.watcher.poll(1)
+
+        thread = threading.Thread(target=watch)
+        thread.start()
+        try:
+            _write(os.path.join(self.src, "a", "new"))
+            segments = self.journal.rotate(timeout=5)
+        finally:
+            stop.set()
+            thread.join()
+
+        assert "a/new" in self.journal.read(segments)
+        assert not [name for name in os.listdir(self.journal.directory)
+                    if name.startswith("flush-")]
+
+    def test_rotating_when_the_watcher_does_not_answer(self):
+        _write(os.path.join(self.src, "a", "new"))
+
+        segments = self.journal.rotate(timeout=0.1)
+
+        assert self.journal.read(segments) is None
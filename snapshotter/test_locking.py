@@ -0,0 +1,49 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from snapshotter import locking
+
+
+class TestLocking(object):
+
+    """Tests for locking destination directories."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lock_and_unlock(self):
+        assert locking.lock(self.directory) == [True, None]
+        try:
+            # Another lock on the same directory can't be taken...
+            locked, holder = locking.lock(self.directory, register=True)
+            assert locked is False
+            assert "pid {pid}".format(pid=os.getpid()) in holder
+            # ...but it leaves a catch-up request for the holder.
+            assert locking.unlock(self.directory) is True
+            assert locking.lock(self.directory)[0] is False
+        finally:
+            assert locking.unlock(self.directory) is False
+        assert locking.lock(self.directory) == [True, None]
+        locking.unlock(self.directory, catch_up=False)
+
+    def test_locks_of_dead_processes_are_released(self):
+        subprocess.check_call([
+            sys.executable, "-c",
+            "import os; from snapshotter import locking; "
+            "locking.lock({directory!r}); os._exit(0)".format(
+                directory=self.directory)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(
+                locking.__file__))))
+
+        assert locking.lock(self.directory) == [True, None]
+        locking.unlock(self.directory)
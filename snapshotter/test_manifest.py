@@ -0,0 +1,85 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import nose.tools
+
+from snapshotter import itemize
+from snapshotter import manifest
+
+
+class TestManifest(object):
+
+    """Tests for writing and reading manifest files."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "incomplete.manifest")
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, *lines):
+        writer = manifest.Writer(self.path)
+        for line in lines:
+            writer(itemize.parse(line))
+        return writer.close()
+
+    def test_round_trip(self):
+        self._write("cd+++++++++ ./",
+                    "cd+++++++++ Documents/",
+                    ">f+++++++++ Documents/new file.txt",
+                    ">f.st...... Documents/changed.txt",
+                    "*deleting   Music/old.mp3",
+                    "sent 1.23K bytes  received 35 bytes")
+
+        assert list(manifest.read(self.path)) == [
+            ("cd+++++++++", "./"),
+            ("cd+++++++++", "Documents/"),
+            (">f+++++++++", "Documents/new file.txt"),
+            (">f.st......", "Documents/changed.txt"),
+            ("*deleting", "Music/old.mp3"),
+        ]
+
+    def test_prefixes_are_interned(self):
+        lines = [">f+++++++++ a/long/directory/name/file%d" % i
+                 for i in range(100)]
+
+        self._write(*lines)
+
+        # Smaller than rsync's own output, although every entry also stores
+        # the fixed-width flags.
+        assert os.path.getsize(self.path) < sum(len(l) + 1 for l in lines)
+
+    def test_nothing_written(self):
+        assert self._write("sent 1.23K bytes") is False
+        assert not os.path.exists(self.path)
+
+    def test_segments_are_appended(self):
+        self._write(">f+++++++++ dir/one")
+        self._write(">f+++++++++ other/two", ">f.s....... dir/one")
+
+        assert manifest.changes(self.path) == {
+            "dir/one": ">f.s.......",
+            "other/two": ">f+++++++++",
+        }
+
+    def test_corrupt_manifest(self):
+        self._write(">f+++++++++ dir/one")
+        with open(self.path, "ab") as file_:
+            file_.write(b"E>f+++")
+
+        nose.tools.assert_raises(
+            manifest.CorruptManifestError, list, manifest.read(self.path))
+
+
+class TestPathFor(object):
+
+    def test_path_for(self):
+        assert manifest.path_for(
+            "/backups/2016-03-20T13_19_25.snapshot") == (
+                "/backups/2016-03-20T13_19_25.manifest")
@@ -0,0 +1,123 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+
+from snapshotter import metrics
+
+
+class TestReport(object):
+
+    """Tests for the Report class."""
+
+    def test_phases_and_counters(self):
+        report = metrics.Report("/home/fred", "/media/backup")
+
+        with report.phase("transfer"):
+            with report.phase("list_snapshots"):
+                pass
+        with report.phase("transfer"):
+            pass
+        report.count("subprocesses")
+        report.count("subprocesses", 2)
+        report.finish(metrics.COMPLETE)
+
+        assert list(report.phases) == ["transfer", "list_snapshots"]
+        assert report.phases["transfer"][1] == 2
+        assert report.phases["transfer"][0] >= (
+            report.phases["list_snapshots"][0])
+        assert report.counters["subprocesses"] == 3
+        assert report.duration >= 0
+        assert report.as_dict()["phases"]["list_snapshots"]["count"] == 1
+
+    def test_hooks(self):
+        hook = mock.Mock()
+        metrics.hooks.append(hook)
+        try:
+            with metrics.Report().phase("prune"):
+                pass
+        finally:
+            metrics.hooks.remove(hook)
+
+        assert hook.call_args[0][0] == "prune"
+
+    def test_write_json_and_textfile(self):
+        report = metrics.Report("/home/fred", 'backup "1"')
+        with report.phase("transfer"):
+            pass
+        report.count("ssh_connections")
+        report.stats = {"Total transferred file size": 100}
+        report.finish(metrics.FAILED)
+        directory = tempfile.mkdtemp()
+        try:
+            report.write_json(os.path.join(directory, "report.json"))
+            report.write_textfile(os.path.join(directory, "metrics.prom"))
+
+            with open(os.path.join(directory, "report.json")) as file_:
+                assert json.load(file_)["status"] == "failed"
+            with open(os.path.join(directory, "metrics.prom")) as file_:
+                lines = file_.read().splitlines()
+            assert sorted(os.listdir(directory)) == ["metrics.prom",
+                                                     "report.json"]
+        finally:
+            shutil.rmtree(directory)
+
+        dest = 'dest="backup \\"1\\""'
+        assert "snapshotter_last_run_success{%s} 0" % dest in lines
+        assert "snapshotter_ssh_connections{%s} 1" % dest in lines
+        assert ("snapshotter_rsync_total_transferred_file_size{%s} 100" %
+                dest in lines)
+        assert any(line.startswith(
+            'snapshotter_phase_duration_seconds{%s,phase="transfer"} ' % dest)
+            for line in lines)
+        assert "# TYPE snapshotter_last_run_success gauge" in lines
+
+
+class TestRecording(object):
+
+    """Tests for recording into the current thread's report."""
+
+    def test_it_records_into_the_current_report(self):
+        report = metrics.Report()
+
+        with metrics.recording(report):
+            metrics.count("agent_calls")
+            with metrics.phase("prune"):
+                pass
+            assert metrics.current() is report
+        metrics.count("agent_calls")
+
+        assert report.counters["agent_calls"] == 1
+        assert "prune" in report.phases
+        assert metrics.current() is None
+
+    def test_reports_are_per_thread(self):
+        report = metrics.Report()
+
+        with metrics.recording(report):
+            thread = threading.Thread(target=metrics.count,
+                                      args=("subprocesses",))
+            thread.start()
+            thread.join()
+
+        assert report.counters["subprocesses"] == 0
+
+    def test_timed(self):
+        @metrics.timed("list_snapshots")
+        def list_snapshots():
+            """List the snapshots."""
+            return ["a.snapshot"]
+        report = metrics.Report()
+
+        with metrics.recording(report):
+            assert list_snapshots() == ["a.snapshot"]
+
+        assert report.phases["list_snapshots"][1] == 1
+        assert list_snapshots.__doc__ == "List the snapshots."
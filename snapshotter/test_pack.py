@@ -0,0 +1,160 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import stat
+import tempfile
+
+import mock
+import nose.tools
+
+from snapshotter import pack
+
+
+FIRST = "2015-03-05T16_23_12.snapshot"
+SECOND = "2015-03-06T16_23_12.snapshot"
+
+
+class TestPack(object):
+
+    """Tests for packing snapshots and reading packed snapshots."""
+
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+        self.first = os.path.join(self.root, FIRST)
+        self.data = os.urandom(100000)
+        self._write(os.path.join(FIRST, "etc", "big"), self.data)
+        self._write(os.path.join(FIRST, "etc", "sub", "small"), b"small")
+        os.link(os.path.join(self.first, "etc", "big"),
+                os.path.join(self.first, "etc", "hardlink"))
+        os.symlink("big", os.path.join(self.first, "etc", "symlink"))
+        os.chmod(os.path.join(self.first, "etc", "sub", "small"), 0o600)
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, path, data, mtime=1425572592):
+        full = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(full)):
+            os.makedirs(os.path.dirname(full))
+        with open(full, "wb") as file_:
+            file_.write(data)
+        os.utime(full, (mtime, mtime))
+        return full
+
+    def _pack(self, name, previous=None):
+        output = os.path.join(self.root, "packed", name)
+        if not os.path.isdir(os.path.dirname(output)):
+            os.mkdir(os.path.dirname(output))
+        return output, pack.pack(os.path.join(self.root, name), output,
+                                 previous)
+
+    def test_pack_and_read(self):
+        output, result = self._pack(FIRST)
+
+        assert (result.entries, result.bytes, result.reused) == (
+            6, 200005, 0)
+        # The hard-linked file is only stored once.
+        assert 100000 < result.written < 101000
+        assert pack.is_packed(output)
+        assert not pack.is_packed(self.first)
+        assert sorted(os.listdir(output)) == [FIRST + pack.SEGMENT_SUFFIX,
+                                              pack.INDEX_FILENAME]
+        with pack.PackedSnapshot(output) as packed:
+            assert packed.read("etc/big") == self.data
+            assert packed.read("/etc/sub/small") == b"small"
+            assert packed.lookup("etc/symlink").target == "big"
+            assert packed.lookup("etc/sub").type == pack.DIRECTORY
+            assert packed.lookup("etc/missing") is None
+            nose.tools.assert_raises(KeyError, packed.read, "etc")
+            assert [entry.path for entry in packed.entries(["etc/sub"])] == [
+                "etc/sub", "etc/sub/small"]
+            assert len(packed.entries()) == 6
+
+    def test_it_reuses_the_previous_packed_snapshot(self):
+        second = os.path.join(self.root, SECOND)
+        os.makedirs(os.path.join(second, "etc"))
+        os.link(os.path.join(self.first, "etc", "big"),
+                os.path.join(second, "etc", "big"))
+        self._write(os.path.join(SECOND, "etc", "new"), b"new")
+        previous, _ = self._pack(FIRST)
+        # Deleting the first snapshot mustn't break the second.
+        shutil.rmtree(self.first)
+
+        output, result = self._pack(SECOND, previous)
+        shutil.rmtree(previous)
+
+        assert (result.entries, result.reused) == (3, 100000)
+        assert result.written < 100
+        assert sorted(os.listdir(output)) == [
+            FIRST + pack.SEGMENT_SUFFIX, SECOND + pack.SEGMENT_SUFFIX,
+            pack.INDEX_FILENAME]
+        with pack.PackedSnapshot(output) as packed:
+            assert packed.read("etc/big") == self.data
+            assert packed.read("etc/new") == b"new"
+
+    def test_changed_files_are_stored_again(self):
+        previous, _ = self._pack(FIRST)
+        os.utime(os.path.join(self.first, "etc", "big"), (0, 0))
+        os.rename(self.first, os.path.join(self.root, SECOND))
+
+        output, result = self._pack(SECOND, previous)
+
+        # Only etc/sub/small is reused.
+        assert result.reused == 5
+        assert result.written > 100000
+        with pack.PackedSnapshot(output) as packed:
+            assert packed.lookup("etc/big").segment == (
+                SECOND + pack.SEGMENT_SUFFIX)
+
+    def test_extract(self):
+        output, _ = self._pack(FIRST)
+        target = os.path.join(self.root, "restored")
+
+        with pack.PackedSnapshot(output) as packed:
+            assert packed.extract(target) == 6
+
+        with open(os.path.join(target, "etc", "big"), "rb") as file_:
+            assert file_.read() == self.data
+        assert os.readlink(os.path.join(target, "etc", "symlink")) == "big"
+        small = os.lstat(os.path.join(target, "etc", "sub", "small"))
+        assert stat.S_IMODE(small.st_mode) == 0o600
+        assert small.st_mtime == 1425572592
+        assert os.lstat(os.path.join(target, "etc", "big")).st_ino == (
+            os.lstat(os.path.join(target, "etc", "hardlink")).st_ino)
+        assert os.lstat(os.path.join(target, "etc")).st_mtime == (
+            os.lstat(os.path.join(self.first, "etc")).st_mtime)
+
+    def test_extract_some_paths(self):
+        output, _ = self._pack(FIRST)
+        target = os.path.join(self.root, "restored")
+        os.mkdir(target)
+        self._write(os.path.join("restored", "etc", "sub", "small"), b"old")
+
+        with pack.PackedSnapshot(output) as packed:
+            assert packed.extract(target, ["etc/sub/small", "etc/big"]) == 2
+
+        assert sorted(os.listdir(os.path.join(target, "etc"))) == [
+            "big", "sub"]
+        with open(os.path.join(target, "etc", "sub", "small"), "rb") as file_:
+            assert file_.read() == b"small"
+
+    @mock.patch("snapshotter.pack._UTIME_NS", False)
+    def test_extract_without_nanosecond_times(self):
+        output, _ = self._pack(FIRST)
+        target = os.path.join(self.root, "restored")
+        utime = os.utime
+
+        def utime_without_keywords(path, times):
+            """os.utime() as it is in Python 2."""
+            return utime(path, times)
+
+        with mock.patch("os.utime", utime_without_keywords):
+            with pack.PackedSnapshot(output) as packed:
+                assert packed.extract(target) == 6
+
+        small = os.lstat(os.path.join(target, "etc", "sub", "small"))
+        assert small.st_mtime == 1425572592
+        assert os.readlink(os.path.join(target, "etc", "symlink")) == "big"
@@ -0,0 +1,123 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+
+import nose.tools
+
+from snapshotter import itemize
+from snapshotter import progress
+
+
+class TestParseSize(object):
+
+    """Unit tests for the parse_size() function."""
+
+    def test_parse_size(self):
+        assert progress.parse_size("1,234,567") == 1234567
+        assert progress.parse_size("35") == 35
+        assert progress.parse_size("1.23K") == 1230
+        assert progress.parse_size("10.50MB/s") == 10500000
+        assert progress.parse_size("2.00G bytes") == 2000000000
+
+    def test_invalid_size(self):
+        nose.tools.assert_raises(ValueError, progress.parse_size, "abc")
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMonitor(object):
+
+    """Unit tests for the Monitor consumer."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "progress.jsonl")
+        self.clock = FakeClock()
+        self.monitor = progress.Monitor(10, self.path, clock=self.clock)
+        self.monitor._last = (self.clock.now, 0, 0)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _feed(self, *lines):
+        for line in lines:
+            self.monitor(itemize.parse(line))
+
+    def test_report(self):
+        self._feed(">f+++++++++ a_file",
+                   "    100.00M  25%   10.00MB/s    0:00:10 "
+                   "(xfr#50, to-chk=600/1000)")
+        self.clock.now += 10
+
+        report = self.monitor.report()
+
+        assert report["bytes"] == 100000000
+        assert report["bytes_per_second"] == 10000000
+        assert report["files_checked"] == 400
+        assert report["files_per_second"] == 40
+        assert report["files_transferred"] == 50
+        assert report["files_total"] == 1000
+        assert report["eta_seconds"] == 30
+
+    def test_it_adds_up_the_progress_of_its_forks(self):
+        first, second = self.monitor.fork(), self.monitor.fork()
+        first(itemize.parse("    100.00M  25%   10.00MB/s    0:00:10 "
+                            "(xfr#50, to-chk=600/1000)"))
+        second(itemize.parse("    300.00M  75%   10.00MB/s    0:00:30 "
+                             "(xfr#10, to-chk=0/100)"))
+        second(itemize.parse("Number of files: 100"))
+        self._feed("Number of files: 10")
+        self.clock.now += 10
+
+        report = self.monitor.report()
+
+        assert report["bytes"] == 400000000
+        assert report["percent"] == 50
+        assert report["files_checked"] == 500
+        assert report["files_total"] == 1100
+        assert report["files_transferred"] == 60
+        self.monitor.stop()
+        with open(self.path) as file_:
+            records = [json.loads(line) for line in file_]
+        assert records[-1]["stats"] == {"Number of files": 110}
+
+    def test_stalled_transfer(self):
+        self._feed("    100.00M  25%   10.00MB/s    0:00:10 "
+                   "(xfr#50, to-chk=600/1000)")
+        self.clock.now += 10
+        self.monitor.report()
+        self.clock.now += 10
+
+        report = self.monitor.report()
+
+        assert report["bytes_per_second"] == 0
+        assert report["eta_seconds"] is None
+
+    def test_emit_and_stop_write_json_lines(self):
+        self._feed("Number of files: 1,000 (reg: 900, dir: 100)",
+                   "Total transferred file size: 1.23M bytes")
+        self.monitor.emit()
+        self.monitor.stop()
+
+        with open(self.path) as file_:
+            records = [json.loads(line) for line in file_]
+        assert len(records) == 2
+        assert records[0]["bytes"] == 0
+        assert records[1]["stats"] == {
+            "Number of files": 1000,
+            "Number of files (reg)": 900,
+            "Number of files (dir)": 100,
+            "Total transferred file size": 1230000,
+        }
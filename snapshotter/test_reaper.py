@@ -0,0 +1,84 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+from snapshotter import reaper
+
+
+def _make_tree(root):
+    for directory in ("a", "a/b", "a/b/c", "d"):
+        os.makedirs(os.path.join(root, directory))
+        for i in range(5):
+            with open(os.path.join(root, directory, str(i)), "w") as file_:
+                file_.write(directory)
+    os.symlink("a", os.path.join(root, "link_to_a"))
+
+
+class TestRemoveTree(object):
+
+    """Tests for the remove_tree() function."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_it_removes_the_tree(self):
+        tree = os.path.join(self.directory, "tree")
+        _make_tree(tree)
+
+        reaper.remove_tree(tree, threads=3)
+
+        assert os.listdir(self.directory) == []
+
+    def test_it_does_not_follow_symlinks(self):
+        target = os.path.join(self.directory, "target")
+        _make_tree(target)
+        tree = os.path.join(self.directory, "tree")
+        os.makedirs(tree)
+        os.symlink(target, os.path.join(tree, "link"))
+
+        reaper.remove_tree(tree)
+
+        assert os.listdir(self.directory) == ["target"]
+        assert os.path.isfile(os.path.join(target, "a", "b", "c", "4"))
+
+    def test_missing_path(self):
+        reaper.remove_tree(os.path.join(self.directory, "missing"))
+
+    def test_pace(self):
+        tree = os.path.join(self.directory, "tree")
+        _make_tree(tree)
+        calls = []
+
+        reaper.remove_tree(tree, threads=2, pace=lambda: calls.append(1))
+
+        assert len(calls) == 5
+        assert os.listdir(self.directory) == []
+
+
+class TestReaper(object):
+
+    """Tests for the Reaper class."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_reap_and_wait(self):
+        reaper_ = reaper.Reaper(threads=2)
+        for name in ("one", "two"):
+            _make_tree(os.path.join(self.directory, name))
+            reaper_.reap(os.path.join(self.directory, name))
+
+        reaper_.wait()
+
+        assert not reaper_.pending()
+        assert os.listdir(self.directory) == []
@@ -0,0 +1,55 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from snapshotter import reflinks
+
+
+class TestReflinks(object):
+
+    """Tests for cloning snapshots with reflinks."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_supports_reflink(self):
+        # Whatever the answer on this filesystem, the probe files are gone.
+        assert reflinks.supports_reflink(self.directory) in (True, False)
+        assert os.listdir(self.directory) == []
+
+    @mock.patch("snapshotter.reflinks.supports_reflink")
+    @mock.patch("snapshotter.reflinks.clone_file")
+    def test_reflink_seed(self, mock_clone_file_function,
+                          mock_supports_reflink_function):
+        mock_clone_file_function.side_effect = shutil.copy2
+        mock_supports_reflink_function.return_value = True
+        latest = os.path.join(self.directory, "2015-03-05T16_23_12.snapshot")
+        os.makedirs(os.path.join(latest, "dir"))
+        with open(os.path.join(latest, "dir", "file"), "w") as file_:
+            file_.write("file")
+        os.symlink("dir/file", os.path.join(latest, "link"))
+        os.symlink(os.path.basename(latest),
+                   os.path.join(self.directory, "latest.snapshot"))
+        os.mkdir(os.path.join(self.directory, "incomplete.snapshot"))
+        trash = os.path.join(self.directory, "trash")
+
+        seeded, stale = reflinks.reflink_seed(self.directory, trash)
+
+        incomplete = os.path.join(self.directory, "incomplete.snapshot")
+        assert seeded is True
+        assert os.path.dirname(stale) == trash and os.path.isdir(stale)
+        with open(os.path.join(incomplete, "dir", "file")) as file_:
+            assert file_.read() == "file"
+        assert os.readlink(os.path.join(incomplete, "link")) == "dir/file"
+
+        mock_supports_reflink_function.return_value = False
+        assert reflinks.reflink_seed(self.directory, trash) == [False, None]
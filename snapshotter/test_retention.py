@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import datetime
+
+import nose.tools
+
+from snapshotter import retention
+
+
+def _snapshots(start, count, step):
+    """Return count snapshot names, step apart, oldest-first."""
+    return [(start + step * i).strftime("%Y-%m-%dT%H_%M_%S") + ".snapshot"
+            for i in range(count)]
+
+
+class TestParsePolicy(object):
+
+    """Tests for the parse_policy() function."""
+
+    def test_it_parses_policies(self):
+        policy = retention.parse_policy("monthly=*,hourly=24, daily=30")
+
+        assert policy == [("hourly", 24), ("daily", 30),
+                          ("monthly", retention.INF)]
+
+    def test_invalid_policies(self):
+        for text in ("fortnightly=2", "daily", "daily=x", "daily=-1", ""):
+            nose.tools.assert_raises(ValueError, retention.parse_policy, text)
+
+
+class TestThin(object):
+
+    """Tests for the thin() function."""
+
+    def test_hourly_snapshots(self):
+        # Four snapshots an hour for two days.
+        snapshots = _snapshots(datetime.datetime(2015, 3, 5, 0, 10), 4 * 48,
+                               datetime.timedelta(minutes=15))
+
+        keep, remove = retention.thin(
+            snapshots, retention.parse_policy("hourly=24,daily=7"))
+
+        # The last snapshot of each of the last 24 hours, plus the last one
+        # of the first day.
+        assert len(keep) == 25
+        assert keep[0] == "2015-03-05T23_55_00.snapshot"
+        assert keep[-1] == snapshots[-1]
+        assert sorted(keep + remove) == snapshots
+
+    def test_weekly_monthly_and_yearly(self):
+        snapshots = _snapshots(datetime.datetime(2013, 1, 1, 12), 3 * 365,
+                               datetime.timedelta(days=1))
+
+        keep, _ = retention.thin(
+            snapshots, retention.parse_policy("weekly=4,monthly=*,yearly=3"))
+
+        # 36 months, three of whose last snapshots are in the last 4 weeks.
+        assert len(keep) == 4 + 36 - 1
+
+    def test_min_snapshots(self):
+        snapshots = _snapshots(datetime.datetime(2015, 3, 5), 10,
+                               datetime.timedelta(minutes=1))
+
+        keep, remove = retention.thin(
+            snapshots, retention.parse_policy("daily=1"), min_snapshots=3)
+
+        assert keep == snapshots[-3:]
+        assert remove == snapshots[:-3]
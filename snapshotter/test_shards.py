@@ -0,0 +1,80 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+from snapshotter import shards
+
+
+class TestScan(object):
+
+    """Tests for the scan() function."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, path, size):
+        path = os.path.join(self.directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as file_:
+            file_.write(b"x" * size)
+
+    def test_scan(self):
+        self._write("a/one", 100)
+        self._write("a/sub/two", 50)
+        self._write("b/three", 10)
+        self._write("top_level_file", 1000)
+        os.symlink("a", os.path.join(self.directory, "link_to_a"))
+
+        subtrees = sorted(shards.scan(self.directory))
+
+        assert [s.name for s in subtrees] == ["a", "b"]
+        assert subtrees[0].count == 3
+        assert subtrees[0].bytes >= 150
+        assert subtrees[1].count == 1
+
+    def test_scan_with_a_limit(self):
+        for i in range(4):
+            for j in range(4):
+                self._write("a/sub%d/file%d" % (i, j), 100)
+
+        subtree, = shards.scan(self.directory, limit=None)
+        estimate, = shards.scan(self.directory, limit=8)
+
+        assert subtree.count == 20
+        # Only a/ and one subdirectory were read, the other three are
+        # taken to hold as much as the average of those two directories.
+        assert estimate.count == 8 + 8 * 3 // 2
+
+
+class TestPlan(object):
+
+    """Unit tests for the plan() function."""
+
+    def test_it_balances_shards(self):
+        subtrees = [
+            shards.Subtree("big", 100 * shards.PER_FILE_COST, 0),
+            shards.Subtree("medium", 60 * shards.PER_FILE_COST, 0),
+            shards.Subtree("small", 0, 30),
+            shards.Subtree("tiny", 0, 20),
+        ]
+
+        plan = shards.plan(subtrees, 2)
+
+        assert sorted(sorted(shard) for shard in plan) == [
+            ["big"], ["medium", "small", "tiny"]]
+
+    def test_more_jobs_than_subtrees(self):
+        plan = shards.plan([shards.Subtree("only", 1, 1)], 8)
+
+        assert plan == [["only"]]
+
+    def test_no_subtrees(self):
+        assert shards.plan([], 4) == []
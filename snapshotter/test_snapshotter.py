@@ -2,7 +2,10 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 from __future__ import print_function
 
+import errno
+import json
 import os
+import pstats
 import tempfile
 import sys
 import shutil
@@ -11,6 +14,7 @@ import mock
 import nose.tools
 
 from snapshotter import snapshotter
+from snapshotter.snapshotter import text
 
 
 def _this_directory():
@@ -37,9 +41,15 @@ class TestLsSnapshots(object):
         self.mock_os_module.path.join.side_effect = os.path.join
         self.mock_os_module.path.abspath.side_effect = os.path.abspath
 
+        # Test the fallback of running commands over ssh, not the agent.
+        self.agent_patcher = mock.patch('snapshotter.snapshotter._agent')
+        self.mock_agent_function = self.agent_patcher.start()
+        self.mock_agent_function.return_value = None
+
     def teardown(self):
         self.run_patcher.stop()
         self.os_patcher.stop()
+        self.agent_patcher.stop()
 
     def test_it_calls_run_correctly_when_dest_is_remote(self):
         snapshotter._ls_snapshots("seanh@192.168.1.92:notes.backup")
@@ -74,6 +84,22 @@ class TestLsSnapshots(object):
         for snapshot in snapshots:
             assert "some other directory" not in snapshot
 
+    def test_it_lists_remote_dests_with_the_agent(self):
+        self.mock_agent_function.return_value = mock.Mock()
+        self.mock_agent_function.return_value.call.return_value = [
+            ["2016-03-20T13_19_25.snapshot", True],
+            ["2016-03-20T13_20_11.snapshot", False],
+            ["latest.snapshot", True],
+        ]
+
+        snapshots = snapshotter._ls_snapshots(
+            "seanh@192.168.1.92:notes.backup")
+
+        self.mock_agent_function.return_value.call.assert_called_once_with(
+            "list", path="notes.backup")
+        assert not self.mock_run_function.called
+        assert snapshots == ["notes.backup/2016-03-20T13_19_25.snapshot"]
+
     def test_it_calls_os_listdir_correctly(self):
         snapshots = snapshotter._ls_snapshots("/home/seanh/Music")
 
@@ -162,6 +188,46 @@ class TestRun(object):
 
         assert not mock_check_output_function.called
 
+    def test_streaming_passes_lines_to_consumers(self):
+        lines = []
+
+        output = snapshotter._run(
+            ["printf", "one\ntwo\rthree"], consumers=[lines.append])
+
+        assert output is None
+        assert lines == ["one", "two", "three"]
+
+    def test_streaming_keeps_only_a_tail_of_the_output(self):
+        command = ["sh", "-c", "seq 1 1000; exit 3"]
+        try:
+            snapshotter._run(command, consumers=[])
+            assert False, "We shouldn't get here"
+        except snapshotter.CalledProcessError as err:
+            assert err.exit_value == 3
+            lines = err.output.split("\n")
+            assert len(lines) == snapshotter.TAIL_LINES
+            assert lines[0] == text(1000 - snapshotter.TAIL_LINES + 1)
+
+    def test_streaming_registers_the_process_with_the_throttle(self):
+        throttle_ = mock.Mock()
+        lines = []
+
+        snapshotter._run(
+            [sys.executable, "-c",
+             "import os; print(os.getpid() == os.getpgrp())"],
+            consumers=[lines.append], throttle_=throttle_)
+
+        pid = throttle_.add.call_args[0][0]
+        assert pid > 0
+        throttle_.remove.assert_called_once_with(pid)
+        # It leads a process group of its own, for the throttle to pause.
+        assert lines == ["True"]
+
+    def test_streaming_command_does_not_exist(self):
+        nose.tools.assert_raises(
+            snapshotter.NoSuchCommandError, snapshotter._run, ["bar"],
+            consumers=[])
+
 
 class TestRsync(object):
 
@@ -188,6 +254,37 @@ class TestRsync(object):
             snapshotter.NoSpaceLeftOnDeviceError,
             snapshotter._rsync, "source", "dest")
 
+    @mock.patch("snapshotter.snapshotter._run")
+    def test_rsync_detects_no_space_in_streamed_output(
+            self, mock_run_function):
+        """The no space error should be found even if it's not in the tail."""
+        def run(command, consumers, throttle_=None):
+            for consumer in consumers:
+                consumer('rsync: write failed on "/media/foo/bar": No space '
+                         'left on device (28)')
+                consumer('some other output')
+            raise snapshotter.CalledProcessError(
+                command="rsync ...", output="some other output",
+                exit_value=11)
+        mock_run_function.side_effect = run
+
+        nose.tools.assert_raises(
+            snapshotter.NoSpaceLeftOnDeviceError,
+            snapshotter._rsync, "source", "dest")
+
+    @mock.patch("snapshotter.snapshotter._run")
+    def test_rsync_passes_parsed_lines_to_consumers(self, mock_run_function):
+        def run(command, consumers, throttle_=None):
+            for consumer in consumers:
+                consumer(">f+++++++++ new_file.txt")
+        mock_run_function.side_effect = run
+        lines = []
+
+        snapshotter._rsync("source", "dest", consumers=[lines.append])
+
+        assert lines == [snapshotter.itemize.Line(
+            ">f+++++++++ new_file.txt", ">f+++++++++", "new_file.txt")]
+
     @mock.patch("snapshotter.snapshotter._run")
     def test_rsync_raises_CalledProcessError(self, mock_run_function):
         """CalledProcessError should be raised for other rsync errors.
@@ -225,6 +322,1150 @@ class TestRsync(object):
             snapshotter._rsync, "source", "dest")
 
 
+class TestIncrementalRsync(object):
+
+    """Tests for the --journal functions."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, "source")
+        self.dest = os.path.join(self.directory, "dest")
+        latest = os.path.join(self.dest, "2015-02-23T18_00_00.snapshot")
+        for root in (self.source, latest):
+            os.makedirs(os.path.join(root, "dir"))
+            for name in ("unchanged", "changed"):
+                with open(os.path.join(root, "dir", name), "w") as file_:
+                    file_.write(name)
+        os.makedirs(os.path.join(latest, "deleted"))
+        os.symlink(os.path.basename(latest),
+                   os.path.join(self.dest, "latest.snapshot"))
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    @mock.patch("snapshotter.snapshotter._run")
+    def test_rsync_files_from(self, mock_run_function):
+        snapshotter._rsync("source", "dest", files_from="/tmp/files")
+
+        args = _get_args(mock_run_function.call_args)
+        assert "--files-from=/tmp/files" in args
+        assert "--from0" in args
+        assert not [arg for arg in args if arg.startswith("--delete")]
+
+    @mock.patch("snapshotter.snapshotter._rsync")
+    def test_incremental_rsync(self, mock_rsync_function):
+        files = []
+        mock_rsync_function.side_effect = lambda *args, **kwargs: (
+            files.append(open(kwargs["files_from"], "rb").read()))
+        lines = []
+
+        snapshotter._incremental_rsync(
+            self.source, self.dest, set(["dir", "dir/changed", "deleted"]),
+            consumers=[lines.append])
+
+        incomplete = os.path.join(self.dest, "incomplete.snapshot")
+        assert os.path.samefile(
+            os.path.join(incomplete, "dir", "unchanged"),
+            os.path.join(self.dest, "latest.snapshot", "dir", "unchanged"))
+        assert not os.path.exists(os.path.join(incomplete, "dir", "changed"))
+        assert not os.path.exists(os.path.join(incomplete, "deleted"))
+        assert [line.path for line in lines] == ["deleted"]
+        assert files == [b"dir\0dir/changed\0"]
+
+    def test_journal_changes(self):
+        journal_ = snapshotter.journal.Journal(
+            os.path.join(self.directory, "journal"))
+        alive = journal_.start()
+        try:
+            journal_.commit(journal_.rotate(), "2015-02-23T18_00_00.snapshot")
+            journal_.record(["dir/changed"])
+
+            assert snapshotter._journal_changes(
+                journal_, journal_.rotate(), self.source, self.dest) == set(
+                    ["dir/changed"])
+            assert snapshotter._journal_changes(
+                journal_, [], self.source, "host:" + self.dest) is None
+
+            journal_.commit([], "2015-02-23T17_00_00.snapshot")
+            assert snapshotter._journal_changes(
+                journal_, [], self.source, self.dest) is None
+        finally:
+            alive.close()
+
+
+class TestLinkDestCandidates(object):
+
+    """Unit tests for the _link_dest_candidates() function."""
+
+    def setup(self):
+        # One snapshot a day for 56 days.
+        self.snapshots = [
+            "/dest/2015-%02d-%02dT12_00_00.snapshot" % (month, day)
+            for month in (1, 2) for day in range(1, 29)]
+
+    def test_only_latest(self):
+        assert snapshotter._link_dest_candidates(self.snapshots) == []
+        assert snapshotter._link_dest_candidates([]) == []
+
+    def test_most_recent(self):
+        assert snapshotter._link_dest_candidates(self.snapshots, 3) == [
+            "2015-02-27T12_00_00.snapshot", "2015-02-26T12_00_00.snapshot"]
+
+    def test_history(self):
+        candidates = snapshotter._link_dest_candidates(
+            self.snapshots, 2, snapshotter.retention.parse_policy(
+                "daily=3,monthly=2"))
+
+        assert candidates == [
+            "2015-02-27T12_00_00.snapshot", "2015-02-26T12_00_00.snapshot",
+            "2015-01-28T12_00_00.snapshot"]
+
+    def test_at_most_20(self):
+        candidates = snapshotter._link_dest_candidates(self.snapshots, 50)
+
+        assert len(candidates) == snapshotter.MAX_LINK_DESTS - 1
+
+    @mock.patch("snapshotter.snapshotter._list_snapshots")
+    @mock.patch("snapshotter.snapshotter._agent")
+    def test_packed_remote_snapshots_arent_chosen(
+            self, mock_agent_function, mock_list_snapshots_function):
+        mock_list_snapshots_function.return_value = self.snapshots
+
+        def call(op, path):
+            if "2015-02-26" not in path:
+                raise snapshotter.agent.RemoteError(
+                    op, "No such file or directory", errno.ENOENT)
+            return {}
+        mock_agent_function.return_value.call.side_effect = call
+
+        assert snapshotter._choose_link_dests("fred@host:/dest", 4) == [
+            "2015-02-27T12_00_00.snapshot", "2015-02-25T12_00_00.snapshot"]
+        mock_agent_function.return_value.call.assert_any_call(
+            "stat", path="/dest/2015-02-26T12_00_00.snapshot/" +
+            snapshotter.pack.INDEX_FILENAME)
+
+
+class TestParallelRsync(object):
+
+    """Unit tests for the _parallel_rsync() function."""
+
+    def setup(self):
+        self.rsync_patcher = mock.patch('snapshotter.snapshotter._rsync')
+        self.mock_rsync_function = self.rsync_patcher.start()
+
+        self.scan_patcher = mock.patch('snapshotter.snapshotter._scan_source')
+        self.mock_scan_function = self.scan_patcher.start()
+        self.mock_scan_function.return_value = [
+            snapshotter.shards.Subtree("Documents", 100, 10),
+            snapshotter.shards.Subtree("Music", 1000, 10),
+            snapshotter.shards.Subtree("Photos", 800, 10),
+        ]
+
+        self.mkdir_patcher = mock.patch('snapshotter.snapshotter._mkdir')
+        self.mock_mkdir_function = self.mkdir_patcher.start()
+
+    def teardown(self):
+        self.rsync_patcher.stop()
+        self.scan_patcher.stop()
+        self.mkdir_patcher.stop()
+
+    def test_it_runs_one_rsync_per_subdir_then_a_root_pass(self):
+        snapshotter._parallel_rsync("/home/fred", "/media/backup", 2)
+
+        self.mock_mkdir_function.assert_called_once_with(
+            "/media/backup/incomplete.snapshot", None, None, debug=False)
+        calls = self.mock_rsync_function.call_args_list
+        assert sorted(c[1]["subdir"] for c in calls[:-1]) == [
+            "Documents", "Music", "Photos"]
+        root_args = calls[-1][0][3]
+        assert "subdir" not in calls[-1][1]
+        for subdir in ("Documents", "Music", "Photos"):
+            assert "--exclude=/%s/" % subdir in root_args
+            assert "--filter=P /%s/" % subdir in root_args
+
+    def test_it_escapes_wildcards_in_subdir_names(self):
+        self.mock_scan_function.return_value = [
+            snapshotter.shards.Subtree(name, 100, 10)
+            for name in ("*", "a?b[1]", "back\\slash", "c:\\temp?")]
+
+        snapshotter._parallel_rsync("/home/fred", "/media/backup", 2)
+
+        root_args = self.mock_rsync_function.call_args_list[-1][0][3]
+        assert sorted(arg for arg in root_args
+                      if arg.startswith("--exclude")) == [
+            "--exclude=/\\*/", "--exclude=/a\\?b\\[1]/",
+            "--exclude=/back\\slash/", "--exclude=/c:\\\\temp\\?/"]
+        assert "--filter=P /a\\?b\\[1]/" in root_args
+
+    def test_it_prefixes_consumed_paths_with_the_subdir(self):
+        lines = []
+
+        def rsync(*args, **kwargs):
+            for consumer in kwargs["consumers"]:
+                consumer(snapshotter.itemize.parse(">f+++++++++ file"))
+        self.mock_rsync_function.side_effect = rsync
+
+        snapshotter._parallel_rsync("/home/fred", "/media/backup", 2,
+                                    consumers=[lines.append])
+
+        assert sorted(line.path for line in lines) == [
+            "Documents/file", "Music/file", "Photos/file", "file"]
+
+    def test_each_rsync_gets_its_own_fork_of_stateful_consumers(self):
+        subdir_consumers = []
+
+        def rsync(*args, **kwargs):
+            if kwargs.get("subdir"):
+                subdir_consumers.extend(kwargs["consumers"])
+        self.mock_rsync_function.side_effect = rsync
+        recorder = snapshotter.catalog.Recorder()
+
+        snapshotter._parallel_rsync("/home/fred", "/media/backup", 2,
+                                    consumers=[recorder])
+        # The stats of concurrent rsyncs arrive interleaved.
+        for text in ("Number of files: 10",
+                     "Total transferred file size: 100 bytes"):
+            for consumer in subdir_consumers:
+                consumer(snapshotter.itemize.parse(text))
+
+        assert recorder.files == 30
+        assert recorder.bytes == 300
+
+    def test_no_space_left_on_device_in_one_shard(self):
+        def rsync(*args, **kwargs):
+            if kwargs.get("subdir") == "Music":
+                raise snapshotter.NoSpaceLeftOnDeviceError()
+            if kwargs.get("subdir") == "Photos":
+                raise snapshotter.CalledProcessError("rsync", "error", 23)
+        self.mock_rsync_function.side_effect = rsync
+
+        nose.tools.assert_raises(
+            snapshotter.NoSpaceLeftOnDeviceError,
+            snapshotter._parallel_rsync, "/home/fred", "/media/backup", 3)
+
+    def test_other_error_in_one_shard(self):
+        def rsync(*args, **kwargs):
+            if kwargs.get("subdir") == "Photos":
+                raise snapshotter.CalledProcessError("rsync", "error", 23)
+        self.mock_rsync_function.side_effect = rsync
+
+        nose.tools.assert_raises(
+            snapshotter.CalledProcessError,
+            snapshotter._parallel_rsync, "/home/fred", "/media/backup", 3)
+
+    def test_without_subdirs(self):
+        self.mock_scan_function.return_value = []
+
+        snapshotter._parallel_rsync("/home/fred", "/media/backup", 4)
+
+        assert self.mock_rsync_function.call_count == 1
+        assert not self.mock_mkdir_function.called
+
+    @mock.patch("snapshotter.snapshotter._run")
+    def test_subdir_rsync_command(self, mock_run_function):
+        self.rsync_patcher.stop()
+        try:
+            snapshotter._rsync("/home/fred", "/media/backup", subdir="Music")
+        finally:
+            self.rsync_patcher.start()
+
+        args = _get_args(mock_run_function.call_args)
+        assert args[-2] == "/home/fred/Music/"
+        assert args[-1] == "/media/backup/incomplete.snapshot/Music"
+        assert "--link-dest=../../latest.snapshot/Music" in args
+
+
+class TestPlanSpace(object):
+
+    """Tests for planning free space before running rsync."""
+
+    def setup(self):
+        def rsync(source, dest, debug, extra_args, consumers):
+            assert debug is True
+            assert extra_args[-2:] == ["--stats", "--no-human-readable"]
+            for text_ in ("Number of files: 1,100 (reg: 1,000, dir: 100)",
+                          "Number of regular files transferred: 900",
+                          "Total transferred file size: 1,004,321,000 bytes"):
+                for consumer in consumers:
+                    consumer(snapshotter.itemize.parse(text_))
+        self.rsync_patcher = mock.patch('snapshotter.snapshotter._rsync')
+        self.mock_rsync_function = self.rsync_patcher.start()
+        self.mock_rsync_function.side_effect = rsync
+
+        self.free_space_patcher = mock.patch(
+            'snapshotter.snapshotter._free_space')
+        self.mock_free_space_function = self.free_space_patcher.start()
+
+        self.remove_oldest_snapshot_patcher = mock.patch(
+            'snapshotter.snapshotter._remove_oldest_snapshot')
+        self.mock_remove_oldest_snapshot_function = (
+            self.remove_oldest_snapshot_patcher.start())
+
+    def teardown(self):
+        self.rsync_patcher.stop()
+        self.free_space_patcher.stop()
+        self.remove_oldest_snapshot_patcher.stop()
+
+    def test_estimate_space(self):
+        bytes_, inodes = snapshotter._estimate_space("source", "dest",
+                                                     ["--human-readable"])
+
+        assert bytes_ > 1004321000
+        assert inodes >= 1000
+
+    def test_it_removes_snapshots_until_there_is_enough_space(self):
+        self.mock_free_space_function.side_effect = [
+            (500000000, 100000), (900000000, 100000), (2000000000, 100000)]
+
+        snapshotter._plan_space("source", "dest", min_snapshots=5)
+
+        assert self.mock_remove_oldest_snapshot_function.call_args_list == [
+            mock.call("dest", None, None, min_snapshots=5, debug=False)] * 2
+
+    def test_it_removes_snapshots_until_there_are_enough_inodes(self):
+        self.mock_free_space_function.side_effect = [
+            (2000000000, 10), (2000000000, snapshotter.INF)]
+
+        snapshotter._plan_space("source", "dest")
+
+        assert self.mock_remove_oldest_snapshot_function.call_count == 1
+
+    def test_it_does_nothing_if_there_is_enough_space(self):
+        self.mock_free_space_function.return_value = (2000000000, 100000)
+
+        snapshotter._plan_space("source", "dest")
+
+        assert not self.mock_remove_oldest_snapshot_function.called
+
+    def test_it_stops_when_there_are_no_more_snapshots_to_remove(self):
+        self.mock_free_space_function.return_value = (0, 0)
+        self.mock_remove_oldest_snapshot_function.side_effect = (
+            snapshotter.NoMoreSnapshotsToRemoveError)
+
+        snapshotter._plan_space("source", "dest")
+
+    def test_it_does_nothing_if_free_space_is_unknown(self):
+        self.mock_free_space_function.return_value = None
+
+        snapshotter._plan_space("source", "dest")
+
+        assert not self.mock_remove_oldest_snapshot_function.called
+
+    def test_free_space_of_local_dest(self):
+        self.free_space_patcher.stop()
+        dest = tempfile.mkdtemp()
+        try:
+            bytes_, inodes = snapshotter._free_space(dest)
+            assert bytes_ > 0
+            assert inodes > 0
+            assert snapshotter._free_space(
+                os.path.join(dest, "missing")) is None
+        finally:
+            shutil.rmtree(dest)
+            self.free_space_patcher.start()
+
+
+class TestCatalog(object):
+
+    """Tests for keeping the list of snapshots in the catalog."""
+
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        for name in ("2015-03-05T16_24_15.snapshot",
+                     "2015-03-05T16_23_12.snapshot"):
+            os.mkdir(os.path.join(self.dest, name))
+
+    def teardown(self):
+        snapshotter._reaper.wait()
+        shutil.rmtree(self.dest)
+
+    def _catalog(self):
+        return snapshotter.catalog.Catalog(
+            snapshotter.catalog.path_for(self.dest))
+
+    def test_it_creates_the_catalog_from_the_listing(self):
+        snapshots = snapshotter._list_snapshots(self.dest)
+
+        assert snapshots == [
+            os.path.join(self.dest, "2015-03-05T16_23_12.snapshot"),
+            os.path.join(self.dest, "2015-03-05T16_24_15.snapshot")]
+        assert self._catalog().snapshots() == [
+            "2015-03-05T16_23_12.snapshot", "2015-03-05T16_24_15.snapshot"]
+
+    def test_it_does_not_create_the_catalog_in_dry_run_mode(self):
+        snapshotter._list_snapshots(self.dest, debug=True)
+
+        assert self._catalog().snapshots() is None
+
+    @mock.patch("snapshotter.snapshotter._ls_snapshots")
+    def test_it_uses_the_catalog(self, mock_ls_snapshots_function):
+        self._catalog().reindex(["2015-03-05T16_23_12.snapshot"])
+
+        snapshots = snapshotter._list_snapshots(self.dest)
+
+        assert snapshots == [
+            os.path.join(self.dest, "2015-03-05T16_23_12.snapshot")]
+        assert not mock_ls_snapshots_function.called
+
+    @mock.patch("snapshotter.snapshotter._run")
+    def test_moving_and_discarding_snapshots_updates_the_catalog(
+            self, mock_run_function):
+        snapshotter.reindex(self.dest)
+        recorder = snapshotter.catalog.Recorder()
+        recorder(snapshotter.itemize.parse("Number of files: 10"))
+
+        snapshotter._move_incomplete_dir(
+            self.dest, "2015-03-05T16_25_09", recorder=recorder, duration=2)
+        snapshotter._discard_snapshot(
+            os.path.join(self.dest, "2015-03-05T16_23_12.snapshot"))
+
+        assert self._catalog().snapshots() == [
+            "2015-03-05T16_24_15.snapshot", "2015-03-05T16_25_09.snapshot"]
+        entry = self._catalog().entries()[-1]
+        assert (entry.duration, entry.files) == (2, 10)
+
+    def test_reindex(self):
+        self._catalog().reindex(["2015-03-05T16_20_00.snapshot"])
+
+        assert snapshotter.reindex(self.dest) == 2
+
+        assert self._catalog().snapshots() == [
+            "2015-03-05T16_23_12.snapshot", "2015-03-05T16_24_15.snapshot"]
+
+    def test_reindex_without_a_catalog(self):
+        nose.tools.assert_raises(
+            snapshotter.catalog.CatalogError, snapshotter.reindex,
+            os.path.join(self.dest, "missing"))
+
+
+class TestVerify(object):
+
+    """Tests for the verify() function."""
+
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        for name in ("2015-03-05T16_23_12.snapshot",
+                     "2015-03-05T16_24_15.snapshot"):
+            os.mkdir(os.path.join(self.dest, name))
+            with open(os.path.join(self.dest, name, "file"), "wb") as file_:
+                file_.write(name.encode("ascii"))
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def test_verify(self):
+        result = snapshotter.verify(self.dest)
+
+        assert (result["files"], result["problems"]) == (2, [])
+        assert os.path.isfile(os.path.join(
+            self.dest, snapshotter.integrity.LEDGER_FILENAME))
+
+    @mock.patch("snapshotter.snapshotter._list_snapshots")
+    @mock.patch("snapshotter.snapshotter._agent")
+    def test_remote_dest(self, mock_agent_function,
+                         mock_list_snapshots_function):
+        mock_list_snapshots_function.return_value = [
+            "/dest/2015-03-05T16_23_12.snapshot"]
+        remote = mock_agent_function.return_value
+        remote.call.return_value = {
+            "files": 1, "bytes": 10, "new": 0, "remaining": 0,
+            "finished": True,
+            "problems": [["2015-03-05T16_23_12.snapshot", "file", "corrupt"]]}
+
+        result = snapshotter.verify("fred@host:/dest", max_bytes=100)
+
+        assert result["problems"][0][2] == "corrupt"
+        remote.call.assert_called_once_with(
+            "verify", snapshots_root="/dest",
+            names=["2015-03-05T16_23_12.snapshot"], max_seconds=None,
+            max_bytes=100, threads=4)
+
+    @mock.patch("snapshotter.snapshotter._list_snapshots")
+    @mock.patch("snapshotter.snapshotter._agent")
+    def test_remote_dest_without_the_agent(self, mock_agent_function,
+                                           mock_list_snapshots_function):
+        mock_agent_function.return_value = None
+        mock_list_snapshots_function.return_value = []
+
+        nose.tools.assert_raises(snapshotter.CalledProcessError,
+                                 snapshotter.verify, "host:/dest")
+
+
+class TestDeduplicate(object):
+
+    """Tests for the deduplicate() function."""
+
+    @mock.patch("snapshotter.snapshotter.dedup.dedup")
+    def test_deduplicate(self, mock_dedup_function):
+        mock_dedup_function.return_value = snapshotter.dedup.Result(
+            1, 10, 2, 2, 8192)
+
+        assert snapshotter.deduplicate("/backups", debug=True) == (
+            mock_dedup_function.return_value)
+        mock_dedup_function.assert_called_once_with(
+            "/backups", threads=8, min_size=snapshotter.dedup.MIN_SIZE,
+            dry_run=True)
+
+    def test_remote_root(self):
+        nose.tools.assert_raises(snapshotter.InconsistentArgumentsError,
+                                 snapshotter.deduplicate, "host:/backups")
+
+
+class TestPackSnapshots(object):
+
+    """Tests for the pack_snapshots() and unpack() functions."""
+
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        for day in range(1, 4):
+            directory = os.path.join(
+                self.dest, "2015-02-0%dT12_00_00.snapshot" % day, "etc")
+            os.makedirs(directory)
+            with open(os.path.join(directory, "file"), "w") as file_:
+                file_.write("day %d" % day)
+        os.makedirs(os.path.join(self.dest, "2099-01-01T12_00_00.snapshot"))
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def _snapshot(self, day):
+        return os.path.join(self.dest, "2015-02-0%dT12_00_00.snapshot" % day)
+
+    @mock.patch("snapshotter.snapshotter._reap")
+    def test_pack_snapshots(self, mock_reap_function):
+        packed = snapshotter.pack_snapshots(self.dest, 86400)
+
+        assert packed == [self._snapshot(day) for day in range(1, 4)]
+        assert all(snapshotter.pack.is_packed(path) for path in packed)
+        assert [os.path.basename(path) for path in snapshotter._ls_snapshots(
+            self.dest)][:3] == [os.path.basename(path) for path in packed]
+        assert sorted(os.listdir(os.path.join(self.dest, "trash"))) == [
+            os.path.basename(path) for path in packed]
+        assert mock_reap_function.call_count == 3
+        assert not os.path.exists(os.path.join(self.dest, "incomplete.pack"))
+
+        # Packed snapshots are skipped and the newest isn't packed.
+        assert snapshotter.pack_snapshots(self.dest, 0) == []
+
+        target = os.path.join(self.dest, "restored")
+        assert snapshotter.unpack(self._snapshot(2), target,
+                                  ["etc/file"]) == 1
+        with open(os.path.join(target, "etc", "file")) as file_:
+            assert file_.read() == "day 2"
+
+    @mock.patch("snapshotter.snapshotter._reap")
+    def test_it_forgets_the_du_cache_of_packed_snapshots(
+            self, mock_reap_function):
+        names = [os.path.basename(self._snapshot(day)) for day in (1, 2, 3)]
+        snapshotter.diskusage.reclaimable(self.dest, names)
+
+        snapshotter.pack_snapshots(self.dest, 86400)
+
+        assert os.listdir(os.path.join(self.dest, "du-cache")) == []
+        # The packed snapshots' segments are counted again.
+        reclaimable = snapshotter.diskusage.reclaimable(self.dest, names)
+        assert reclaimable[names[0]] > 0
+
+    @mock.patch("snapshotter.snapshotter._reap")
+    def test_only_old_snapshots_are_packed(self, mock_reap_function):
+        os.rename(self._snapshot(3), os.path.join(
+            self.dest, "2099-01-01T00_00_00.snapshot"))
+
+        assert snapshotter.pack_snapshots(self.dest, 86400) == [
+            self._snapshot(1), self._snapshot(2)]
+
+    def test_dry_run(self):
+        assert snapshotter.pack_snapshots(self.dest, 86400, debug=True) == [
+            self._snapshot(day) for day in range(1, 4)]
+        assert not any(snapshotter.pack.is_packed(self._snapshot(day))
+                       for day in range(1, 4))
+
+    def test_remote_dest(self):
+        nose.tools.assert_raises(snapshotter.InconsistentArgumentsError,
+                                 snapshotter.pack_snapshots, "host:/backups",
+                                 86400)
+
+    def test_unpack_an_unpacked_snapshot(self):
+        nose.tools.assert_raises(snapshotter.InconsistentArgumentsError,
+                                 snapshotter.unpack, self._snapshot(1),
+                                 os.path.join(self.dest, "restored"))
+
+
+class TestRestore(object):
+
+    """Tests for the restore() function."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.directory,
+                                     "2015-02-01T12_00_00.snapshot")
+        self.target = os.path.join(self.directory, "target")
+        os.makedirs(os.path.join(self.snapshot, "etc"))
+        for name in ("fstab", "hosts"):
+            with open(os.path.join(self.snapshot, "etc", name), "w") as file_:
+                file_.write(name)
+        os.link(os.path.join(self.snapshot, "etc", "hosts"),
+                os.path.join(self.snapshot, "hosts"))
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_restore(self):
+        os.makedirs(os.path.join(self.target, "etc"))
+        with open(os.path.join(self.target, "etc", "extra"), "w") as file_:
+            file_.write("extra")
+
+        counter = snapshotter.restore(self.snapshot, self.target, jobs=2)
+
+        assert counter.counts[snapshotter.itemize.CREATED] == 2
+        assert counter.counts[snapshotter.itemize.HARDLINKED] == 1
+        assert os.path.samefile(os.path.join(self.target, "hosts"),
+                                os.path.join(self.target, "etc", "hosts"))
+        assert os.path.exists(os.path.join(self.target, "etc", "extra"))
+
+        # Only what differs is copied again.
+        with open(os.path.join(self.target, "etc", "fstab"), "w") as file_:
+            file_.write("changed")
+
+        counter = snapshotter.restore(self.snapshot, self.target, delete=True)
+
+        assert counter.counts[snapshotter.itemize.UPDATED] == 1
+        assert counter.counts[snapshotter.itemize.CREATED] == 0
+        assert counter.counts[snapshotter.itemize.DELETED] == 1
+        with open(os.path.join(self.target, "etc", "fstab")) as file_:
+            assert file_.read() == "fstab"
+
+    @mock.patch("snapshotter.snapshotter._run")
+    def test_remote_snapshot(self, mock_run_function):
+        snapshotter.restore("fred@host:/backups/a.snapshot", self.target,
+                            checksum=True, delete=True)
+
+        args = mock_run_function.call_args[0][0]
+        assert args[0] == "rsync"
+        assert "--hard-links" in args
+        assert "--sparse" in args
+        assert "--checksum" in args
+        assert "--delete" in args
+        assert args[-2:] == ["fred@host:/backups/a.snapshot/", self.target]
+
+    @mock.patch("snapshotter.snapshotter._run")
+    def test_remote_target(self, mock_run_function):
+        snapshotter.restore(self.snapshot, "host:/srv")
+
+        args = mock_run_function.call_args[0][0]
+        assert "--checksum" not in args
+        assert "--delete" not in args
+        assert args[-2:] == [self.snapshot + os.sep, "host:/srv"]
+
+    def test_both_remote(self):
+        nose.tools.assert_raises(snapshotter.InconsistentArgumentsError,
+                                 snapshotter.restore, "host:/backups/a",
+                                 "other:/srv")
+
+    @mock.patch("snapshotter.snapshotter.unpack")
+    @mock.patch("snapshotter.snapshotter.pack.is_packed")
+    def test_packed_snapshot(self, mock_is_packed_function,
+                             mock_unpack_function):
+        mock_is_packed_function.return_value = True
+        mock_unpack_function.return_value = 4
+
+        counter = snapshotter.restore(self.snapshot, self.target)
+
+        mock_unpack_function.assert_called_once_with(self.snapshot,
+                                                     self.target)
+        assert counter.counts[snapshotter.itemize.UPDATED] == 4
+        nose.tools.assert_raises(snapshotter.InconsistentArgumentsError,
+                                 snapshotter.restore, self.snapshot,
+                                 "host:/srv")
+        for option in ("checksum", "delete"):
+            nose.tools.assert_raises(
+                snapshotter.InconsistentArgumentsError, snapshotter.restore,
+                self.snapshot, self.target, **{option: True})
+
+
+class TestDiff(object):
+
+    """Tests for the diff() function."""
+
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.names = ["2015-03-05T16_23_12.snapshot",
+                      "2015-03-05T16_24_15.snapshot",
+                      "2015-03-06T09_00_00.snapshot"]
+        for name in self.names:
+            os.mkdir(os.path.join(self.dest, name))
+        with open(os.path.join(self.dest, self.names[0], "file"), "w") as f:
+            f.write("file")
+        for name in self.names[1:]:
+            os.link(os.path.join(self.dest, self.names[0], "file"),
+                    os.path.join(self.dest, name, "file"))
+        open(os.path.join(self.dest, self.names[2], "new"), "w").close()
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def test_find_snapshot(self):
+        assert snapshotter._find_snapshot(self.names, "latest") == (
+            self.names[2])
+        assert snapshotter._find_snapshot(
+            self.names, "2015-03-05T16:24:15") == self.names[1]
+        assert snapshotter._find_snapshot(self.names, self.names[0]) == (
+            self.names[0])
+        assert snapshotter._find_snapshot(self.names, "2015-03-06") == (
+            self.names[2])
+        nose.tools.assert_raises(snapshotter.InconsistentArgumentsError,
+                                 snapshotter._find_snapshot, self.names,
+                                 "2015-03-05")
+        nose.tools.assert_raises(snapshotter.InconsistentArgumentsError,
+                                 snapshotter._find_snapshot, [], "latest")
+
+    @mock.patch("sys.stdout")
+    def test_diff(self, mock_stdout):
+        result = snapshotter.diff(
+            os.path.join(self.dest, "2015-03-05T16:23:12"), "latest")
+
+        assert result["changes"] == [["added", "new"]]
+        assert result["shared"] == 1
+        assert result["new"] == os.path.join(self.dest, self.names[2])
+        # Only main() prints the changes.
+        assert not mock_stdout.write.called
+
+    @mock.patch("sys.stdout")
+    def test_main_prints_the_changes(self, mock_stdout):
+        with mock.patch("sys.argv", [
+                "snapshotter", "diff",
+                os.path.join(self.dest, "2015-03-05T16:23:12"), "latest"]):
+            snapshotter.main()
+
+        printed = "".join(call[0][0] for call in
+                          mock_stdout.write.call_args_list)
+        assert printed == "added\tnew\n"
+
+    @mock.patch("sys.stdout")
+    def test_json(self, mock_stdout):
+        with mock.patch("sys.argv", [
+                "snapshotter", "diff", "--json",
+                os.path.join(self.dest, "latest"),
+                os.path.join(self.dest, "2015-03-05T16_24")]):
+            snapshotter.main()
+
+        printed = json.loads("".join(call[0][0] for call in
+                                     mock_stdout.write.call_args_list))
+        assert printed["changes"] == [{"change": "deleted", "path": "new"}]
+        assert printed["new"] == os.path.join(self.dest, self.names[1])
+
+    @mock.patch("snapshotter.snapshotter._list_snapshots")
+    @mock.patch("snapshotter.snapshotter._agent")
+    def test_remote_dest(self, mock_agent_function,
+                         mock_list_snapshots_function):
+        mock_list_snapshots_function.return_value = [
+            "/dest/" + name for name in self.names]
+        remote = mock_agent_function.return_value
+
+        def call(op, **kwargs):
+            if op == "stat":
+                # Not packed.
+                raise snapshotter.agent.RemoteError(
+                    op, "No such file or directory", errno.ENOENT)
+            return {"changes": [], "shared": 1, "compared": 0}
+        remote.call.side_effect = call
+
+        snapshotter.diff("fred@host:/dest/2015-03-06", "latest",
+                         checksum=True)
+
+        remote.call.assert_called_with(
+            "diff", old="/dest/" + self.names[2], new="/dest/" + self.names[2],
+            checksum=True, threads=8)
+        nose.tools.assert_raises(
+            snapshotter.InconsistentArgumentsError, snapshotter.diff,
+            "fred@host:/dest/latest", "/dest/latest")
+
+    @mock.patch("snapshotter.snapshotter.pack.is_packed")
+    def test_packed_snapshot(self, mock_is_packed_function):
+        mock_is_packed_function.return_value = True
+
+        nose.tools.assert_raises(snapshotter.InconsistentArgumentsError,
+                                 snapshotter.diff,
+                                 os.path.join(self.dest, "latest"),
+                                 "2015-03-06")
+
+    @mock.patch("snapshotter.snapshotter._list_snapshots")
+    @mock.patch("snapshotter.snapshotter._agent")
+    def test_packed_remote_snapshot(self, mock_agent_function,
+                                    mock_list_snapshots_function):
+        mock_list_snapshots_function.return_value = [
+            "/dest/" + name for name in self.names]
+        remote = mock_agent_function.return_value
+        remote.call.return_value = {}
+
+        nose.tools.assert_raises(snapshotter.InconsistentArgumentsError,
+                                 snapshotter.diff,
+                                 "fred@host:/dest/2015-03-06", "latest")
+        remote.call.assert_called_once_with(
+            "stat", path="/dest/" + self.names[2] + "/" +
+            snapshotter.pack.INDEX_FILENAME)
+
+
+class TestRunJobs(object):
+
+    """Tests for running the jobs in a job file."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.job_file = os.path.join(self.directory, "jobs.toml")
+        with open(self.job_file, "w") as file_:
+            file_.write(
+                "[limits]\njobs = 2\n\n"
+                "[[job]]\nname = 'quick'\nsource = '/home/fred'\n"
+                "dest = '{dir}/quick'\nrsync_args = ['--exclude', '*.tmp']\n"
+                "\n[[job]]\nname = 'slow'\nsource = '/srv'\n"
+                "dest = '{dir}/slow'\nkeep = 'daily=7'\n".format(
+                    dir=self.directory))
+        for name, duration in (("quick", 1.0), ("slow", 100.0)):
+            dest = os.path.join(self.directory, name)
+            os.mkdir(dest)
+            catalog_ = snapshotter.catalog.Catalog(
+                snapshotter.catalog.path_for(dest))
+            catalog_.reindex([])
+            catalog_.add("2015-03-05T16_23_12.snapshot", duration=duration)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_recent_runtime(self):
+        assert snapshotter._recent_runtime(
+            os.path.join(self.directory, "slow")) == 100.0
+        assert snapshotter._recent_runtime(
+            os.path.join(self.directory, "missing")) is None
+
+    def test_dest_device(self):
+        assert snapshotter._dest_device(os.path.join(
+            self.directory, "missing", "dest")) == os.stat(
+                self.directory).st_dev
+        assert snapshotter._dest_device("fred@nas:backups") == "nas"
+
+    @mock.patch("snapshotter.snapshotter.snapshot")
+    def test_it_runs_every_job(self, mock_snapshot_function):
+        def snapshot(source, dest, **kwargs):
+            if source == "/srv":
+                raise snapshotter.CalledProcessError("rsync", "failed", 23)
+            report = snapshotter.metrics.Report(source, dest)
+            report.snapshot = dest + "/2015-03-06T10_00_00.snapshot"
+            return report
+        mock_snapshot_function.side_effect = snapshot
+
+        results = snapshotter.run_jobs(self.job_file, debug=True)
+
+        # The slow job is started first.
+        assert mock_snapshot_function.call_args_list[0][0] == (
+            "/srv", os.path.join(self.directory, "slow"))
+        mock_snapshot_function.assert_any_call(
+            "/home/fred", os.path.join(self.directory, "quick"), debug=True,
+            extra_args=["--exclude", "*.tmp"])
+        assert [(r.name, r.status) for r in results] == [
+            ("quick", "ok"), ("slow", "failed")]
+        assert results[0].snapshot == os.path.join(
+            self.directory, "quick", "2015-03-06T10_00_00.snapshot")
+
+    def test_invalid_job_file(self):
+        nose.tools.assert_raises(
+            snapshotter.jobfile.JobFileError, snapshotter.run_jobs,
+            os.path.join(self.directory, "missing.toml"))
+
+
+class TestLocking(object):
+
+    """Tests for locking the destination while making a snapshot."""
+
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        patcher = mock.patch("snapshotter.snapshotter._snapshot")
+        self.mock_snapshot_function = patcher.start()
+        self.mock_snapshot_function.return_value = "new.snapshot"
+        self.patchers = [patcher]
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.dest)
+
+    def _hold_lock(self):
+        """Lock dest as another snapshotter would, return the lock file."""
+        import fcntl
+        file_ = open(os.path.join(self.dest, "snapshotter.lock"), "a+")
+        fcntl.flock(file_.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return file_
+
+    def test_it_locks_dest(self):
+        def snapshot(*args):
+            assert snapshotter.locking.lock(self.dest)[0] is False
+            return "new.snapshot"
+        self.mock_snapshot_function.side_effect = snapshot
+
+        report = snapshotter.snapshot("/home/fred", self.dest)
+
+        assert report.snapshot == "new.snapshot"
+        assert report.status == snapshotter.metrics.COMPLETE
+
+        # It's unlocked again.
+        self._hold_lock().close()
+
+    def test_it_unlocks_dest_when_the_snapshot_fails(self):
+        self.mock_snapshot_function.side_effect = (
+            snapshotter.CalledProcessError("rsync", "failed", 23))
+
+        nose.tools.assert_raises(snapshotter.CalledProcessError,
+                                 snapshotter.snapshot, "/home/fred",
+                                 self.dest)
+
+        self._hold_lock().close()
+
+    def test_exit_if_locked(self):
+        holder = self._hold_lock()
+        try:
+            nose.tools.assert_raises(
+                snapshotter.DestinationLockedError, snapshotter.snapshot,
+                "/home/fred", self.dest, if_locked=snapshotter.EXIT)
+        finally:
+            holder.close()
+        assert not self.mock_snapshot_function.called
+
+    @mock.patch("snapshotter.snapshotter.time.sleep")
+    def test_wait_if_locked(self, mock_sleep_function):
+        holder = self._hold_lock()
+        mock_sleep_function.side_effect = lambda seconds: holder.close()
+
+        snapshotter.snapshot("/home/fred", self.dest)
+
+        mock_sleep_function.assert_called_once_with(snapshotter.LOCK_POLL)
+        assert self.mock_snapshot_function.call_count == 1
+
+    @mock.patch("snapshotter.snapshotter.time.sleep")
+    def test_coalesce(self, mock_sleep_function):
+        def snapshot(*args):
+            if self.mock_snapshot_function.call_count == 1:
+                # Another snapshotter is run while this one is running.
+                report = snapshotter.snapshot(
+                    "/home/fred", self.dest, if_locked=snapshotter.COALESCE)
+                assert report.snapshot is None
+                assert report.status == snapshotter.metrics.COALESCED
+            return "new.snapshot"
+        self.mock_snapshot_function.side_effect = snapshot
+
+        report = snapshotter.snapshot("/home/fred", self.dest)
+
+        # The running snapshotter made one more snapshot for it.
+        assert self.mock_snapshot_function.call_count == 2
+        assert report.counters["catch_up_snapshots"] == 1
+        self._hold_lock().close()
+
+    def test_dry_runs_dont_lock(self):
+        holder = self._hold_lock()
+        try:
+            snapshotter.snapshot("/home/fred", self.dest, debug=True,
+                                 if_locked=snapshotter.EXIT)
+        finally:
+            holder.close()
+        assert self.mock_snapshot_function.call_count == 1
+
+
+class TestPruneBySpace(object):
+
+    """Tests for removing the snapshots that free the most space."""
+
+    def setup(self):
+        self.list_snapshots_patcher = mock.patch(
+            'snapshotter.snapshotter._list_snapshots')
+        self.mock_list_snapshots_function = self.list_snapshots_patcher.start()
+        self.mock_list_snapshots_function.return_value = [
+            "/dest/2015-03-05T16_23_12.snapshot",
+            "/dest/2015-03-05T16_24_15.snapshot",
+            "/dest/2015-03-05T16_25_09.snapshot",
+            "/dest/2015-03-05T16_26_00.snapshot"]
+
+        self.reclaimable_patcher = mock.patch(
+            'snapshotter.snapshotter._reclaimable')
+        self.mock_reclaimable_function = self.reclaimable_patcher.start()
+        self.mock_reclaimable_function.return_value = {
+            "/dest/2015-03-05T16_23_12.snapshot": 10,
+            "/dest/2015-03-05T16_24_15.snapshot": 1000,
+            "/dest/2015-03-05T16_25_09.snapshot": 1000,
+            "/dest/2015-03-05T16_26_00.snapshot": 5000}
+
+        self.discard_patcher = mock.patch(
+            'snapshotter.snapshotter._discard_snapshot')
+        self.mock_discard_function = self.discard_patcher.start()
+
+    def teardown(self):
+        self.list_snapshots_patcher.stop()
+        self.reclaimable_patcher.stop()
+        self.discard_patcher.stop()
+
+    def test_it_removes_the_snapshot_that_frees_the_most_space(self):
+        snapshotter._remove_most_reclaimable_snapshot("/dest", min_snapshots=2)
+
+        # Not the newest snapshot, and the oldest of the two that free the
+        # most space.
+        self.mock_discard_function.assert_called_once_with(
+            "/dest/2015-03-05T16_24_15.snapshot", None, None, debug=False)
+
+    def test_it_keeps_min_snapshots(self):
+        nose.tools.assert_raises(
+            snapshotter.NoMoreSnapshotsToRemoveError,
+            snapshotter._remove_most_reclaimable_snapshot, "/dest",
+            min_snapshots=4)
+
+    @mock.patch('snapshotter.snapshotter._remove_oldest_snapshot')
+    def test_it_falls_back_to_removing_the_oldest_snapshot(
+            self, mock_remove_oldest_snapshot_function):
+        self.mock_reclaimable_function.return_value = None
+
+        snapshotter._remove_most_reclaimable_snapshot(
+            "host:/dest", None, "host")
+
+        mock_remove_oldest_snapshot_function.assert_called_once_with(
+            "host:/dest", None, "host", min_snapshots=3, debug=False)
+
+    def test_du(self):
+        assert snapshotter.du("/dest") == (
+            self.mock_reclaimable_function.return_value)
+
+    @mock.patch("sys.stdout")
+    def test_main_prints_du(self, mock_stdout):
+        self.mock_reclaimable_function.return_value = {
+            "/dest/2015-03-06T12_00_00.snapshot": 200,
+            "/dest/2015-03-05T12_00_00.snapshot": 100}
+
+        with mock.patch("sys.argv", ["snapshotter", "du", "/dest"]):
+            snapshotter.main()
+
+        printed = "".join(call[0][0] for call in
+                          mock_stdout.write.call_args_list)
+        assert printed == ("100\t/dest/2015-03-05T12_00_00.snapshot\n"
+                           "200\t/dest/2015-03-06T12_00_00.snapshot\n")
+
+
+class TestRetention(object):
+
+    """Tests for thinning out snapshots with a retention policy."""
+
+    def setup(self):
+        self.list_snapshots_patcher = mock.patch(
+            'snapshotter.snapshotter._list_snapshots')
+        self.mock_list_snapshots_function = self.list_snapshots_patcher.start()
+        self.mock_list_snapshots_function.return_value = [
+            "/dest/2015-03-0%dT12_00_00.snapshot" % day
+            for day in range(1, 6)]
+
+        self.discard_patcher = mock.patch(
+            'snapshotter.snapshotter._discard_snapshots')
+        self.mock_discard_function = self.discard_patcher.start()
+
+    def teardown(self):
+        self.list_snapshots_patcher.stop()
+        self.discard_patcher.stop()
+
+    def test_it_removes_snapshots_in_batches(self):
+        with mock.patch("snapshotter.snapshotter.RETENTION_BATCH", 2):
+            removed = snapshotter._apply_retention(
+                "/dest", snapshotter.retention.parse_policy("daily=2"),
+                min_snapshots=1)
+
+        assert removed == self.mock_list_snapshots_function.return_value[:3]
+        assert self.mock_discard_function.call_args_list == [
+            mock.call(removed[:2], None, None),
+            mock.call(removed[2:], None, None)]
+
+    def test_dry_run(self):
+        removed = snapshotter._apply_retention(
+            "/dest", snapshotter.retention.parse_policy("daily=2"),
+            min_snapshots=1, debug=True)
+
+        assert len(removed) == 3
+        assert not self.mock_discard_function.called
+
+    def test_it_keeps_min_snapshots(self):
+        removed = snapshotter._apply_retention(
+            "/dest", snapshotter.retention.parse_policy("daily=2"),
+            min_snapshots=4)
+
+        assert len(removed) == 1
+
+
+class TestTrash(object):
+
+    """Tests for deleting old snapshots via the trash directory."""
+
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+
+    def teardown(self):
+        snapshotter._reaper.wait()
+        shutil.rmtree(self.dest)
+
+    def test_discard_snapshot(self):
+        snapshot_ = os.path.join(self.dest, "2015-03-05T16_23_12.snapshot")
+        os.makedirs(os.path.join(snapshot_, "sub"))
+        with open(snapshotter.manifest.path_for(snapshot_), "w"):
+            pass
+
+        snapshotter._discard_snapshot(snapshot_)
+        snapshotter._reaper.wait()
+
+        assert os.listdir(self.dest) == ["trash"]
+        assert os.listdir(os.path.join(self.dest, "trash")) == []
+
+    def test_it_resumes_deleting_the_trash(self):
+        os.makedirs(os.path.join(self.dest, "trash", "old.snapshot", "sub"))
+
+        snapshotter._reap_trash(self.dest)
+        snapshotter._reaper.wait()
+
+        assert os.listdir(os.path.join(self.dest, "trash")) == []
+
+    @mock.patch("snapshotter.snapshotter._agent")
+    @mock.patch("snapshotter.snapshotter._run")
+    def test_remote_discard_snapshot(self, mock_run_function,
+                                     mock_agent_function):
+        mock_agent_function.return_value = None
+        snapshotter._discard_snapshot(
+            "/snapshots/2015-03-05T16_23_12.snapshot", "fred", "example.com")
+
+        commands = [call[0][0] for call in mock_run_function.call_args_list]
+        assert commands[1] == [
+            "ssh", "fred@example.com", "mv",
+            "/snapshots/2015-03-05T16_23_12.snapshot",
+            "/snapshots/trash/2015-03-05T16_23_12.snapshot"]
+        assert commands[-1][:5] == [
+            "ssh", "fred@example.com", "nohup", "rm", "-r"]
+
+    @mock.patch("snapshotter.snapshotter._agent")
+    @mock.patch("snapshotter.snapshotter._run")
+    def test_remote_discard_snapshots_in_one_command(self, mock_run_function,
+                                                     mock_agent_function):
+        mock_agent_function.return_value = None
+        snapshots = ["/snapshots/2015-03-05T16_23_12.snapshot",
+                     "/snapshots/2015-03-05T16_24_15.snapshot"]
+
+        snapshotter._discard_snapshots(snapshots, "fred", "example.com")
+
+        commands = [call[0][0] for call in mock_run_function.call_args_list]
+        assert commands[1] == ["ssh", "fred@example.com", "mv"] + snapshots + [
+            "/snapshots/trash"]
+        assert len(commands) == 4
+
+    @mock.patch("snapshotter.snapshotter._agent")
+    def test_remote_discard_snapshot_with_agent(self, mock_agent_function):
+        remote = mock_agent_function.return_value = mock.Mock()
+        remote.call.return_value = None
+
+        snapshotter._discard_snapshot(
+            "/snapshots/2015-03-05T16_23_12.snapshot", "fred", "example.com")
+
+        assert remote.call.call_args_list[-1] == mock.call(
+            "reap", path="/snapshots/trash/2015-03-05T16_23_12.snapshot")
+
+
 class TestCLI(object):
 
     """Tests for the parse_cli() function."""
@@ -240,23 +1481,249 @@ class TestCLI(object):
             args=["/home/fred"])
 
     def test_with_default_options(self):
-        src, dest, debug, _, _, _ = (
-            snapshotter._parse_cli(args=["/home/fred", "/media/backup"]))
-        assert src == "/home/fred"
-        assert dest == "/media/backup"
-        assert debug is False
+        command, kwargs = snapshotter._parse_cli(
+            args=["/home/fred", "/media/backup"])
+        assert command == "snapshot"
+        assert kwargs["source"] == "/home/fred"
+        assert kwargs["dest"] == "/media/backup"
+        assert kwargs["debug"] is False
+        assert kwargs["extra_args"] == []
 
     def test_dry_run(self):
         for option in ("-n", "--dry-run"):
-            _, _, debug, _, _, _ = snapshotter._parse_cli(
+            _, kwargs = snapshotter._parse_cli(
                 args=[option, "/home/fred", "/media/backup"])
-            assert debug is True
+            assert kwargs["debug"] is True
 
     def test_extra_args(self):
-        _, _, _, _, _, extra_args = (
-            snapshotter._parse_cli(
-                args=["--foo=fred", "-x", "/home/fred", "/media/backup"]))
-        assert extra_args == ["--foo=fred", "-x"]
+        _, kwargs = snapshotter._parse_cli(
+            args=["--foo=fred", "-x", "/home/fred", "/media/backup"])
+        assert kwargs["extra_args"] == ["--foo=fred", "-x"]
+
+    def test_progress_options(self):
+        _, options = snapshotter._parse_cli(
+            args=["--progress-interval", "5", "--progress-file",
+                  "/tmp/progress.jsonl", "/home/fred", "/media/backup"])
+        assert options["progress_interval"] == 5
+        assert options["progress_file"] == "/tmp/progress.jsonl"
+        assert options["extra_args"] == []
+
+    def test_rsync_options_that_our_options_extend(self):
+        """rsync's --progress and --link-dest aren't abbreviations."""
+        _, options = snapshotter._parse_cli(
+            args=["--progress", "/home/fred", "/media/backup"])
+        assert options["extra_args"] == ["--progress"]
+        assert options["progress_interval"] is None
+
+        _, options = snapshotter._parse_cli(
+            args=["--link-dest=/media/old", "/home/fred", "/media/backup"])
+        assert options["extra_args"] == ["--link-dest=/media/old"]
+        assert options["link_dest_history"] is None
+
+    def test_command(self):
+        assert snapshotter._parse_cli(["reindex", "/media/backup"]) == (
+            "reindex", {"dest": "/media/backup"})
+        assert snapshotter._parse_cli(["du", "/media/backup"]) == (
+            "du", {"dest": "/media/backup"})
+
+        nose.tools.assert_raises(
+            snapshotter.CommandLineArgumentsError,
+            snapshotter._parse_cli, ["reindex"])
+        # Commands don't pass unknown options on to rsync.
+        nose.tools.assert_raises(
+            snapshotter.CommandLineArgumentsError,
+            snapshotter._parse_cli, ["du", "--foo", "/media/backup"])
+
+    def test_sources_named_like_commands(self):
+        # With three arguments "du" can only be the source.
+        nose.tools.assert_raises(
+            snapshotter.CommandLineArgumentsError,
+            snapshotter._parse_cli, ["du", "/media/backup", "extra"])
+        for args in (["snapshot", "du", "/media/backup"],
+                     ["./du", "/media/backup"]):
+            command, kwargs = snapshotter._parse_cli(args)
+            assert command == "snapshot"
+            assert kwargs["dest"] == "/media/backup"
+        command, kwargs = snapshotter._parse_cli(
+            ["snapshot", "-n", "--jobs", "2", "run", "/media/backup"])
+        assert (command, kwargs["source"], kwargs["jobs"]) == (
+            "snapshot", "run", 2)
+
+    def test_prune_by_space(self):
+        _, options = snapshotter._parse_cli(
+            args=["--prune-by-space", "/home/fred", "/media/backup"])
+        assert options["prune_by_space"] is True
+
+    def test_keep(self):
+        _, options = snapshotter._parse_cli(
+            args=["--keep", "daily=7,weekly=*", "/home/fred", "/media/backup"])
+        assert options["keep"] == [("daily", 7),
+                                   ("weekly", snapshotter.retention.INF)]
+
+        nose.tools.assert_raises(
+            snapshotter.CommandLineArgumentsError, snapshotter._parse_cli,
+            args=["--keep", "daily=x", "/home/fred", "/media/backup"])
+
+    def test_link_dest_options(self):
+        _, options = snapshotter._parse_cli(
+            args=["--link-dests", "5", "--link-dest-history", "weekly=4",
+                  "--link-dest-report", "/home/fred", "/media/backup"])
+        assert options["link_dest_count"] == 5
+        assert options["link_dest_history"] == [("weekly", 4)]
+        assert options["link_dest_report"] is True
+
+    def test_detect_renames(self):
+        _, options = snapshotter._parse_cli(
+            args=["/home/fred", "/media/backup"])
+        assert options["detect_renames"] is False
+
+        _, options = snapshotter._parse_cli(
+            args=["--detect-renames", "/home/fred", "/media/backup"])
+        assert options["detect_renames"] is True
+
+    def test_journal(self):
+        _, options = snapshotter._parse_cli(
+            args=["--journal", "/var/lib/journal", "/home/fred",
+                  "/media/backup"])
+        assert options["journal_dir"] == "/var/lib/journal"
+
+    def test_engine(self):
+        _, options = snapshotter._parse_cli(
+            args=["/home/fred", "/media/backup"])
+        assert options["engine"] == "rsync"
+
+        _, options = snapshotter._parse_cli(
+            args=["--engine=native", "/home/fred", "/media/backup"])
+        assert options["engine"] == "native"
+
+    def test_reflink(self):
+        _, options = snapshotter._parse_cli(
+            args=["--reflink", "/home/fred", "/media/backup"])
+        assert options["reflink"] is True
+
+    def test_watch(self):
+        assert snapshotter._parse_cli(
+            ["watch", "/home/fred", "/var/lib/journal"]) == (
+                "watch", {"source": "/home/fred",
+                          "journal_dir": "/var/lib/journal"})
+
+    def test_report(self):
+        _, options = snapshotter._parse_cli(
+            args=["--report", "report.json", "--metrics-textfile",
+                  "snapshotter.prom", "--profile", "snapshotter.prof",
+                  "/home/fred", "/media/backup"])
+        assert options["report_file"] == "report.json"
+        assert options["metrics_textfile"] == "snapshotter.prom"
+        assert options["profile"] == "snapshotter.prof"
+
+    def test_if_locked(self):
+        _, options = snapshotter._parse_cli(
+            args=["/home/fred", "/media/backup"])
+        assert options["if_locked"] == snapshotter.WAIT
+
+        _, options = snapshotter._parse_cli(
+            args=["--if-locked=coalesce", "/home/fred", "/media/backup"])
+        assert options["if_locked"] == snapshotter.COALESCE
+
+    def test_throttle(self):
+        _, options = snapshotter._parse_cli(
+            args=["--throttle", "10", "--throttle-cgroup",
+                  "/sys/fs/cgroup/backup", "/home/fred", "/media/backup"])
+
+        assert options["throttle_target"] == 10.0
+        assert options["throttle_cgroup"] == "/sys/fs/cgroup/backup"
+
+    def test_verify(self):
+        assert snapshotter._parse_cli(["verify", "/dest"]) == (
+            "verify", {"dest": "/dest", "max_seconds": None,
+                       "max_bytes": None, "jobs": 4})
+        assert snapshotter._parse_cli(
+            ["verify", "--max-time", "2h", "--max-bytes", "500G", "--jobs",
+             "8", "/dest"]) == (
+                 "verify", {"dest": "/dest", "max_seconds": 7200,
+                            "max_bytes": 500 * 1024 ** 3, "jobs": 8})
+        nose.tools.assert_raises(
+            snapshotter.CommandLineArgumentsError,
+            snapshotter._parse_cli,
+            ["verify", "--max-bytes", "lots", "/dest"])
+
+    def test_dedup(self):
+        assert snapshotter._parse_cli(["dedup", "/backups"]) == (
+            "dedup", {"root": "/backups", "jobs": 8,
+                      "min_size": snapshotter.dedup.MIN_SIZE,
+                      "debug": False})
+        assert snapshotter._parse_cli(
+            ["dedup", "-n", "--jobs", "2", "--min-size", "1M",
+             "/backups"]) == (
+                 "dedup", {"root": "/backups", "jobs": 2,
+                           "min_size": 1024 ** 2, "debug": True})
+
+    def test_pack(self):
+        assert snapshotter._parse_cli(
+            ["pack", "--older-than", "30d", "/backups"]) == (
+                "pack", {"dest": "/backups", "older_than": 30 * 86400,
+                         "debug": False})
+        nose.tools.assert_raises(snapshotter.CommandLineArgumentsError,
+                                 snapshotter._parse_cli,
+                                 ["pack", "/backups"])
+
+    def test_unpack(self):
+        assert snapshotter._parse_cli(
+            ["unpack", "/backups/a.snapshot", "/tmp/restore"]) == (
+                "unpack", {"snapshot_": "/backups/a.snapshot",
+                           "target": "/tmp/restore", "paths": []})
+        assert snapshotter._parse_cli(
+            ["unpack", "/backups/a.snapshot", "/tmp/restore", "etc",
+             "home/fred"])[1]["paths"] == ["etc", "home/fred"]
+
+    def test_restore(self):
+        assert snapshotter._parse_cli(
+            ["restore", "/backups/a.snapshot", "/srv"]) == (
+                "restore", {"snapshot_": "/backups/a.snapshot",
+                            "target": "/srv", "checksum": False,
+                            "delete": False, "jobs": 8})
+        assert snapshotter._parse_cli(
+            ["restore", "-c", "--delete", "--jobs", "4", "host:/backups/a",
+             "/srv"]) == (
+                 "restore", {"snapshot_": "host:/backups/a",
+                             "target": "/srv", "checksum": True,
+                             "delete": True, "jobs": 4})
+
+    def test_diff(self):
+        assert snapshotter._parse_cli(
+            ["diff", "/backups/2015-03-05T16:23:12", "latest"]) == (
+                "diff", {"old": "/backups/2015-03-05T16:23:12",
+                         "new": "latest", "checksum": False,
+                         "output_format": "text", "jobs": 8})
+        assert snapshotter._parse_cli(
+            ["diff", "-c", "--json", "--jobs", "2", "host:/backups/latest",
+             "2015-03-05"]) == (
+                 "diff", {"old": "host:/backups/latest", "new": "2015-03-05",
+                          "checksum": True, "output_format": "json",
+                          "jobs": 2})
+
+    def test_sizes_and_durations(self):
+        assert snapshotter._parse_size("1024") == 1024
+        assert snapshotter._parse_size("1.5k") == 1536
+        assert snapshotter._parse_size("2MB") == 2 * 1024 ** 2
+        assert snapshotter._parse_duration("90m") == 5400
+        assert snapshotter._parse_duration("30") == 30
+        assert snapshotter._parse_duration("2w") == 14 * 86400
+
+    def test_run(self):
+        assert snapshotter._parse_cli(["run", "jobs.toml"]) == (
+            "run", {"job_file": "jobs.toml", "debug": False})
+        assert snapshotter._parse_cli(["run", "-n", "jobs.toml"]) == (
+            "run", {"job_file": "jobs.toml", "debug": True})
+
+    def test_lazy_delete(self):
+        _, options = snapshotter._parse_cli(
+            args=["/home/fred", "/media/backup"])
+        assert options["lazy_delete"] is False
+
+        _, options = snapshotter._parse_cli(
+            args=["--lazy-delete", "/home/fred", "/media/backup"])
+        assert options["lazy_delete"] is True
 
 
 class TestFunctional(object):
@@ -287,6 +1754,84 @@ class TestFunctional(object):
         finally:
             shutil.rmtree(dest)
 
+    @mock.patch("snapshotter.snapshotter._datetime")
+    def test_native_engine_functional(self, mock_datetime_function):
+        """Two snapshots with the native engine, the second one linked."""
+        try:
+            dest = tempfile.mkdtemp()
+            src = os.path.join(_this_directory(), "test_data")
+
+            mock_datetime_function.return_value = "2015-02-23T18_58_02"
+            snapshotter.snapshot(src, dest, engine="native")
+            mock_datetime_function.return_value = "2015-02-23T19_58_02"
+            snapshotter.snapshot(src, dest, engine="native")
+
+            for file_ in os.listdir(src):
+                assert os.path.samefile(
+                    os.path.join(dest, "2015-02-23T18_58_02.snapshot", file_),
+                    os.path.join(dest, "2015-02-23T19_58_02.snapshot", file_))
+            assert os.path.realpath(os.path.join(
+                dest, "latest.snapshot")) == os.path.join(
+                    dest, "2015-02-23T19_58_02.snapshot")
+            assert snapshotter.catalog.Catalog(
+                snapshotter.catalog.path_for(dest)).entries()[1].files == (
+                    len(os.listdir(src)))
+        finally:
+            shutil.rmtree(dest)
+
+
+class TestMoveIncompleteDir(object):
+
+    """Tests for publishing manifests in _move_incomplete_dir()."""
+
+    def setup(self):
+        self.run_patcher = mock.patch('snapshotter.snapshotter._run')
+        self.mock_run_function = self.run_patcher.start()
+        self.dest = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.dest, "incomplete.manifest")
+        open(self.manifest_path, "w").close()
+
+    def teardown(self):
+        self.run_patcher.stop()
+        shutil.rmtree(self.dest)
+
+    def test_it_publishes_the_manifest(self):
+        snapshotter._move_incomplete_dir(
+            self.dest, "2015-02-23T18_58_02",
+            manifest_path=self.manifest_path)
+
+        assert os.listdir(self.dest) == ["2015-02-23T18_58_02.manifest"]
+
+    def test_it_does_not_publish_the_manifest_if_mv_fails(self):
+        self.mock_run_function.side_effect = snapshotter.CalledProcessError(
+            "mv ...", "error", 1)
+
+        nose.tools.assert_raises(
+            snapshotter.CalledProcessError, snapshotter._move_incomplete_dir,
+            self.dest, "2015-02-23T18_58_02",
+            manifest_path=self.manifest_path)
+
+        assert os.listdir(self.dest) == ["incomplete.manifest"]
+
+    def test_it_does_not_publish_the_manifest_in_debug_mode(self):
+        snapshotter._move_incomplete_dir(
+            self.dest, "2015-02-23T18_58_02", debug=True,
+            manifest_path=self.manifest_path)
+
+        assert os.listdir(self.dest) == ["incomplete.manifest"]
+
+    def test_remote_manifests_dont_collide(self):
+        paths = [snapshotter._incomplete_manifest_path(
+            "/media/backup", "2015-02-23T18_58_02", "example.com")
+            for _ in range(2)]
+        try:
+            assert paths[0] != paths[1]
+            # The files are only created when there are changes to write.
+            assert not any(os.path.exists(path) for path in paths)
+        finally:
+            for path in paths:
+                os.rmdir(os.path.dirname(path))
+
 
 def _get_args(call_args):
     """Return the arg string passed to a mock _run() function."""
@@ -320,11 +1865,84 @@ class TestSnapshot(object):
         self.mock_remove_oldest_snapshot_function = (
             self.remove_oldest_snapshot_patcher.start())
 
+        self.agent_patcher = mock.patch('snapshotter.snapshotter._agent')
+        self.mock_agent_function = self.agent_patcher.start()
+        self.mock_agent_function.return_value = None
+
     def teardown(self):
         self.run_patcher.stop()
         self.datetime_patcher.stop()
         self.ls_snapshots_patcher.stop()
         self.remove_oldest_snapshot_patcher.stop()
+        self.agent_patcher.stop()
+
+    def test_report(self):
+        def run(command, debug=False, consumers=None, throttle_=None):
+            for consumer in consumers or []:
+                consumer("Number of files: 10 (reg: 8, dir: 2)")
+                consumer("Total transferred file size: 100 bytes")
+        self.mock_run_function.side_effect = run
+
+        report = snapshotter.snapshot("/home/fred", "/media/backup")
+
+        assert report.status == snapshotter.metrics.COMPLETE
+        assert report.snapshot == os.path.join("/media/backup",
+                                               self.datetime + ".snapshot")
+        for phase in ("list_snapshots", "prune", "transfer",
+                      "move_incomplete", "update_latest"):
+            assert phase in report.phases, phase
+        assert report.counters["rsync_runs"] == 1
+        assert report.stats["Number of files"] == 10
+        assert report.stats["Total transferred file size"] == 100
+
+    def test_report_files_are_written_when_the_snapshot_fails(self):
+        self.mock_run_function.side_effect = snapshotter.CalledProcessError(
+            "rsync", "failed", 23)
+        directory = tempfile.mkdtemp()
+        try:
+            report_file = os.path.join(directory, "report.json")
+            textfile = os.path.join(directory, "snapshotter.prom")
+
+            nose.tools.assert_raises(
+                snapshotter.CalledProcessError, snapshotter.snapshot,
+                "/home/fred", "/media/backup", report_file=report_file,
+                metrics_textfile=textfile)
+
+            with open(report_file) as file_:
+                assert json.load(file_)["status"] == "failed"
+            with open(textfile) as file_:
+                assert ('snapshotter_last_run_success{dest="/media/backup"} 0'
+                        in file_.read())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_profile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "snapshotter.prof")
+
+            snapshotter.snapshot("/home/fred", "/media/backup", profile=path)
+
+            pstats.Stats(path)
+        finally:
+            shutil.rmtree(directory)
+
+    @mock.patch("snapshotter.snapshotter.throttle.Throttle")
+    def test_throttle(self, mock_throttle_class):
+        controller = mock_throttle_class.return_value
+        controller.command.side_effect = lambda command: ["nice"] + command
+
+        snapshotter.snapshot("/home/fred", "/media/backup",
+                             throttle_target=10)
+
+        assert mock_throttle_class.call_args[0] == (10,)
+        assert mock_throttle_class.call_args[1]["path"] == "/home/fred"
+        rsync_calls = [c for c in self.mock_run_function.call_args_list
+                       if c[0][0][:2] == ["nice", "rsync"]]
+        assert len(rsync_calls) == 1
+        assert rsync_calls[0][1]["throttle_"] is controller
+        assert controller.start.call_count == 1
+        assert controller.stop.call_count == 1
 
     def test_it_raises_if_min_snapshots_greater_than_max_snapshots(self):
         try:
@@ -443,6 +2061,146 @@ class TestSnapshot(object):
         _, value = link_dest_arg.split("=")
         assert value == "../latest.snapshot"
 
+    def test_more_link_dests(self):
+        """More --link-dest args should be given most recent first."""
+        self.mock_ls_snapshots_function.return_value = [
+            "/media/backup/2015-02-0%dT12_00_00.snapshot" % day
+            for day in range(1, 6)]
+
+        snapshotter.snapshot("/home/fred", "/media/backup", link_dest_count=3)
+
+        args = _get_args(self.mock_run_function.call_args_list[0])
+        assert [a for a in args if a.startswith("--link-dest")] == [
+            "--link-dest=../latest.snapshot",
+            "--link-dest=../2015-02-04T12_00_00.snapshot",
+            "--link-dest=../2015-02-03T12_00_00.snapshot"]
+
+    @mock.patch("snapshotter.snapshotter.pack.is_packed")
+    def test_packed_snapshots_arent_link_dests(self, mock_is_packed_function):
+        self.mock_ls_snapshots_function.return_value = [
+            "/media/backup/2015-02-0%dT12_00_00.snapshot" % day
+            for day in range(1, 6)]
+        mock_is_packed_function.side_effect = lambda path: path.endswith(
+            "2015-02-04T12_00_00.snapshot")
+
+        snapshotter.snapshot("/home/fred", "/media/backup", link_dest_count=3)
+
+        args = _get_args(self.mock_run_function.call_args_list[0])
+        assert [a for a in args if a.startswith("--link-dest")] == [
+            "--link-dest=../latest.snapshot",
+            "--link-dest=../2015-02-03T12_00_00.snapshot"]
+
+    @mock.patch("snapshotter.snapshotter._incremental_rsync")
+    @mock.patch("snapshotter.snapshotter._journal_changes")
+    @mock.patch("snapshotter.snapshotter.journal.Journal")
+    def test_journal(self, mock_journal_class, mock_journal_changes_function,
+                     mock_incremental_rsync_function):
+        journal_ = mock_journal_class.return_value
+        journal_.rotate.return_value = ["/journal/segment-0"]
+        mock_journal_changes_function.return_value = set(["a"])
+
+        snapshotter.snapshot("/home/fred", "/media/backup",
+                             journal_dir="/journal")
+
+        mock_journal_class.assert_called_once_with("/journal")
+        assert mock_incremental_rsync_function.call_args[0][:3] == (
+            "/home/fred", "/media/backup", set(["a"]))
+        assert not [c for c in self.mock_run_function.call_args_list
+                    if _get_args(c)[0] == "rsync"]
+        journal_.commit.assert_called_once_with(
+            ["/journal/segment-0"], self.datetime + ".snapshot")
+
+    @mock.patch("snapshotter.snapshotter._reflink_seed")
+    def test_reflink(self, mock_reflink_seed_function):
+        """Seeded snapshots should be updated in place, without --link-dest.
+        """
+        mock_reflink_seed_function.return_value = True
+
+        snapshotter.snapshot("/home/fred", "/media/backup", reflink=True)
+
+        mock_reflink_seed_function.assert_called_once_with(
+            "/media/backup", None, None)
+        args = _get_args(self.mock_run_function.call_args_list[0])
+        assert "--inplace" in args
+        assert "--no-whole-file" in args
+        assert not [a for a in args if a.startswith(("--link-dest",
+                                                     "--partial"))]
+
+    @mock.patch("snapshotter.snapshotter._reflink_seed")
+    def test_reflink_falls_back_to_link_dest(self,
+                                             mock_reflink_seed_function):
+        mock_reflink_seed_function.return_value = False
+
+        snapshotter.snapshot("/home/fred", "/media/backup", reflink=True)
+
+        args = _get_args(self.mock_run_function.call_args_list[0])
+        assert "--inplace" not in args
+        assert "--link-dest=../latest.snapshot" in args
+
+    @mock.patch("snapshotter.snapshotter._native_copy")
+    def test_native_engine(self, mock_native_copy_function):
+        snapshotter.snapshot("/home/fred", "/media/backup", engine="native",
+                             jobs=4)
+
+        assert not [c for c in self.mock_run_function.call_args_list
+                    if _get_args(c)[0] == "rsync"]
+        args, kwargs = mock_native_copy_function.call_args
+        assert args == ("/home/fred", "/media/backup")
+        assert kwargs["threads"] == 4
+
+    def test_native_engine_needs_local_paths_and_no_rsync_options(self):
+        nose.tools.assert_raises(
+            snapshotter.InconsistentArgumentsError, snapshotter.snapshot,
+            "/home/fred", "host:/media/backup", engine="native")
+        nose.tools.assert_raises(
+            snapshotter.InconsistentArgumentsError, snapshotter.snapshot,
+            "/home/fred", "/media/backup", engine="native",
+            extra_args=["--exclude=*~"])
+
+    @mock.patch("snapshotter.snapshotter.engine.copy_tree")
+    def test_native_copy_no_space(self, mock_copy_tree_function):
+        mock_copy_tree_function.side_effect = OSError(
+            errno.ENOSPC, "No space left on device")
+
+        nose.tools.assert_raises(
+            snapshotter.NoSpaceLeftOnDeviceError, snapshotter._native_copy,
+            "/home/fred", "/media/backup")
+        assert mock_copy_tree_function.call_args[1]["link_dests"] == [
+            "/media/backup/latest.snapshot"]
+
+    @mock.patch("snapshotter.snapshotter._journal_changes")
+    @mock.patch("snapshotter.snapshotter.journal.Journal")
+    def test_incomplete_journal(self, mock_journal_class,
+                                mock_journal_changes_function):
+        """The whole source should be scanned if the journal isn't complete."""
+        mock_journal_changes_function.return_value = None
+
+        snapshotter.snapshot("/home/fred", "/media/backup",
+                             journal_dir="/journal")
+
+        assert _get_args(self.mock_run_function.call_args_list[0])[0] == (
+            "rsync")
+        assert mock_journal_class.return_value.commit.called
+
+    @mock.patch("snapshotter.snapshotter._report_link_dests")
+    def test_link_dest_report(self, mock_report_function):
+        self.mock_ls_snapshots_function.return_value = [
+            "/media/backup/2015-02-0%dT12_00_00.snapshot" % day
+            for day in range(1, 6)]
+
+        snapshotter.snapshot("/home/fred", "/media/backup", link_dest_count=2,
+                             link_dest_report=True)
+
+        # A dry run with only latest.snapshot first.
+        args = _get_args(self.mock_run_function.call_args_list[0])
+        assert "--dry-run" in args
+        assert len([a for a in args if a.startswith("--link-dest")]) == 1
+        args = _get_args(self.mock_run_function.call_args_list[1])
+        assert "--dry-run" not in args
+        assert len([a for a in args if a.startswith("--link-dest")]) == 2
+        assert mock_report_function.call_args[0][0] == [
+            "2015-02-04T12_00_00.snapshot"]
+
     def test_relative_local_to_relative_local(self):
         """Test backing up a relative local dir to a relative local dir."""
         src = "Mail"
@@ -578,6 +2336,42 @@ class TestSnapshot(object):
 
     # TODO: Same test for rm and ln
 
+    def test_remote_dest_with_agent(self):
+        """With an agent no ssh commands should be run after rsync."""
+        remote = self.mock_agent_function.return_value = mock.Mock()
+        # The destination has no catalog.
+        remote.call.return_value = None
+        src = "Mail"
+        dst = "you@yourdomain.org:/path/to/snapshots"
+
+        snapshotter.snapshot(src, dst)
+
+        assert self.mock_run_function.call_count == 1
+        snapshot_dir = "/path/to/snapshots/" + self.datetime + ".snapshot"
+        latest = "/path/to/snapshots/latest.snapshot"
+        calls = [c for c in remote.call.call_args_list if c[0][0] != "sql"]
+        assert calls == [
+            mock.call("lock", snapshots_root="/path/to/snapshots",
+                      register=False),
+            mock.call("rename",
+                      src="/path/to/snapshots/incomplete.snapshot",
+                      dest=snapshot_dir),
+            mock.call("unlink", path=latest, missing_ok=True),
+            mock.call("symlink", target=self.datetime + ".snapshot",
+                      path=latest),
+        ]
+
+    def test_remote_error_from_agent(self):
+        remote = self.mock_agent_function.return_value = mock.Mock()
+        remote.call.side_effect = snapshotter.agent.RemoteError(
+            "rename", "No such file or directory", 2)
+
+        try:
+            snapshotter.snapshot("Mail", "you@yourdomain.org:snapshots")
+            assert False, "snapshot() should have raised an exception"
+        except snapshotter.CalledProcessError as err:
+            assert err.exit_value == 2
+
     def test_mv_command_fails(self):
         """snapshot() should raise if the mv command exits with non-zero."""
         src = "Mail"
@@ -592,6 +2386,13 @@ class TestSnapshot(object):
         except snapshotter.CalledProcessError as err:
             assert err.output == "output 25"
 
+    def test_progress_mode_passes_progress_args_to_rsync(self):
+        snapshotter.snapshot("src", "dest", progress_interval=60)
+
+        args = _get_args(self.mock_run_function.call_args_list[0])
+        for arg in snapshotter.progress.RSYNC_ARGS:
+            assert arg in args
+
     def test_extra_args_are_passed_on_to_rsync(self):
         extra_args = ["-v", "--info=progress2"]
 
@@ -613,8 +2414,9 @@ class TestRemovingOldSnapshots(object):
         self.rsync_patcher = mock.patch('snapshotter.snapshotter._rsync')
         self.mock_rsync_function = self.rsync_patcher.start()
 
-        self.rm_patcher = mock.patch('snapshotter.snapshotter._rm')
-        self.mock_rm_function = self.rm_patcher.start()
+        self.discard_patcher = mock.patch(
+            'snapshotter.snapshotter._discard_snapshot')
+        self.mock_discard_function = self.discard_patcher.start()
 
         self.ls_snapshots_patcher = mock.patch(
             'snapshotter.snapshotter._ls_snapshots')
@@ -623,7 +2425,7 @@ class TestRemovingOldSnapshots(object):
     def teardown(self):
         self.run_patcher.stop()
         self.rsync_patcher.stop()
-        self.rm_patcher.stop()
+        self.discard_patcher.stop()
         self.ls_snapshots_patcher.stop()
 
     def test_removing_oldest_snapshot(self):
@@ -650,10 +2452,9 @@ class TestRemovingOldSnapshots(object):
 
         snapshotter.snapshot("source", "destination")
 
-        assert self.mock_rm_function.call_count == 2
-        assert self.mock_rm_function.call_args_list[0] == mock.call(
-            '2015-03-05T16_23_12.snapshot', None, None, debug=False,
-            directory=True)
+        assert self.mock_discard_function.call_count == 1
+        assert self.mock_discard_function.call_args_list[0] == mock.call(
+            '2015-03-05T16_23_12.snapshot', None, None, debug=False)
 
         assert self.mock_rsync_function.call_count == 2
 
@@ -683,22 +2484,19 @@ class TestRemovingOldSnapshots(object):
                 return result
         self.mock_rsync_function.side_effect = rsync
 
-        def rm(*args, **kwargs):
+        def discard(*args, **kwargs):
             snapshots.pop(0)
-        self.mock_rm_function.side_effect = rm
+        self.mock_discard_function.side_effect = discard
 
         snapshotter.snapshot("source", "destination")
 
-        assert self.mock_rm_function.call_count == 4
-        assert self.mock_rm_function.call_args_list[0] == mock.call(
-            '2015-03-05T16_23_12.snapshot', None, None, debug=False,
-            directory=True)
-        assert self.mock_rm_function.call_args_list[1] == mock.call(
-            '2015-03-05T16_24_15.snapshot', None, None, debug=False,
-            directory=True)
-        assert self.mock_rm_function.call_args_list[2] == mock.call(
-            '2015-03-05T16_25_09.snapshot', None, None, debug=False,
-            directory=True)
+        assert self.mock_discard_function.call_count == 3
+        assert self.mock_discard_function.call_args_list[0] == mock.call(
+            '2015-03-05T16_23_12.snapshot', None, None, debug=False)
+        assert self.mock_discard_function.call_args_list[1] == mock.call(
+            '2015-03-05T16_24_15.snapshot', None, None, debug=False)
+        assert self.mock_discard_function.call_args_list[2] == mock.call(
+            '2015-03-05T16_25_09.snapshot', None, None, debug=False)
 
         assert self.mock_rsync_function.call_count == 4
 
@@ -732,21 +2530,19 @@ class TestRemovingOldSnapshots(object):
         self.mock_rsync_function.side_effect = (
             snapshotter.NoSpaceLeftOnDeviceError)
 
-        def rm(*args, **kwargs):
+        def discard(*args, **kwargs):
             snapshots.pop(0)
-        self.mock_rm_function.side_effect = rm
+        self.mock_discard_function.side_effect = discard
 
         nose.tools.assert_raises(
             snapshotter.NoMoreSnapshotsToRemoveError,
             snapshotter.snapshot, "source", "destination")
 
-        assert self.mock_rm_function.call_count == 2
-        assert self.mock_rm_function.call_args_list[0] == mock.call(
-            '2015-03-05T16_23_12.snapshot', None, None, debug=False,
-            directory=True)
-        assert self.mock_rm_function.call_args_list[1] == mock.call(
-            '2015-03-05T16_24_15.snapshot', None, None, debug=False,
-            directory=True)
+        assert self.mock_discard_function.call_count == 2
+        assert self.mock_discard_function.call_args_list[0] == mock.call(
+            '2015-03-05T16_23_12.snapshot', None, None, debug=False)
+        assert self.mock_discard_function.call_args_list[1] == mock.call(
+            '2015-03-05T16_24_15.snapshot', None, None, debug=False)
 
         assert self.mock_rsync_function.call_count == 3
 
@@ -773,9 +2569,9 @@ class TestRemovingOldSnapshots(object):
         self.mock_rsync_function.side_effect = snapshotter.CalledProcessError(
             "rsync ...", "error", 23)
 
-        def rm(*args, **kwargs):
+        def discard(*args, **kwargs):
             snapshots.pop(0)
-        self.mock_rm_function.side_effect = rm
+        self.mock_discard_function.side_effect = discard
 
         nose.tools.assert_raises(
             snapshotter.CalledProcessError,
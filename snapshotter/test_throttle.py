@@ -0,0 +1,235 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import io
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+
+import mock
+
+from snapshotter import throttle
+
+
+def _write(path, text):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with io.open(path, "w") as file_:
+        file_.write(text)
+
+
+class TestMeasurements(object):
+
+    """Tests for reading the pressure, load and disk stats from /proc."""
+
+    def setup(self):
+        self.proc = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.proc)
+
+    def test_pressure(self):
+        _write(os.path.join(self.proc, "pressure", "io"),
+               "some avg10=12.50 avg60=3.00 avg300=1.00 total=1234\n"
+               "full avg10=8.00 avg60=2.00 avg300=0.50 total=567\n")
+
+        assert throttle.pressure("io", self.proc) == 12.5
+        assert throttle.pressure("cpu", self.proc) is None
+
+    def test_load_pressure(self):
+        _write(os.path.join(self.proc, "loadavg"),
+               "6.00 2.00 1.00 3/200 12345\n")
+
+        assert throttle.load_pressure(self.proc, cpus=4) == 50.0
+        assert throttle.load_pressure(self.proc, cpus=8) == 0.0
+        assert throttle.load_pressure(self.directory_without_proc(),
+                                      cpus=4) is None
+
+    def directory_without_proc(self):
+        return os.path.join(self.proc, "missing")
+
+    @mock.patch("snapshotter.throttle.time.time")
+    def test_disk_stats(self, mock_time):
+        path = os.path.join(self.proc, "diskstats")
+        line = "   8       1 sda1 10 0 {0} 0 20 0 {1} 0 0 {2} 0\n"
+        _write(path, "   8       0 sda 1 0 1 0 1 0 1 0 0 1 0\n" +
+               line.format(100, 100, 1000))
+        mock_time.return_value = 100.0
+        stats = throttle.DiskStats((8, 1), self.proc)
+        _write(path, line.format(1100, 1100, 1500))
+        mock_time.return_value = 102.0
+
+        assert stats.sample() == (25.0, 512 * 2000 / 2.0)
+        assert throttle.DiskStats((9, 0), self.proc).sample() is None
+
+
+class TestAdjust(object):
+
+    """Tests for the adjust() function."""
+
+    def test_it_halves_the_rate_above_the_target(self):
+        assert throttle.adjust(1.0, 20.0, 10.0) == 0.5
+        assert throttle.adjust(0.06, 20.0, 10.0) == throttle.MIN_RATE
+
+    def test_it_raises_the_rate_below_the_target(self):
+        assert abs(throttle.adjust(0.5, 5.0, 10.0) - 0.6) < 1e-9
+        assert throttle.adjust(0.95, 5.0, 10.0) == 1.0
+
+    def test_unknown_pressure(self):
+        assert throttle.adjust(0.5, None, 10.0) == 0.5
+
+
+class TestThrottle(object):
+
+    """Tests for the Throttle class."""
+
+    def setup(self):
+        self.proc = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.proc)
+
+    def test_measure_prefers_pressure_stall_information(self):
+        _write(os.path.join(self.proc, "loadavg"), "90.0 1 1 1/1 1\n")
+        throttle_ = throttle.Throttle(10, proc=self.proc)
+
+        assert throttle_.measure() > 100
+
+        _write(os.path.join(self.proc, "pressure", "io"),
+               "some avg10=3.00 avg60=0 avg300=0 total=0\n")
+        _write(os.path.join(self.proc, "pressure", "cpu"),
+               "some avg10=7.00 avg60=0 avg300=0 total=0\n")
+
+        assert throttle_.measure() == 7.0
+
+    def test_command(self):
+        command = throttle.Throttle(10, proc=self.proc).command(
+            ["rsync", "src", "dest"])
+
+        assert command[:3] == ["nice", "-n", "10"]
+        assert command[-3:] == ["rsync", "src", "dest"]
+
+    def test_it_pauses_processes_under_pressure(self):
+        _write(os.path.join(self.proc, "pressure", "io"),
+               "some avg10=50.00 avg60=0 avg300=0 total=0\n")
+        throttle_ = throttle.Throttle(10, interval=0.05, proc=self.proc)
+
+        with mock.patch("snapshotter.throttle.os.killpg") as mock_kill:
+            with throttle_:
+                throttle_.add(1234)
+                time.sleep(0.3)
+            stopped = mock_kill.call_count
+
+        assert throttle_.rate < 0.5
+        assert mock.call(1234, signal.SIGSTOP) in mock_kill.call_args_list
+        assert mock_kill.call_args_list[-1] == mock.call(1234, signal.SIGCONT)
+        assert stopped % 2 == 0
+
+    def test_a_real_process_is_resumed(self):
+        _write(os.path.join(self.proc, "pressure", "io"),
+               "some avg10=50.00 avg60=0 avg300=0 total=0\n")
+        process = subprocess.Popen(["sleep", "0.2"],
+                                   **throttle.new_process_group())
+        throttle_ = throttle.Throttle(10, interval=0.05, proc=self.proc)
+
+        with throttle_:
+            throttle_.add(process.pid)
+            time.sleep(0.2)
+
+        assert process.wait() == 0
+
+    def test_children_are_paused_too(self):
+        process = subprocess.Popen(
+            ["sh", "-c", "sleep 5 & echo $!; wait"], stdout=subprocess.PIPE,
+            **throttle.new_process_group())
+        child = int(process.stdout.readline())
+        throttle_ = throttle.Throttle(10, proc=self.proc)
+        throttle_.add(process.pid)
+
+        def state():
+            with io.open("/proc/{0}/stat".format(child)) as file_:
+                return file_.read().rsplit(")", 1)[1].split()[0]
+
+        try:
+            throttle_._signal(signal.SIGSTOP)
+            for _ in range(100):
+                if state() == "T":
+                    break
+                time.sleep(0.01)
+            assert state() == "T"
+            throttle_._signal(signal.SIGCONT)
+        finally:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.stdout.close()
+            process.wait()
+
+    def test_command_joins_the_cgroup(self):
+        cgroup = os.path.join(self.proc, "cgroup")
+        os.makedirs(cgroup)
+        throttle_ = throttle.Throttle(10, cgroup=cgroup, proc=self.proc)
+
+        output = subprocess.check_output(
+            throttle_.command(["sh", "-c", "echo $$"]))
+
+        with io.open(os.path.join(cgroup, "cgroup.procs")) as file_:
+            assert file_.read().strip() == output.decode("ascii").strip()
+
+    def test_cgroup_limits(self):
+        cgroup = os.path.join(self.proc, "cgroup")
+        os.makedirs(cgroup)
+        throttle_ = throttle.Throttle(10, cgroup=cgroup, proc=self.proc)
+        throttle_._disk_io_max = (8, 0)
+        throttle_.peak = 200 * 1024 ** 2
+        throttle_.add(1234)
+        throttle_.rate = 0.25
+
+        throttle_._set_limits()
+
+        with io.open(os.path.join(cgroup, "cgroup.procs")) as file_:
+            assert file_.read() == "1234"
+        with io.open(os.path.join(cgroup, "io.max")) as file_:
+            assert file_.read() == "8:0 rbps={0} wbps={0}".format(
+                50 * 1024 ** 2)
+        with io.open(os.path.join(cgroup, "cpu.max")) as file_:
+            assert file_.read().endswith(" 100000")
+
+        throttle_.stop()
+
+        with io.open(os.path.join(cgroup, "cpu.max")) as file_:
+            assert file_.read() == "max 100000"
+
+    def test_it_falls_back_to_pausing_without_the_cgroup(self):
+        throttle_ = throttle.Throttle(
+            10, cgroup=os.path.join(self.proc, "missing"), proc=self.proc)
+
+        throttle_.add(1234)
+
+        assert throttle_.cgroup is None
+
+    @mock.patch("snapshotter.throttle.time.sleep")
+    def test_pace(self, mock_sleep):
+        throttle_ = throttle.Throttle(10, interval=10, proc=self.proc)
+        throttle_.pace()
+        throttle_.rate = 0.25
+        later = time.time() + 1
+
+        with mock.patch("snapshotter.throttle.time.time") as mock_time:
+            mock_time.return_value = later
+            throttle_.pace()
+
+        assert 2.9 < mock_sleep.call_args[0][0] < 3.1
+
+
+class TestApplying(object):
+
+    def test_it_applies_to_the_current_thread(self):
+        throttle_ = throttle.Throttle(10)
+
+        with throttle.applying(throttle_):
+            assert throttle.current() is throttle_
+
+        assert throttle.current() is None
@@ -0,0 +1,93 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from snapshotter import integrity
+from snapshotter import treediff
+
+
+class TestDiff(object):
+
+    """Tests for comparing snapshots."""
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _snapshots(self):
+        """Make three snapshots that share most of their files."""
+        names = ["one", "two", "three"]
+        for name in names:
+            os.mkdir(os.path.join(self.directory, name))
+        for i in range(4):
+            path = os.path.join(self.directory, "one", "shared%d" % i)
+            with open(path, "wb") as file_:
+                file_.write(os.urandom(1000))
+            for name in ("two", "three"):
+                os.link(path, os.path.join(self.directory, name,
+                                           "shared%d" % i))
+        with open(os.path.join(self.directory, "three", "new"), "wb") as file_:
+            file_.write(b"new")
+        return names
+
+    def test_diff(self):
+        self._snapshots()
+        one = os.path.join(self.directory, "one")
+        three = os.path.join(self.directory, "three")
+        os.unlink(os.path.join(three, "shared0"))
+        # Same size and modification time, different contents.
+        with open(os.path.join(three, "shared1"), "rb") as file_:
+            data = file_.read()
+        stat = os.stat(os.path.join(three, "shared1"))
+        os.unlink(os.path.join(three, "shared1"))
+        with open(os.path.join(three, "shared1"), "wb") as file_:
+            file_.write(b"x" + data[1:])
+        os.utime(os.path.join(three, "shared1"), (stat.st_atime,
+                                                  stat.st_mtime))
+        os.unlink(os.path.join(three, "shared2"))
+        os.mkdir(os.path.join(three, "shared2"))
+        open(os.path.join(three, "shared2", "file"), "w").close()
+        os.chmod(os.path.join(three, "shared3"), 0o600)
+
+        result = treediff.diff(one, three, threads=2)
+
+        assert result["changes"] == [
+            [treediff.ADDED, "new"],
+            [treediff.DELETED, "shared0"],
+            [treediff.DELETED, "shared2"],
+            [treediff.ADDED, "shared2"],
+            [treediff.ADDED, os.path.join("shared2", "file")],
+        ]
+        # shared3 is still a hard link, so its permissions changed in one too.
+        assert (result["shared"], result["compared"]) == (1, 2)
+
+        with mock.patch("snapshotter.integrity.file_hash",
+                        side_effect=integrity.file_hash) as mock_file_hash:
+            result = treediff.diff(one, three, checksum=True)
+
+        assert [treediff.MODIFIED, "shared1"] in result["changes"]
+        assert mock_file_hash.call_count == 2
+
+    def test_diff_metadata(self):
+        for name in ("one", "two"):
+            os.makedirs(os.path.join(self.directory, name, "dir"))
+            with open(os.path.join(self.directory, name, "file"), "w") as f:
+                f.write("same")
+            os.utime(os.path.join(self.directory, name, "file"), (0, 0))
+        os.chmod(os.path.join(self.directory, "two", "file"), 0o600)
+        os.symlink("a", os.path.join(self.directory, "one", "link"))
+        os.symlink("b", os.path.join(self.directory, "two", "link"))
+
+        result = treediff.diff(os.path.join(self.directory, "one"),
+                            os.path.join(self.directory, "two"))
+
+        assert result["changes"] == [[treediff.METADATA, "file"],
+                                     [treediff.MODIFIED, "link"]]
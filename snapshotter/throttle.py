@@ -0,0 +1,412 @@
+"""Adaptive throttling of snapshots on busy hosts.
+
+A full-speed rsync can slow down everything else on the host it reads from,
+for example a database. A Throttle runs rsync at low CPU and I/O priority
+(nice and, if it's installed, ionice) and adjusts how fast it may go with a
+feedback loop: every interval it measures the pressure on the host and
+halves the rate if it's above the target, or else raises it a little
+(additive increase, multiplicative decrease).
+
+The pressure is Linux's pressure stall information (/proc/pressure/io and
+/proc/pressure/cpu): the percentage of the last 10 seconds in which some
+tasks were stalled waiting for I/O or CPU. On kernels without PSI it's
+estimated from the utilisation of the source's disk (/proc/diskstats) and
+the runnable tasks in excess of the CPUs (/proc/loadavg).
+
+The rate is applied by pausing the throttled processes (SIGSTOP/SIGCONT)
+for part of each interval or, if a delegated cgroup v2 directory is given,
+by starting them in it and setting its cpu.max and io.max limits. Either way
+the limits cover the processes' children too: the processes are started in
+process groups of their own, which are paused as a whole, and join the
+cgroup before they exec, so their children start in it as well. Work done
+in this process, like deleting old snapshots (see reaper), is throttled by
+calling pace() between units of work. Only the local host is measured and
+only local processes are throttled.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import contextlib
+import io
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+
+#: How often, in seconds, the pressure is measured and the rate adjusted.
+INTERVAL = 2
+
+#: The lowest rate: throttled work always gets this fraction of the time.
+MIN_RATE = 0.05
+
+#: How much the rate is raised each interval the pressure is below target.
+INCREASE = 0.1
+
+#: The cpu.max period, in microseconds.
+CPU_PERIOD = 100000
+
+_current = threading.local()
+
+
+def pressure(resource, proc="/proc"):
+    """Return the PSI "some avg10" of resource ("io", "cpu" or "memory").
+
+    That's the percentage of the last 10 seconds in which some tasks were
+    stalled waiting for the resource. Returns None if the kernel doesn't
+    report pressure stall information.
+
+    """
+    try:
+        with io.open(os.path.join(proc, "pressure", resource)) as file_:
+            for line in file_:
+                fields = line.split()
+                if fields and fields[0] == "some":
+                    values = dict(field.split("=", 1)
+                                  for field in fields[1:])
+                    return float(values["avg10"])
+    except (EnvironmentError, KeyError, ValueError):
+        pass
+    return None
+
+
+def load_pressure(proc="/proc", cpus=None):
+    """Return the runnable tasks in excess of the CPUs, as a % of the CPUs.
+
+    This is a rough stand-in for the CPU pressure, from the 1-minute load
+    average. Returns None if /proc/loadavg can't be read.
+
+    """
+    cpus = cpus or multiprocessing.cpu_count()
+    try:
+        with io.open(os.path.join(proc, "loadavg")) as file_:
+            load = float(file_.read().split()[0])
+    except (EnvironmentError, IndexError, ValueError):
+        return None
+    return 100.0 * max(0.0, load - cpus) / cpus
+
+
+def device_of(path):
+    """Return (major, minor) of the device that path, or its parent, is on."""
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    device = os.stat(path).st_dev
+    return os.major(device), os.minor(device)
+
+
+def whole_disk(device, sys="/sys"):
+    """Return (major, minor) of the disk that the partition device is on.
+
+    cgroup io.max limits can only be set on whole disks. Returns device
+    itself if it isn't a partition.
+
+    """
+    path = os.path.join(sys, "dev", "block", "{0}:{1}".format(*device))
+    if not os.path.exists(os.path.join(path, "partition")):
+        return device
+    try:
+        with io.open(os.path.join(os.path.realpath(path), os.pardir,
+                                  "dev")) as file_:
+            major, minor = file_.read().strip().split(":")
+    except (EnvironmentError, ValueError):
+        return device
+    return int(major), int(minor)
+
+
+class DiskStats(object):
+
+    """Samples the utilisation and throughput of a block device.
+
+    Each call to sample() returns the figures since the previous call, from
+    the device's line in /proc/diskstats.
+
+    """
+
+    def __init__(self, device, proc="/proc"):
+        self.device = device
+        self.path = os.path.join(proc, "diskstats")
+        self._last = self._read()
+
+    def _read(self):
+        """Return (time, ms spent doing I/O, sectors read and written)."""
+        try:
+            with io.open(self.path) as file_:
+                for line in file_:
+                    fields = line.split()
+                    if (int(fields[0]), int(fields[1])) == self.device:
+                        return (time.time(), int(fields[12]),
+                                int(fields[5]) + int(fields[9]))
+        except (EnvironmentError, IndexError, ValueError):
+            pass
+        return None
+
+    def sample(self):
+        """Return (utilisation %, bytes per second), or None if unknown."""
+        last, self._last = self._last, self._read()
+        if last is None or self._last is None or self._last[0] <= last[0]:
+            return None
+        seconds = self._last[0] - last[0]
+        busy = (self._last[1] - last[1]) / 1000.0
+        sectors = self._last[2] - last[2]
+        return min(100.0, 100.0 * busy / seconds), 512 * sectors / seconds
+
+
+def adjust(rate, pressure_, target, minimum=MIN_RATE, increase=INCREASE):
+    """Return the new rate given the latest pressure measurement.
+
+    Halve the rate if the pressure is above target, otherwise raise it by
+    increase, up to 1 (full speed). The rate stays the same if the pressure
+    is unknown.
+
+    """
+    if pressure_ is None:
+        return rate
+    if pressure_ > target:
+        return max(minimum, rate / 2.0)
+    return min(1.0, rate + increase)
+
+
+def new_process_group():
+    """Return the Popen() keyword arguments for a new process group.
+
+    Processes to throttle must be started with these, see Throttle.add().
+
+    """
+    if sys.version_info >= (3, 2):
+        return {"start_new_session": True}
+    return {"preexec_fn": os.setsid}
+
+
+def _which(name):
+    """Return the path of the executable name in PATH, or None."""
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+class Throttle(object):
+
+    """Keeps the pressure on this host near a target by throttling work.
+
+    Start it (or use it as a context manager) to run the feedback loop in a
+    background thread, run the commands to throttle with command() and
+    new_process_group() and register their processes with add() and
+    remove(). The rate is 1 (full
+    speed) until the pressure goes above target.
+
+    :param target: the pressure to stay under, a percentage (see pressure())
+    :param path: a local path on the disk being read, whose utilisation is
+        measured if the kernel doesn't report pressure stall information and
+        whose throughput is limited with io.max
+    :param cgroup: the path of a cgroup v2 directory that this user can
+        write to (for example one delegated by systemd), to throttle
+        processes with cpu.max and io.max limits instead of pausing them
+
+    """
+
+    def __init__(self, target, path=None, interval=INTERVAL, cgroup=None,
+                 proc="/proc", sys="/sys"):
+        self.target = target
+        self.interval = interval
+        self.cgroup = cgroup
+        self.proc = proc
+        self.rate = 1.0
+        self.device = device_of(path) if path else None
+        self._disk = DiskStats(self.device, proc) if self.device else None
+        self._disk_io_max = (whole_disk(self.device, sys) if self.device
+                             else None)
+        #: The highest throughput of the disk seen so far, in bytes/second.
+        self.peak = 0
+        self._pids = set()
+        self._paused = False
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._paces = threading.local()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Start adjusting the rate in a background thread."""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop throttling and let the throttled processes run at full speed.
+
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._resume()
+        if self.cgroup and self.rate < 1:
+            self.rate = 1.0
+            self._set_limits()
+
+    def command(self, command):
+        """Return command prefixed to run at low CPU and I/O priority.
+
+        With a cgroup the command also moves itself into the cgroup before
+        it starts, so that none of its children are left outside it.
+
+        """
+        prefix = ["nice", "-n", "10"]
+        if _which("ionice"):
+            prefix.extend(["ionice", "-c", "2", "-n", "7"])
+        if self.cgroup:
+            # If this fails, so does add(), which then gives up the cgroup.
+            prefix = ["sh", "-c", 'echo $$ > "$0" 2>/dev/null; exec "$@"',
+                      os.path.join(self.cgroup, "cgroup.procs")] + prefix
+        return prefix + list(command)
+
+    def add(self, pid):
+        """Throttle the process pid (until remove() is called).
+
+        pid must lead a process group of its own (see new_process_group()),
+        as the whole group is paused.
+
+        """
+        with self._lock:
+            self._pids.add(pid)
+        if self.cgroup:
+            try:
+                self._write("cgroup.procs", "{0}".format(pid))
+            except EnvironmentError as err:
+                self._give_up_cgroup(err)
+
+    def remove(self, pid):
+        """Stop throttling the process pid."""
+        with self._lock:
+            self._pids.discard(pid)
+
+    def pace(self):
+        """Throttle work done by the calling thread.
+
+        Call this between units of work: it sleeps for long enough that the
+        thread only works for the current rate's fraction of the time since
+        its previous call.
+
+        """
+        now = time.time()
+        last = getattr(self._paces, "last", None)
+        rate = self.rate
+        if last is not None and rate < 1 and not self._stopping.is_set():
+            time.sleep(min(self.interval, (now - last) * (1 - rate) / rate))
+        self._paces.last = time.time()
+
+    def measure(self):
+        """Return the pressure on the host now, or None if it's unknown."""
+        disk = self._disk.sample() if self._disk else None
+        if disk is not None:
+            self.peak = max(self.peak, disk[1])
+        stalls = [value for value in (pressure("io", self.proc),
+                                      pressure("cpu", self.proc))
+                  if value is not None]
+        if stalls:
+            return max(stalls)
+        estimates = [value for value in (disk and disk[0],
+                                         load_pressure(self.proc))
+                     if value is not None]
+        return max(estimates) if estimates else None
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            pressure_ = self.measure()
+            rate = adjust(self.rate, pressure_, self.target)
+            if rate != self.rate:
+                logging.getLogger("snapshotter.throttle").debug(
+                    "Pressure {pressure:.1f}%, rate {rate:.2f}".format(
+                        pressure=pressure_, rate=rate))
+            self.rate = rate
+            if self.cgroup:
+                self._set_limits()
+                self._stopping.wait(self.interval)
+            else:
+                self._duty_cycle()
+
+    def _duty_cycle(self):
+        """Pause the processes for (1 - rate) of the next interval."""
+        if self._stopping.wait(self.interval * self.rate):
+            return
+        if self.rate < 1:
+            self._signal(signal.SIGSTOP)
+            self._paused = True
+            self._stopping.wait(self.interval * (1 - self.rate))
+            self._resume()
+
+    def _resume(self):
+        if self._paused:
+            self._signal(signal.SIGCONT)
+            self._paused = False
+
+    def _signal(self, signum):
+        with self._lock:
+            pids = list(self._pids)
+        for pid in pids:
+            try:
+                os.killpg(pid, signum)
+            except OSError:
+                # The processes have already exited.
+                pass
+
+    def _write(self, name, value):
+        with io.open(os.path.join(self.cgroup, name), "w") as file_:
+            file_.write(value)
+
+    def _set_limits(self):
+        """Set the cgroup's cpu.max and io.max limits from the rate."""
+        if self.rate >= 1:
+            cpu, bps = "max", "max"
+        else:
+            cpu = "{0}".format(max(1000, int(
+                self.rate * multiprocessing.cpu_count() * CPU_PERIOD)))
+            bps = "{0}".format(max(1024 ** 2, int(self.rate * self.peak)))
+        try:
+            self._write("cpu.max", "{0} {1}".format(cpu, CPU_PERIOD))
+            if self._disk_io_max and (self.peak or bps == "max"):
+                self._write("io.max", "{0}:{1} rbps={2} wbps={2}".format(
+                    self._disk_io_max[0], self._disk_io_max[1], bps))
+        except EnvironmentError as err:
+            self._give_up_cgroup(err)
+
+    def _give_up_cgroup(self, err):
+        """Fall back to pausing the processes if the cgroup can't be used."""
+        if self.cgroup:
+            logging.getLogger("snapshotter").warning(
+                "Can't throttle with the cgroup {cgroup}, pausing processes "
+                "instead: {err}".format(cgroup=self.cgroup, err=err))
+            self.cgroup = None
+
+
+def current():
+    """Return the Throttle applying to this thread, or None."""
+    return getattr(_current, "throttle", None)
+
+
+@contextlib.contextmanager
+def applying(throttle):
+    """Throttle the work done in the with block with throttle (or None)."""
+    previous = current()
+    _current.throttle = throttle
+    try:
+        yield throttle
+    finally:
+        _current.throttle = previous
@@ -0,0 +1,174 @@
+"""Comparing two snapshots, skipping the files that are hard links.
+
+See diff(), which `snapshotter diff` runs on the host that the snapshots are
+on, through the helper agent for remote ones. So apart from integrity this
+module only imports from the standard library.
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import stat as stat_module
+from multiprocessing.pool import ThreadPool
+
+from snapshotter import integrity
+
+
+#: The kinds of changes that diff() reports.
+ADDED = "added"
+DELETED = "deleted"
+MODIFIED = "modified"
+METADATA = "metadata"
+
+
+class _Entry(object):
+
+    """A stand-in for os.DirEntry on Pythons without os.scandir()."""
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def stat(self, follow_symlinks=False):
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
+
+    def inode(self):
+        return self.stat().st_ino
+
+    def is_dir(self, follow_symlinks=False):
+        return stat_module.S_ISDIR(self.stat().st_mode)
+
+
+def _scandir(path):
+    """Return {name: entry} of the directory path's entries.
+
+    With os.scandir() the inodes and types of the entries come from the
+    directory listing itself, without a stat() per entry.
+
+    """
+    if hasattr(os, "scandir"):
+        return dict((entry.name, entry) for entry in os.scandir(path))
+    return dict((name, _Entry(path, name)) for name in os.listdir(path))
+
+
+def _tree(path, relative):
+    """Return the paths of everything in the tree at path, as relative."""
+    paths = [relative]
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                paths.append(os.path.join(
+                    relative, os.path.relpath(os.path.join(root, name),
+                                              path)))
+    return paths
+
+
+def _compare(old, new, checksum):
+    """Return the change from the entry old to the entry new, or None.
+
+    The two aren't the same inode, so they're compared by type, size,
+    modification time and, if checksum is True, contents.
+
+    """
+    old_stat = old.stat(follow_symlinks=False)
+    new_stat = new.stat(follow_symlinks=False)
+    if stat_module.S_ISREG(new_stat.st_mode):
+        if (old_stat.st_size != new_stat.st_size or
+                old_stat.st_mtime != new_stat.st_mtime):
+            return MODIFIED
+        if checksum and (integrity.file_hash(old.path) !=
+                         integrity.file_hash(new.path)):
+            return MODIFIED
+    elif stat_module.S_ISLNK(new_stat.st_mode):
+        if os.readlink(old.path) != os.readlink(new.path):
+            return MODIFIED
+    elif not stat_module.S_ISDIR(new_stat.st_mode):
+        if old_stat.st_rdev != new_stat.st_rdev:
+            return MODIFIED
+    if (old_stat.st_mode, old_stat.st_uid, old_stat.st_gid) != (
+            new_stat.st_mode, new_stat.st_uid, new_stat.st_gid):
+        return METADATA
+    return None
+
+
+def diff(old, new, checksum=False, threads=8):
+    """Return the changes from the snapshot directory old to new.
+
+    The two trees are walked in parallel, a level of directories at a time
+    with the given number of threads. Files that are the same inode in both
+    (as unchanged files in snapshots are hard links to each other) are
+    unchanged, without even a stat(). Other files are compared by type, size
+    and modification time and, if checksum is True, by the SHA-256 of their
+    contents, see _compare().
+
+    Returns {"changes": [[change, path], ...], "shared": ..., "compared":
+    ...} where the changes (ADDED, DELETED, MODIFIED or METADATA) are sorted
+    by path, shared is the number of paths found to be the same inode and
+    compared the number of other paths in both trees that were compared.
+    Something that changed type is reported as deleted and added.
+
+    """
+    same_device = os.stat(old).st_dev == os.stat(new).st_dev
+
+    def compare_directory(relative):
+        old_entries = _scandir(os.path.join(old, relative))
+        new_entries = _scandir(os.path.join(new, relative))
+        changes, directories = [], []
+        shared = compared = 0
+        for name in set(old_entries) - set(new_entries):
+            changes.extend([DELETED, path] for path in _tree(
+                old_entries[name].path, os.path.join(relative, name)))
+        for name in set(new_entries) - set(old_entries):
+            changes.extend([ADDED, path] for path in _tree(
+                new_entries[name].path, os.path.join(relative, name)))
+        for name in set(old_entries) & set(new_entries):
+            old_entry, new_entry = old_entries[name], new_entries[name]
+            path = os.path.join(relative, name)
+            if same_device and old_entry.inode() == new_entry.inode():
+                shared += 1
+                continue
+            compared += 1
+            if stat_module.S_IFMT(old_entry.stat(
+                    follow_symlinks=False).st_mode) != stat_module.S_IFMT(
+                        new_entry.stat(follow_symlinks=False).st_mode):
+                changes.extend([DELETED, p] for p in _tree(
+                    old_entry.path, path))
+                changes.extend([ADDED, p] for p in _tree(
+                    new_entry.path, path))
+                continue
+            change = _compare(old_entry, new_entry, checksum)
+            if change is not None:
+                changes.append([change, path])
+            if new_entry.is_dir(follow_symlinks=False):
+                directories.append(path)
+        return changes, directories, shared, compared
+
+    result = {"changes": [], "shared": 0, "compared": 0}
+    pool = ThreadPool(max(1, threads))
+    try:
+        level = [""]
+        while level:
+            next_level = []
+            for changes, directories, shared, compared in pool.map(
+                    compare_directory, level):
+                result["changes"].extend(changes)
+                result["shared"] += shared
+                result["compared"] += compared
+                next_level.extend(directories)
+            level = next_level
+    finally:
+        pool.close()
+        pool.join()
+    result["changes"].sort(key=lambda change: change[1])
+    return result
+
+
+#: The operations that this module adds to the agent.
+OPS = {
+    "diff": diff,
+}